@@ -0,0 +1,398 @@
+# Threshold alert rules evaluated over the telemetry stream
+#
+# Rules are one comparison on one signal, optionally held for a duration:
+#
+#   abs(roll) > 30 for 5s          tilted more than 30 degrees for 5 s
+#   pitch <= -20 for 500ms
+#   abs(rate(yaw)) > 90            turning faster than 90 degrees/s
+#   temperature > 60 for 1min
+#
+# A signal is a field (roll, pitch, yaw, temperature), rate(field) in units
+# per second from the board's millis() timestamps (angle differences wrap at
+# +-180), and abs() of either; readings without a board timestamp are left
+# out of rate rules. A rule applies to every device or to the ones it lists.
+# An alert fires on the first reading that finds the condition true
+# continuously for the hold time (by ingest wall time) and resolves on the
+# first reading that finds it false; both are reported once, as Alerts.
+#
+# AlertEngine compiles the rules into flat arrays: one state slot (the time
+# the condition became true, and whether it fires) per device-rule pair, the
+# pairs of a device stored contiguously, so a reading only touches the pairs
+# of its own device. A batch is evaluated as a whole: every reading expanded
+# to its device's pairs, the conditions of all of them computed at once, and
+# the per-pair sequences resolved with running maxima instead of a loop, so
+# the cost per batch is a few numpy passes over its reading-rule rows.
+#
+# AlertSink plugs the engine into ingest_server.IngestServer; live_stream.py
+# --rules sends the alerts to the dashboard.
+#
+#   python alert_rules.py                             10k devices x 10 rules at 10 Hz
+#   python alert_rules.py --devices 1000 --rules 100 --rate 1
+
+import argparse
+import json
+import re
+from collections import namedtuple
+
+import numpy as np
+
+FIELDS = ("roll", "pitch", "yaw", "temperature")
+ANGLE_FIELDS = ("roll", "pitch", "yaw")
+UNITS_MS = {"ms": 1, "s": 1000, "min": 60_000}
+
+# field, rate and absolute describe the signal; hold_ms is 0 without "for"
+Rule = namedtuple("Rule", ["name", "field", "rate", "absolute", "op", "threshold", "hold_ms",
+                           "devices"])
+# state is "firing" or "resolved"; timestamp is the reading's ingest time, ms
+Alert = namedtuple("Alert", ["rule", "device", "state", "timestamp", "value"])
+
+_RULE = re.compile(r"\s*(?P<signal>[\w()\s]+?)\s*(?P<op>[<>]=?)\s*(?P<threshold>[-+]?[\d.]+)"
+                   r"(?:\s+for\s+(?P<hold>[\d.]+)\s*(?P<unit>ms|s|min))?\s*$")
+_SIGNAL = re.compile(r"(?P<abs>abs\(\s*)?(?P<rate>rate\(\s*)?(?P<field>\w+)\s*"
+                     r"(?(rate)\)\s*)(?(abs)\))$")
+
+
+def parse_rule(name, text, devices=None):
+    match = _RULE.match(text)
+    signal = _SIGNAL.match(match.group("signal")) if match else None
+    if signal is None:
+        raise ValueError(f"cannot parse rule {name!r}: {text!r}")
+    if signal.group("field") not in FIELDS:
+        raise ValueError(f"rule {name!r}: unknown field {signal.group('field')!r}")
+    hold = match.group("hold")
+    return Rule(name, signal.group("field"), bool(signal.group("rate")),
+                bool(signal.group("abs")), match.group("op"), float(match.group("threshold")),
+                int(float(hold) * UNITS_MS[match.group("unit")]) if hold else 0,
+                None if devices is None else frozenset(devices))
+
+
+class AlertEngine:
+    def __init__(self, rules):
+        self.rules = list(rules)
+        if len({rule.name for rule in self.rules}) != len(self.rules):
+            raise ValueError("rule names must be unique")
+        # Distinct signals, each computed once per reading
+        self._signals = list(dict.fromkeys((r.field, r.rate, r.absolute) for r in self.rules))
+        self._rate_fields = list(dict.fromkeys(r.field for r in self.rules if r.rate))
+        # x < t is evaluated as -x > -t
+        sign = np.array([-1.0 if r.op[0] == "<" else 1.0 for r in self.rules])
+        self._rule_signal = np.array([self._signals.index((r.field, r.rate, r.absolute))
+                                      for r in self.rules], dtype=np.int64)
+        self._rule_rate = np.array([r.rate for r in self.rules], dtype=bool)
+        self._sign = sign
+        self._threshold = sign * np.array([r.threshold for r in self.rules])
+        self._strict = np.array([len(r.op) == 1 for r in self.rules])
+        self._hold = np.array([r.hold_ms for r in self.rules], dtype=np.int64)
+        # Index by rule: the rules every device gets, and the device-specific ones
+        self._global_rules = [i for i, r in enumerate(self.rules) if r.devices is None]
+        self._device_rules = {}
+        for i, rule in enumerate(self.rules):
+            for device in rule.devices or ():
+                self._device_rules.setdefault(device, []).append(i)
+
+        # Per device
+        self.devices = []
+        self._index = {}
+        self._pair_first = np.zeros(0, dtype=np.int64)
+        self._pair_count = np.zeros(0, dtype=np.int64)
+        self._last_ts = np.zeros(0, dtype=np.int64)
+        self._last_value = np.zeros((0, len(self._rate_fields)))
+        # Per device-rule pair: since is -1 while the condition is false
+        self._pair_rule = np.zeros(0, dtype=np.int64)
+        self._pair_device = np.zeros(0, dtype=np.int64)
+        self._since = np.zeros(0, dtype=np.int64)
+        self._firing = np.zeros(0, dtype=bool)
+
+    # Rules from a JSON list of {"name": ..., "when": ..., "devices": [...]}
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(parse_rule(entry["name"], entry["when"], entry.get("devices"))
+                       for entry in json.load(f))
+
+    @property
+    def pairs(self):
+        return len(self._pair_rule)
+
+    def _add_devices(self, names):
+        rules = [self._global_rules + self._device_rules.get(name, []) for name in names]
+        counts = np.array([len(r) for r in rules], dtype=np.int64)
+        first = self.pairs + np.cumsum(counts) - counts
+        base = len(self.devices)
+        for name in names:
+            self._index[name] = len(self.devices)
+            self.devices.append(name)
+        self._pair_first = np.concatenate([self._pair_first, first])
+        self._pair_count = np.concatenate([self._pair_count, counts])
+        self._last_ts = np.concatenate([self._last_ts, np.full(len(names), -1, dtype=np.int64)])
+        self._last_value = np.concatenate(
+            [self._last_value, np.full((len(names), len(self._rate_fields)), np.nan)])
+        total = int(counts.sum())
+        self._pair_rule = np.concatenate(
+            [self._pair_rule, np.array([i for r in rules for i in r], dtype=np.int64)])
+        self._pair_device = np.concatenate(
+            [self._pair_device, np.repeat(np.arange(base, base + len(names)), counts)])
+        self._since = np.concatenate([self._since, np.full(total, -1, dtype=np.int64)])
+        self._firing = np.concatenate([self._firing, np.zeros(total, dtype=bool)])
+
+    # Rate of each rate field per reading, against the device's previous
+    # reading with a timestamp (in this batch or carried over from the last
+    # one); NaN for readings without one
+    def _rates(self, dev, timestamps, values):
+        rates = {field: np.full(len(dev), np.nan) for field in self._rate_fields}
+        stamped = np.flatnonzero(timestamps >= 0)
+        if len(stamped) == 0:
+            return rates
+        order = stamped[np.argsort(dev[stamped], kind="stable")]
+        d = dev[order]
+        ts = timestamps[order]
+        first = np.r_[True, d[1:] != d[:-1]]
+        last = np.r_[d[1:] != d[:-1], True]
+        prev_ts = np.r_[0, ts[:-1]]
+        prev_ts[first] = self._last_ts[d[first]]
+        valid = (prev_ts >= 0) & (ts > prev_ts)
+        seconds = np.where(valid, ts - prev_ts, 1) / 1000
+        for k, field in enumerate(self._rate_fields):
+            v = values[field][order]
+            prev = np.r_[np.nan, v[:-1]]
+            prev[first] = self._last_value[d[first], k]
+            diff = v - prev
+            if field in ANGLE_FIELDS:
+                diff = (diff + 180) % 360 - 180
+            rates[field][order] = np.where(valid, diff / seconds, np.nan)
+            self._last_value[d[last], k] = v[last]
+        self._last_ts[d[last]] = ts[last]
+        return rates
+
+    # Evaluate one batch of readings in arrival order: devices (names),
+    # timestamps (board ms, for rates; negative when unknown), received (ingest ms, for hold times)
+    # and values (field -> array). Returns the Alerts it raised or resolved.
+    def evaluate(self, devices, timestamps, received, values):
+        n = len(devices)
+        if n == 0 or not self.rules:
+            return []
+        new = [name for name in dict.fromkeys(devices) if name not in self._index]
+        if new:
+            self._add_devices(new)
+        dev = np.fromiter((self._index[name] for name in devices), np.int64, n)
+        received = np.asarray(received, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = {field: np.asarray(values[field], dtype=np.float64)
+                  for field in {field for field, _, _ in self._signals}}
+        rates = self._rates(dev, timestamps, values) \
+            if self._rate_fields else {}
+        signals = np.empty((n, len(self._signals)))
+        for s, (field, rate, absolute) in enumerate(self._signals):
+            signals[:, s] = np.abs(rates[field] if rate else values[field]) if absolute \
+                else (rates[field] if rate else values[field])
+
+        # One row per (reading, pair of its device), grouped by pair in
+        # arrival order
+        counts = self._pair_count[dev]
+        total = int(counts.sum())
+        if total == 0:
+            return []
+        ends = np.cumsum(counts)
+        pair = np.repeat(self._pair_first[dev] - (ends - counts), counts) + np.arange(total)
+        record = np.repeat(np.arange(n), counts)
+        order = np.argsort(pair, kind="stable")
+        pair = pair[order]
+        record = record[order]
+        rule = self._pair_rule[pair]
+        if self._rate_fields:
+            # No board timestamp, no rate: rate rules skip the reading
+            keep = ~self._rule_rate[rule] | (timestamps[record] >= 0)
+            pair, record, rule = pair[keep], record[keep], rule[keep]
+            total = len(pair)
+            if total == 0:
+                return []
+        value = signals[record, self._rule_signal[rule]]
+        scaled = value * self._sign[rule]
+        cond = np.where(self._strict[rule], scaled > self._threshold[rule],
+                        scaled >= self._threshold[rule])
+        t = received[record]
+
+        # Start of each true run: the pair's carried-in time if the run
+        # continues from the last batch, else its first row's time
+        first = np.r_[True, pair[1:] != pair[:-1]]
+        last = np.r_[pair[1:] != pair[:-1], True]
+        run_start = cond & ~np.r_[False, cond[:-1]] | cond & first
+        start_row = np.maximum.accumulate(np.where(run_start, np.arange(total), 0))
+        carried = self._since[pair]
+        since = np.where(first[start_row] & (carried >= 0), carried, t[start_row])
+        since = np.where(cond, since, -1)
+        active = cond & (t - since >= self._hold[rule])
+        was_active = np.r_[False, active[:-1]]
+        was_active[first] = self._firing[pair[first]]
+        self._since[pair[last]] = since[last]
+        self._firing[pair[last]] = active[last]
+
+        # In arrival order
+        changed = np.flatnonzero(active != was_active)
+        changed = changed[np.lexsort((pair[changed], record[changed]))]
+        return [Alert(self.rules[rule[i]].name, devices[record[i]],
+                      "firing" if active[i] else "resolved", int(t[i]), float(value[i]))
+                for i in changed.tolist()]
+
+    # Batch of ingest_server TelemetryRecords
+    def evaluate_records(self, batch):
+        return self.evaluate([r.device for r in batch],
+                             [-1 if r.timestamp is None else r.timestamp for r in batch],
+                             [int(r.received * 1000) for r in batch],
+                             {field: [getattr(r, field) for r in batch] for field in FIELDS})
+
+    # (device, rule name) of every alert currently firing
+    def active(self):
+        return [(self.devices[self._pair_device[p]], self.rules[self._pair_rule[p]].name)
+                for p in np.flatnonzero(self._firing).tolist()]
+
+
+# Sink for ingest_server.IngestServer: evaluates each batch, hands any alerts
+# to notify, then passes the batch on to inner
+class AlertSink:
+    def __init__(self, engine, inner=None, notify=None):
+        self.engine = engine
+        self.inner = inner
+        self.notify = notify
+
+    def __call__(self, batch):
+        alerts = self.engine.evaluate_records(batch)
+        if alerts and self.notify is not None:
+            self.notify(alerts)
+        if self.inner is not None:
+            self.inner(batch)
+
+
+# Reading-by-reading evaluation of the same rules, for checking AlertEngine
+def _reference(rules, devices, timestamps, received, values):
+    alerts = []
+    since = {}
+    firing = {}
+    previous = {}
+    for i, device in enumerate(devices):
+        for field in {rule.field for rule in rules if rule.rate} if timestamps[i] >= 0 else ():
+            last = previous.get((device, field))
+            rate = np.nan
+            if last is not None and timestamps[i] > last[0]:
+                diff = values[field][i] - last[1]
+                if field in ANGLE_FIELDS:
+                    diff = (diff + 180) % 360 - 180
+                rate = diff / ((timestamps[i] - last[0]) / 1000)
+            previous[(device, field)] = (timestamps[i], values[field][i])
+            previous[(device, field, "rate")] = rate
+        for rule in rules:
+            if rule.devices is not None and device not in rule.devices:
+                continue
+            if rule.rate and timestamps[i] < 0:
+                continue
+            key = (device, rule.name)
+            value = previous[(device, rule.field, "rate")] if rule.rate else values[rule.field][i]
+            value = abs(value) if rule.absolute else value
+            cond = {">": value > rule.threshold, ">=": value >= rule.threshold,
+                    "<": value < rule.threshold, "<=": value <= rule.threshold}[rule.op]
+            since[key] = (since.get(key, -1) if since.get(key, -1) >= 0 else received[i]) \
+                if cond else -1
+            active = bool(cond and received[i] - since[key] >= rule.hold_ms)
+            if active != firing.get(key, False):
+                alerts.append(Alert(rule.name, device, "firing" if active else "resolved",
+                                    received[i], float(value)))
+            firing[key] = active
+    return alerts
+
+
+if __name__ == "__main__":
+    import time
+
+    from ingest_loadgen import percentile
+
+    parser = argparse.ArgumentParser(description="Alert rule engine benchmark")
+    parser.add_argument("--devices", type=int, default=10_000)
+    parser.add_argument("--rules", type=int, default=10, help="rules applying to every device")
+    parser.add_argument("--rate", type=float, default=10.0, help="readings per second per device")
+    parser.add_argument("--seconds", type=float, default=10.0, help="simulated time")
+    parser.add_argument("--flush-ms", type=int, default=50,
+                        help="ingest batch interval (IngestServer.flush_interval)")
+    args = parser.parse_args()
+
+    templates = ["abs(roll) > {0} for 5s", "abs(pitch) > {0} for 2s", "abs(rate(yaw)) > {1}",
+                 "roll < -{0}", "temperature >= 60 for 1min", "abs(rate(roll)) > {1} for 500ms",
+                 "pitch <= -{0} for 100ms", "yaw > 170", "abs(rate(pitch)) >= {1}",
+                 "abs(roll) > {0}"]
+    rules = [parse_rule(f"rule-{i}", templates[i % len(templates)].format(
+        20 + i % 40, 60 + i % 100)) for i in range(args.rules)]
+
+    # Random-walk orientation per device; a few start tilting and turning
+    def simulate(devices, rate, seconds, flush_ms, seed=0):
+        rng = np.random.default_rng(seed)
+        step = 1000 / rate
+        angles = rng.uniform(-10, 10, (devices, 3))
+        phase = rng.uniform(0, step, devices)
+        names = [f"device-{i}" for i in range(devices)]
+        for t in np.arange(0, seconds * 1000, flush_ms):
+            # Readings taken in [t, t + flush_ms)
+            k = np.floor((t + flush_ms - phase) / step) - np.floor((t - phase) / step)
+            idx = np.repeat(np.arange(devices), k.astype(np.int64))
+            if not len(idx):
+                continue
+            stamp = t + rng.uniform(0, flush_ms, len(idx))
+            order = np.argsort(stamp)
+            idx, stamp = idx[order], stamp[order].astype(np.int64)
+            angles[idx] += rng.normal(0, 2, (len(idx), 3))
+            angles[idx[:len(idx) // 50]] += 8
+            angles[:] = (angles + 180) % 360 - 180
+            yield ([names[i] for i in idx], stamp, stamp,
+                   {"roll": angles[idx, 0], "pitch": angles[idx, 1] / 2, "yaw": angles[idx, 2],
+                    "temperature": np.full(len(idx), 25.0)}, t + flush_ms)
+
+    # Same alerts as the reading-by-reading reference on a small fleet
+    engine = AlertEngine(rules + [parse_rule("only-3", "abs(roll) > 5 for 200ms", ["device-3"])])
+    got = []
+    stream = ([], [], [], {field: [] for field in FIELDS})
+    for devices, stamps, received, values, _ in simulate(50, 20, 20, 50, seed=1):
+        # Some readings arrive without a board timestamp
+        stamps = np.where(np.arange(len(stamps)) % 7 == 3, -1, stamps)
+        got += engine.evaluate(devices, stamps, received, values)
+        stream[0].extend(devices)
+        stream[1].extend(stamps.tolist())
+        stream[2].extend(received.tolist())
+        for field in FIELDS:
+            stream[3][field].extend(values[field].tolist())
+    expected = _reference(engine.rules, *stream)
+    assert len(got) == len(expected) and all(
+        a[:4] == b[:4] and (a.value == b.value or np.isclose(a.value, b.value))
+        for a, b in zip(got, expected)), "engine and reference disagree"
+    assert {a.device for a in got if a.rule == "only-3"} == {"device-3"}
+    print(f"{len(got)} alerts match the reading-by-reading reference")
+
+    # A record without a board timestamp only meets the non-rate rules
+    from ingest_server import TelemetryRecord
+
+    engine = AlertEngine([parse_rule("turn", "abs(rate(yaw)) > 1"),
+                          parse_rule("hot", "temperature > 60")])
+    engine.evaluate_records([TelemetryRecord("a", 1000, 0.0, 0.0, 0.0, 25.0, 1.0)])
+    raised = engine.evaluate_records([TelemetryRecord("a", None, 0.0, 0.0, 90.0, 70.0, 1.1)])
+    assert [(a.rule, a.state) for a in raised] == [("hot", "firing")]
+
+    engine = AlertEngine(rules)
+    batches = list(simulate(args.devices, args.rate, args.seconds, args.flush_ms))
+    elapsed = []
+    latencies = []
+    alerts = 0
+    for devices, stamps, received, values, flushed_at in batches:
+        began = time.perf_counter()
+        raised = engine.evaluate(devices, stamps, received, values)
+        cost = (time.perf_counter() - began) * 1000
+        elapsed.append(cost)
+        alerts += len(raised)
+        # Reading -> alert: waiting for the batch flush, then the evaluation
+        latencies += [flushed_at - alert.timestamp + cost for alert in raised]
+    readings = sum(len(batch[0]) for batch in batches)
+    print(f"{engine.pairs:,} device-rule pairs, {readings:,} readings "
+          f"({readings / args.seconds:,.0f}/s), {alerts:,} alert changes")
+    print(f"batch evaluation p50 {percentile(elapsed, 50):.1f} ms, "
+          f"p99 {percentile(elapsed, 99):.1f} ms every {args.flush_ms} ms: "
+          f"{readings * args.rules / (sum(elapsed) / 1000) / 1e6:.1f} M pair evaluations/s, "
+          f"{sum(elapsed) / 1000 / args.seconds:.0%} of one core")
+    print(f"alert latency p50 {percentile(latencies, 50):.0f} ms, "
+          f"max {max(latencies):.0f} ms after the reading")
+    assert max(latencies) < 100
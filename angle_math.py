@@ -0,0 +1,112 @@
+# Accuracy sweep for the --angle-math variants of the sketches' tilt math
+#
+# The reference is the formula the sketches have always used,
+#   roll  = atan(y / sqrt(x^2 + z^2)) * 180 / PI
+#   pitch = atan(-x / sqrt(y^2 + z^2)) * 180 / PI
+# evaluated in float64. 'fast' is the atan2f / float32 version and 'poly'
+# emulates polyAtan2() from sketch_features.py step by step in float32, so
+# the errors printed here are the ones the firmware will see.
+
+import numpy as np
+
+from sketch_features import ATAN_COEFFS, POLY_ATAN2_ERROR
+
+F32 = np.float32
+RAD_TO_DEG = F32(57.2957795)
+HALF_PI = F32(1.57079633)
+
+
+def exact_angles(x, y, z):
+    x, y, z = (np.asarray(v, dtype=np.float64) for v in (x, y, z))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        roll = np.degrees(np.arctan(y / np.sqrt(x ** 2 + z ** 2)))
+        pitch = np.degrees(np.arctan(-1 * x / np.sqrt(y ** 2 + z ** 2)))
+    return roll, pitch
+
+
+def fast_angles(x, y, z, atan2=np.arctan2):
+    x, y, z = (np.asarray(v, dtype=F32) for v in (x, y, z))
+    roll = atan2(y, np.sqrt(x * x + z * z)) * RAD_TO_DEG
+    pitch = atan2(-x, np.sqrt(y * y + z * z)) * RAD_TO_DEG
+    return roll, pitch
+
+
+# polyAtan2(y, x) in float32, same operation order as the C fragment
+def poly_atan2(y, x):
+    y = np.asarray(y, dtype=F32)
+    x = np.asarray(x, dtype=F32)
+    ax, ay = np.abs(x), np.abs(y)
+    hi = np.maximum(ax, ay)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = np.minimum(ax, ay) / hi
+    s = a * a
+    c0, c1, c2, c3, c4 = (F32(c) for c in ATAN_COEFFS)
+    r = ((((c4 * s + c3) * s + c2) * s + c1) * s + c0) * a
+    r = np.where(ay > ax, HALF_PI - r, r)
+    r = np.where(x < 0, F32(3.14159265) - r, r)
+    r = np.where(y < 0, -r, r)
+    return np.where(hi == 0, F32(0), r).astype(F32)
+
+
+def poly_angles(x, y, z):
+    return fast_angles(x, y, z, atan2=poly_atan2)
+
+
+ANGLE_MATH = {"fast": fast_angles, "poly": poly_angles}
+
+
+# Accelerometer readings covering every orientation: Fibonacci-sphere
+# directions at magnitudes from free fall to the sensor's 8 g range, plus the
+# axis-aligned cases where a denominator goes to zero
+def sweep_inputs(directions=200_000, magnitudes=(0.05, 0.5, 1.0, 2.0, 8.0), g=9.80665):
+    i = np.arange(directions) + 0.5
+    polar = np.arccos(1 - 2 * i / directions)
+    azimuth = np.pi * (1 + 5 ** 0.5) * i
+    unit = np.stack([np.cos(azimuth) * np.sin(polar),
+                     np.sin(azimuth) * np.sin(polar),
+                     np.cos(polar)], axis=1)
+    axes = np.concatenate([np.eye(3), -np.eye(3)])
+    unit = np.concatenate([unit, axes])
+    points = np.concatenate([unit * (m * g) for m in magnitudes])
+    return points[:, 0], points[:, 1], points[:, 2]
+
+
+# Max |error| in degrees per angle for one variant -> {angle: (error, reading)}.
+# Readings where the exact formula is 0/0 are left out.
+def angle_errors(variant, x, y, z):
+    reference = exact_angles(x, y, z)
+    result = ANGLE_MATH[variant](x, y, z)
+    report = {}
+    for name, ref, value in zip(("roll", "pitch"), reference, result):
+        defined = np.isfinite(ref)
+        error = np.abs(value[defined].astype(np.float64) - ref[defined])
+        worst = int(np.argmax(error))
+        report[name] = (float(error[worst]),
+                        tuple(float(v[defined][worst]) for v in (x, y, z)))
+    return report
+
+
+# Max |polyAtan2 - atan2| in degrees over the whole circle
+def poly_atan2_error(samples=1_000_001):
+    theta = np.linspace(-np.pi, np.pi, samples)
+    y, x = np.sin(theta).astype(F32), np.cos(theta).astype(F32)
+    exact = np.arctan2(y.astype(np.float64), x.astype(np.float64))
+    error = np.abs(poly_atan2(y, x) - exact)
+    error = np.minimum(error, 2 * np.pi - error)  # -pi and pi are the same angle
+    return float(np.degrees(error.max()))
+
+
+if __name__ == "__main__":
+    x, y, z = sweep_inputs()
+    print(f"{len(x)} accelerometer readings, max |error| against the exact formula:")
+    for variant in ANGLE_MATH:
+        report = angle_errors(variant, x, y, z)
+        for name in ("roll", "pitch"):
+            error, (px, py, pz) = report[name]
+            print(f"  {variant:4s} {name:5s} {error:.2e} deg "
+                  f"at ({px:7.2f}, {py:7.2f}, {pz:7.2f}) m/s^2")
+
+    error = poly_atan2_error()
+    print(f"polyAtan2 over the full circle: {error:.2e} deg "
+          f"(sketch comment states {POLY_ATAN2_ERROR} deg)")
+    assert error <= POLY_ATAN2_ERROR
@@ -1,5 +1,10 @@
 // IoT Position and Orientation Monitoring System
-// Real-time data simulation and visualization
+// Real-time visualization of the live stream from live_stream.py
+//
+// Query parameters: ?device=<name> picks the device (default ESP32-001),
+// ?stream=ws://host:port/live points at another stream server, ?api=<url>
+// at another chart API (chart_api.py; default: the page's own origin) and
+// ?demo replaces the stream with simulated data.
 
 class IoTDashboard {
     constructor() {
@@ -29,6 +34,26 @@ class IoTDashboard {
             totalSamples: 36000
         };
 
+        // Live stream connection; updates arriving between two render ticks
+        // are coalesced into the latest one
+        const params = new URLSearchParams(window.location.search);
+        this.deviceId = params.get('device') || 'ESP32-001';
+        this.demoMode = params.has('demo');
+        this.apiBase = params.get('api') || '';
+        this.chartRange = 'live';
+        this.alerts = new Set(); // Rules firing for this device
+        this.rangeSpans = { '5m': 300e3, '1h': 3600e3, '6h': 21600e3, '24h': 86400e3,
+                            '7d': 604800e3, '30d': 2592000e3 };
+        this.stream = {
+            url: params.get('stream') || `ws://${window.location.hostname || 'localhost'}:8765/live`,
+            socket: null,
+            retryDelay: 1000,
+            fresh: false,
+            lastUpdate: null,
+            lastMessageAt: 0,
+            messageCount: 0
+        };
+
         // Animation and timing
         this.updateInterval = null;
         this.chartUpdateInterval = null;
@@ -36,7 +61,7 @@ class IoTDashboard {
         
         // Chart data storage
         this.historicalData = {
-            labels: [],
+            time: [],
             roll: [],
             pitch: [],
             yaw: []
@@ -49,7 +74,10 @@ class IoTDashboard {
     init() {
         this.setupEventListeners();
         this.initializeChart();
-        this.startDataSimulation();
+        if (!this.demoMode) {
+            this.connectStream();
+        }
+        this.startRendering();
         this.updateTimestamp();
         this.updateSystemInfo();
         
@@ -82,19 +110,123 @@ class IoTDashboard {
         });
     }
 
-    startDataSimulation() {
+    startRendering() {
         if (this.updateInterval) {
             clearInterval(this.updateInterval);
         }
 
         this.updateInterval = setInterval(() => {
-            if (this.systemStatus.isMonitoring) {
+            if (!this.systemStatus.isMonitoring) {
+                return;
+            }
+            if (this.demoMode) {
                 this.generateRealisticsensorData();
-                this.updateUI();
-                this.update3DVisualization();
-                this.updateHistoricalData();
+            } else if (this.stream.fresh) {
+                this.stream.fresh = false;
+            } else {
+                return;
+            }
+            this.updateUI();
+            this.update3DVisualization();
+            this.updateHistoricalData();
+        }, 100); // Render at most 10 Hz, whatever the device rate
+    }
+
+    connectStream() {
+        const url = `${this.stream.url}?device=${encodeURIComponent(this.deviceId)}`;
+        const socket = new WebSocket(url);
+        this.stream.socket = socket;
+
+        socket.onopen = () => {
+            this.stream.retryDelay = 1000;
+            this.setStatus('connectionStatus', 'success', 'Live Stream Connected');
+        };
+
+        socket.onmessage = (event) => {
+            const update = JSON.parse(event.data);
+            if (update.device !== this.deviceId) {
+                return;
             }
-        }, 100); // 10 Hz update rate
+            if (update.alert) {
+                this.applyAlert(update);
+            } else {
+                this.applyUpdate(update);
+            }
+        };
+
+        // Reconnect with exponential backoff, capped at 30 s
+        socket.onclose = () => {
+            this.setStatus('connectionStatus', 'warning', 'Reconnecting...');
+            this.setStatus('dataStreamStatus', 'warning', 'Data Stream Paused');
+            setTimeout(() => this.connectStream(), this.stream.retryDelay);
+            this.stream.retryDelay = Math.min(this.stream.retryDelay * 2, 30000);
+        };
+    }
+
+    // Fused roll/pitch/yaw and temperature come from the device; the
+    // accelerometer bars show the gravity vector they imply and the gyro
+    // bars the angle rates between consecutive updates
+    applyUpdate(update) {
+        const previous = this.stream.lastUpdate;
+        ['roll', 'pitch', 'yaw', 'temperature'].forEach((field) => {
+            if (update[field] !== null) {
+                this.sensorData[field] = update[field];
+            }
+        });
+
+        const rollRad = this.sensorData.roll * Math.PI / 180;
+        const pitchRad = this.sensorData.pitch * Math.PI / 180;
+        this.sensorData.accelX = 9.81 * Math.sin(rollRad);
+        this.sensorData.accelY = 9.81 * Math.sin(pitchRad);
+        this.sensorData.accelZ = 9.81 * Math.cos(rollRad) * Math.cos(pitchRad);
+
+        if (previous && update.timestamp > previous.timestamp) {
+            const dt = (update.timestamp - previous.timestamp) / 1000;
+            this.sensorData.gyroX = this.angleDifference(update.roll, previous.roll) / dt;
+            this.sensorData.gyroY = this.angleDifference(update.pitch, previous.pitch) / dt;
+            this.sensorData.gyroZ = this.angleDifference(update.yaw, previous.yaw) / dt;
+        }
+
+        this.stream.lastUpdate = update;
+        this.stream.lastMessageAt = Date.now();
+        this.stream.messageCount += 1;
+        this.stream.fresh = true;
+        this.systemStatus.totalSamples += 1;
+    }
+
+    // current - previous in degrees, wrapped to [-180, 180) so crossing
+    // +-180 is a small step rather than a 360 degree jump
+    angleDifference(current, previous) {
+        return ((current - previous + 180) % 360 + 360) % 360 - 180;
+    }
+
+    // Alert state changes from the server's rules (alert_rules.py)
+    applyAlert(alert) {
+        if (alert.state === 'firing') {
+            this.alerts.add(alert.alert);
+            const value = alert.value === null ? 'n/a' : alert.value.toFixed(1);
+            this.showNotification(`Alert ${alert.alert}: ${value}`, 'error');
+        } else {
+            this.alerts.delete(alert.alert);
+            this.showNotification(`Alert ${alert.alert} resolved`, 'success');
+        }
+        this.updateDeviceStatus();
+    }
+
+    updateDeviceStatus() {
+        if (this.alerts.size) {
+            this.setStatus('deviceStatus', 'error', `Alert: ${[...this.alerts].join(', ')}`);
+            return;
+        }
+        const silent = Date.now() - this.stream.lastMessageAt > 5000;
+        this.setStatus('deviceStatus', silent ? 'warning' : 'success',
+            silent ? 'No Data' : 'Device Online');
+    }
+
+    setStatus(id, state, text) {
+        const element = document.getElementById(id);
+        element.querySelector('.status-dot').className = `status-dot status-dot--${state}`;
+        element.querySelector('.status-label').textContent = text;
     }
 
     generateRealisticsensorData() {
@@ -195,26 +327,23 @@ class IoTDashboard {
     }
 
     updateHistoricalData() {
-        const now = new Date();
-        const timeLabel = now.toLocaleTimeString();
-        
         // Add new data point
-        this.historicalData.labels.push(timeLabel);
+        this.historicalData.time.push(Date.now());
         this.historicalData.roll.push(this.sensorData.roll);
         this.historicalData.pitch.push(this.sensorData.pitch);
         this.historicalData.yaw.push(this.sensorData.yaw);
         
         // Keep only last 60 data points (6 seconds at 10Hz)
         const maxPoints = 60;
-        if (this.historicalData.labels.length > maxPoints) {
-            this.historicalData.labels.shift();
+        if (this.historicalData.time.length > maxPoints) {
+            this.historicalData.time.shift();
             this.historicalData.roll.shift();
             this.historicalData.pitch.shift();
             this.historicalData.yaw.shift();
         }
         
-        // Update chart every 10 data points
-        if (this.historicalData.labels.length % 10 === 0) {
+        // Update chart every 10 data points, unless it shows a stored range
+        if (this.chartRange === 'live' && this.historicalData.time.length % 10 === 0) {
             this.updateChart();
         }
     }
@@ -225,7 +354,6 @@ class IoTDashboard {
         this.chart = new Chart(ctx, {
             type: 'line',
             data: {
-                labels: [],
                 datasets: [{
                     label: 'Roll (°)',
                     data: [],
@@ -257,7 +385,8 @@ class IoTDashboard {
                 maintainAspectRatio: false,
                 interaction: {
                     intersect: false,
-                    mode: 'index'
+                    mode: 'nearest',
+                    axis: 'x'
                 },
                 plugins: {
                     legend: {
@@ -270,13 +399,15 @@ class IoTDashboard {
                 },
                 scales: {
                     x: {
+                        type: 'linear',
                         display: true,
                         title: {
                             display: true,
                             text: 'Time'
                         },
                         ticks: {
-                            maxTicksLimit: 10
+                            maxTicksLimit: 10,
+                            callback: (value) => this.formatTick(value)
                         }
                     },
                     y: {
@@ -302,10 +433,11 @@ class IoTDashboard {
     updateChart() {
         if (!this.chart) return;
         
-        this.chart.data.labels = [...this.historicalData.labels];
-        this.chart.data.datasets[0].data = [...this.historicalData.roll];
-        this.chart.data.datasets[1].data = [...this.historicalData.pitch];
-        this.chart.data.datasets[2].data = [...this.historicalData.yaw];
+        const { time } = this.historicalData;
+        ['roll', 'pitch', 'yaw'].forEach((field, i) => {
+            this.chart.data.datasets[i].data =
+                this.historicalData[field].map((value, j) => ({ x: time[j], y: value }));
+        });
         
         this.chart.update('none'); // No animation for real-time updates
     }
@@ -317,32 +449,72 @@ class IoTDashboard {
     }
 
     updateSystemInfo() {
-        document.getElementById('deviceId').textContent = 'ESP32-001';
+        document.getElementById('deviceId').textContent = this.deviceId;
         document.getElementById('firmwareVersion').textContent = '1.0.0';
         document.getElementById('batteryLevel').textContent = 
-            this.systemStatus.batteryLevel + '%';
+            this.systemStatus.batteryLevel === null ? 'n/a' : this.systemStatus.batteryLevel + '%';
         document.getElementById('totalSamples').textContent = 
             this.systemStatus.totalSamples.toLocaleString();
         document.getElementById('packetsPerMin').textContent = 
             (this.systemStatus.dataRate * 60).toLocaleString();
         
         // Update uptime
-        this.systemStatus.uptime += 5;
+        if (this.systemStatus.uptime === null) {
+            document.getElementById('uptime').textContent = 'n/a';
+            return;
+        }
         const hours = Math.floor(this.systemStatus.uptime / 3600);
         const minutes = Math.floor((this.systemStatus.uptime % 3600) / 60);
         document.getElementById('uptime').textContent = `${hours}h ${minutes}m`;
     }
 
+    // The server's state of the device (chart_api.py /api/status, from its
+    // last-value cache): measured rate, board uptime, sample count and
+    // connection state. isMonitoring stays the local pause switch.
+    async fetchSystemStatus() {
+        const query = `device=${encodeURIComponent(this.deviceId)}`;
+        try {
+            const response = await fetch(`${this.apiBase}/api/status?${query}`);
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            const status = await response.json();
+            ['deviceOnline', 'wifiConnected', 'cloudConnected', 'dataRate', 'batteryLevel',
+             'uptime', 'totalSamples'].forEach((field) => {
+                this.systemStatus[field] = status[field];
+            });
+        } catch (error) {
+            // No API, or the device has not sent anything yet: keep the
+            // stream's own measurements
+        }
+        this.updateSystemInfo();
+    }
+
     updateSystemStats() {
-        // Simulate occasional status changes
-        if (Math.random() < 0.05) { // 5% chance
-            this.simulateStatusChange();
+        if (this.demoMode) {
+            // Simulate occasional status changes
+            if (Math.random() < 0.05) { // 5% chance
+                this.simulateStatusChange();
+            }
+        } else {
+            // Measured update rate over the last 5 s, and device silence
+            this.systemStatus.dataRate = Math.round(this.stream.messageCount / 5);
+            this.stream.messageCount = 0;
+            const silent = Date.now() - this.stream.lastMessageAt > 5000;
+            this.updateDeviceStatus();
+            if (this.stream.socket && this.stream.socket.readyState === WebSocket.OPEN) {
+                this.setStatus('dataStreamStatus', silent ? 'warning' : 'success',
+                    silent ? 'Waiting for Data' : 'Data Stream Active');
+            }
+            this.fetchSystemStatus();
+            return;
         }
         
-        // Update battery level (slowly decreasing)
+        // Update battery level (slowly decreasing) and uptime
         if (Math.random() < 0.1) {
             this.systemStatus.batteryLevel = Math.max(20, this.systemStatus.batteryLevel - 1);
         }
+        this.systemStatus.uptime += 5;
         
         this.updateSystemInfo();
     }
@@ -388,7 +560,7 @@ class IoTDashboard {
         if (this.systemStatus.isMonitoring) {
             text.textContent = 'Stop Monitoring';
             button.className = 'btn btn--primary';
-            this.startDataSimulation();
+            this.startRendering();
         } else {
             text.textContent = 'Start Monitoring';
             button.className = 'btn btn--secondary';
@@ -401,7 +573,7 @@ class IoTDashboard {
     resetData() {
         // Reset historical data
         this.historicalData = {
-            labels: [],
+            time: [],
             roll: [],
             pitch: [],
             yaw: []
@@ -436,7 +608,26 @@ class IoTDashboard {
         this.showNotification('Data reset successfully', 'success');
     }
 
+    // Stored data downloads straight from the export API (telemetry_export.py),
+    // streamed by the server: the range on the chart, or the last hour when
+    // it is live. Demo data only exists in the page, so it is saved from here.
     exportData() {
+        if (!this.demoMode) {
+            const end = Date.now();
+            const span = this.rangeSpans[this.chartRange] || this.rangeSpans['1h'];
+            const query = new URLSearchParams({
+                device: this.deviceId, start: end - span, end, format: 'csv.gz'
+            });
+            const a = document.createElement('a');
+            a.href = `${this.apiBase}/api/export?${query}`;
+            a.download = '';
+            document.body.appendChild(a);
+            a.click();
+            document.body.removeChild(a);
+            this.showNotification('Export started', 'success');
+            return;
+        }
+
         const data = {
             timestamp: new Date().toISOString(),
             currentData: this.sensorData,
@@ -480,10 +671,47 @@ class IoTDashboard {
         }, 3000);
     }
 
-    updateChartTimeRange(range) {
-        // This would typically filter historical data by time range
-        // For demo purposes, we'll just show a notification
-        this.showNotification(`Chart updated to show ${range}`, 'info');
+    formatTick(value) {
+        const date = new Date(value);
+        const span = this.chart ? this.chart.scales.x.max - this.chart.scales.x.min : 0;
+        return span > 86400000 ? date.toLocaleDateString() + ' ' + date.toLocaleTimeString()
+            : date.toLocaleTimeString();
+    }
+
+    // Stored ranges come from the chart API, downsampled on the server to
+    // no more points than the chart is wide in pixels
+    async updateChartTimeRange(range) {
+        this.chartRange = range;
+        if (range === 'live') {
+            this.updateChart();
+            return;
+        }
+
+        const end = Date.now();
+        const points = Math.max(3, Math.floor(this.chart.width));
+        const query = new URLSearchParams({
+            device: this.deviceId, start: end - this.rangeSpans[range], end, points
+        });
+
+        try {
+            const response = await fetch(`${this.apiBase}/api/chart?${query}`);
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            const chart = await response.json();
+            if (this.chartRange !== range) {
+                return; // Superseded while loading
+            }
+            ['roll', 'pitch', 'yaw'].forEach((field, i) => {
+                const { t, v } = chart.series[field];
+                this.chart.data.datasets[i].data = t.map((x, j) => ({ x, y: v[j] }));
+            });
+            this.chart.update('none');
+            this.showNotification(
+                `Showing ${range}: ${chart.rows.toLocaleString()} readings (${chart.source})`, 'info');
+        } catch (error) {
+            this.showNotification(`Could not load ${range} of history: ${error.message}`, 'error');
+        }
     }
 
     showNotification(message, type = 'info') {
@@ -0,0 +1,294 @@
+# HTTP chart endpoint for the dashboard: downsampled orientation series
+#
+#   GET /api/chart?device=esp32-01&start=<ms>&end=<ms>&points=900
+#                 [&method=lttb|minmax][&fields=roll,pitch,yaw]
+#
+# Returns at most points points per field, as
+#
+#   {"device": ..., "start": ..., "end": ..., "rows": 3600000,
+#    "source": "raw", "method": "lttb",
+#    "series": {"roll": {"t": [...], "v": [...]}, ...}}
+#
+# Ranges up to max_raw_rows stored readings are read from the TelemetryStore
+# and reduced with downsample.lttb() (or minmax(), the envelope). Longer
+# ones come from the rollup pyramid, when there is one: "source" is then
+# "rollup", "v" holds bucket means and each series also carries the buckets'
+# "min" and "max", so a 30-day chart never touches raw data. Without a
+# pyramid a long range is still read from the store, but one segment at a
+# time: each is reduced to its share of points and the reductions are
+# reduced again, so memory stays at a segment however long the range.
+#
+#   GET /api/export?device=esp32-01[&start=<ms>][&end=<ms>][&format=csv.gz|parquet|npz]
+#
+# streams every stored column of the range as a download, written chunk by
+# chunk by telemetry_export.export() while the response is sent.
+#
+#   GET /api/status[?device=esp32-01]
+#
+# answers from the LastValueCache, when the service has one, without
+# touching storage. The fields are the dashboard's systemStatus fields for
+# one device, or the same fields as lists for the whole fleet. The
+# dashboard files (DASHBOARD_FILES, nothing else) are served alongside, so the
+# page and the API share an origin.
+#
+#   python chart_api.py --store data                  dashboard on http://localhost:8080/
+#   python chart_api.py --store data --port 8000
+#   python chart_api.py --benchmark                   1M-point request timing
+
+import argparse
+import json
+import os
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+import numpy as np
+
+from downsample import lttb, minmax
+from rollup_pyramid import FIELDS
+from telemetry_export import CONTENT_TYPES, available_formats, count_rows, export
+
+CHART_FIELDS = ("roll", "pitch", "yaw")
+DASHBOARD_FILES = ("/index.html", "/app.js", "/style.css")
+METHODS = ("lttb", "minmax")
+
+
+def _values(values):
+    return [None if np.isnan(v) else v for v in np.round(np.asarray(values, np.float64), 3).tolist()]
+
+
+# The finite readings of one field reduced to at most points, as (t, v)
+def _reduce(t, v, points, method):
+    finite = np.isfinite(v)
+    t = t[finite]
+    v = v[finite]
+    index = lttb(t, v, points) if method == "lttb" else minmax(v, points)
+    return t[index], v[index]
+
+
+class ChartService:
+    def __init__(self, store, pyramid=None, max_raw_rows=2_000_000, max_points=4000, cache=None):
+        self.store = store
+        self.pyramid = pyramid
+        self.cache = cache
+        self.max_raw_rows = max_raw_rows
+        self.max_points = max_points
+
+    def chart(self, device, start, end, points, method="lttb", fields=CHART_FIELDS):
+        if method not in METHODS:
+            raise ValueError(f"method must be one of {METHODS}")
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"unknown fields {sorted(unknown)}")
+        points = min(max(int(points), 3), self.max_points)
+        rows = count_rows(self.store, device, start, end)
+        response = {"device": device, "start": start, "end": end, "rows": rows}
+
+        if rows > self.max_raw_rows and self.pyramid is not None:
+            rollup = self.pyramid.query(device, start, end, points)
+            t = rollup.timestamp.tolist()
+            response.update(source="rollup", method="rollup", bucket_ms=rollup.bucket_ms, series={
+                field: {"t": t, "v": _values(rollup.mean[field]),
+                        "min": _values(rollup.min[field]), "max": _values(rollup.max[field])}
+                for field in fields})
+            return response
+
+        if rows > self.max_raw_rows:
+            # No pyramid: reduce segment by segment, each to its share of points
+            parts = {field: ([], []) for field in fields}
+            for part in self.store.scan(device, start, end, ["timestamp", *fields]):
+                share = max(3, -(-points * len(part["timestamp"]) // rows))
+                for field in fields:
+                    t, v = _reduce(part["timestamp"], np.asarray(part[field]), share, method)
+                    parts[field][0].append(t)
+                    parts[field][1].append(v)
+            data = {field: (np.concatenate(t), np.concatenate(v))
+                    for field, (t, v) in parts.items()}
+        else:
+            data = self.store.read(device, start, end, ["timestamp", *fields])
+            data = {field: (data["timestamp"], data[field]) for field in fields}
+        series = {}
+        for field, (t, v) in data.items():
+            t, v = _reduce(t, v, points, method)
+            series[field] = {"t": t.tolist(), "v": _values(v)}
+        response.update(source="raw", method=method, series=series)
+        return response
+
+
+class ChartHandler(SimpleHTTPRequestHandler):
+    def __init__(self, *args, service, **kwargs):
+        self.service = service
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/":
+            self.path = "/index.html"
+            return super().do_GET()
+        if url.path in DASHBOARD_FILES:
+            return super().do_GET()
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == "/api/export":
+            return self.export(query)
+        if url.path == "/api/status":
+            return self.status(query)
+        if url.path != "/api/chart":
+            return self.send_error(404)
+        try:
+            device = query["device"]
+            end = int(query["end"])
+            start = int(query["start"])
+            points = int(query.get("points", 1000))
+            fields = tuple(query.get("fields", ",".join(CHART_FIELDS)).split(","))
+            body = self.service.chart(device, start, end, points, query.get("method", "lttb"),
+                                      fields)
+            status = 200
+        except KeyError as error:
+            body = {"error": f"missing parameter {error}"}
+            status = 400
+        except ValueError as error:
+            body = {"error": str(error)}
+            status = 400
+        self.send_json(status, body)
+
+    def status(self, query):
+        cache = self.service.cache
+        if cache is None:
+            return self.send_error(404, "no live state on this server")
+        if "device" not in query:
+            return self.send_json(200, cache.fleet_status())
+        body = cache.status(query["device"])
+        if body is None:
+            return self.send_json(404, {"error": f"unknown device {query['device']!r}"})
+        self.send_json(200, body)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body, separators=(",", ":")).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # No Content-Length: the body is produced while it is sent and ends when
+    # the connection closes (HTTP/1.0)
+    def export(self, query):
+        format = query.get("format", "csv.gz")
+        try:
+            device = query["device"]
+            start = int(query["start"]) if "start" in query else None
+            end = int(query["end"]) if "end" in query else None
+        except KeyError as error:
+            return self.send_error(400, f"missing parameter {error}")
+        except ValueError as error:
+            return self.send_error(400, str(error))
+        if format not in available_formats():
+            return self.send_error(400, f"format must be one of {available_formats()}")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[format])
+        self.send_header("Content-Disposition",
+                         f'attachment; filename="{quote(device, safe="")}.{format}"')
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        try:
+            export(self.service.store, device, self.wfile, format, start, end)
+        except ConnectionError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the API and the dashboard files in directory from a background thread
+def start_chart_server(service, host="0.0.0.0", port=8080,
+                       directory=os.path.dirname(os.path.abspath(__file__))):
+    handler = partial(ChartHandler, service=service, directory=directory)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import io
+    import tempfile
+    import time
+    from urllib.request import urlopen
+
+    from last_value_cache import LastValueCache
+    from rollup_pyramid import RollupPyramid
+    from telemetry_store import TelemetryStore
+
+    parser = argparse.ArgumentParser(description="Chart API and dashboard server")
+    parser.add_argument("--store", help="TelemetryStore root (rollups in <store>/rollups)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--benchmark", action="store_true",
+                        help="time a request over 1M stored points instead")
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        if not args.store:
+            parser.error("give --store or --benchmark")
+        store = TelemetryStore(args.store)
+        rollups = os.path.join(args.store, "rollups")
+        service = ChartService(store, RollupPyramid(rollups) if os.path.isdir(rollups) else None)
+        server = start_chart_server(service, args.host, args.port)
+        print(f"Dashboard and chart API on http://{args.host}:{server.server_port}/")
+        threading.Event().wait()
+
+    # 1M points of 1 kHz data, then the same request through HTTP
+    root = tempfile.mkdtemp(prefix="chart-api-")
+    store = TelemetryStore(root)
+    n = 1_000_000
+    t0 = 1_750_000_000_000
+    rng = np.random.default_rng(0)
+    angles = (20 * np.sin(np.arange(n) / 20_000) + rng.normal(0, 0.3, n)).astype(np.float32)
+    store.append("device-0", {"timestamp": t0 + np.arange(n), "roll": angles,
+                              "pitch": -angles, "yaw": angles * 2})
+    cache = LastValueCache()
+    cache.update(["device-0"], [n - 1], [time.time()], {"roll": angles[-1:], "pitch": -angles[-1:],
+                                                        "yaw": angles[-1:] * 2, "temperature": [25.0]})
+    service = ChartService(store, cache=cache)
+    service.chart("device-0", t0, t0 + n, 900)
+    for method in METHODS:
+        began = time.perf_counter()
+        response = service.chart("device-0", t0, t0 + n, 900, method)
+        elapsed = time.perf_counter() - began
+        print(f"{method:7s} {response['rows']:,} rows -> "
+              f"{len(response['series']['roll']['t'])} points per field in {elapsed * 1000:.1f} ms")
+        assert all(len(s["t"]) <= 900 for s in response["series"].values())
+
+    # Over max_raw_rows without a pyramid: reduced a segment at a time
+    segmented = TelemetryStore(tempfile.mkdtemp(prefix="chart-api-"), segment_rows=1 << 17)
+    segmented.append("device-0", {"timestamp": t0 + np.arange(n), "roll": angles})
+    scanned = ChartService(segmented, max_raw_rows=100_000).chart("device-0", t0, t0 + n, 900,
+                                                                   "minmax")
+    assert scanned["rows"] == n and len(scanned["series"]["roll"]["t"]) <= 900
+    assert max(scanned["series"]["roll"]["v"]) == round(float(angles.max()), 3)
+
+    server = start_chart_server(service, "127.0.0.1", 0)
+    url = (f"http://127.0.0.1:{server.server_port}/api/chart?device=device-0"
+           f"&start={t0}&end={t0 + n}&points=900")
+    began = time.perf_counter()
+    with urlopen(url) as reply:
+        body = reply.read()
+    elapsed = time.perf_counter() - began
+    assert json.loads(body)["series"]["yaw"]["v"][0] == round(float(angles[0]) * 2, 3)
+    print(f"HTTP    {len(body):,} bytes in {elapsed * 1000:.1f} ms")
+
+    began = time.perf_counter()
+    with urlopen(f"http://127.0.0.1:{server.server_port}/api/export?device=device-0"
+                 f"&format=npz&end={t0 + n}") as reply:
+        body = reply.read()
+    elapsed = time.perf_counter() - began
+    with np.load(io.BytesIO(body)) as npz:
+        assert np.array_equal(npz["roll"], angles)
+    print(f"export  {len(body):,} bytes of npz in {elapsed * 1000:.1f} ms")
+
+    with urlopen(f"http://127.0.0.1:{server.server_port}/api/status?device=device-0") as reply:
+        status = json.loads(reply.read())
+    assert status["isMonitoring"] and status["totalSamples"] == 1 and status["uptime"] == n // 1000
+    server.shutdown()
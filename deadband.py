@@ -0,0 +1,196 @@
+# Report-by-exception telemetry: the sketch's --deadband filter and the
+# step-hold reconstruction that turns its sparse stream back into a series
+#
+# deadband_filter() makes the firmware's decision step for step, in float32:
+# given the readings the sketch takes every cloudInterval it returns the ones
+# it would queue. reconstruct() holds each reported reading until the next one
+# on a uniform grid. At every reading the device took, the held value is
+# within the deadband of the true one, plus half the 0.01 degree JSON
+# rounding, so analytics on the rebuilt series have a known error bound.
+# Grid points after a report with no successor within stale_ms are NaN: the
+# heartbeat guarantees a report at least that often, so a longer silence
+# means the device was offline, not idle.
+#
+#   python deadband.py                                  synthetic idle fleet
+#   python deadband.py --deadband 0.25 --heartbeat 30
+#   python deadband.py --store data --device esp32-01 --step 1000
+
+import argparse
+import json
+from collections import namedtuple
+
+import numpy as np
+
+import mqtt_protocol as mqtt
+
+ANGLES = ("roll", "pitch", "yaw")
+
+# sendToCloud() rounds every angle to 0.01 degree
+JSON_RESOLUTION = 0.01
+
+DeadbandReport = namedtuple("DeadbandReport", [
+    "readings",       # readings the sketch took
+    "reports",        # readings it queued
+    "bytes_dense",    # MQTT PUBLISH bytes without the deadband
+    "bytes_sparse",   # and with it
+    "max_error",      # worst |reconstructed - actual| over every angle
+    "bound",          # deadband + JSON_RESOLUTION / 2
+])
+
+
+# Readings as (n,) arrays, ms timestamps; returns the indices the sketch
+# would queue. Each report's successor is searched in numpy chunks, so an
+# idle device costs one Python iteration per report, not per reading.
+def deadband_filter(timestamps, roll, pitch, yaw, deadband, heartbeat_ms, chunk=256):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    angles = np.stack([np.asarray(a, dtype=np.float32) for a in (roll, pitch, yaw)])
+    threshold = np.float32(deadband)
+    n = len(timestamps)
+    reports = []
+    i = 0
+    while i < n:
+        reports.append(i)
+        reference = angles[:, i:i + 1]
+        due = timestamps[i] + heartbeat_ms
+        start = i + 1
+        size = chunk
+        i = n
+        while start < n:
+            stop = min(start + size, n)
+            moved = np.any(np.abs(angles[:, start:stop] - reference) > threshold, axis=0)
+            moved |= timestamps[start:stop] >= due
+            hit = np.flatnonzero(moved)
+            if len(hit):
+                i = start + int(hit[0])
+                break
+            start = stop
+            size *= 2
+    return np.array(reports, dtype=np.int64)
+
+
+# Sparse reports -> (grid, {name: held values}). grid runs from start to end
+# (default the first and last report) in step_ms steps; NaN before the first
+# report and, with stale_ms, once the last report is older than that.
+def reconstruct(timestamps, columns, step_ms, start=None, end=None, stale_ms=None):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    start = timestamps[0] if start is None else start
+    end = timestamps[-1] if end is None else end
+    grid = np.arange(start, end + 1, step_ms, dtype=np.int64)
+    return grid, hold(timestamps, columns, grid, stale_ms)
+
+
+# Step-hold reports onto arbitrary timestamps
+def hold(timestamps, columns, at, stale_ms=None):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    index = np.searchsorted(timestamps, at, side="right") - 1
+    missing = index < 0
+    if stale_ms is not None:
+        missing |= at - timestamps[np.maximum(index, 0)] > stale_ms
+    index = np.maximum(index, 0)
+    held = {}
+    for name, values in columns.items():
+        values = np.asarray(values, dtype=np.float64)[index]
+        values[missing] = np.nan
+        held[name] = values
+    return held
+
+
+def reconstruct_store(store, device, step_ms, start=None, end=None, stale_ms=None):
+    data = store.read(device, start, end, columns=("timestamp",) + ANGLES)
+    return reconstruct(data["timestamp"], {name: data[name] for name in ANGLES}, step_ms,
+                       start, end, stale_ms)
+
+
+def json_round(values):
+    return np.round(np.asarray(values, dtype=np.float64) * 100) / 100
+
+
+# Size of the PUBLISH the sketch sends for one reading
+def publish_bytes(roll, pitch, yaw, timestamp):
+    payload = json.dumps({"roll": roll, "pitch": pitch, "yaw": yaw, "temperature": 25.0,
+                          "timestamp": int(timestamp)})
+    return len(mqtt.encode_publish(mqtt.TELEMETRY_TOPIC, payload))
+
+
+# Run one device's dense readings through the filter, rebuild them from the
+# rounded reports at the original timestamps and measure the traffic
+def evaluate(timestamps, roll, pitch, yaw, deadband, heartbeat_ms):
+    reports = deadband_filter(timestamps, roll, pitch, yaw, deadband, heartbeat_ms)
+    angles = {name: np.asarray(a, dtype=np.float32) for name, a in zip(ANGLES, (roll, pitch, yaw))}
+    sent = {name: json_round(a[reports]) for name, a in angles.items()}
+    held = hold(np.asarray(timestamps)[reports], sent, np.asarray(timestamps, dtype=np.int64))
+    max_error = max(float(np.max(np.abs(held[name] - angles[name]))) for name in ANGLES)
+    rounded = [json_round(a) for a in angles.values()]
+    sizes = np.array([publish_bytes(float(r), float(p), float(y), t)
+                      for r, p, y, t in zip(*rounded, timestamps)])
+    return DeadbandReport(
+        readings=len(timestamps),
+        reports=len(reports),
+        bytes_dense=int(sizes.sum()),
+        bytes_sparse=int(sizes[reports].sum()),
+        max_error=max_error,
+        bound=deadband + JSON_RESOLUTION / 2,
+    )
+
+
+# Fused angles of a mounted unit read every interval_ms: fixed attitude,
+# filter noise, a slow yaw drift from residual gyro bias and, for the few
+# units that are handled at all, a couple of half-minute sways per hour
+def synthetic_device(seconds, interval_ms=1000, moves_per_hour=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(seconds * 1000 / interval_ms)
+    t = np.arange(n) * interval_ms
+    base = rng.uniform(-30, 30, 3)
+    angles = base[:, None] + rng.normal(0, 0.03, (3, n))
+    angles[2] += rng.normal(0, 0.002) * t / 1000.0
+    for _ in range(rng.poisson(moves_per_hour * seconds / 3600.0)):
+        at = rng.uniform(0, seconds * 1000)
+        window = (t >= at) & (t < at + 30_000)
+        since = (t[window] - at) / 1000.0
+        # 0.2 Hz sway under a half-sine envelope
+        angles[:2, window] += rng.uniform(5, 20, (2, 1)) * np.sin(np.pi * since / 30) \
+            * np.sin(2 * np.pi * 0.2 * since)
+    return t, *angles.astype(np.float32)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report-by-exception savings and reconstruction")
+    parser.add_argument("--deadband", type=float, default=0.5, help="degrees")
+    parser.add_argument("--heartbeat", type=float, default=60.0, help="seconds")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--moving", type=float, default=0.1,
+                        help="fraction of the synthetic fleet that gets handled")
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--interval", type=int, default=1000, help="cloudInterval in ms")
+    parser.add_argument("--store", help="TelemetryStore root to rebuild a device from")
+    parser.add_argument("--device")
+    parser.add_argument("--step", type=int, default=1000, help="grid step in ms")
+    args = parser.parse_args()
+    heartbeat_ms = args.heartbeat * 1000
+
+    if args.store:
+        from telemetry_store import TelemetryStore
+
+        grid, held = reconstruct_store(TelemetryStore(args.store), args.device, args.step,
+                                       stale_ms=heartbeat_ms + 2 * args.step)
+        gaps = np.isnan(held["roll"])
+        print(f"{args.device}: {len(grid)} points at {args.step} ms, "
+              f"{int(gaps.sum())} in gaps longer than the heartbeat")
+    else:
+        totals = np.zeros(4)
+        worst = 0.0
+        moving = int(round(args.devices * args.moving))
+        for seed in range(args.devices):
+            t, roll, pitch, yaw = synthetic_device(args.hours * 3600, args.interval,
+                                                   4.0 if seed < moving else 0.0, seed)
+            report = evaluate(t, roll, pitch, yaw, args.deadband, heartbeat_ms)
+            totals += (report.readings, report.reports, report.bytes_dense, report.bytes_sparse)
+            worst = max(worst, report.max_error)
+        readings, reports, dense, sparse = totals
+        bound = args.deadband + JSON_RESOLUTION / 2
+        print(f"{args.devices} devices ({moving} handled), {args.hours:g} h at {args.interval} ms, "
+              f"{args.deadband:g} deg deadband, {args.heartbeat:g} s heartbeat")
+        print(f"  publishes   {readings:10.0f} -> {reports:8.0f}  ({readings / reports:.1f}x fewer)")
+        print(f"  MQTT bytes  {dense:10.0f} -> {sparse:8.0f}  ({dense / sparse:.1f}x fewer)")
+        print(f"  max error   {worst:.4f} deg (bound {bound:.4f} deg)")
+        assert worst <= bound + 1e-6
@@ -0,0 +1,356 @@
+# Block compression for stored telemetry, after Facebook's Gorilla
+#
+# A block is a set of equal-length columns (a device's timestamps and
+# orientation, say) encoded together into one bytes object:
+#
+#   integers (timestamps)  deltas, or delta-of-deltas where those pack
+#                          smaller: millis() stamps a steady loop apart leave
+#                          a few ms either way
+#   floats                 XOR with the previous value's bits, the common
+#                          trailing zero bits of the block dropped: slowly
+#                          changing values share sign, exponent and top bits
+#   quantized floats       rounded to a step (0.01 degrees is what the sketch
+#                          sends, round(roll * 100) / 100.0), then deltas or
+#                          delta-of-deltas of the integer steps; lossless for
+#                          values already rounded to the step. NaN, +-inf and
+#                          values too large to count in steps are kept
+#                          bit-exact on the side.
+#
+# Gorilla writes every value with its own variable-length bit code, which
+# has to be decoded one value at a time. Here each column's transformed
+# values (signed deltas as offsets from a low value of the block) are
+# bit-packed at one width per block, chosen to minimize the size, with the
+# values that do not fit stored apart as exceptions (patched frame of
+# reference). Packing lays the block out as 64 lanes of consecutive values,
+# so unpacking is one shift/or/mask pass over whole lanes per lane and
+# decode_block() is a handful of numpy calls per column: unpack, patch, add
+# the base, then cumsum or bitwise_xor.accumulate.
+#
+# For blocks of BLOCK_ROWS (an hour of the default sketch's loop) on the
+# default trace, quantized blocks take about 14.3 bits a row, 11x smaller
+# than the store's 20 byte rows, and decode at 145-190M values per second on
+# one core; XOR blocks decode at 195-250M but take 64 bits a row. The
+# quantized mode is slower because roll and pitch pack best as
+# delta-of-deltas, which take two cumsum passes. Smaller blocks pay the
+# per-lane calls more often.
+#
+#   python gorilla_codec.py                            4 h of the sketch's loop() cadence
+#   python gorilla_codec.py --trace log.npz
+#   python gorilla_codec.py --store data --device esp32-01
+
+import argparse
+import struct
+
+import numpy as np
+
+MAGIC = b"GOR1"
+DELTA, XOR, QUANTIZED = 0, 1, 2
+QUANTUM = 0.01      # degrees, the sketch's rounding of roll/pitch/yaw
+BLOCK_ROWS = 1 << 18
+
+_HEADER = struct.Struct("<4sHI")        # magic, columns, rows
+_COLUMN = struct.Struct("<B3s")         # kind, dtype ("<i8", "<f4", ...)
+_PACKED = struct.Struct("<BIq")         # bit width, exceptions, base
+_QUANTIZED = struct.Struct("<dI")       # step, count of values kept apart
+# An exception costs its position (uint32) and full value (uint64)
+_EXCEPTION_BITS = 96
+
+
+# Bits needed by each uint64 (the float conversion can only round up, to 65)
+def _bit_lengths(values):
+    return np.minimum(np.frexp(values.astype(np.float64))[1], 64)
+
+
+# Pack uint64 values at width bits: value i of lane k = i // lanes is in bits
+# [(k * width), (k + 1) * width) of the words at row i % lanes
+def _pack(values, width):
+    lanes = -(-len(values) // 64)
+    padded = np.zeros(64 * lanes, dtype=np.uint64)
+    padded[:len(values)] = values
+    padded = padded.reshape(64, lanes)
+    words = np.zeros((width, lanes), dtype=np.uint64)
+    for k in range(64 if width else 0):
+        bit = k * width
+        j, shift = bit >> 6, bit & 63
+        words[j] |= padded[k] << np.uint64(shift)
+        if shift + width > 64:
+            words[j + 1] |= padded[k] >> np.uint64(64 - shift)
+    return words
+
+
+def _unpack(words, n, width):
+    lanes = words.shape[1] if width else -(-n // 64)
+    out = np.empty((64, lanes), dtype=np.uint64) if width else np.zeros((64, lanes), np.uint64)
+    if width:
+        mask = np.uint64((1 << width) - 1)
+        spill = np.empty(lanes, dtype=np.uint64)
+        for k in range(64):
+            bit = k * width
+            j, shift = bit >> 6, bit & 63
+            np.right_shift(words[j], np.uint64(shift), out=out[k])
+            if shift + width > 64:
+                np.left_shift(words[j + 1], np.uint64(64 - shift), out=spill)
+                np.bitwise_or(out[k], spill, out=out[k])
+            if width < 64:
+                np.bitwise_and(out[k], mask, out=out[k])
+    return out.reshape(-1)[:n]
+
+
+def _align(out):
+    out += bytes(-len(out) % 8)
+
+
+# Append uint64 values, packed at the width that minimizes their size; base
+# is added back (as int64) on reading
+def _write_uints(out, values, base=0):
+    n = len(values)
+    counts = np.bincount(_bit_lengths(values), minlength=65)
+    lanes = -(-n // 64)
+    exceptions = n - np.cumsum(counts)
+    cost = 64 * lanes * np.arange(65) + exceptions * _EXCEPTION_BITS
+    width = int(np.argmin(cost))
+    packed = values
+    positions = np.zeros(0, dtype=np.uint32)
+    if width < 64:
+        packed = values & np.uint64((1 << width) - 1)
+        positions = np.flatnonzero(packed != values).astype(np.uint32)
+    out += _PACKED.pack(width, len(positions), base)
+    _align(out)
+    out += _pack(packed, width).tobytes()
+    out += positions.tobytes()
+    _align(out)
+    out += values[positions].tobytes()
+
+
+# Offsets from the 0.1% lowest value: the few below it (the first values of
+# a block, a clock jump) become exceptions instead of widening everything
+def _write_ints(out, values):
+    low = len(values) // 1000
+    base = int(np.partition(values, low)[low]) if len(values) else 0
+    _write_uints(out, (values - base).view(np.uint64), base)
+
+
+# Deltas of order 1 or 2, whichever packs smaller, after a byte with the order
+def _write_deltas(out, values):
+    pad = len(out) % 8  # Trial buffers keep the alignment out will have
+    best = None
+    for order in (1, 2):
+        values = np.diff(values, prepend=0)
+        trial = bytearray(pad) + bytes([order])
+        _write_ints(trial, values)
+        if best is None or len(trial) < len(best):
+            best = trial
+    out += best[pad:]
+
+
+def _read_uints(data, offset, n):
+    width, count, base = _PACKED.unpack_from(data, offset)
+    offset += _PACKED.size
+    offset += -offset % 8
+    lanes = -(-n // 64)
+    words = np.frombuffer(data, np.uint64, width * lanes, offset).reshape(width, lanes)
+    offset += words.nbytes
+    values = _unpack(words, n, width)
+    positions = np.frombuffer(data, np.uint32, count, offset)
+    offset += positions.nbytes
+    offset += -offset % 8
+    values[positions] = np.frombuffer(data, np.uint64, count, offset)
+    if base:
+        values = values.view(np.int64)
+        values += base
+    return values, offset + 8 * count
+
+
+def _read_deltas(data, offset, n):
+    order = data[offset]
+    values, offset = _read_uints(data, offset + 1, n)
+    values = values.view(np.int64)
+    for _ in range(order):
+        np.cumsum(values, out=values)
+    return values, offset
+
+
+# Encode {name: array} of equal length. quantize maps float column names to
+# their step; other float columns are XOR-encoded, integer ones delta
+# encoded.
+def encode_block(columns, quantize=None):
+    quantize = quantize or {}
+    names = list(columns)
+    rows = len(columns[names[0]]) if names else 0
+    out = bytearray(_HEADER.pack(MAGIC, len(names), rows))
+    for name in names:
+        values = np.asarray(columns[name])
+        if len(values) != rows:
+            raise ValueError(f"column {name!r} has {len(values)} rows, not {rows}")
+        encoded = name.encode()
+        out += bytes([len(encoded)]) + encoded
+        if values.dtype.kind in "iu":
+            out += _COLUMN.pack(DELTA, values.dtype.str.encode())
+            _write_deltas(out, values.astype(np.int64))
+        elif values.dtype.kind == "f" and name in quantize:
+            out += _COLUMN.pack(QUANTIZED, values.dtype.str.encode())
+            step = quantize[name]
+            steps = np.rint(values.astype(np.float64) / step)
+            # NaN, +-inf and steps beyond 2^53 (where int64 deltas could
+            # overflow) are stored as they are
+            valid = np.abs(steps) <= 2.0 ** 53
+            apart = np.flatnonzero(~valid).astype(np.uint32)
+            if len(apart):
+                # Hold the previous value over them, so they cost no deltas
+                steps = steps[np.maximum.accumulate(np.where(valid, np.arange(rows), 0))]
+                steps[~(np.abs(steps) <= 2.0 ** 53)] = 0
+            out += _QUANTIZED.pack(step, len(apart)) + apart.tobytes() + values[apart].tobytes()
+            _write_deltas(out, steps.astype(np.int64))
+        elif values.dtype.kind == "f":
+            out += _COLUMN.pack(XOR, values.dtype.str.encode())
+            bits = values.view(f"<u{values.dtype.itemsize}").astype(np.uint64)
+            xor = bits ^ np.r_[np.uint64(0), bits[:-1]]
+            # Trailing zeros every XOR shares: the lowest set bit of them all
+            combined = int(np.bitwise_or.reduce(xor)) if rows else 0
+            trailing = (combined & -combined).bit_length() - 1 if combined else 0
+            out += bytes([trailing])
+            _write_uints(out, xor >> np.uint64(trailing))
+        else:
+            raise ValueError(f"column {name!r}: cannot encode dtype {values.dtype}")
+    return bytes(out)
+
+
+# bytes from encode_block() -> {name: array}, with the original dtypes
+def decode_block(data):
+    magic, count, rows = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a compressed telemetry block")
+    offset = _HEADER.size
+    columns = {}
+    for _ in range(count):
+        length = data[offset]
+        name = bytes(data[offset + 1:offset + 1 + length]).decode()
+        offset += 1 + length
+        kind, dtype = _COLUMN.unpack_from(data, offset)
+        dtype = np.dtype(dtype.decode())
+        offset += _COLUMN.size
+        if kind == DELTA:
+            values, offset = _read_deltas(data, offset, rows)
+            columns[name] = values.astype(dtype, copy=False)
+        elif kind == QUANTIZED:
+            step, count = _QUANTIZED.unpack_from(data, offset)
+            offset += _QUANTIZED.size
+            apart = np.frombuffer(data, np.uint32, count, offset)
+            offset += apart.nbytes
+            kept = np.frombuffer(data, dtype, count, offset)
+            offset += kept.nbytes
+            values, offset = _read_deltas(data, offset, rows)
+            # Divided like the sketch's round(x * 100) / 100.0, for steps of 1/k
+            decoded = values.astype(np.float64)
+            decoded = np.divide(decoded, 1 / step, out=decoded).astype(dtype, copy=False)
+            decoded[apart] = kept
+            columns[name] = decoded
+        elif kind == XOR:
+            trailing = data[offset]
+            values, offset = _read_uints(data, offset + 1, rows)
+            bits = np.bitwise_xor.accumulate(values << np.uint64(trailing))
+            columns[name] = bits.astype(f"<u{dtype.itemsize}", copy=False).view(dtype)
+        else:
+            raise ValueError(f"unknown column encoding {kind}")
+    return columns
+
+
+# Fused orientation at the pass times of the default sketch's loop(),
+# rounded the way sendToCloud() rounds it
+def sketch_trace(seconds, seed=0):
+    from imu_fusion import ComplementaryFilter
+    from sketch_sim import SketchConfig, pass_schedule, synthetic_trace
+
+    trace = synthetic_trace(seconds, seed=seed)
+    starts, _ = pass_schedule(SketchConfig(), seconds * 1000.0, seed)
+    millis = np.floor(starts + trace.timestamps[0])
+    index = np.searchsorted(trace.timestamps, millis, side="right") - 1
+    roll, pitch, yaw = ComplementaryFilter().update(*(c[index] for c in trace.columns), millis)
+    columns = {"timestamp": millis.astype(np.int64)}
+    for name, values in (("roll", roll), ("pitch", pitch), ("yaw", yaw)):
+        columns[name] = (np.round(values * 100) / 100.0).astype(np.float32)
+    return columns
+
+
+if __name__ == "__main__":
+    import json
+    import time
+
+    parser = argparse.ArgumentParser(description="Telemetry block compression ratios and speed")
+    parser.add_argument("--seconds", type=float, default=4 * 3600.0,
+                        help="synthetic trace length")
+    parser.add_argument("--trace", help=".npz with timestamp and roll/pitch/yaw columns")
+    parser.add_argument("--store", help="TelemetryStore root, with --device")
+    parser.add_argument("--device")
+    parser.add_argument("--block-rows", type=int, default=BLOCK_ROWS)
+    args = parser.parse_args()
+
+    if args.store:
+        from telemetry_store import TelemetryStore
+
+        columns = TelemetryStore(args.store).read(args.device, columns=[
+            "timestamp", "roll", "pitch", "yaw"])
+        source = f"{args.device} in {args.store}"
+    elif args.trace:
+        with np.load(args.trace) as data:
+            columns = {name: data[name] for name in ("timestamp", "roll", "pitch", "yaw")}
+        columns["timestamp"] = columns["timestamp"].astype(np.int64)
+        source = args.trace
+    else:
+        columns = sketch_trace(args.seconds)
+        source = f"{args.seconds:g} s of the default sketch's loop()"
+    rows = len(columns["timestamp"])
+    angles = ("roll", "pitch", "yaw")
+    print(f"{rows:,} rows from {source}, "
+          f"{rows / ((columns['timestamp'][-1] - columns['timestamp'][0]) / 1000):.1f} Hz")
+
+    blocks = [{name: values[i:i + args.block_rows] for name, values in columns.items()}
+              for i in range(0, rows, args.block_rows)]
+    raw64 = rows * 8 * len(columns)
+    store_bytes = sum(values.nbytes for values in columns.values())
+    json_bytes = sum(len(json.dumps({"timestamp": int(t), "roll": float(r), "pitch": float(p),
+                                     "yaw": float(y)}, separators=(",", ":")))
+                     for t, r, p, y in zip(*(columns[name][:10_000].tolist()
+                                             for name in ("timestamp", *angles))))
+    json_bytes = json_bytes * rows / min(rows, 10_000)
+    for label, quantize in (("xor", None), ("quantized", {name: QUANTUM for name in angles})):
+        encoded = [encode_block(block, quantize) for block in blocks]
+        size = sum(len(data) for data in encoded)
+        decode = [decode_block(data) for data in encoded]
+        # Exact, except quantized columns of data not already on the step
+        for name, values in columns.items():
+            got = np.concatenate([block[name] for block in decode])
+            tolerance = QUANTUM / 2 + 1e-4 if quantize and name in quantize else 0
+            assert got.dtype == values.dtype and np.allclose(
+                got, values, rtol=0, atol=tolerance, equal_nan=True), (label, name)
+        best = float("inf")
+        for _ in range(5):
+            began = time.perf_counter()
+            for data in encoded:
+                decode_block(data)
+            best = min(best, time.perf_counter() - began)
+        print(f"{label:9s} {size * 8 / rows:5.1f} bits/row: {raw64 / size:5.1f}x vs 8-byte "
+              f"values, {store_bytes / size:4.1f}x vs the store's columns, "
+              f"{json_bytes / size:5.0f}x vs JSON; decode "
+              f"{rows * len(columns) / best / 1e6:.0f} M values/s")
+    # One device's year at the trace's rate, quantized
+    rate = rows / ((columns["timestamp"][-1] - columns["timestamp"][0]) / 1000)
+    print(f"one device-year at {rate:.0f} Hz: {size / rows * rate * 365 * 86400 / 1e9:.1f} GB")
+
+    # Lossless round trip of odd data: NaN, jumps, negative steps, tiny blocks
+    rng = np.random.default_rng(1)
+    for n in (0, 1, 2, 63, 64, 65, 1000):
+        odd = {"timestamp": np.cumsum(rng.integers(-5, 10_000_000, n)).astype(np.int64),
+               "roll": rng.normal(0, 1e6, n).astype(np.float32),
+               "pitch": np.round(rng.normal(0, 50, n), 2).astype(np.float32),
+               "yaw": rng.normal(0, 1, n)}
+        odd["roll"][::7] = np.nan
+        odd["pitch"][::5] = np.nan
+        odd["pitch"][3::11] = np.inf
+        odd["pitch"][4::11] = -np.inf
+        odd["pitch"][6::13] = np.float32(3e38)
+        for quantize in (None, {"pitch": QUANTUM}):
+            back = decode_block(encode_block(odd, quantize))
+            for name, values in odd.items():
+                assert np.array_equal(back[name], values, equal_nan=True), (n, name, quantize)
+    print("round trips are exact")
@@ -0,0 +1,236 @@
+# Python twin of the sketch's IMU calibration, for replaying recorded logs
+#
+# fixed_calibration() is the original calculateIMUError(): 200 readings for
+# the accelerometer angles, then 200 more for the gyro bias.
+# StreamingCalibrator and GyroBiasTracker follow the --calibration streaming
+# firmware step for step, with the constants taken from
+# sketch_features.CALIBRATION. compare() runs both over one log and reports
+# time to ready, the offsets each ends up with and the yaw that accumulates
+# while the device is still, which is all gyro bias error.
+#
+# Each log row stands for one calibration read, so logs should be sampled at
+# 1000 / CALIBRATION["period_ms"] Hz (200 Hz) like the firmware loop.
+#
+#   python imu_calibration.py                          synthetic 10 minute log
+#   python imu_calibration.py --store data --device esp32-01
+
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from imu_fusion import RAD_TO_DEG, accel_angles
+from sketch_features import CALIBRATION
+
+G = 9.80665
+
+# offsets: AccErrorX, AccErrorY (deg), GyroErrorX/Y/Z (deg/s); ready_index is
+# the log row after which setup() carries on
+Calibration = namedtuple("Calibration", ["offsets", "ready_index", "samples", "restarts"])
+
+CalibrationReport = namedtuple("CalibrationReport", [
+    "ready_seconds",      # from the first calibration read
+    "offsets",
+    "still_seconds",      # time after calibration the device was still
+    "still_yaw_drift",    # |yaw| accumulated while still (deg)
+    "bias_error",         # |GyroErrorZ - true bias| at the end (deg/s), if known
+])
+
+
+class RunningStats:
+    def __init__(self, axes=5):
+        self.n = 0
+        self.mean = np.zeros(axes)
+        self.m2 = np.zeros(axes)
+
+    def add(self, sample):
+        self.n += 1
+        delta = sample - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (sample - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else np.zeros_like(self.m2)
+
+
+# Raw mpu.getEvent() columns (m/s^2, rad/s) -> (n, 5) rows of accel roll and
+# pitch in degrees and gyro rates in deg/s, what calculateIMUError() averages
+def calibration_samples(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z):
+    roll, pitch = accel_angles(acc_x, acc_y, acc_z)
+    gyro = [np.asarray(g, dtype=np.float32) * RAD_TO_DEG for g in (gyro_x, gyro_y, gyro_z)]
+    return np.column_stack([roll, pitch, *gyro]).astype(np.float64)
+
+
+def fixed_calibration(samples):
+    offsets = np.concatenate([samples[:200, :2].mean(axis=0), samples[200:400, 2:].mean(axis=0)])
+    return Calibration(offsets, 399, 400, 0)
+
+
+class StreamingCalibrator:
+    def __init__(self, params=CALIBRATION):
+        self.params = params
+        self.stats = RunningStats()
+        self.restarts = 0
+        target = [params["accel_sem"]] * 2 + [params["gyro_sem"]] * 3
+        self._target = np.square(target)
+
+    # Add one read; True once calibration is done
+    def add(self, sample):
+        self.stats.add(sample)
+        if self.stats.n < self.params["min_samples"]:
+            return False
+        variance = self.stats.variance
+        if np.any(variance[2:] > self.params["moving_gyro_std"] ** 2):
+            self.stats = RunningStats()
+            self.restarts += 1
+            return False
+        return bool(np.all(variance / self.stats.n <= self._target)
+                    or self.stats.n >= self.params["max_samples"])
+
+
+def streaming_calibration(samples, timestamps, params=CALIBRATION):
+    calibrator = StreamingCalibrator(params)
+    start = timestamps[0]
+    index = 0
+    for index, sample in enumerate(samples):
+        if timestamps[index] - start >= params["timeout_ms"]:
+            break
+        if calibrator.add(sample):
+            break
+    stats = calibrator.stats
+    return Calibration(stats.mean.copy(), index, stats.n, calibrator.restarts)
+
+
+# refineGyroBias(): raw rates averaged over bias_window still samples pull the
+# bias bias_gain of the way towards their mean
+class GyroBiasTracker:
+    def __init__(self, bias, params=CALIBRATION):
+        self.params = params
+        self.bias = np.array(bias, dtype=np.float64)
+        self._reset()
+
+    def _reset(self):
+        self._n = 0
+        self._sum = np.zeros(3)
+
+    # acc: m/s^2, raw_gyro: deg/s, both length 3; returns the current bias
+    def update(self, acc, raw_gyro):
+        p = self.params
+        still = (abs(np.sqrt(np.dot(acc, acc)) - G) < p["still_accel"]
+                 and np.all(np.abs(raw_gyro - self.bias) < p["still_gyro"]))
+        if not still:
+            self._reset()
+            return self.bias
+        self._n += 1
+        self._sum += raw_gyro
+        if self._n >= p["bias_window"]:
+            self.bias += p["bias_gain"] * (self._sum / self._n - self.bias)
+            self._reset()
+        return self.bias
+
+
+# Per-row GyroErrorZ over the run after calibration, for both procedures
+def runtime_bias_z(samples, acc, calibration, track):
+    start = calibration.ready_index + 1
+    if not track:
+        return np.full(len(samples) - start, calibration.offsets[4])
+    tracker = GyroBiasTracker(calibration.offsets[2:])
+    bias = np.empty(len(samples) - start)
+    for i in range(start, len(samples)):
+        bias[i - start] = tracker.update(acc[i], samples[i, 2:])[2]
+    return bias
+
+
+def compare(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamps, still=None,
+            true_bias_z=None):
+    samples = calibration_samples(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z)
+    acc = np.column_stack([acc_x, acc_y, acc_z]).astype(np.float64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    dt = np.diff(timestamps, prepend=timestamps[0]) / 1000.0
+    if still is None:
+        # Without ground truth, call the device still where a generous
+        # threshold sees no rotation
+        still = np.all(np.abs(samples[:, 2:] - np.median(samples[:, 2:], axis=0)) < 5.0, axis=1)
+
+    reports = {}
+    for name, result, track in (
+            ("fixed", fixed_calibration(samples), False),
+            ("streaming", streaming_calibration(samples, timestamps), True)):
+        start = result.ready_index + 1
+        bias_z = runtime_bias_z(samples, acc, result, track)
+        mask = still[start:]
+        drift = np.sum(((samples[start:, 4] - bias_z) * dt[start:])[mask])
+        bias_error = None
+        if true_bias_z is not None:
+            bias_error = abs(bias_z[-1] - true_bias_z[-1])
+        reports[name] = CalibrationReport(
+            ready_seconds=(timestamps[result.ready_index] - timestamps[0]) / 1000.0
+            + CALIBRATION["period_ms"] / 1000.0,
+            offsets=result.offsets,
+            still_seconds=float(np.sum(dt[start:][mask])),
+            still_yaw_drift=abs(float(drift)),
+            bias_error=bias_error,
+        )
+    return reports
+
+
+# Bench log: the board is handled for the first seconds after power-on, then
+# sits on a table with the odd rotation about Z while the gyro bias drifts as
+# the chip warms up. Returns raw columns, timestamps, a still mask and the
+# true Z bias in deg/s.
+def synthetic_calibration_log(seconds=600, rate_hz=200, handling_seconds=1.5, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(seconds * rate_hz)
+    t = np.arange(n) / rate_hz
+
+    bias = np.array([0.8, -0.5, 0.3])[:, None] + np.array([0.1, 0.05, 0.4])[:, None] * (
+        1 - np.exp(-t / 120.0))
+    rate = np.zeros((3, n))
+    acc = np.zeros((3, n))
+    acc[2] = G
+
+    handling = t < handling_seconds
+    rate[:, handling] = 40 * np.sin(2 * np.pi * np.array([0.7, 1.1, 0.5])[:, None] * t[handling])
+    acc[:, handling] += rng.normal(0, 2.0, (3, int(handling.sum())))
+
+    turning = (t % 60 >= 30) & (t % 60 < 34)
+    rate[2, turning] = 45.0
+
+    gyro = (rate + bias + rng.normal(0, 0.05, (3, n))) / float(RAD_TO_DEG)
+    acc += rng.normal(0, 0.05, (3, n))
+    timestamps = np.round(t * 1000)
+    still = ~(handling | turning)
+    columns = tuple(c.astype(np.float32) for c in (*acc, *gyro))
+    return columns, timestamps, still, bias[2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare fixed and streaming IMU calibration")
+    parser.add_argument("--store", help="TelemetryStore root holding raw acc_*/gyro_* columns")
+    parser.add_argument("--device")
+    parser.add_argument("--handling", type=float, default=1.5,
+                        help="seconds the synthetic board is moved after power-on")
+    args = parser.parse_args()
+
+    if args.store:
+        from telemetry_store import TelemetryStore
+
+        names = ["acc_x", "acc_y", "acc_z", "gyro_x", "gyro_y", "gyro_z", "timestamp"]
+        data = TelemetryStore(args.store).read(args.device, columns=names)
+        reports = compare(*(data[name] for name in names))
+    else:
+        columns, timestamps, still, true_bias_z = synthetic_calibration_log(
+            handling_seconds=args.handling)
+        reports = compare(*columns, timestamps, still=still, true_bias_z=true_bias_z)
+
+    for name, report in reports.items():
+        gyro = ", ".join(f"{v:.3f}" for v in report.offsets[2:])
+        print(f"{name}:")
+        print(f"  ready after     {report.ready_seconds:.2f} s")
+        print(f"  offsets         accel {report.offsets[0]:.2f}, {report.offsets[1]:.2f} deg, "
+              f"gyro {gyro} deg/s")
+        print(f"  yaw drift       {report.still_yaw_drift:.1f} deg over "
+              f"{report.still_seconds:.0f} s still")
+        if report.bias_error is not None:
+            print(f"  Z bias error    {report.bias_error:.3f} deg/s at the end of the log")
@@ -0,0 +1,161 @@
+# Batch replay of the complementary filter that loop() runs in the generated sketch
+#
+# The sketch (see arduino_code in script_4.py) does, once per loop pass:
+#   accAngleX = atan(AccY / sqrt(AccX^2 + AccZ^2)) * 180 / PI - AccErrorX
+#   accAngleY = atan(-AccX / sqrt(AccY^2 + AccZ^2)) * 180 / PI - AccErrorY
+#   roll  = alpha * (roll  + GyroX * elapsedTime) + (1 - alpha) * accAngleX
+#   pitch = alpha * (pitch + GyroY * elapsedTime) + (1 - alpha) * accAngleY
+#   yaw   = yaw + GyroZ * elapsedTime
+#
+# roll/pitch are a first order IIR with a constant pole at alpha, so a whole
+# recording can be pushed through scipy.signal.lfilter in one call instead of
+# stepping sample by sample. Yaw is a plain running sum.
+
+import numpy as np
+from scipy.signal import lfilter
+
+RAD_TO_DEG = np.float32(180 / np.pi)
+ALPHA = 0.96
+
+
+# Accelerometer tilt angles in degrees, one vectorized pass over whole columns
+def accel_angles(acc_x, acc_y, acc_z, acc_error_x=0.0, acc_error_y=0.0):
+    acc_x = np.asarray(acc_x, dtype=np.float32)
+    acc_y = np.asarray(acc_y, dtype=np.float32)
+    acc_z = np.asarray(acc_z, dtype=np.float32)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acc_angle_x = np.arctan(acc_y / np.sqrt(acc_x * acc_x + acc_z * acc_z)) * RAD_TO_DEG
+        acc_angle_y = np.arctan(-acc_x / np.sqrt(acc_y * acc_y + acc_z * acc_z)) * RAD_TO_DEG
+    acc_angle_x -= np.float32(acc_error_x)
+    acc_angle_y -= np.float32(acc_error_y)
+    return acc_angle_x, acc_angle_y
+
+
+# elapsedTime in seconds for every sample, from millis() style timestamps
+def elapsed_seconds(timestamps, start_time=None):
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if start_time is None:
+        start_time = timestamps[0] if len(timestamps) else 0.0
+    dt = np.diff(timestamps, prepend=start_time) / 1000.0
+    return dt.astype(np.float32)
+
+
+class ComplementaryFilter:
+    # Stateful wrapper so long recordings can be fed in chunks; the state carried
+    # between calls is exactly what the sketch keeps in globals
+    # (roll, pitch, yaw and the previous millis() value).
+
+    def __init__(self, alpha=ALPHA, acc_error=(0.0, 0.0), gyro_error=(0.0, 0.0, 0.0),
+                 roll=0.0, pitch=0.0, yaw=0.0, start_time=None):
+        self.alpha = np.float32(alpha)
+        self.acc_error = acc_error
+        self.gyro_error = np.asarray(gyro_error, dtype=np.float32)
+        self.roll = np.float32(roll)
+        self.pitch = np.float32(pitch)
+        self.yaw = np.float32(yaw)
+        self.last_time = start_time
+
+    # Gyro columns are in rad/s and accel in m/s^2, as returned by mpu.getEvent()
+    def update(self, acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamps):
+        dt = elapsed_seconds(timestamps, self.last_time)
+        if len(dt) == 0:
+            empty = np.empty(0, dtype=np.float32)
+            return empty, empty.copy(), empty.copy()
+        self.last_time = float(np.asarray(timestamps)[-1])
+
+        acc_angle_x, acc_angle_y = accel_angles(acc_x, acc_y, acc_z, *self.acc_error)
+        gyro_x = np.asarray(gyro_x, dtype=np.float32) * RAD_TO_DEG - self.gyro_error[0]
+        gyro_y = np.asarray(gyro_y, dtype=np.float32) * RAD_TO_DEG - self.gyro_error[1]
+        gyro_z = np.asarray(gyro_z, dtype=np.float32) * RAD_TO_DEG - self.gyro_error[2]
+
+        alpha = self.alpha
+        beta = np.float32(1) - alpha
+        den = np.array([1, -alpha], dtype=np.float32)
+        num = np.array([1], dtype=np.float32)
+
+        # y[n] = alpha * y[n-1] + (alpha * gyro[n] * dt[n] + (1 - alpha) * acc[n])
+        drive_x = alpha * (gyro_x * dt) + beta * acc_angle_x
+        drive_y = alpha * (gyro_y * dt) + beta * acc_angle_y
+        roll, _ = lfilter(num, den, drive_x, zi=np.array([alpha * self.roll], dtype=np.float32))
+        pitch, _ = lfilter(num, den, drive_y, zi=np.array([alpha * self.pitch], dtype=np.float32))
+
+        yaw = np.cumsum(gyro_z * dt, dtype=np.float32)
+        yaw += self.yaw
+
+        self.roll, self.pitch, self.yaw = roll[-1], pitch[-1], yaw[-1]
+        return roll.astype(np.float32, copy=False), pitch.astype(np.float32, copy=False), yaw
+
+
+# One-shot replay of a whole recording; returns (roll, pitch, yaw) float32 arrays
+def complementary_filter(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamps, **kwargs):
+    return ComplementaryFilter(**kwargs).update(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamps)
+
+
+# Sample-by-sample port of loop(), kept as the ground truth for the batch path
+def complementary_filter_reference(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamps,
+                                   alpha=ALPHA, start_time=None):
+    f32 = np.float32
+    alpha = f32(alpha)
+    n = len(timestamps)
+    out = np.zeros((3, n), dtype=np.float32)
+    roll = pitch = yaw = f32(0)
+    previous_time = timestamps[0] if start_time is None else start_time
+    for i in range(n):
+        elapsed = f32((timestamps[i] - previous_time) / 1000.0)
+        previous_time = timestamps[i]
+        ax, ay, az = f32(acc_x[i]), f32(acc_y[i]), f32(acc_z[i])
+        acc_angle_x = f32(np.arctan(ay / np.sqrt(ax * ax + az * az)) * RAD_TO_DEG)
+        acc_angle_y = f32(np.arctan(-ax / np.sqrt(ay * ay + az * az)) * RAD_TO_DEG)
+        gx = f32(gyro_x[i]) * RAD_TO_DEG
+        gy = f32(gyro_y[i]) * RAD_TO_DEG
+        gz = f32(gyro_z[i]) * RAD_TO_DEG
+        roll = alpha * (roll + gx * elapsed) + (f32(1) - alpha) * acc_angle_x
+        pitch = alpha * (pitch + gy * elapsed) + (f32(1) - alpha) * acc_angle_y
+        yaw = yaw + gz * elapsed
+        out[:, i] = roll, pitch, yaw
+    return out[0], out[1], out[2]
+
+
+# Synthetic MPU6050 recording: slow tilting plus sensor noise, 100 Hz millis() stamps
+def synthetic_recording(n, rate_hz=100, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n) / rate_hz
+    roll = np.radians(30 * np.sin(0.3 * t))
+    pitch = np.radians(25 * np.cos(0.25 * t))
+    g = 9.81
+    acc_x = -g * np.sin(pitch) + rng.normal(0, 0.05, n)
+    acc_y = g * np.sin(roll) * np.cos(pitch) + rng.normal(0, 0.05, n)
+    acc_z = g * np.cos(roll) * np.cos(pitch) + rng.normal(0, 0.05, n)
+    gyro_x = np.gradient(roll, t) + rng.normal(0, 0.002, n)
+    gyro_y = np.gradient(pitch, t) + rng.normal(0, 0.002, n)
+    gyro_z = rng.normal(0, 0.002, n)
+    timestamps = np.round(t * 1000)
+    columns = (acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z)
+    return tuple(c.astype(np.float32) for c in columns) + (timestamps,)
+
+
+# True roll and pitch (degrees) of synthetic_recording() at millis() timestamps
+def synthetic_truth(timestamps):
+    t = np.asarray(timestamps, dtype=np.float64) / 1000.0
+    return 30 * np.sin(0.3 * t), 25 * np.cos(0.25 * t)
+
+
+if __name__ == "__main__":
+    import time
+
+    # Agreement with the per-sample port of loop()
+    columns = synthetic_recording(20000)
+    batch = complementary_filter(*columns)
+    reference = complementary_filter_reference(*columns)
+    for name, b, r in zip(("roll", "pitch", "yaw"), batch, reference):
+        err = np.max(np.abs(b - r))
+        print(f"{name:5s} max |batch - reference| = {err:.2e} deg")
+
+    # Throughput on one core
+    n = 10_000_000
+    columns = synthetic_recording(n)
+    start = time.perf_counter()
+    complementary_filter(*columns)
+    elapsed = time.perf_counter() - start
+    print(f"{n:,} samples in {elapsed:.3f} s -> {n / elapsed / 1e6:.1f} M samples/s")
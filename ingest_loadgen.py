@@ -0,0 +1,110 @@
+# Load generator for ingest_server.py
+#
+# Opens one MQTT connection per simulated board and publishes the exact JSON
+# that sendToCloud() builds. By default an in-process IngestServer is started
+# as the local broker stand-in, which lets the generator match each committed
+# record back to its send time and report end-to-end ingest latency.
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+import mqtt_protocol as mqtt
+from ingest_server import DeviceRegistry, IngestServer
+
+
+class LatencySink:
+    def __init__(self, sent):
+        self.sent = sent
+        self.latencies = []
+        self.count = 0
+
+    def __call__(self, batch):
+        now = time.perf_counter()
+        for record in batch:
+            sent_at = self.sent.pop((record.device, record.timestamp), None)
+            if sent_at is not None:
+                self.latencies.append(now - sent_at)
+        self.count += len(batch)
+
+
+def percentile(values, q):
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def run_device(host, port, token, device, rate, stop_at, sent):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(mqtt.encode_connect("ESP32Client", token, ""))
+    packet_type, _, body = await mqtt.read_packet(reader)
+    if packet_type != mqtt.CONNACK or body[1] != mqtt.ACCEPTED:
+        writer.close()
+        return 0
+
+    period = 1.0 / rate
+    boot = time.perf_counter() - random.uniform(0, 3600)
+    await asyncio.sleep(random.uniform(0, period))
+    published = 0
+    next_send = time.perf_counter()
+    while time.perf_counter() < stop_at:
+        now = time.perf_counter()
+        millis = int((now - boot) * 1000) + published  # unique per device
+        payload = json.dumps({
+            "roll": round(random.uniform(-90, 90), 2),
+            "pitch": round(random.uniform(-90, 90), 2),
+            "yaw": round(random.uniform(-180, 180), 2),
+            "temperature": 25.0,
+            "timestamp": millis,
+        })
+        sent[(device, millis)] = now
+        writer.write(mqtt.encode_publish(mqtt.TELEMETRY_TOPIC, payload))
+        await writer.drain()
+        published += 1
+        next_send += period
+        await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+    writer.write(mqtt.DISCONNECT_PACKET)
+    await writer.drain()
+    writer.close()
+    return published
+
+
+async def main(args):
+    registry = DeviceRegistry({f"token-{i}": f"device-{i}" for i in range(args.devices)})
+    sent = {}
+    sink = LatencySink(sent)
+    server = await IngestServer(registry, sink, host="127.0.0.1", port=0,
+                                batch_size=args.batch_size).start()
+
+    stop_at = time.perf_counter() + args.duration
+    start = time.perf_counter()
+    devices = [
+        run_device("127.0.0.1", server.port, f"token-{i}", f"device-{i}",
+                   args.rate, stop_at, sent)
+        for i in range(args.devices)
+    ]
+    published = sum(await asyncio.gather(*devices))
+    await server.close()
+    elapsed = time.perf_counter() - start
+
+    print(f"Devices:          {args.devices}")
+    print(f"Published:        {published:,} messages in {elapsed:.1f} s")
+    print(f"Committed:        {sink.count:,} records in {server.stats['batches']} batches")
+    print(f"Throughput:       {sink.count / elapsed:,.0f} messages/s")
+    print(f"Latency p50:      {percentile(sink.latencies, 50) * 1000:.1f} ms")
+    print(f"Latency p99:      {percentile(sink.latencies, 99) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for the ingest server")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="messages per second per device (sketch: 1)")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,464 @@
+# Self-hosted MQTT telemetry ingest for boards running the generated sketch
+#
+# Speaks the same contract as ThingsBoard for sendToCloud(): the device token is
+# the MQTT username and telemetry JSON is published to v1/devices/me/telemetry
+# (packed binary frames from telemetry_codec.py go to .../telemetry/packed).
+# With a raw_sink, raw MPU6050 FIFO frames on .../telemetry/raw (see
+# mpu6050_fifo.py) are decoded into RawImuBatch and committed to it alongside.
+# Every connection is served on one asyncio event loop; decoded records are
+# buffered and committed to storage in batches from a background task, so a
+# slow disk never stalls the sockets. At most max_pending records wait for
+# the sink (later ones are dropped and counted in stats), and a sink that
+# raises loses that batch but not the committer.
+#
+# The downlink follows ThingsBoard too: set_attributes() pushes shared
+# attributes (the sketch's runtime rates) to subscribed devices and answers
+# their attribute requests, rpc() sends a request and waits for the reply.
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import struct
+import time
+from collections import namedtuple
+
+import mqtt_protocol as mqtt
+from mpu6050_fifo import decode_raw, to_si
+from telemetry_codec import decode_frame
+
+TelemetryRecord = namedtuple(
+    "TelemetryRecord",
+    ["device", "timestamp", "roll", "pitch", "yaw", "temperature", "received"],
+)
+
+# One raw message: board millis per sample, acc/gyro columns in SI units
+# (mpu6050_fifo.to_si) and temperature
+RawImuBatch = namedtuple(
+    "RawImuBatch",
+    ["device", "rate_hz", "timestamp", "columns", "temperature", "received"],
+)
+
+TELEMETRY_FIELDS = ("roll", "pitch", "yaw", "temperature")
+
+log = logging.getLogger(__name__)
+
+
+# In-memory token -> device index used to authenticate CONNECT
+class DeviceRegistry:
+    def __init__(self, tokens=None):
+        self._by_token = dict(tokens or {})
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def add(self, token, device):
+        self._by_token[token] = device
+
+    def remove(self, token):
+        self._by_token.pop(token, None)
+
+    def lookup(self, token):
+        return self._by_token.get(token)
+
+    def __len__(self):
+        return len(self._by_token)
+
+
+# Default sink: keeps committed records in a list (tests, load generator)
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, batch):
+        self.records.extend(batch)
+
+
+def _value(values, key):
+    value = values.get(key)
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return math.nan
+    try:
+        return float(value)
+    except OverflowError:
+        return math.nan
+
+
+# Board millis() as an int, or None when missing or not a usable number
+def _timestamp(value):
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return None
+    if not (math.isfinite(value) and -(1 << 63) <= value < 1 << 63):
+        return None
+    return int(value)
+
+
+# Telemetry payload -> list of TelemetryRecord. Accepts the flat object that
+# sendToCloud() builds and the ThingsBoard [{"ts": ..., "values": {...}}] form.
+def decode_telemetry(device, payload, received):
+    data = json.loads(payload)
+    items = data if isinstance(data, list) else [data]
+    records = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        values = item.get("values", item)
+        if not isinstance(values, dict):
+            continue
+        records.append(TelemetryRecord(
+            device,
+            _timestamp(item.get("ts", values.get("timestamp"))),
+            *(_value(values, key) for key in TELEMETRY_FIELDS),
+            received,
+        ))
+    return records
+
+
+# Packed binary frame -> list of TelemetryRecord. The device comes from the
+# authenticated token; the id inside the frame is informational only.
+def decode_packed_telemetry(device, payload, received):
+    _, columns = decode_frame(payload)
+    return list(map(
+        TelemetryRecord,
+        [device] * len(columns["timestamp"]),
+        columns["timestamp"].tolist(),
+        columns["roll"].tolist(),
+        columns["pitch"].tolist(),
+        columns["yaw"].tolist(),
+        columns["temperature"].tolist(),
+        [received] * len(columns["timestamp"]),
+    ))
+
+
+# Raw FIFO message -> [RawImuBatch]
+def decode_raw_telemetry(device, payload, received):
+    rate_hz, timestamps, frames = decode_raw(payload)
+    columns, temperature = to_si(frames)
+    return [RawImuBatch(device, rate_hz, timestamps, columns, temperature, received)]
+
+
+class IngestServer:
+    def __init__(self, registry, sink=None, host="0.0.0.0", port=1883,
+                 batch_size=5000, flush_interval=0.05, max_pending=500_000, raw_sink=None,
+                 on_connection=None):
+        self.registry = registry
+        self.sink = sink if sink is not None else MemorySink()
+        # Receives lists of RawImuBatch; raw messages are ignored without one
+        self.raw_sink = raw_sink
+        # Called on the event loop as on_connection(device, connected) when a
+        # device's session opens and when it ends
+        self.on_connection = on_connection
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Records held while the sink is slow or failing; beyond this new
+        # ones are dropped (and counted) rather than growing without bound
+        self.max_pending = max_pending
+
+        # device -> StreamWriter of its live connection
+        self.clients = {}
+        # device -> shared attributes, kept across reconnects
+        self.attributes = {}
+        self.stats = {
+            "connections": 0,
+            "rejected": 0,
+            "messages": 0,
+            "decode_errors": 0,
+            "committed": 0,
+            "raw_committed": 0,
+            "batches": 0,
+            "dropped": 0,
+            "sink_errors": 0,
+            "last_commit_seconds": 0.0,
+            "downlink": 0,
+        }
+
+        self._pending = []
+        self._raw_pending = []
+        self._raw_samples = 0
+        self._flush_now = asyncio.Event()
+        self._server = None
+        self._tasks = []
+        self._last_seen = {}
+        self._subscriptions = {}
+        self._rpc_ids = itertools.count(1)
+        self._rpc_waiting = {}
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    # Receive time of the oldest record waiting for the next commit, or None
+    @property
+    def oldest_pending(self):
+        return self._pending[0].received if self._pending else None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_client, self.host, self.port, backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._tasks = [
+            asyncio.create_task(self._committer()),
+            asyncio.create_task(self._reaper()),
+        ]
+        return self
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        for writer in list(self.clients.values()):
+            writer.close()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._server.wait_closed()
+        await self.flush()
+
+    # Commit whatever is buffered right now
+    async def flush(self):
+        if self._pending:
+            batch, self._pending = self._pending, []
+            await self._commit(self.sink, batch, len(batch), "committed")
+        if self._raw_pending:
+            raw, self._raw_pending = self._raw_pending, []
+            samples, self._raw_samples = self._raw_samples, 0
+            await self._commit(self.raw_sink, raw, samples, "raw_committed")
+
+    async def _commit(self, sink, batch, count, counter):
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(sink, batch)
+        except Exception:
+            self.stats["dropped"] += count
+            raise
+        self.stats["last_commit_seconds"] = time.perf_counter() - start
+        self.stats[counter] += count
+        self.stats["batches"] += 1
+
+    # A failing sink loses that batch, not the committer: the next batch is
+    # tried as usual
+    async def _committer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush()
+            except Exception:
+                self.stats["sink_errors"] += 1
+                log.exception("sink failed, batch dropped")
+
+    # Drop connections that missed 1.5x their keepalive, as a broker would
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for writer, (deadline, _) in list(self._last_seen.items()):
+                if deadline and now > deadline:
+                    writer.close()
+
+    # Publish to a device if it is connected and subscribed to the topic
+    def send(self, device, topic, payload):
+        writer = self.clients.get(device)
+        if writer is None or not any(mqtt.topic_matches(f, topic)
+                                     for f in self._subscriptions.get(writer, ())):
+            return False
+        writer.write(mqtt.encode_publish(topic, payload))
+        self.stats["downlink"] += 1
+        return True
+
+    # Merge values into a device's shared attributes and push the change.
+    # Returns whether it went out now; otherwise the device picks it up with
+    # its attribute request after the next connect.
+    def set_attributes(self, device, values):
+        self.attributes.setdefault(device, {}).update(values)
+        return self.send(device, mqtt.ATTRIBUTES_TOPIC, json.dumps(values))
+
+    # Call a method on a device and wait for its reply (the decoded JSON)
+    async def rpc(self, device, method, params=None, timeout=5.0):
+        request_id = str(next(self._rpc_ids))
+        reply = asyncio.get_running_loop().create_future()
+        self._rpc_waiting[(device, request_id)] = reply
+        try:
+            request = json.dumps({"method": method, "params": params or {}})
+            if not self.send(device, mqtt.RPC_REQUEST_PREFIX + request_id, request):
+                raise ConnectionError(f"{device} is not subscribed to RPC requests")
+            return await asyncio.wait_for(reply, timeout)
+        finally:
+            self._rpc_waiting.pop((device, request_id), None)
+
+    def _touch(self, writer, keepalive):
+        deadline = time.monotonic() + 1.5 * keepalive if keepalive else 0
+        self._last_seen[writer] = (deadline, keepalive)
+
+    async def _handle_client(self, reader, writer):
+        device = None
+        try:
+            packet_type, _, body = await asyncio.wait_for(mqtt.read_packet(reader), 10)
+            if packet_type != mqtt.CONNECT:
+                return
+            connect = mqtt.decode_connect(body)
+            # Every board connects as "ESP32Client", so sessions are keyed by
+            # the token's device rather than the MQTT client id.
+            device = self.registry.lookup(connect["username"])
+            if device is None:
+                self.stats["rejected"] += 1
+                writer.write(mqtt.encode_connack(mqtt.BAD_CREDENTIALS))
+                await writer.drain()
+                device = None
+                return
+
+            previous = self.clients.get(device)
+            if previous is not None:
+                previous.close()
+            self.clients[device] = writer
+            self.stats["connections"] += 1
+            if self.on_connection is not None:
+                self.on_connection(device, True)
+            keepalive = connect["keepalive"]
+            self._touch(writer, keepalive)
+            writer.write(mqtt.encode_connack(mqtt.ACCEPTED))
+            await writer.drain()
+
+            while True:
+                packet_type, flags, body = await mqtt.read_packet(reader)
+                self._touch(writer, keepalive)
+                if packet_type == mqtt.PUBLISH:
+                    topic, payload, qos, packet_id = mqtt.decode_publish(flags, body)
+                    self._on_publish(device, topic, payload)
+                    if qos == 1:
+                        writer.write(mqtt.encode_puback(packet_id))
+                elif packet_type == mqtt.PINGREQ:
+                    writer.write(mqtt.PINGRESP_PACKET)
+                elif packet_type == mqtt.SUBSCRIBE:
+                    packet_id, topics = mqtt.decode_subscribe(body)
+                    self._subscriptions.setdefault(writer, set()).update(
+                        topic for topic, _ in topics)
+                    writer.write(mqtt.encode_suback(packet_id, [0] * len(topics)))
+                elif packet_type == mqtt.DISCONNECT:
+                    return
+        # A packet the codec cannot parse ends the session, as a broker would
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError,
+                mqtt.ProtocolError, struct.error, IndexError, UnicodeDecodeError):
+            pass
+        finally:
+            self._last_seen.pop(writer, None)
+            self._subscriptions.pop(writer, None)
+            if device is not None and self.clients.get(device) is writer:
+                del self.clients[device]
+                if self.on_connection is not None:
+                    self.on_connection(device, False)
+            writer.close()
+
+    def _on_publish(self, device, topic, payload):
+        if topic == mqtt.TELEMETRY_TOPIC:
+            decode = decode_telemetry
+        elif topic == mqtt.PACKED_TELEMETRY_TOPIC:
+            decode = decode_packed_telemetry
+        elif topic == mqtt.RAW_TELEMETRY_TOPIC and self.raw_sink is not None:
+            decode = decode_raw_telemetry
+        elif topic.startswith(mqtt.ATTRIBUTES_REQUEST_PREFIX):
+            request_id = topic[len(mqtt.ATTRIBUTES_REQUEST_PREFIX):]
+            self.send(device, mqtt.ATTRIBUTES_RESPONSE_PREFIX + request_id,
+                      json.dumps({"shared": self.attributes.get(device, {})}))
+            return
+        elif topic.startswith(mqtt.RPC_RESPONSE_PREFIX):
+            waiting = self._rpc_waiting.get((device, topic[len(mqtt.RPC_RESPONSE_PREFIX):]))
+            if waiting is not None and not waiting.done():
+                try:
+                    waiting.set_result(json.loads(payload))
+                except ValueError as e:
+                    waiting.set_exception(e)
+            return
+        else:
+            return
+        self.stats["messages"] += 1
+        try:
+            records = decode(device, payload, time.time())
+        except (ValueError, TypeError, RecursionError):
+            self.stats["decode_errors"] += 1
+            return
+        if decode is decode_raw_telemetry:
+            samples = len(records[0].timestamp)
+            if self._raw_samples + samples > self.max_pending:
+                self.stats["dropped"] += samples
+                self._flush_now.set()
+                return
+            self._raw_pending.extend(records)
+            self._raw_samples += samples
+            if self._raw_samples >= self.batch_size:
+                self._flush_now.set()
+            return
+        if len(self._pending) + len(records) > self.max_pending:
+            self.stats["dropped"] += len(records)
+            self._flush_now.set()
+            return
+        self._pending.extend(records)
+        if len(self._pending) >= self.batch_size:
+            self._flush_now.set()
+
+
+# Sink committing to a TelemetryStore at root with rollups in root/rollups,
+# plus the store and the RollupPyramid (which must be flushed on shutdown)
+# for readers in the same process
+def store_sinks(root):
+    import os
+
+    from rollup_pyramid import RollupPyramid, RollupSink
+    from telemetry_store import StoreSink, TelemetryStore
+
+    store = TelemetryStore(root)
+    pyramid = RollupPyramid(os.path.join(root, "rollups"))
+    return RollupSink(pyramid, StoreSink(store)), store, pyramid
+
+
+# raw_sink for root: vibration rows in root/vibration, the raw samples
+# themselves in root/raw (the sink buffers both and must be closed on
+# shutdown)
+def raw_sinks(root, workers=None):
+    import os
+
+    from telemetry_store import TelemetryStore
+    from vibration_analytics import VIBRATION_SCHEMA, VibrationSink
+
+    return VibrationSink(TelemetryStore(os.path.join(root, "vibration"), VIBRATION_SCHEMA),
+                         TelemetryStore(os.path.join(root, "raw")), workers=workers)
+
+
+async def _main(args):
+    registry = DeviceRegistry.from_file(args.tokens)
+    sink, _, pyramid = store_sinks(args.store) if args.store else (None, None, None)
+    raw_sink = raw_sinks(args.store) if args.store else None
+    server = await IngestServer(registry, sink, host=args.host, port=args.port,
+                                batch_size=args.batch_size, raw_sink=raw_sink).start()
+    print(f"Ingest server listening on {args.host}:{server.port} "
+          f"for {len(registry)} devices")
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+        if pyramid is not None:
+            pyramid.flush()
+        if raw_sink is not None:
+            raw_sink.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MQTT telemetry ingest server")
+    parser.add_argument("--tokens", required=True,
+                        help="JSON file mapping device token -> device name")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--store", help="TelemetryStore root, with rollups kept in <store>/rollups and "
+                             "raw IMU data in <store>/raw and <store>/vibration")
+    asyncio.run(_main(parser.parse_args()))
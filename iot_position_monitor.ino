@@ -61,9 +61,33 @@ PubSubClient mqttClient(wifiClient);
 float AccX, AccY, AccZ;
 float GyroX, GyroY, GyroZ;
 float roll, pitch, yaw = 0;
+float temperature = 0;
 float AccErrorX = 0, AccErrorY = 0;
 float GyroErrorX = 0, GyroErrorY = 0, GyroErrorZ = 0;
 
+// Streaming calibration (see imu_calibration.py): Welford running mean and
+// variance of accel roll/pitch (deg) and gyro x/y/z (deg/s)
+#define CAL_AXES 5
+struct RunningStats {
+  uint32_t n;
+  float mean[CAL_AXES];
+  float m2[CAL_AXES];
+};
+const unsigned long calibrationPeriod = 5;
+const uint32_t minCalibrationSamples = 50;
+const uint32_t maxCalibrationSamples = 400;
+const unsigned long calibrationTimeout = 10000;
+const float accelTargetSem = 0.05;
+const float gyroTargetSem = 0.01;
+const float movingGyroStd = 1.0;
+
+// Runtime gyro bias refinement while the device is still
+const float stillAccelTolerance = 0.5;
+const float stillGyroTolerance = 2.0;
+const uint32_t biasWindow = 200;
+const float biasGain = 0.25;
+RunningStats stillStats = {};
+
 // Timing variables
 unsigned long previousTime = 0;
 unsigned long currentTime = 0;
@@ -74,11 +98,63 @@ float alpha = 0.96;
 
 // Display update timing
 unsigned long lastDisplayUpdate = 0;
-const unsigned long displayInterval = 100; // Update every 100ms
+unsigned long displayInterval = 100; // Update every 100ms, the server can change it
+
+// Dirty-region display: the panel's last known contents, one byte per
+// 8-pixel column of a page, and the fields redrawn when their text changes
+#define OLED_CHUNK 127 // Data bytes per I2C write; ESP32's Wire buffer is 128
+uint8_t oledShown[SCREEN_WIDTH * SCREEN_HEIGHT / 8];
+bool displayDirty = false;
+
+struct DisplayField {
+  int16_t x, y, w, h;
+  char text[24];
+};
+DisplayField rollField = {42, 15, 86, 8};
+DisplayField pitchField = {42, 25, 86, 8};
+DisplayField yawField = {42, 35, 86, 8};
+DisplayField wifiField = {0, 50, 128, 7}; // 7 rows, row 57 is the cloud line's top
+DisplayField cloudField = {0, 57, 128, 7};
 
 // Cloud update timing
 unsigned long lastCloudUpdate = 0;
-const unsigned long cloudInterval = 1000; // Send to cloud every 1 second
+unsigned long cloudInterval = 1000; // Send to cloud every 1 second, the server can change it
+const int replayBudget = 5; // Queued messages sent per loop pass after an outage
+
+// Readings waiting to be sent; holds the last OFFLINE_QUEUE_SIZE while offline
+#define OFFLINE_QUEUE_SIZE 300
+struct Reading {
+  float roll, pitch, yaw;
+  unsigned long timestamp;
+};
+Reading offlineQueue[OFFLINE_QUEUE_SIZE];
+uint32_t queueHead = 0; // Readings queued so far
+uint32_t queueTail = 0; // Readings sent so far
+
+// Readings per publish, the server can raise it up to maxBatchSize; a batch
+// goes out as a JSON array of the single-reading objects
+uint16_t batchSize = 1;
+const uint16_t maxBatchSize = 10;
+char jsonBuffer[1024];
+
+// Connection state machine, polled from loop() so an outage never blocks sensing
+enum LinkState { LINK_WIFI_WAIT, LINK_MQTT_IDLE, LINK_MQTT_CONNECTING, LINK_ONLINE };
+LinkState linkState = LINK_WIFI_WAIT;
+const unsigned long minBackoff = 500;    // First retry after 0.5 s
+const unsigned long maxBackoff = 30000;  // Retries back off to at most 30 s
+unsigned long linkBackoff = minBackoff;
+unsigned long linkRetryAt = 0;
+volatile bool mqttAttemptDone = false;
+volatile bool mqttAttemptOk = false;
+
+// Downlink: shared attribute updates and setRates RPCs from the server change
+// cloudInterval, batchSize and displayInterval at runtime (see rate_controller.py)
+const char* attributesTopic = "v1/devices/me/attributes";
+const char* rpcRequestPrefix = "v1/devices/me/rpc/request/";
+const unsigned long minCloudInterval = 200;
+const unsigned long maxCloudInterval = 60000;
+const unsigned long minDisplayInterval = 50;
+const unsigned long maxDisplayInterval = 5000;
 
 void setup() {
   Serial.begin(115200);
@@ -126,62 +202,104 @@ void setup() {
 
   calculateIMUError();
 
-  // Initialize WiFi
+  // Initialize WiFi (updateConnection() in loop() completes the connection)
+  WiFi.mode(WIFI_STA);
   WiFi.begin(ssid, password);
-  display.clearDisplay();
-  display.setCursor(0, 0);
-  display.println("Connecting to WiFi...");
-  display.display();
-
-  while (WiFi.status() != WL_CONNECTED) {
-    delay(500);
-    Serial.print(".");
-  }
-
-  Serial.println("");
-  Serial.println("WiFi connected!");
-  Serial.print("IP address: ");
-  Serial.println(WiFi.localIP());
 
   // Initialize MQTT
   mqttClient.setServer(tb_server, tb_port);
+  mqttClient.setCallback(onMqttMessage);
+  mqttClient.setBufferSize(sizeof(jsonBuffer) + 64); // A full batch exceeds the default 256 bytes
 
   display.clearDisplay();
   display.setCursor(0, 0);
   display.println("System Ready!");
-  display.println("WiFi: Connected");
-  display.print("IP: ");
-  display.println(WiFi.localIP());
+  display.println("WiFi: Connecting...");
   display.display();
   delay(2000);
+  drawDisplayChrome();
 
   Serial.println("System initialization complete!");
   currentTime = millis();
 }
 
 void loop() {
-  // Read sensor data
-  sensors_event_t a, g, temp;
-  mpu.getEvent(&a, &g, &temp);
-
   // Get current time
   previousTime = currentTime;
   currentTime = millis();
   elapsedTime = (currentTime - previousTime) / 1000.0;
 
+  // Read sensors and apply the complementary filter
+  updateOrientation();
+
+  // Update display
+  if (millis() - lastDisplayUpdate >= displayInterval) {
+    updateDisplay();
+    lastDisplayUpdate = millis();
+  }
+
+  // Keep WiFi and MQTT up without blocking
+  updateConnection();
+
+  // Queue batchSize readings for the cloud every cloudInterval
+  if (millis() - lastCloudUpdate >= cloudInterval / batchSize) {
+    queueReading();
+    lastCloudUpdate = millis();
+  }
+
+  // Send full batches, including any backlog from an outage
+  if (queueHead - queueTail >= batchSize) {
+    sendToCloud();
+  }
+
+  // Print to serial monitor
+  Serial.print("Roll: "); Serial.print(roll, 2);
+  Serial.print("° | Pitch: "); Serial.print(pitch, 2);
+  Serial.print("° | Yaw: "); Serial.print(yaw, 2);
+  Serial.println("°");
+
+  delay(10); // Small delay for stability
+}
+
+// Accelerometer tilt angles and gyro rates in degrees
+float accelRoll(float x, float y, float z) {
+  return atan(y / sqrt(pow(x, 2) + pow(z, 2))) * 180 / PI;
+}
+
+float accelPitch(float x, float y, float z) {
+  return atan(-1 * x / sqrt(pow(y, 2) + pow(z, 2))) * 180 / PI;
+}
+
+float toDegrees(float radians) {
+  return radians * 180 / PI;
+}
+
+void updateOrientation() {
+  // Read sensor data
+  sensors_event_t a, g, temp;
+  mpu.getEvent(&a, &g, &temp);
+  temperature = temp.temperature;
+  fuseEvents(a, g);
+}
+
+// Complementary filter step over elapsedTime for one accelerometer and gyro reading
+void fuseEvents(const sensors_event_t& a, const sensors_event_t& g) {
   // Read accelerometer data (in m/s²)
   AccX = a.acceleration.x;
   AccY = a.acceleration.y;
   AccZ = a.acceleration.z;
 
   // Calculate roll and pitch from accelerometer
-  float accAngleX = (atan(AccY / sqrt(pow(AccX, 2) + pow(AccZ, 2))) * 180 / PI) - AccErrorX;
-  float accAngleY = (atan(-1 * AccX / sqrt(pow(AccY, 2) + pow(AccZ, 2))) * 180 / PI) - AccErrorY;
+  float accAngleX = accelRoll(AccX, AccY, AccZ) - AccErrorX;
+  float accAngleY = accelPitch(AccX, AccY, AccZ) - AccErrorY;
 
   // Read gyroscope data (in rad/s, convert to deg/s)
-  GyroX = g.gyro.x * 180 / PI - GyroErrorX;
-  GyroY = g.gyro.y * 180 / PI - GyroErrorY;
-  GyroZ = g.gyro.z * 180 / PI - GyroErrorZ;
+  GyroX = toDegrees(g.gyro.x) - GyroErrorX;
+  GyroY = toDegrees(g.gyro.y) - GyroErrorY;
+  GyroZ = toDegrees(g.gyro.z) - GyroErrorZ;
+
+  // Track gyro drift while the device is still
+  refineGyroBias();
 
   // Integrate gyroscope data
   float gyroAngleX = roll + GyroX * elapsedTime;
@@ -191,29 +309,71 @@ void loop() {
   // Apply complementary filter
   roll = alpha * gyroAngleX + (1 - alpha) * accAngleX;
   pitch = alpha * gyroAngleY + (1 - alpha) * accAngleY;
+}
 
-  // Update display
-  if (millis() - lastDisplayUpdate >= displayInterval) {
-    updateDisplay();
-    lastDisplayUpdate = millis();
+// Redraw a field only if its text changed
+void drawField(DisplayField& field, const char* text) {
+  if (strcmp(field.text, text) == 0) {
+    return;
   }
+  strncpy(field.text, text, sizeof(field.text) - 1);
+  display.fillRect(field.x, field.y, field.w, field.h, BLACK);
+  display.setCursor(field.x, field.y);
+  display.print(text);
+  displayDirty = true;
+}
 
-  // Send data to cloud
-  if (millis() - lastCloudUpdate >= cloudInterval) {
-    sendToCloud();
-    lastCloudUpdate = millis();
-  }
+// Push the whole framebuffer and remember it as the panel contents
+void pushFullFrame() {
+  display.display();
+  memcpy(oledShown, display.getBuffer(), sizeof(oledShown));
+}
 
-  // Print to serial monitor
-  Serial.print("Roll: "); Serial.print(roll, 2);
-  Serial.print("° | Pitch: "); Serial.print(pitch, 2);
-  Serial.print("° | Yaw: "); Serial.print(yaw, 2);
-  Serial.println("°");
+// Send only the changed span of each changed page
+void pushDirtyPages() {
+  if (!displayDirty) {
+    return; // Nothing visible changed, skip the frame
+  }
+  displayDirty = false;
+  uint8_t* buffer = display.getBuffer();
+  for (uint8_t page = 0; page < SCREEN_HEIGHT / 8; page++) {
+    uint8_t* row = buffer + page * SCREEN_WIDTH;
+    uint8_t* shown = oledShown + page * SCREEN_WIDTH;
+    int first = 0;
+    while (first < SCREEN_WIDTH && row[first] == shown[first]) {
+      first++;
+    }
+    if (first == SCREEN_WIDTH) {
+      continue;
+    }
+    int last = SCREEN_WIDTH - 1;
+    while (row[last] == shown[last]) {
+      last--;
+    }
 
-  delay(10); // Small delay for stability
+    // Horizontal addressing window covering just this span
+    Wire.beginTransmission(OLED_ADDRESS);
+    Wire.write((uint8_t)0x00); // Command stream
+    Wire.write((uint8_t)SSD1306_COLUMNADDR);
+    Wire.write((uint8_t)first);
+    Wire.write((uint8_t)last);
+    Wire.write((uint8_t)SSD1306_PAGEADDR);
+    Wire.write(page);
+    Wire.write(page);
+    Wire.endTransmission();
+
+    for (int column = first; column <= last; column += OLED_CHUNK) {
+      Wire.beginTransmission(OLED_ADDRESS);
+      Wire.write((uint8_t)0x40); // Data stream
+      Wire.write(row + column, min(OLED_CHUNK, last + 1 - column));
+      Wire.endTransmission();
+    }
+    memcpy(shown + first, row + first, last + 1 - first);
+  }
 }
 
-void updateDisplay() {
+// Static labels, drawn once; updateDisplay() only redraws the values
+void drawDisplayChrome() {
   display.clearDisplay();
 
   // Title
@@ -224,118 +384,309 @@ void updateDisplay() {
   // Draw separator line
   display.drawLine(0, 10, SCREEN_WIDTH, 10, WHITE);
 
-  // Roll value
+  // Value labels
   display.setCursor(0, 15);
   display.print("Roll:  ");
-  display.print(roll, 1);
-  display.println("°");
-
-  // Pitch value
   display.setCursor(0, 25);
   display.print("Pitch: ");
-  display.print(pitch, 1);
-  display.println("°");
-
-  // Yaw value
   display.setCursor(0, 35);
   display.print("Yaw:   ");
-  display.print(yaw, 1);
-  display.println("°");
 
-  // Connection status
-  display.setCursor(0, 50);
-  if (WiFi.status() == WL_CONNECTED) {
-    display.print("WiFi: OK");
-  } else {
-    display.print("WiFi: DISCONNECTED");
-  }
+  pushFullFrame();
+}
 
-  display.setCursor(0, 57);
-  if (mqttClient.connected()) {
-    display.print("Cloud: CONNECTED");
-  } else {
-    display.print("Cloud: OFFLINE");
-  }
+void updateDisplay() {
+  char text[24];
 
-  display.display();
+  // Roll value
+  snprintf(text, sizeof(text), "%.1f°", roll);
+  drawField(rollField, text);
+
+  // Pitch value
+  snprintf(text, sizeof(text), "%.1f°", pitch);
+  drawField(pitchField, text);
+
+  // Yaw value
+  snprintf(text, sizeof(text), "%.1f°", yaw);
+  drawField(yawField, text);
+
+  // Connection status
+  drawField(wifiField, WiFi.status() == WL_CONNECTED ? "WiFi: OK" : "WiFi: DISCONNECTED");
+  drawField(cloudField, linkState == LINK_ONLINE ? "Cloud: CONNECTED" : "Cloud: OFFLINE");
+
+  pushDirtyPages();
 }
 
 void sendToCloud() {
-  if (!mqttClient.connected()) {
-    reconnectMQTT();
+  if (linkState != LINK_ONLINE) {
+    return; // Telemetry stays queued until updateConnection() restores the link
   }
 
-  if (mqttClient.connected()) {
-    // Create JSON payload
-    StaticJsonDocument<200> doc;
-    doc["roll"] = round(roll * 100) / 100.0;
-    doc["pitch"] = round(pitch * 100) / 100.0;
-    doc["yaw"] = round(yaw * 100) / 100.0;
-    doc["temperature"] = 25.0; // You can add actual temp from MPU6050
-    doc["timestamp"] = millis();
-
-    char buffer[256];
-    serializeJson(doc, buffer);
+  // Oldest first, at most replayBudget per call so a backlog never stalls the loop;
+  // the last publish may carry fewer than batchSize readings
+  for (int i = 0; i < replayBudget && queueHead != queueTail; i++) {
+    uint16_t count = min(queueHead - queueTail, (uint32_t)batchSize);
+
+    // Create JSON payload: one object per reading, an array of them for a batch
+    StaticJsonDocument<1024> doc;
+    for (uint16_t j = 0; j < count; j++) {
+      Reading& reading = offlineQueue[(queueTail + j) % OFFLINE_QUEUE_SIZE];
+      JsonObject item = count == 1 ? doc.to<JsonObject>() : doc.createNestedObject();
+      item["roll"] = round(reading.roll * 100) / 100.0;
+      item["pitch"] = round(reading.pitch * 100) / 100.0;
+      item["yaw"] = round(reading.yaw * 100) / 100.0;
+      item["temperature"] = 25.0; // You can add actual temp from MPU6050
+      item["timestamp"] = reading.timestamp;
+    }
+    serializeJson(doc, jsonBuffer, sizeof(jsonBuffer));
 
     // Publish to ThingsBoard
     String topic = "v1/devices/me/telemetry";
-    mqttClient.publish(topic.c_str(), buffer);
+    if (!mqttClient.publish(topic.c_str(), jsonBuffer)) {
+      break;
+    }
+    queueTail += count;
 
-    Serial.println("Data sent to cloud: " + String(buffer));
+    Serial.println("Data sent to cloud: " + String(jsonBuffer));
   }
+}
 
-  mqttClient.loop();
+void queueReading() {
+  if (queueHead - queueTail >= OFFLINE_QUEUE_SIZE) {
+    queueTail++; // Queue full: drop the oldest reading
+  }
+  offlineQueue[queueHead % OFFLINE_QUEUE_SIZE] = {roll, pitch, yaw, millis()};
+  queueHead++;
 }
 
-void reconnectMQTT() {
-  while (!mqttClient.connected()) {
-    Serial.print("Attempting MQTT connection...");
-    if (mqttClient.connect("ESP32Client", tb_token, "")) {
-      Serial.println("connected");
-    } else {
-      Serial.print("failed, rc=");
-      Serial.print(mqttClient.state());
-      Serial.println(" try again in 5 seconds");
-      delay(5000);
-    }
+// Schedule the next connection attempt with exponential backoff and jitter,
+// so a fleet does not reconnect in lockstep after a broker restart
+void scheduleRetry() {
+  linkRetryAt = millis() + linkBackoff / 2 + random(linkBackoff / 2 + 1);
+  linkBackoff = min(linkBackoff * 2, maxBackoff);
+}
+
+// PubSubClient::connect() blocks on DNS, TCP and CONNACK, so each attempt runs
+// in a short-lived task on the other core while loop() keeps sampling
+void mqttConnectTask(void* parameter) {
+  mqttAttemptOk = mqttClient.connect("ESP32Client", tb_token, "");
+  mqttAttemptDone = true;
+  vTaskDelete(NULL);
+}
+
+void updateConnection() {
+  bool wifiUp = WiFi.status() == WL_CONNECTED;
+
+  switch (linkState) {
+    case LINK_WIFI_WAIT:
+      if (wifiUp) {
+        Serial.print("WiFi connected, IP address: ");
+        Serial.println(WiFi.localIP());
+        linkState = LINK_MQTT_IDLE;
+        linkBackoff = minBackoff;
+        linkRetryAt = millis();
+      } else if ((long)(millis() - linkRetryAt) >= 0) {
+        WiFi.reconnect();
+        scheduleRetry();
+      }
+      break;
+
+    case LINK_MQTT_IDLE:
+      if (!wifiUp) {
+        linkState = LINK_WIFI_WAIT;
+      } else if ((long)(millis() - linkRetryAt) >= 0) {
+        Serial.println("Attempting MQTT connection...");
+        mqttAttemptDone = false;
+        linkState = LINK_MQTT_CONNECTING;
+        xTaskCreatePinnedToCore(mqttConnectTask, "mqttConnect", 6144, NULL, 1, NULL, 0);
+      }
+      break;
+
+    case LINK_MQTT_CONNECTING:
+      if (!mqttAttemptDone) {
+        break;
+      }
+      if (mqttAttemptOk) {
+        Serial.println("MQTT connected");
+        linkState = LINK_ONLINE;
+        linkBackoff = minBackoff;
+        subscribeDownlink();
+      } else {
+        Serial.print("MQTT connection failed, rc=");
+        Serial.println(mqttClient.state());
+        linkState = wifiUp ? LINK_MQTT_IDLE : LINK_WIFI_WAIT;
+        scheduleRetry();
+      }
+      break;
+
+    case LINK_ONLINE:
+      if (!mqttClient.connected()) {
+        Serial.println("MQTT connection lost");
+        linkState = wifiUp ? LINK_MQTT_IDLE : LINK_WIFI_WAIT;
+        scheduleRetry();
+      } else {
+        mqttClient.loop();
+      }
+      break;
   }
 }
 
-void calculateIMUError() {
-  // Calculate accelerometer error (200 readings)
-  int c = 0;
-  while (c < 200) {
-    sensors_event_t a, g, temp;
-    mpu.getEvent(&a, &g, &temp);
+// Subscribe to rate changes and ask for the current values, which the server
+// may have changed while this board was offline
+void subscribeDownlink() {
+  mqttClient.subscribe(attributesTopic);
+  mqttClient.subscribe("v1/devices/me/attributes/response/+");
+  mqttClient.subscribe("v1/devices/me/rpc/request/+");
+  mqttClient.publish("v1/devices/me/attributes/request/1",
+                     "{\"sharedKeys\":\"cloudInterval,batchSize,displayInterval\"}");
+}
+
+// Apply whichever of cloudInterval (ms), batchSize and displayInterval (ms)
+// are present, clamped to what this build supports
+void applyRates(JsonObjectConst rates) {
+  unsigned long oldPeriod = cloudInterval / batchSize;
+  if (rates.containsKey("cloudInterval")) {
+    cloudInterval = constrain(rates["cloudInterval"].as<unsigned long>(), minCloudInterval, maxCloudInterval);
+  }
+  if (rates.containsKey("batchSize")) {
+    batchSize = constrain(rates["batchSize"].as<int>(), 1, (int)maxBatchSize);
+  }
+  if (rates.containsKey("displayInterval")) {
+    displayInterval = constrain(rates["displayInterval"].as<unsigned long>(), minDisplayInterval, maxDisplayInterval);
+  }
+  if (cloudInterval / batchSize != oldPeriod) {
+    // Restart the sample timer at a random point of the new period: boards
+    // slowed down together would keep phases packed into the old, shorter
+    // period and publish in bunches
+    lastCloudUpdate = millis() - random(cloudInterval / batchSize);
+  }
+  Serial.printf("Rates: cloud %lu ms, batch %u, display %lu ms\n",
+                cloudInterval, batchSize, displayInterval);
+}
+
+// Runs inside mqttClient.loop(), so it never races loop() over the rates
+void onMqttMessage(char* topic, byte* payload, unsigned int length) {
+  StaticJsonDocument<256> doc;
+  // Parse from a const pointer so ArduinoJson copies the strings: publishing
+  // the RPC reply reuses the client buffer payload points into
+  if (deserializeJson(doc, (const byte*)payload, length)) {
+    return;
+  }
 
-    AccErrorX += (atan((a.acceleration.y) / sqrt(pow((a.acceleration.x), 2) + pow((a.acceleration.z), 2))) * 180 / PI);
-    AccErrorY += (atan(-1 * (a.acceleration.x) / sqrt(pow((a.acceleration.y), 2) + pow((a.acceleration.z), 2))) * 180 / PI);
-    c++;
-    delay(5);
+  if (strcmp(topic, attributesTopic) == 0) {
+    applyRates(doc.as<JsonObjectConst>());
+  } else if (strncmp(topic, rpcRequestPrefix, strlen(rpcRequestPrefix)) == 0) {
+    if (doc["method"] != "setRates") {
+      return;
+    }
+    applyRates(doc["params"].as<JsonObjectConst>());
+
+    // Reply with the rates now in force
+    char responseTopic[64];
+    snprintf(responseTopic, sizeof(responseTopic), "v1/devices/me/rpc/response/%s",
+             topic + strlen(rpcRequestPrefix));
+    StaticJsonDocument<128> reply;
+    reply["cloudInterval"] = cloudInterval;
+    reply["batchSize"] = batchSize;
+    reply["displayInterval"] = displayInterval;
+    char buffer[128];
+    serializeJson(reply, buffer);
+    mqttClient.publish(responseTopic, buffer);
+  } else {
+    // Attribute request response: {"shared": {...}}
+    applyRates(doc["shared"].as<JsonObjectConst>());
+  }
+}
+
+void addSample(RunningStats& stats, const float* sample) {
+  stats.n++;
+  for (int i = 0; i < CAL_AXES; i++) {
+    float delta = sample[i] - stats.mean[i];
+    stats.mean[i] += delta / stats.n;
+    stats.m2[i] += delta * (sample[i] - stats.mean[i]);
   }
-  AccErrorX = AccErrorX / 200;
-  AccErrorY = AccErrorY / 200;
+}
+
+float sampleVariance(const RunningStats& stats, int axis) {
+  return stats.n > 1 ? stats.m2[axis] / (stats.n - 1) : 0;
+}
 
-  c = 0;
-  // Calculate gyroscope error (200 readings)
-  while (c < 200) {
+void calculateIMUError() {
+  RunningStats stats = {};
+  uint32_t restarts = 0;
+  unsigned long start = millis();
+
+  while (millis() - start < calibrationTimeout) {
     sensors_event_t a, g, temp;
     mpu.getEvent(&a, &g, &temp);
-
-    GyroErrorX += (g.gyro.x * 180 / PI);
-    GyroErrorY += (g.gyro.y * 180 / PI);
-    GyroErrorZ += (g.gyro.z * 180 / PI);
-    c++;
-    delay(5);
+    float sample[CAL_AXES] = {
+      accelRoll(a.acceleration.x, a.acceleration.y, a.acceleration.z),
+      accelPitch(a.acceleration.x, a.acceleration.y, a.acceleration.z),
+      toDegrees(g.gyro.x), toDegrees(g.gyro.y), toDegrees(g.gyro.z)
+    };
+    addSample(stats, sample);
+
+    if (stats.n >= minCalibrationSamples) {
+      bool moving = false;
+      bool converged = true;
+      for (int i = 0; i < CAL_AXES; i++) {
+        float variance = sampleVariance(stats, i);
+        float target = i < 2 ? accelTargetSem : gyroTargetSem;
+        if (i >= 2 && variance > movingGyroStd * movingGyroStd) {
+          moving = true;
+        }
+        if (variance / stats.n > target * target) {
+          converged = false;
+        }
+      }
+      if (moving) {
+        stats = {}; // Device is being handled, start over
+        restarts++;
+      } else if (converged || stats.n >= maxCalibrationSamples) {
+        break;
+      }
+    }
+    delay(calibrationPeriod);
   }
-  GyroErrorX = GyroErrorX / 200;
-  GyroErrorY = GyroErrorY / 200;
-  GyroErrorZ = GyroErrorZ / 200;
 
-  Serial.println("IMU Calibration Complete");
+  AccErrorX = stats.mean[0];
+  AccErrorY = stats.mean[1];
+  GyroErrorX = stats.mean[2];
+  GyroErrorY = stats.mean[3];
+  GyroErrorZ = stats.mean[4];
+
+  Serial.print("IMU Calibration Complete in ");
+  Serial.print(millis() - start);
+  Serial.print(" ms (");
+  Serial.print(stats.n);
+  Serial.print(" samples, ");
+  Serial.print(restarts);
+  Serial.println(" restarts)");
   Serial.print("AccErrorX: "); Serial.println(AccErrorX);
   Serial.print("AccErrorY: "); Serial.println(AccErrorY);
   Serial.print("GyroErrorX: "); Serial.println(GyroErrorX);
   Serial.print("GyroErrorY: "); Serial.println(GyroErrorY);
   Serial.print("GyroErrorZ: "); Serial.println(GyroErrorZ);
+}
+
+// While the device is still, average the raw gyro rates over biasWindow
+// samples and move the bias biasGain of the way to that average
+void refineGyroBias() {
+  float accelNorm = sqrtf(AccX * AccX + AccY * AccY + AccZ * AccZ);
+  bool still = fabsf(accelNorm - 9.80665f) < stillAccelTolerance &&
+               fabsf(GyroX) < stillGyroTolerance &&
+               fabsf(GyroY) < stillGyroTolerance &&
+               fabsf(GyroZ) < stillGyroTolerance;
+  if (!still) {
+    stillStats = {};
+    return;
+  }
+  float sample[CAL_AXES] = {0, 0, GyroX + GyroErrorX, GyroY + GyroErrorY, GyroZ + GyroErrorZ};
+  addSample(stillStats, sample);
+  if (stillStats.n >= biasWindow) {
+    GyroErrorX += biasGain * (stillStats.mean[2] - GyroErrorX);
+    GyroErrorY += biasGain * (stillStats.mean[3] - GyroErrorY);
+    GyroErrorZ += biasGain * (stillStats.mean[4] - GyroErrorZ);
+    stillStats = {};
+  }
 }
\ No newline at end of file
@@ -0,0 +1,197 @@
+# Sample-interval jitter from the --rtos sketch's timing log
+#
+# networkTask prints "TM <period us> <first tick> <latency us>..." lines, each
+# a run of consecutive timer ticks with how long after its tick sensorTask
+# woke up. parse_timing_log() collects them from a raw Serial capture (other
+# lines are skipped) and analyze() histograms each sample interval's
+# deviation from the nominal period, which for consecutive ticks is just the
+# difference of two latencies.
+#
+# --simulate runs both schedules against the same flaky network: the stock
+# loop(), which samples whenever the previous pass (display, publish, Serial)
+# is done, and the timer-driven task, whose wake-up only waits for the ISR
+# and for an OLED transfer holding the shared I2C bus. Per-pass costs come
+# from sketch_sim.SketchConfig.
+#
+#   python jitter_analyzer.py serial.log
+#   python jitter_analyzer.py --simulate --seconds 600 --stall-rate 0.05
+
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from sketch_sim import SketchConfig
+
+# wake_us is relative to the timer start: ticks * period_us + latency_us
+TimingLog = namedtuple("TimingLog", ["period_us", "ticks", "latency_us", "wake_us"])
+
+JitterReport = namedtuple("JitterReport", [
+    "samples",
+    "missed",          # timer ticks without a sample (sensorTask overran)
+    "period_us",       # nominal, or the median interval when there is none
+    "mean_us",         # mean interval
+    "std_us",
+    "p99_us",          # 99th percentile |interval - period|
+    "max_us",
+    "edges_us",        # histogram bin edges for |interval - period|
+    "counts",
+])
+
+# |deviation| bins, microseconds
+DEFAULT_EDGES = (0, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000, np.inf)
+
+
+def parse_timing_log(lines):
+    period = None
+    ticks = []
+    latencies = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 4 or fields[0] != "TM":
+            continue
+        try:
+            values = [int(v) for v in fields[1:]]
+        except ValueError:
+            continue  # A line cut short by a reset or a full UART buffer
+        if period is None:
+            period = values[0]
+        elif values[0] != period:
+            raise ValueError(f"period changed from {period} to {values[0]} us within one log")
+        first = values[1]
+        ticks.extend(range(first, first + len(values) - 2))
+        latencies.extend(values[2:])
+    if period is None:
+        raise ValueError("no TM lines in the log")
+    ticks = np.array(ticks, dtype=np.int64)
+    latency = np.array(latencies, dtype=np.int64)
+    return TimingLog(period, ticks, latency, ticks * period + latency)
+
+
+# Interval deviations of consecutive samples, plus the ticks skipped between
+# samples. Without a nominal period (loop()-paced sampling) the median
+# interval stands in for it.
+def deviations(wake_us, ticks=None, period_us=None):
+    intervals = np.diff(np.asarray(wake_us, dtype=np.float64))
+    missed = 0
+    if ticks is not None:
+        steps = np.diff(ticks)
+        missed = int(np.sum(steps[steps > 1] - 1))  # a reset restarts the ticks
+        intervals = intervals[steps == 1]
+    if not len(intervals):
+        raise ValueError("need at least two consecutive samples")
+    period = float(np.median(intervals)) if period_us is None else float(period_us)
+    return intervals, intervals - period, period, missed
+
+
+def analyze(wake_us, ticks=None, period_us=None, edges=DEFAULT_EDGES):
+    intervals, deviation, period, missed = deviations(wake_us, ticks, period_us)
+    magnitude = np.abs(deviation)
+    counts, _ = np.histogram(magnitude, bins=np.asarray(edges, dtype=np.float64))
+    return JitterReport(
+        samples=len(wake_us),
+        missed=missed,
+        period_us=period,
+        mean_us=float(intervals.mean()),
+        std_us=float(intervals.std()),
+        p99_us=float(np.percentile(magnitude, 99)),
+        max_us=float(magnitude.max()),
+        edges_us=tuple(edges),
+        counts=counts,
+    )
+
+
+def _edge(value):
+    if value == np.inf:
+        return "inf"
+    return f"{value / 1000:g} ms" if value >= 1000 else f"{value:g} us"
+
+
+def format_report(name, report, width=40):
+    lines = [f"{name}: {report.samples} samples, period {report.period_us:.0f} us, "
+             f"mean {report.mean_us:.1f} us, std {report.std_us:.1f} us, "
+             f"p99 |jitter| {report.p99_us:.0f} us, max {report.max_us:.0f} us, "
+             f"{report.missed} missed ticks"]
+    total = max(int(report.counts.sum()), 1)
+    for low, high, count in zip(report.edges_us[:-1], report.edges_us[1:], report.counts):
+        bar = "#" * int(np.ceil(width * count / total)) if count else ""
+        lines.append(f"  {_edge(low):>8s} - {_edge(high):<8s} {count:9d} {bar}")
+    return "\n".join(lines)
+
+
+# Network model shared by both simulations: each publish normally costs
+# config.publish_ms, but with probability stall_rate it blocks for an
+# exponential time with mean stall_ms (a TCP retransmit, a broker hiccup)
+def _publish_ms(rng, config, stall_rate, stall_ms):
+    if rng.random() < stall_rate:
+        return config.publish_ms + rng.exponential(stall_ms)
+    return config.publish_ms
+
+
+# Stock loop(): a sample at the start of every pass, then display, publish,
+# Serial and delay(10). Returns sample times in us.
+def simulate_loop(seconds, config=SketchConfig(), stall_rate=0.02, stall_ms=300.0, seed=0):
+    rng = np.random.default_rng(seed)
+    t = 0.0
+    last_display = last_cloud = 0.0
+    samples = []
+    while t < seconds * 1000:
+        samples.append(t)
+        t += config.sense_ms + abs(rng.normal(0, config.jitter_ms))
+        if t - last_display >= config.display_interval:
+            t += config.display_ms
+            last_display = t
+        if t - last_cloud >= config.cloud_interval:
+            t += _publish_ms(rng, config, stall_rate, stall_ms)
+            last_cloud = t
+        t += config.serial_ms + config.loop_delay
+    return np.array(samples) * 1000
+
+
+# Timer-driven sensorTask: wakes dispatch_us after each tick, later if an OLED
+# transfer holds the bus (the display pushes ~bus_ms of I2C per redraw, one
+# 32 byte chunk of ~chunk_us at a time). Network stalls never reach core 1; a
+# stall longer than the queue only costs the samples that overflow it.
+# Returns (ticks, latencies in us, samples dropped).
+def simulate_timer(seconds, rate_hz=100, config=SketchConfig(), stall_rate=0.02, stall_ms=300.0,
+                   dispatch_us=4.0, bus_ms=2.0, chunk_us=800.0, queue_seconds=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(seconds * rate_hz)
+    ticks = np.arange(1, n + 1)
+    latency = dispatch_us + rng.exponential(1.0, n)
+    busy = rng.random(n) < bus_ms / config.display_interval
+    latency[busy] += rng.uniform(0, chunk_us, int(busy.sum()))
+
+    publishes = int(seconds * 1000 / config.cloud_interval)
+    stalls = np.array([_publish_ms(rng, config, stall_rate, stall_ms) for _ in range(publishes)])
+    dropped = int(np.sum(np.maximum(stalls / 1000 - queue_seconds, 0)) * rate_hz)
+    return ticks, np.round(latency).astype(np.int64), dropped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sample-interval jitter from --rtos timing logs")
+    parser.add_argument("log", nargs="?", help="captured Serial output with TM lines")
+    parser.add_argument("--simulate", action="store_true",
+                        help="compare loop()-paced and timer-driven sampling instead")
+    parser.add_argument("--seconds", type=float, default=300.0)
+    parser.add_argument("--rate", type=int, default=100, help="timer sample rate, Hz")
+    parser.add_argument("--stall-rate", type=float, default=0.02,
+                        help="fraction of publishes that block")
+    parser.add_argument("--stall-ms", type=float, default=300.0, help="mean blocking time")
+    args = parser.parse_args()
+
+    if args.simulate:
+        wake = simulate_loop(args.seconds, stall_rate=args.stall_rate, stall_ms=args.stall_ms)
+        print(format_report("loop() schedule", analyze(wake)))
+        period = 1_000_000 // args.rate
+        ticks, latency, dropped = simulate_timer(args.seconds, args.rate,
+                                                 stall_rate=args.stall_rate,
+                                                 stall_ms=args.stall_ms)
+        print(format_report("timer + tasks", analyze(ticks * period + latency, ticks, period)))
+        print(f"  {dropped} samples dropped by stalls longer than the queue")
+    elif args.log:
+        with open(args.log, errors="replace") as f:
+            log = parse_timing_log(f)
+        print(format_report(args.log, analyze(log.wake_us, log.ticks, log.period_us)))
+    else:
+        parser.error("give a log file or --simulate")
@@ -0,0 +1,373 @@
+# In-process last-value cache: the current state of every device, without storage
+#
+# One NumPy array per field, indexed by a device's slot (its position in
+# names, assigned on first sight), so "what is device X doing now" is a
+# dict lookup plus a few array reads. update() takes a whole ingest batch
+# as columns: it finds the last reading of each device in the batch with
+# np.maximum.at, then writes all of them under the lock. A reader never
+# sees half a batch. snapshot() copies every column for the whole fleet in
+# the same way, and builds no per-device objects.
+#
+# Per device it keeps the last finite roll/pitch/yaw/temperature, the last
+# device timestamp (millis() uptime) and arrival time, the first arrival, the
+# sample count, the sample rate measured over rate_window seconds, and the
+# MQTT connection state, which IngestServer reports through set_link() as
+# sessions open and close. status() and fleet_status() give the dashboard's
+# systemStatus fields from those:
+#
+#   deviceOnline    connected, or data within online_s
+#   wifiConnected   connected: a board's MQTT session only exists over WiFi
+#   cloudConnected  connected
+#   isMonitoring    data within online_s
+#   dataRate        samples/s over the last rate window, 0 when not monitoring
+#   batteryLevel    null unless set_battery() was given one: the sketch
+#                   has no battery sensing
+#   uptime          the board's millis() at its last sample plus the time since, s
+#   totalSamples    samples received since this process started
+#
+#   python last_value_cache.py                          100k devices
+#   python last_value_cache.py --devices 10000 --batches 2000
+
+import argparse
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+FIELDS = ("roll", "pitch", "yaw", "temperature")
+COLUMNS = (
+    ("roll", np.float32),
+    ("pitch", np.float32),
+    ("yaw", np.float32),
+    ("temperature", np.float32),
+    ("timestamp", np.int64),          # device millis() of the last sample, -1 before one
+    ("received", np.float64),         # wall time the last sample arrived, s
+    ("first_received", np.float64),
+    ("samples", np.int64),
+    ("rate", np.float32),             # samples/s over the last full rate window
+    ("connected", np.bool_),
+    ("connected_since", np.float64),
+    ("battery", np.float32),          # percent
+)
+_INITIAL = {"timestamp": -1, "samples": 0, "connected": False}
+
+DeviceState = namedtuple("DeviceState", ["device", *(name for name, _ in COLUMNS)])
+FleetSnapshot = namedtuple("FleetSnapshot", ["devices", *(name for name, _ in COLUMNS)])
+
+
+class LastValueCache:
+    def __init__(self, capacity=1024, rate_window=5.0, online_s=5.0):
+        self.rate_window = rate_window
+        self.online_s = online_s
+        self.names = []
+        self.index = {}
+        self._lock = threading.Lock()
+        self._columns = {}
+        self._window_start = np.empty(0, np.float64)
+        self._window_samples = np.empty(0, np.int64)
+        self._grow(max(capacity, 1))
+
+    def _grow(self, capacity):
+        count = len(self._window_start)
+        for name, dtype in COLUMNS:
+            column = np.full(capacity, _INITIAL.get(name, np.nan), dtype)
+            if name in self._columns:
+                column[:count] = self._columns[name]
+            self._columns[name] = column
+            setattr(self, name, column)
+        window_start = np.full(capacity, np.nan)
+        window_start[:count] = self._window_start
+        window_samples = np.zeros(capacity, np.int64)
+        window_samples[:count] = self._window_samples
+        self._window_start, self._window_samples = window_start, window_samples
+
+    # Slots for names, adding the unseen ones. Call with the lock held.
+    def _slots(self, names):
+        slots = np.empty(len(names), np.int64)
+        for i, name in enumerate(names):
+            name = name.decode(errors="replace") if isinstance(name, bytes) else str(name)
+            slot = self.index.get(name)
+            if slot is None:
+                slot = self.index[name] = len(self.names)
+                self.names.append(name)
+                if slot == len(self.roll):
+                    self._grow(2 * slot)
+            slots[i] = slot
+        return slots
+
+    def slot(self, device):
+        return self.index.get(device)
+
+    # One batch as columns: devices (names or bytes), device timestamps (-1
+    # for none), arrival times in s and {field: values} for FIELDS. Rows are
+    # in arrival order; the last one of each device wins, field by field,
+    # skipping NaN.
+    def update(self, devices, timestamp, received, values):
+        devices = np.asarray(devices)
+        n = len(devices)
+        if n == 0:
+            return
+        timestamp = np.asarray(timestamp, np.int64)
+        received = np.asarray(received, np.float64)
+        names, earliest, inverse = np.unique(devices, return_index=True, return_inverse=True)
+        order = np.arange(n)
+        last = np.zeros(len(names), np.int64)
+        np.maximum.at(last, inverse, order)
+        counts = np.bincount(inverse, minlength=len(names))
+        latest = {}
+        for field in FIELDS:
+            column = np.asarray(values[field], np.float32)
+            newest = np.full(len(names), -1, np.int64)
+            np.maximum.at(newest, inverse, np.where(np.isfinite(column), order, -1))
+            latest[field] = (newest >= 0, column[np.maximum(newest, 0)])
+        stamped = np.full(len(names), -1, np.int64)
+        np.maximum.at(stamped, inverse, np.where(timestamp >= 0, order, -1))
+        now = received[last]
+
+        with self._lock:
+            slots = self._slots(names)
+            for field, (found, column) in latest.items():
+                getattr(self, field)[slots[found]] = column[found]
+            found = stamped >= 0
+            self.timestamp[slots[found]] = timestamp[stamped[found]]
+            self.received[slots] = now
+            first = np.isnan(self.first_received[slots])
+            self.first_received[slots[first]] = received[earliest[first]]
+            self.samples[slots] += counts
+
+            # Measured rate: samples since the window started over its length
+            start = self._window_start[slots]
+            fresh = np.isnan(start)
+            self._window_start[slots[fresh]] = now[fresh]
+            self._window_samples[slots[~fresh]] += counts[~fresh]
+            elapsed = now - start
+            done = ~fresh & (elapsed >= self.rate_window)
+            self.rate[slots[done]] = self._window_samples[slots[done]] / elapsed[done]
+            self._window_start[slots[done]] = now[done]
+            self._window_samples[slots[done]] = 0
+
+    # A batch of ingest_server TelemetryRecords
+    def update_batch(self, batch):
+        self.update([r.device for r in batch],
+                    [-1 if r.timestamp is None else r.timestamp for r in batch],
+                    [r.received for r in batch],
+                    {field: [getattr(r, field) for r in batch] for field in FIELDS})
+
+    # A shm_ring.RECORD_DTYPE array, e.g. a view from Consumer.poll()
+    def update_records(self, records):
+        self.update(records["device"], records["timestamp"], records["received"],
+                    {field: records[field] for field in FIELDS})
+
+    # One device's MQTT session opened or closed; fits IngestServer's
+    # on_connection
+    def set_link(self, device, connected, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            slot = self._slots([device])[0]
+            if not connected:
+                self.connected_since[slot] = np.nan
+            elif not self.connected[slot]:
+                self.connected_since[slot] = now
+            self.connected[slot] = connected
+
+    # Mark exactly devices as connected (the ingest server's live sessions)
+    def set_connected(self, devices, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            slots = self._slots(list(devices))
+            count = len(self.names)
+            connected = np.zeros(count, bool)
+            connected[slots] = True
+            self.connected_since[:count][connected & ~self.connected[:count]] = now
+            self.connected_since[:count][~connected] = np.nan
+            self.connected[:count] = connected
+
+    def set_battery(self, device, level):
+        with self._lock:
+            self.battery[self._slots([device])[0]] = level
+
+    # The device's row, or None if it was never seen
+    def get(self, device):
+        slot = self.index.get(device)
+        if slot is None:
+            return None
+        with self._lock:
+            return DeviceState(device, *(self._columns[name][slot].item() for name, _ in COLUMNS))
+
+    # Copies of every column for every device, consistent with one another
+    def snapshot(self):
+        with self._lock:
+            count = len(self.names)
+            return FleetSnapshot(tuple(self.names),
+                                 *(self._columns[name][:count].copy() for name, _ in COLUMNS))
+
+    # systemStatus fields (see the header) for one device, or None
+    def status(self, device, now=None):
+        state = self.get(device)
+        if state is None:
+            return None
+        now = time.time() if now is None else now
+        monitoring = now - state.received < self.online_s
+        uptime = state.timestamp / 1000 + now - state.received if state.timestamp >= 0 else None
+        return {
+            "deviceOnline": bool(state.connected or monitoring),
+            "wifiConnected": bool(state.connected),
+            "cloudConnected": bool(state.connected),
+            "isMonitoring": bool(monitoring),
+            "dataRate": round(state.rate) if monitoring and state.rate == state.rate else 0,
+            "batteryLevel": None if state.battery != state.battery else round(state.battery),
+            "uptime": None if uptime is None else int(uptime),
+            "totalSamples": state.samples,
+        }
+
+    # The same fields for the whole fleet, as {field: list} with a "device" list
+    def fleet_status(self, now=None):
+        snap = self.snapshot()
+        now = time.time() if now is None else now
+        with np.errstate(invalid="ignore"):
+            monitoring = now - snap.received < self.online_s
+        uptime = np.where(snap.timestamp >= 0, snap.timestamp / 1000 + now - snap.received, np.nan)
+        rate = np.where(monitoring & np.isfinite(snap.rate), np.round(snap.rate), 0)
+        return {
+            "device": list(snap.devices),
+            "deviceOnline": (snap.connected | monitoring).tolist(),
+            "wifiConnected": snap.connected.tolist(),
+            "cloudConnected": snap.connected.tolist(),
+            "isMonitoring": monitoring.tolist(),
+            "dataRate": rate.astype(np.int64).tolist(),
+            "batteryLevel": [None if b != b else b for b in np.round(snap.battery).tolist()],
+            "uptime": [None if u != u else int(u) for u in uptime.tolist()],
+            "totalSamples": snap.samples.tolist(),
+        }
+
+
+# Sink for ingest_server.IngestServer: updates the cache with each batch,
+# then passes the batch on to inner. Connection state comes from the server
+# itself, as it changes: IngestServer(..., on_connection=cache.set_link).
+class LastValueSink:
+    def __init__(self, cache, inner=None):
+        self.cache = cache
+        self.inner = inner
+
+    def __call__(self, batch):
+        self.cache.update_batch(batch)
+        if self.inner is not None:
+            self.inner(batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Last-value cache update and read benchmark")
+    parser.add_argument("--devices", type=int, default=100_000)
+    parser.add_argument("--batches", type=int, default=400)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    cache = LastValueCache()
+    devices = np.array([f"esp32-{i:06d}" for i in range(args.devices)])
+    rng = np.random.default_rng(0)
+    reference = {}
+    t0 = 1_750_000_000.0
+    update_seconds = 0.0
+    for b in range(args.batches):
+        picked = rng.integers(0, args.devices, args.batch_size)
+        received = t0 + b * 0.05 + np.zeros(args.batch_size)
+        timestamp = (b * 50 + np.arange(args.batch_size)) % 1000 + b * 1000
+        values = {field: rng.normal(0, 30, args.batch_size).astype(np.float32) for field in FIELDS}
+        values["temperature"][rng.random(args.batch_size) < 0.1] = np.nan
+        began = time.perf_counter()
+        cache.update(devices[picked], timestamp, received, values)
+        update_seconds += time.perf_counter() - began
+        for i, d in enumerate(picked.tolist()):
+            row = reference.setdefault(d, {"samples": 0})
+            row["samples"] += 1
+            row["timestamp"] = timestamp[i]
+            for field in FIELDS:
+                if np.isfinite(values[field][i]):
+                    row[field] = values[field][i]
+
+    for d, row in list(reference.items())[:2000]:
+        state = cache.get(devices[d])
+        assert state.samples == row["samples"] and state.timestamp == row["timestamp"]
+        for field in FIELDS:
+            value = getattr(state, field)
+            assert value == row[field] if field in row else np.isnan(value), (d, field)
+    records = args.batches * args.batch_size
+    print(f"update: {records / update_seconds / 1e6:.2f}M records/s "
+          f"({update_seconds / args.batches * 1000:.2f} ms per {args.batch_size}-record batch)")
+
+    lookups = devices[rng.integers(0, args.devices, 100_000)].tolist()
+    began = time.perf_counter()
+    for name in lookups:
+        cache.get(name)
+    print(f"get: {(time.perf_counter() - began) / len(lookups) * 1e6:.2f} us per device")
+    began = time.perf_counter()
+    snap = cache.snapshot()
+    print(f"snapshot: {len(snap.devices):,} devices in {(time.perf_counter() - began) * 1000:.2f} ms")
+    began = time.perf_counter()
+    fleet = cache.fleet_status(t0 + args.batches * 0.05)
+    print(f"fleet_status: {(time.perf_counter() - began) * 1000:.1f} ms")
+    assert sum(fleet["totalSamples"]) == records and fleet["isMonitoring"].count(True) > 0
+
+    # Readers never see half a batch: every batch writes its number to all
+    # of a fixed set of devices
+    cache = LastValueCache()
+    fleet = devices[:1000]
+    stop = threading.Event()
+    torn = []
+
+    def reader():
+        while not stop.is_set():
+            temperature = cache.snapshot().temperature
+            if len(temperature) == len(fleet) and np.ptp(temperature) != 0:
+                torn.append(temperature)
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    for b in range(2000):
+        cache.update(fleet, np.full(len(fleet), b), np.full(len(fleet), t0 + b),
+                     {field: np.full(len(fleet), b, np.float32) for field in FIELDS})
+    stop.set()
+    thread.join()
+    assert not torn
+
+    # One board: 10 samples that open the rate window, then 50 more at 10 Hz
+    cache.set_connected(["esp32-bench"], now=t0)
+    cache.update(["esp32-bench"] * 10, np.arange(3_600_000, 3_600_010), t0 + np.arange(10),
+                 {field: np.zeros(10) for field in FIELDS})
+    cache.update(["esp32-bench"] * 50, np.arange(3_600_010, 3_600_060), t0 + 10 + np.arange(50) / 10,
+                 {field: np.zeros(50) for field in FIELDS})
+    status = cache.status("esp32-bench", now=t0 + 16)
+    assert status == {"deviceOnline": True, "wifiConnected": True, "cloudConnected": True,
+                      "isMonitoring": True, "dataRate": 8, "batteryLevel": None,
+                      "uptime": 3601, "totalSamples": 60}
+    cache.set_connected([], now=t0 + 20)
+    assert not cache.status("esp32-bench", now=t0 + 30)["deviceOnline"]
+
+    # Through the ingest server: the session ending marks the board
+    # disconnected right away, with no batch after it
+    import asyncio
+
+    import mqtt_protocol as mqtt
+    from ingest_server import DeviceRegistry, IngestServer
+
+    async def session():
+        cache = LastValueCache()
+        server = await IngestServer(DeviceRegistry({"token": "esp32-01"}),
+                                    LastValueSink(cache), host="127.0.0.1", port=0,
+                                    on_connection=cache.set_link).start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(mqtt.encode_connect("ESP32Client", "token", ""))
+        await mqtt.read_packet(reader)
+        writer.write(mqtt.encode_publish(mqtt.TELEMETRY_TOPIC, b'{"roll": 1.5}'))
+        await writer.drain()
+        await asyncio.sleep(0.2)
+        online = cache.status("esp32-01")["cloudConnected"]
+        writer.write(mqtt.packet(mqtt.DISCONNECT))
+        await writer.drain()
+        await asyncio.sleep(0.1)
+        offline = cache.status("esp32-01")["cloudConnected"]
+        await server.close()
+        return online, offline
+
+    assert asyncio.run(session()) == (True, False)
@@ -0,0 +1,216 @@
+# Simulated broker outages against a timing model of the generated sketch
+#
+# Steps the sketch's loop() through simulated time while a broker goes down and
+# comes back, once with the old blocking reconnectMQTT() and once with the
+# updateConnection() state machine script_4.py now emits. Per-pass costs are
+# rough ESP32 figures (I2C reads + fusion, the 100 ms OLED refresh, one
+# publish); what matters is where the loop stops running, not the exact rate.
+#
+#   python link_sim.py --duration 120 --outage 20:50 --outage 70:75
+
+import argparse
+import random
+from collections import namedtuple
+
+LoopCosts = namedtuple("LoopCosts", ["sense", "loop_delay", "display", "publish", "connect"])
+
+# milliseconds; connect is how long a failed PubSubClient::connect() blocks
+DEFAULT_COSTS = LoopCosts(sense=2.5, loop_delay=10.0, display=25.0, publish=2.0, connect=3000.0)
+
+DISPLAY_INTERVAL = 100
+CLOUD_INTERVAL = 1000
+OFFLINE_QUEUE_SIZE = 300
+REPLAY_BUDGET = 5
+MIN_BACKOFF = 500
+MAX_BACKOFF = 30000
+LEGACY_RETRY_DELAY = 5000
+
+LinkReport = namedtuple("LinkReport", [
+    "passes",            # loop() passes run
+    "min_rate",          # fewest passes in any one-second window (Hz)
+    "min_outage_rate",   # same, only windows overlapping an outage
+    "max_stall",         # longest single pass in ms (elapsedTime jump)
+    "generated",         # readings produced (one per cloudInterval)
+    "delivered",
+    "dropped",           # overwritten in the full offline queue
+    "drain_ms",          # from the last restore until the queue was empty
+])
+
+
+# Broker that is down during each [start, end) window, in ms
+class SimulatedBroker:
+    def __init__(self, outages=()):
+        self.outages = sorted(outages)
+
+    def is_up(self, t):
+        return not any(start <= t < end for start, end in self.outages)
+
+    def up_between(self, start, end):
+        return all(e <= start or s >= end for s, e in self.outages)
+
+
+class _Device:
+    def __init__(self, broker, costs, seed):
+        self.broker = broker
+        self.costs = costs
+        self.random = random.Random(seed)
+        self.t = 0.0
+        self.online = False
+        self.queue = []
+        self.generated = self.delivered = self.dropped = 0
+        self.last_display = self.last_cloud = 0.0
+        self.pass_starts = []
+        self.max_stall = 0.0
+        self.drained = []  # times the queue emptied
+
+    def queue_reading(self):
+        self.generated += 1
+        if len(self.queue) >= OFFLINE_QUEUE_SIZE:
+            self.queue.pop(0)
+            self.dropped += 1
+        self.queue.append(self.t)
+
+    def publish(self, budget):
+        for _ in range(min(budget, len(self.queue))):
+            if not self.broker.is_up(self.t):
+                self.online = False
+                return
+            self.queue.pop(0)
+            self.delivered += 1
+            self.t += self.costs.publish
+        if not self.queue:
+            self.drained.append(self.t)
+
+    def run(self, duration):
+        while self.t < duration:
+            start = self.t
+            self.pass_starts.append(start)
+            self.t += self.costs.sense
+            if self.t - self.last_display >= DISPLAY_INTERVAL:
+                self.t += self.costs.display
+                self.last_display = self.t
+            self.step()
+            self.t += self.costs.loop_delay
+            self.max_stall = max(self.max_stall, self.t - start)
+
+
+# Old firmware: sendToCloud() every cloudInterval, blocking in reconnectMQTT()
+# until the broker answers
+class LegacyDevice(_Device):
+    def step(self):
+        if self.t - self.last_cloud < CLOUD_INTERVAL:
+            return
+        if self.online and not self.broker.is_up(self.t):
+            self.online = False
+        while not self.online:
+            attempt = self.t
+            self.t += self.costs.connect if not self.broker.is_up(attempt) else self.costs.publish
+            if self.broker.is_up(attempt):
+                self.online = True
+            else:
+                self.t += LEGACY_RETRY_DELAY
+        # The reading is taken after the stall, so the outage is simply missing
+        self.queue_reading()
+        self.publish(1)
+        self.last_cloud = self.t
+
+
+# New firmware: updateConnection() polls a background connect attempt with
+# jittered exponential backoff; readings queue while offline and replay
+# replayBudget at a time
+class StateMachineDevice(_Device):
+    def __init__(self, broker, costs, seed):
+        super().__init__(broker, costs, seed)
+        self.backoff = MIN_BACKOFF
+        self.retry_at = 0.0
+        self.attempt = None  # (started, finishes) of the connect task
+
+    def schedule_retry(self):
+        self.retry_at = self.t + self.backoff / 2 + self.random.uniform(0, self.backoff / 2)
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    def update_connection(self):
+        if self.online:
+            if not self.broker.is_up(self.t):
+                self.online = False
+                self.schedule_retry()
+        elif self.attempt is not None:
+            started, finishes = self.attempt
+            if self.t >= finishes:
+                self.attempt = None
+                if self.broker.up_between(started, finishes):
+                    self.online = True
+                    self.backoff = MIN_BACKOFF
+                else:
+                    self.schedule_retry()
+        elif self.t >= self.retry_at:
+            up = self.broker.is_up(self.t)
+            self.attempt = (self.t, self.t + (self.costs.publish if up else self.costs.connect))
+
+    def step(self):
+        self.update_connection()
+        if self.t - self.last_cloud >= CLOUD_INTERVAL:
+            self.queue_reading()
+            self.last_cloud = self.t
+        if self.queue and self.online:
+            self.publish(REPLAY_BUDGET)
+
+
+def simulate(device_class, outages, duration=120_000, costs=DEFAULT_COSTS, seed=0):
+    broker = SimulatedBroker(outages)
+    device = device_class(broker, costs, seed)
+    device.run(duration)
+
+    counts = [0] * (int(duration) // 1000)
+    for start in device.pass_starts:
+        if int(start) // 1000 < len(counts):
+            counts[int(start) // 1000] += 1
+    outage_counts = [count for second, count in enumerate(counts)
+                     if not broker.up_between(second * 1000, second * 1000 + 1000)]
+
+    last_restore = max((end for _, end in outages), default=0)
+    drained = [t for t in device.drained if t >= last_restore]
+    drain_ms = drained[0] - last_restore if drained else None
+    return LinkReport(
+        passes=len(device.pass_starts),
+        min_rate=min(counts),
+        min_outage_rate=min(outage_counts, default=None),
+        max_stall=device.max_stall,
+        generated=device.generated,
+        delivered=device.delivered,
+        dropped=device.dropped,
+        drain_ms=drain_ms,
+    )
+
+
+def _outage(text):
+    start, end = (float(part) * 1000 for part in text.split(":"))
+    if end <= start:
+        raise argparse.ArgumentTypeError("outage must be START:END seconds with END > START")
+    return start, end
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Broker outage simulation for the generated sketch")
+    parser.add_argument("--duration", type=float, default=120, help="seconds")
+    parser.add_argument("--outage", type=_outage, action="append",
+                        help="START:END in seconds, repeatable (default 20:50)")
+    parser.add_argument("--connect-timeout", type=float, default=DEFAULT_COSTS.connect,
+                        help="ms a failed connect blocks")
+    args = parser.parse_args()
+
+    outages = args.outage or [(20_000, 50_000)]
+    costs = DEFAULT_COSTS._replace(connect=args.connect_timeout)
+    for name, device_class in (("blocking reconnect", LegacyDevice),
+                               ("state machine", StateMachineDevice)):
+        report = simulate(device_class, outages, args.duration * 1000, costs)
+        drain = f"{report.drain_ms:.0f} ms" if report.drain_ms is not None else "n/a"
+        print(f"{name}:")
+        print(f"  loop rate      min {report.min_rate} Hz, during outages "
+              f"{report.min_outage_rate} Hz, longest pass {report.max_stall:.0f} ms")
+        print(f"  readings       {report.generated} generated, {report.delivered} delivered, "
+              f"{report.dropped} dropped, backlog drained in {drain}")
+
+    report = simulate(StateMachineDevice, outages, args.duration * 1000, costs)
+    assert report.max_stall < 100, "state machine loop stalled during an outage"
+    assert report.min_outage_rate >= 0.9 * report.min_rate
@@ -0,0 +1,331 @@
+# Live WebSocket stream of fused telemetry for the dashboard
+#
+# Browsers connect to ws://host:8765/live?device=esp32-01 (or send
+# {"subscribe": [...]} / {"unsubscribe": [...]} text messages later) and get
+# one JSON text frame per device update:
+#
+#   {"device": "esp32-01", "ts": 1750000000123, "timestamp": 81234,
+#    "roll": 1.5, "pitch": -0.25, "yaw": 12.0, "temperature": 25.1}
+#
+# ts is the ingest wall time in ms, timestamp the board's millis(). With
+# --rules (alert_rules.py) the device's subscribers also get its alert state
+# changes:
+#
+#   {"alert": "tilt", "device": "esp32-01", "state": "firing", "ts": ..., "value": 31.2}
+#
+# Each update is serialized and framed once and the same bytes are handed to
+# every subscriber. Delivery is coalesced per client: a session holds at most
+# one pending frame per subscribed device, replaced by newer ones while its
+# socket is busy, the transport buffer is capped at write_limit and the
+# kernel send buffer at send_buffer, so a slow browser costs a bounded amount
+# of memory and sees the latest value when it catches up instead of a
+# backlog. Control frames (the pong to a ping, the subscription-limit error)
+# queue the same way, the newest of each kind only. A session that cannot
+# take a write for stall_timeout seconds is dropped.
+#
+# Run alongside the MQTT ingest: telemetry committed by IngestServer is fanned
+# out here through LiveSink. With --store the same process also commits it
+# and serves the dashboard and its chart API (chart_api.py) on --http-port,
+# reading the store and rollups it writes; /api/status there answers from the
+# LastValueCache this process keeps.
+#
+#   python live_stream.py --tokens tokens.json
+#   python live_stream.py --tokens tokens.json --store data --port 8765
+#   python live_stream.py --tokens tokens.json --rules rules.json
+
+import argparse
+import asyncio
+import json
+import math
+import socket
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import websocket_protocol as ws
+from ingest_server import DeviceRegistry, IngestServer, raw_sinks, store_sinks
+from last_value_cache import LastValueCache, LastValueSink
+
+STREAM_FIELDS = ("roll", "pitch", "yaw", "temperature")
+
+# pending keys of the control frames, apart from device names and (device, rule)
+_PONG = ("pong",)
+_ERROR = ("error",)
+
+
+def _number(value):
+    return None if value is None or math.isnan(value) else value
+
+
+# TelemetryRecord -> the text frame every subscriber gets
+def encode_update(record):
+    payload = {"device": record.device, "ts": int(record.received * 1000),
+               "timestamp": record.timestamp}
+    for field in STREAM_FIELDS:
+        payload[field] = _number(getattr(record, field))
+    return ws.encode_frame(ws.TEXT, json.dumps(payload, separators=(",", ":")))
+
+
+# alert_rules.Alert -> text frame
+def encode_alert(alert):
+    return ws.encode_frame(ws.TEXT, json.dumps(
+        {"alert": alert.rule, "device": alert.device, "state": alert.state,
+         "ts": alert.timestamp, "value": _number(alert.value)}, separators=(",", ":")))
+
+
+class _Session:
+    __slots__ = ("writer", "devices", "pending", "ready")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.devices = set()
+        self.pending = {}            # device, (device, rule) or control key -> newest frame
+                                     # not yet written
+        self.ready = asyncio.Event()
+
+
+class LiveStreamServer:
+    def __init__(self, host="0.0.0.0", port=8765, path="/live", max_subscriptions=16,
+                 write_limit=64 * 1024, send_buffer=32 * 1024, stall_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_subscriptions = max_subscriptions
+        self.write_limit = write_limit
+        self.send_buffer = send_buffer
+        self.stall_timeout = stall_timeout
+        self.sessions = set()
+        self._subscribers = {}       # device -> set of _Session
+        self._latest = {}            # device -> last frame, sent on subscribe
+        self._server = None
+        self.stats = {"sessions": 0, "rejected": 0, "updates": 0, "frames": 0,
+                      "coalesced": 0, "dropped": 0}
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port,
+                                                  backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        for session in list(self.sessions):
+            session.writer.close()
+        await self._server.wait_closed()
+
+    # Fan one frame out to the device's subscribers, replacing any frame of
+    # that device still waiting on a slow session
+    def publish(self, device, frame):
+        self._latest[device] = frame
+        self.stats["updates"] += 1
+        for session in self._subscribers.get(device, ()):
+            if device in session.pending:
+                self.stats["coalesced"] += 1
+            session.pending[device] = frame
+            session.ready.set()
+
+    def publish_records(self, records):
+        for record in records:
+            self.publish(record.device, encode_update(record))
+
+    # Alert state changes go to the device's subscribers beside its updates;
+    # only a newer state of the same rule replaces one not yet written
+    def publish_alerts(self, alerts):
+        for alert in alerts:
+            frame = encode_alert(alert)
+            for session in self._subscribers.get(alert.device, ()):
+                session.pending[(alert.device, alert.rule)] = frame
+                session.ready.set()
+
+    def _subscribe(self, session, devices):
+        for device in devices:
+            if device in session.devices:
+                continue
+            if len(session.devices) >= self.max_subscriptions:
+                session.pending[_ERROR] = ws.encode_frame(ws.TEXT, json.dumps(
+                    {"error": f"at most {self.max_subscriptions} devices per session"}))
+                session.ready.set()
+                return
+            session.devices.add(device)
+            self._subscribers.setdefault(device, set()).add(session)
+            frame = self._latest.get(device)
+            if frame is not None:
+                session.pending[device] = frame
+                session.ready.set()
+
+    def _unsubscribe(self, session, devices):
+        for device in devices:
+            session.devices.discard(device)
+            session.pending.pop(device, None)
+            subscribers = self._subscribers.get(device)
+            if subscribers is not None:
+                subscribers.discard(session)
+                if not subscribers:
+                    del self._subscribers[device]
+
+    def _on_message(self, session, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+        for key, action in (("subscribe", self._subscribe), ("unsubscribe", self._unsubscribe)):
+            devices = message.get(key)
+            if isinstance(devices, str):
+                devices = [devices]
+            if isinstance(devices, list):
+                action(session, [str(device) for device in devices])
+
+    # Writes whatever is pending, one write per wake-up. When the kernel did
+    # not take it all, wait until the transport buffer is back under
+    # write_limit; meanwhile publish() keeps replacing the pending frames.
+    async def _sender(self, session):
+        writer = session.writer
+        while True:
+            await session.ready.wait()
+            session.ready.clear()
+            if not session.pending:
+                continue
+            frames, session.pending = session.pending, {}
+            writer.write(b"".join(frames.values()))
+            self.stats["frames"] += len(frames)
+            if not writer.transport.get_write_buffer_size():
+                continue
+            try:
+                await asyncio.wait_for(writer.drain(), self.stall_timeout)
+            except asyncio.TimeoutError:
+                self.stats["dropped"] += 1
+                writer.transport.abort()
+                return
+
+    async def _handle_client(self, reader, writer):
+        session = None
+        sender = None
+        try:
+            _, target, headers = await asyncio.wait_for(ws.read_request(reader), 10)
+            url = urlsplit(target)
+            response = ws.handshake_response(headers)
+            if url.path != self.path or response is None:
+                self.stats["rejected"] += 1
+                writer.write(ws.http_error(404 if url.path != self.path else 426,
+                                           "Not Found" if url.path != self.path
+                                           else "Upgrade Required"))
+                await writer.drain()
+                return
+            writer.transport.set_write_buffer_limits(high=self.write_limit)
+            if self.send_buffer:
+                writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                                           self.send_buffer)
+            writer.write(response)
+            session = _Session(writer)
+            self.sessions.add(session)
+            self.stats["sessions"] += 1
+            sender = asyncio.create_task(self._sender(session))
+            query = parse_qs(url.query)
+            self._subscribe(session, [device for value in query.get("device", ())
+                                      for device in value.split(",") if device])
+
+            while True:
+                opcode, payload = await ws.read_frame(reader)
+                if opcode == ws.TEXT:
+                    self._on_message(session, payload)
+                elif opcode == ws.PING:
+                    # through the sender, so a client that pings but never
+                    # reads is bounded and dropped like any other
+                    session.pending[_PONG] = ws.encode_frame(ws.PONG, payload)
+                    session.ready.set()
+                elif opcode == ws.CLOSE:
+                    writer.write(ws.encode_close())
+                    return
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ws.ProtocolError):
+            pass
+        finally:
+            if sender is not None:
+                sender.cancel()
+            if session is not None:
+                self._unsubscribe(session, list(session.devices))
+                self.sessions.discard(session)
+            writer.close()
+
+
+# Sink for ingest_server.IngestServer: hands the newest record of each device
+# in the batch to the stream, then passes the batch on to inner. Sinks run in
+# a worker thread, so the hand-over goes through the event loop.
+class LiveSink:
+    def __init__(self, server, loop, inner=None):
+        self.server = server
+        self.loop = loop
+        self.inner = inner
+
+    def __call__(self, batch):
+        latest = {}
+        for record in batch:
+            latest[record.device] = record
+        self.loop.call_soon_threadsafe(self.server.publish_records, list(latest.values()))
+        if self.inner is not None:
+            self.inner(batch)
+
+
+async def _main(args):
+    stream = await LiveStreamServer(args.host, args.port).start()
+    registry = DeviceRegistry.from_file(args.tokens)
+    inner, store, pyramid = store_sinks(args.store) if args.store else (None, None, None)
+    loop = asyncio.get_running_loop()
+    if args.rules:
+        from alert_rules import AlertEngine, AlertSink
+
+        def notify(alerts):
+            for alert in alerts:
+                value = "n/a" if _number(alert.value) is None else f"{alert.value:g}"
+                print(f"alert {alert.rule} {alert.state} on {alert.device} ({value})")
+            loop.call_soon_threadsafe(stream.publish_alerts, alerts)
+
+        inner = AlertSink(AlertEngine.from_file(args.rules), inner, notify)
+    cache = LastValueCache()
+    latest = LastValueSink(cache, inner=inner)
+    sink = LiveSink(stream, loop, latest)
+    http = None
+    if store is not None:
+        from chart_api import ChartService, start_chart_server
+
+        http = start_chart_server(ChartService(store, pyramid, cache=cache), args.host,
+                                  args.http_port)
+        print(f"Dashboard and chart API on http://{args.host}:{http.server_port}/")
+    raw_sink = raw_sinks(args.store) if store is not None else None
+    ingest = await IngestServer(registry, sink, host=args.host, port=args.mqtt_port,
+                                raw_sink=raw_sink, on_connection=cache.set_link).start()
+    print(f"Live stream on ws://{args.host}:{stream.port}{stream.path}, "
+          f"MQTT ingest on {args.host}:{ingest.port} for {len(registry)} devices")
+    started = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            print(f"{len(stream.sessions)} sessions, {stream.stats['frames']} frames sent, "
+                  f"{stream.stats['coalesced']} coalesced in {time.monotonic() - started:.0f} s")
+    finally:
+        if http is not None:
+            http.shutdown()
+        await ingest.close()
+        await stream.close()
+        if pyramid is not None:
+            pyramid.flush()
+        if raw_sink is not None:
+            raw_sink.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Live WebSocket telemetry stream")
+    parser.add_argument("--tokens", required=True,
+                        help="JSON file mapping device token -> device name")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8765, help="WebSocket port")
+    parser.add_argument("--mqtt-port", type=int, default=1883)
+    parser.add_argument("--store", help="also commit to this TelemetryStore root, with rollups")
+    parser.add_argument("--http-port", type=int, default=8080,
+                        help="dashboard and chart API port, with --store")
+    parser.add_argument("--rules", help="JSON alert rules (alert_rules.py) to evaluate")
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,193 @@
+# Headless load test for live_stream.py
+#
+# Runs a LiveStreamServer in this process and opens --sessions WebSocket
+# sessions against it from --workers client processes (each socket needs a
+# descriptor at both ends), every session subscribed to one of --devices
+# devices, then publishes every device at --rate Hz. A --slow fraction of
+# sessions stop reading for --pause seconds halfway through, like a
+# background tab, and then drain what is waiting.
+# Reports delivery latency on the reading sessions, how many frames were
+# coalesced away for the slow ones, the largest per-session write buffer and
+# pending set the server held, and server memory per session.
+#
+#   python live_stream_loadgen.py --sessions 10000 --devices 100 --rate 1
+#   python live_stream_loadgen.py --sessions 500 --rate 100 --pause 8 --write-limit 16384
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import resource
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import websocket_protocol as ws
+from ingest_server import TelemetryRecord
+from ingest_loadgen import percentile
+from live_stream import LiveStreamServer
+
+
+def _rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Browsers on real links do not have loopback's megabytes of receive buffer;
+# the StreamReader also stops reading the socket at twice its limit
+async def open_session(port, device, receive_buffer=8192):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+    reader, writer = await asyncio.open_connection(sock=sock, limit=receive_buffer // 2)
+    request, key = ws.handshake_request(f"127.0.0.1:{port}", f"/live?device={device}")
+    writer.write(request)
+    response = await reader.readuntil(b"\r\n\r\n")
+    if b" 101 " not in response.split(b"\r\n", 1)[0] or ws.accept_key(key).encode() not in response:
+        raise ConnectionError(f"handshake refused: {response[:80]!r}")
+    return reader, writer
+
+
+# Read frames until the server closes the session after stop_at, appending
+# delivery latencies unless latencies is None; a slow session stops reading
+# for pause seconds once a frame arrives after pause_at
+async def run_session(reader, writer, stop_at, latencies, counts, pause_at=None, pause=0.0):
+    received = 0
+    try:
+        while True:
+            opcode, payload = await ws.read_frame(reader)
+            if opcode != ws.TEXT:
+                continue
+            received += 1
+            if latencies is not None:
+                latencies.append(time.time() - json.loads(payload)["ts"] / 1000)
+            elif pause_at is not None and time.time() >= pause_at:
+                await asyncio.sleep(pause)
+                pause_at = None
+    except (asyncio.IncompleteReadError, ConnectionError):
+        if time.time() < stop_at:
+            counts["disconnected"] += 1
+    finally:
+        writer.close()
+    return received
+
+
+# Publish each device at rate Hz, phases spread across the period
+async def publisher(server, devices, rate, stop_at):
+    period = 1.0 / rate
+    published = 0
+    next_tick = time.monotonic()
+    boot = time.time()
+    while time.time() < stop_at:
+        now = time.time()
+        server.publish_records([
+            TelemetryRecord(device, int((now - boot) * 1000), random.uniform(-90, 90),
+                            random.uniform(-90, 90), random.uniform(-180, 180), 25.0, now)
+            for device in devices])
+        published += len(devices)
+        next_tick += period
+        await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+    return published
+
+
+# Largest per-session write buffer and pending set, sampled while running
+async def watch_buffers(server, stop_at, peaks):
+    while time.time() < stop_at:
+        for session in list(server.sessions):
+            transport = session.writer.transport
+            if not transport.is_closing():
+                peaks["buffer"] = max(peaks["buffer"], transport.get_write_buffer_size())
+            peaks["pending"] = max(peaks["pending"], len(session.pending))
+        await asyncio.sleep(0.5)
+
+
+async def _clients(port, devices, slow, start_at, stop_at, pause):
+    sessions = []
+    for offset in range(0, len(devices), 500):
+        sessions += await asyncio.gather(*(open_session(port, device)
+                                           for device in devices[offset:offset + 500]))
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+    pause_at = start_at + (stop_at - start_at) / 2 - pause / 2
+    latencies = []
+    counts = {"disconnected": 0}
+    received = await asyncio.gather(*(
+        run_session(reader, writer, stop_at, None if i < slow else latencies, counts,
+                    pause_at if i < slow else None, pause)
+        for i, (reader, writer) in enumerate(sessions)))
+    return received[:slow], received[slow:], latencies, counts["disconnected"]
+
+
+# One client process: its share of the sessions, the first slow of them pausing
+def client_worker(port, devices, slow, start_at, stop_at, pause):
+    return asyncio.run(_clients(port, devices, slow, start_at, stop_at, pause))
+
+
+async def main(args):
+    base_rss = _rss_mb()
+    server = await LiveStreamServer("127.0.0.1", 0, write_limit=args.write_limit).start()
+    devices = [f"device-{i}" for i in range(args.devices)]
+    subscribed = [devices[i % len(devices)] for i in range(args.sessions)]
+    slow_count = int(args.sessions * args.slow)
+
+    # Clients connect during the first setup seconds, then everyone starts
+    setup = 5.0 + args.sessions / 1000
+    start_at = time.time() + setup
+    stop_at = start_at + args.duration
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(args.workers, multiprocessing.get_context("spawn"))
+    jobs = [loop.run_in_executor(pool, client_worker, server.port, subscribed[w::args.workers],
+                                 len(range(w, slow_count, args.workers)), start_at, stop_at,
+                                 args.pause)
+            for w in range(args.workers)]
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+    connected = len(server.sessions)
+    session_rss = _rss_mb()
+    peaks = {"buffer": 0, "pending": 0}
+    watcher = asyncio.create_task(watch_buffers(server, stop_at, peaks))
+    published = await publisher(server, devices, args.rate, stop_at)
+    watcher.cancel()
+    peak_rss = _rss_mb()
+    await server.close()
+    results = await asyncio.gather(*jobs)
+    pool.shutdown()
+
+    slow_received = [n for result in results for n in result[0]]
+    fast_received = [n for result in results for n in result[1]]
+    latencies = [value for result in results for value in result[2]]
+    disconnected = sum(result[3] for result in results)
+    expected = args.rate * args.duration
+    print(f"Sessions:         {connected:,} of {args.sessions:,} connected "
+          f"({slow_count} pausing {args.pause:g} s)")
+    print(f"Updates:          {published:,} published, {server.stats['frames']:,} frames sent, "
+          f"{server.stats['coalesced']:,} coalesced")
+    print(f"Per session:      {sum(fast_received) / max(len(fast_received), 1):.1f} frames "
+          f"(reading), {sum(slow_received) / max(len(slow_received), 1):.1f} (pausing), "
+          f"{expected:.0f} published")
+    print(f"Latency p50:      {percentile(latencies, 50) * 1000:.1f} ms")
+    print(f"Latency p99:      {percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"Peak buffer:      {peaks['buffer']:,} bytes write buffer, "
+          f"{peaks['pending']} pending frames in one session")
+    print(f"Server memory:    {session_rss - base_rss:.0f} MB for the open sessions "
+          f"({(session_rss - base_rss) * 1024 / max(connected, 1):.1f} KB each), "
+          f"{peak_rss:.0f} MB peak")
+    print(f"Disconnected:     {disconnected + server.stats['dropped']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the live WebSocket stream")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="updates per second per device (sketch: 1)")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--slow", type=float, default=0.05,
+                        help="fraction of sessions that pause reading")
+    parser.add_argument("--pause", type=float, default=4.0)
+    parser.add_argument("--write-limit", type=int, default=64 * 1024)
+    parser.add_argument("--workers", type=int, default=2, help="client processes")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,349 @@
+# MPU6050 FIFO frames, and a register-level bench for the sketch's --fifo drain
+#
+# With --fifo the MPU6050 samples on its own clock and appends each sample to
+# its 1 KB FIFO as one 14 byte frame: accel x/y/z, temperature, gyro x/y/z,
+# each a big-endian int16. decode_fifo() turns a byte stream of those into
+# numpy columns and FifoDecoder keeps the partial frame and the sample index
+# across reads, so every sample is timestamped from the sensor clock
+# (start + index * period) instead of from when the ESP32 got round to it.
+#
+# MPU6050Model answers register reads and writes the way the chip does
+# (auto-incrementing burst reads, FIFO_R_W popping bytes, a full FIFO
+# overwriting its oldest bytes) and drain() is the firmware's drainFifo()
+# step for step, so the overflow and resync paths can be exercised without
+# a board. The bench also prices the I2C traffic of polling getEvent() once
+# per sample against the burst reads.
+#
+# With --fifo RATE --raw-imu the sketch also publishes the frames as it read
+# them to RAW_TELEMETRY_TOPIC, for vibration_analytics.py on the server. One
+# message is a little-endian header and then the frames, unchanged:
+#
+#   header  magic "RI" | version u8 | flags u8 | count u16 | rate Hz u16 | first sample millis u32
+#   frames  count x 14 byte FIFO frames, consecutive samples on the sensor clock
+#
+#   python mpu6050_fifo.py
+#   python mpu6050_fifo.py --rate 1000 --seconds 30 --stall-rate 0.001
+#   python mpu6050_fifo.py --dump capture.bin --rate 500
+
+import argparse
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+ADDRESS = 0x68
+SMPLRT_DIV = 0x19
+CONFIG = 0x1A
+INT_PIN_CFG = 0x37
+INT_ENABLE = 0x38
+INT_STATUS = 0x3A
+ACCEL_XOUT_H = 0x3B
+FIFO_EN = 0x23
+USER_CTRL = 0x6A
+PWR_MGMT_1 = 0x6B
+FIFO_COUNTH = 0x72
+FIFO_R_W = 0x74
+WHO_AM_I = 0x75
+
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+# FIFO_EN bits for temperature, gyro x/y/z and accel: the sketch's frame layout
+FIFO_EN_FRAME = 0xF8
+
+FIFO_SIZE = 1024
+FRAME_DTYPE = np.dtype([("acc_x", ">i2"), ("acc_y", ">i2"), ("acc_z", ">i2"), ("temp", ">i2"),
+                        ("gyro_x", ">i2"), ("gyro_y", ">i2"), ("gyro_z", ">i2")])
+FRAME_BYTES = FRAME_DTYPE.itemsize
+
+# Ranges the sketch sets up: +-8 g, +-500 deg/s
+ACCEL_LSB = 9.80665 / 4096.0       # m/s^2 per LSB
+GYRO_LSB = np.pi / 180.0 / 65.5    # rad/s per LSB
+
+# arduino-esp32's Wire buffer; one requestFrom() returns at most this much
+WIRE_BUFFER = 128
+
+COLUMNS = ("acc_x", "acc_y", "acc_z", "gyro_x", "gyro_y", "gyro_z")
+
+RAW_MAGIC = b"RI"
+RAW_VERSION = 1
+RAW_HEADER = struct.Struct("<2sBBHHI")
+
+DrainStats = namedtuple("DrainStats", [
+    "samples",      # frames fused
+    "drains",       # drainFifo() calls
+    "reads",        # I2C read transactions (count + bursts)
+    "restarts",     # FIFO resets after an overflow
+    "lost",         # samples the sensor took that were never fused
+    "bus_bytes",    # bytes on the wire, address and register bytes included
+])
+
+
+# Whole frames in data -> (structured array, leftover bytes of a partial frame)
+def decode_fifo(data):
+    whole = len(data) - len(data) % FRAME_BYTES
+    frames = np.frombuffer(bytes(data[:whole]), dtype=FRAME_DTYPE)
+    return frames, bytes(data[whole:])
+
+
+# Raw frames -> ({column: values in m/s^2 and rad/s}, temperature in deg C)
+def to_si(frames):
+    columns = {name: frames[name] * (GYRO_LSB if name.startswith("gyro") else ACCEL_LSB)
+               for name in COLUMNS}
+    return columns, frames["temp"] / 340.0 + 36.53
+
+
+# Inverse of to_si(): what the sensor would put in its registers
+def quantize(columns, temperature=25.0):
+    n = len(columns["acc_x"])
+    frames = np.zeros(n, dtype=FRAME_DTYPE)
+    for name in COLUMNS:
+        scale = GYRO_LSB if name.startswith("gyro") else ACCEL_LSB
+        frames[name] = np.clip(np.round(np.asarray(columns[name]) / scale), -32768, 32767)
+    frames["temp"] = np.clip(np.round((np.asarray(temperature) - 36.53) * 340.0), -32768, 32767)
+    return frames
+
+
+# One raw message: rate_hz, millis() of the first frame and the frames
+def encode_raw(rate_hz, start_ms, frames):
+    header = RAW_HEADER.pack(RAW_MAGIC, RAW_VERSION, 0, len(frames), rate_hz,
+                             int(start_ms) & 0xFFFFFFFF)
+    return header + np.asarray(frames, FRAME_DTYPE).tobytes()
+
+
+# Raw message -> (rate_hz, int64 ms timestamps, frames)
+def decode_raw(payload):
+    if len(payload) < RAW_HEADER.size:
+        raise ValueError("raw message shorter than its header")
+    magic, version, _, count, rate_hz, start = RAW_HEADER.unpack_from(payload)
+    if magic != RAW_MAGIC or version != RAW_VERSION:
+        raise ValueError(f"not a version {RAW_VERSION} raw IMU message")
+    if rate_hz == 0 or len(payload) != RAW_HEADER.size + count * FRAME_BYTES:
+        raise ValueError(f"raw message length {len(payload)} does not match {count} frames")
+    frames, _ = decode_fifo(payload[RAW_HEADER.size:])
+    timestamps = start + np.rint(np.arange(count) * 1000.0 / rate_hz).astype(np.int64)
+    return rate_hz, timestamps, frames
+
+
+# Stateful decoder for a stream of FIFO reads. Timestamps are
+# start_ms + index * period: the sensor clock, however late the reads were.
+class FifoDecoder:
+    def __init__(self, rate_hz, start_ms=0.0):
+        self.period_ms = 1000.0 / rate_hz
+        self.start_ms = start_ms
+        self.index = 0
+        self.pending = b""
+
+    # After a FIFO reset the next frame is sample index, as counted from INT
+    def resync(self, index):
+        self.index = index
+        self.pending = b""
+
+    def feed(self, data):
+        frames, self.pending = decode_fifo(self.pending + bytes(data))
+        timestamps = self.start_ms + (self.index + np.arange(len(frames))) * self.period_ms
+        self.index += len(frames)
+        return timestamps, frames
+
+
+# Register-level MPU6050. The sensor clock runs at (1 + clock_error) times
+# nominal; every sample it appends a frame to the FIFO (when enabled) and
+# raises INT. advance() moves time on, so reads see what the chip would
+# hold at that moment.
+class MPU6050Model:
+    def __init__(self, frames, clock_error=0.0):
+        self.frames = frames
+        self.clock_error = clock_error
+        self.registers = bytearray(128)
+        self.registers[WHO_AM_I] = ADDRESS
+        self.registers[PWR_MGMT_1] = 0x40
+        self.fifo = bytearray()
+        self.taken = 0           # samples taken since power-up, one INT pulse each
+        self.overflows = 0
+        self.time_ms = 0.0
+
+    @property
+    def rate_hz(self):
+        return 1000.0 / (1 + self.registers[SMPLRT_DIV])
+
+    def advance(self, ms):
+        self.time_ms += ms
+        due = int(self.time_ms * self.rate_hz * (1 + self.clock_error) / 1000.0)
+        for index in range(self.taken, min(due, len(self.frames))):
+            self._sample(index)
+        self.taken = max(self.taken, min(due, len(self.frames)))
+
+    def _sample(self, index):
+        if not (self.registers[USER_CTRL] & USER_CTRL_FIFO_EN
+                and self.registers[FIFO_EN] == FIFO_EN_FRAME):
+            return
+        self.fifo += self.frames[index:index + 1].tobytes()
+        if len(self.fifo) > FIFO_SIZE:
+            # Full: the oldest bytes go, so the next read starts mid-frame
+            del self.fifo[:len(self.fifo) - FIFO_SIZE]
+            self.overflows += 1
+
+    def write(self, register, value):
+        if register == USER_CTRL and value & USER_CTRL_FIFO_RESET:
+            self.fifo.clear()
+            value &= ~USER_CTRL_FIFO_RESET
+        self.registers[register] = value & 0xFF
+
+    # Burst read from register on, like Wire.requestFrom() after setting
+    # the register pointer
+    def read(self, register, length):
+        out = bytearray()
+        for _ in range(length):
+            if register == FIFO_R_W:
+                out.append(self.fifo.pop(0) if self.fifo else 0xFF)
+                continue  # The pointer stays on FIFO_R_W
+            out.append(self._register(register))
+            register = (register + 1) & 0x7F
+        return bytes(out)
+
+    def _register(self, register):
+        if register == FIFO_COUNTH:
+            return len(self.fifo) >> 8
+        if register == FIFO_COUNTH + 1:
+            return len(self.fifo) & 0xFF
+        if ACCEL_XOUT_H <= register < ACCEL_XOUT_H + FRAME_BYTES and self.taken:
+            return self.frames[self.taken - 1:self.taken].tobytes()[register - ACCEL_XOUT_H]
+        return self.registers[register]
+
+
+# I2C cost of one read transaction: address+W, register, repeated start,
+# address+R, then the data
+def _read_bytes(length):
+    return 3 + length
+
+
+# setup()'s startFifo(), then drainFifo() whenever loop() sees FIFO_BURST
+# samples counted. stall_ms[i] is extra time loop() pass i spent elsewhere
+# (a publish, a reconnect). Returns the decoded samples and DrainStats.
+def drain(model, rate_hz, seconds, burst=9, pass_ms=1.0, stall_ms=None):
+    model.write(SMPLRT_DIV, 1000 // rate_hz - 1)
+    model.write(INT_PIN_CFG, 0x10)
+    model.write(INT_ENABLE, 0x01)
+    model.write(FIFO_EN, FIFO_EN_FRAME)
+    model.write(USER_CTRL, USER_CTRL_FIFO_RESET)
+    model.write(USER_CTRL, USER_CTRL_FIFO_EN)
+    decoder = FifoDecoder(rate_hz)
+    decoder.resync(model.taken)
+    max_burst = min(burst, WIRE_BUFFER // FRAME_BYTES)
+    indices, chunks = [], []
+    drains = reads = restarts = bus = 0
+    passes = int(seconds * 1000 / pass_ms)
+    for i in range(passes):
+        model.advance(pass_ms + (stall_ms[i] if stall_ms is not None else 0.0))
+        if model.taken - decoder.index < burst:
+            continue
+        drains += 1
+        reads += 1
+        bus += _read_bytes(2)
+        count = int.from_bytes(model.read(FIFO_COUNTH, 2), "big")
+        if count >= FIFO_SIZE:
+            model.write(USER_CTRL, USER_CTRL_FIFO_RESET)
+            model.write(USER_CTRL, USER_CTRL_FIFO_EN)
+            bus += 2 * 3
+            decoder.resync(model.taken)
+            restarts += 1
+            continue
+        left = count // FRAME_BYTES
+        while left:
+            n = min(left, max_burst)
+            reads += 1
+            bus += _read_bytes(n * FRAME_BYTES)
+            first = decoder.index
+            _, frames = decoder.feed(model.read(FIFO_R_W, n * FRAME_BYTES))
+            indices.append(first + np.arange(len(frames)))
+            chunks.append(frames)
+            left -= n
+    index = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+    frames = np.concatenate(chunks) if chunks else np.zeros(0, dtype=FRAME_DTYPE)
+    stats = DrainStats(len(frames), drains, reads, restarts, model.taken - len(frames), bus)
+    return index, frames, stats
+
+
+# Bytes the stock sketch moves per loop() pass: getEvent() reads the 14
+# sensor registers in one burst
+def polled_bus_bytes(samples):
+    return samples * _read_bytes(FRAME_BYTES)
+
+
+# Seconds of 400 kHz bus time: 9 clocks per byte plus start/stop per transaction
+def bus_seconds(byte_count, transactions, clock_hz=400_000):
+    return (9 * byte_count + 2 * transactions) / clock_hz
+
+
+# n samples of a unit swaying on a bench, quantized as the sensor would
+def synthetic_frames(n, rate_hz, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n) / rate_hz
+    roll = np.radians(20.0) * np.sin(2 * np.pi * 0.5 * t)
+    rate = np.radians(20.0) * 2 * np.pi * 0.5 * np.cos(2 * np.pi * 0.5 * t)
+    columns = {
+        "acc_x": rng.normal(0, 0.05, n),
+        "acc_y": 9.80665 * np.sin(roll) + rng.normal(0, 0.05, n),
+        "acc_z": 9.80665 * np.cos(roll) + rng.normal(0, 0.05, n),
+        "gyro_x": rate + rng.normal(0, 0.002, n),
+        "gyro_y": rng.normal(0, 0.002, n),
+        "gyro_z": rng.normal(0, 0.002, n),
+    }
+    return quantize(columns, 25.0 + rng.normal(0, 0.05, n))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MPU6050 FIFO decoder and drain bench")
+    parser.add_argument("--rate", type=int, default=500, choices=(100, 200, 250, 500, 1000))
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0002,
+                        help="fraction of 1 ms loop() passes that block")
+    parser.add_argument("--stall-ms", type=float, default=300.0, help="mean blocking time")
+    parser.add_argument("--clock-error", type=float, default=0.002,
+                        help="sensor clock error, fraction of nominal")
+    parser.add_argument("--dump", help="decode a raw FIFO capture instead")
+    args = parser.parse_args()
+
+    if args.dump:
+        with open(args.dump, "rb") as f:
+            timestamps, frames = FifoDecoder(args.rate).feed(f.read())
+        columns, temperature = to_si(frames)
+        for t, *values in zip(timestamps, *(columns[name] for name in COLUMNS), temperature):
+            print(f"{t:10.2f} " + " ".join(f"{v:9.4f}" for v in values))
+        raise SystemExit
+
+    burst = max(1, min(args.rate // 50, WIRE_BUFFER // FRAME_BYTES))
+    n = int(args.seconds * args.rate * (1 + args.clock_error)) + 1
+    truth = synthetic_frames(n, args.rate)
+    rng = np.random.default_rng(1)
+    passes = int(args.seconds * 1000)
+    stalls = np.where(rng.random(passes) < args.stall_rate,
+                      rng.exponential(args.stall_ms, passes), 0.0)
+
+    model = MPU6050Model(truth, args.clock_error)
+    index, frames, stats = drain(model, args.rate, args.seconds, burst, stall_ms=stalls)
+    # Every frame decodes to exactly the sample the sensor took at its index
+    assert np.array_equal(frames, truth[index])
+    assert np.all(np.diff(index) > 0)
+    assert stats.restarts == 0 or model.overflows > 0
+
+    calm = MPU6050Model(truth, args.clock_error)
+    calm_index, calm_frames, calm_stats = drain(calm, args.rate, args.seconds, burst)
+    assert calm_stats.restarts == 0 and np.array_equal(calm_index, np.arange(len(calm_index)))
+    timestamps = FifoDecoder(args.rate).feed(calm_frames.tobytes())[0]
+    assert np.allclose(timestamps, calm_index * 1000.0 / args.rate)
+    rate, raw_timestamps, raw_frames = decode_raw(encode_raw(args.rate, 81234, calm_frames[:50]))
+    assert rate == args.rate and np.array_equal(raw_frames, calm_frames[:50])
+    assert np.array_equal(raw_timestamps, 81234 + np.rint(np.arange(50) * 1000.0 / args.rate))
+
+    # Polling would need one getEvent() per sample to see them all
+    polled = polled_bus_bytes(model.taken)
+    print(f"{args.rate} Hz for {args.seconds:g} s, {burst} frames per burst, "
+          f"sensor clock {args.clock_error:+.1%}")
+    print(f"  fused {stats.samples} of {model.taken} samples, {stats.restarts} FIFO restarts "
+          f"after {model.overflows} overflowing samples, {stats.lost} lost")
+    print(f"  I2C reads    FIFO {stats.reads:8d}   polled {model.taken:8d}")
+    print(f"  I2C bytes    FIFO {stats.bus_bytes:8d}   polled {polled:8d}")
+    print(f"  bus time     FIFO {bus_seconds(stats.bus_bytes, stats.reads):7.2f}s   "
+          f"polled {bus_seconds(polled, model.taken):7.2f}s")
+    print(f"  decoded frames match the sensor's samples; sensor-clock timestamps, "
+          f"{calm_stats.samples} samples without stalls")
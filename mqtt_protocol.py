@@ -0,0 +1,201 @@
+# Minimal MQTT 3.1.1 packet codec
+#
+# Covers the subset PubSubClient uses from the sketch (CONNECT with the device
+# token as username, QoS 0/1 PUBLISH, SUBSCRIBE, PINGREQ, DISCONNECT) plus the
+# matching broker replies. Shared by the ingest server and its load generator.
+
+import struct
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# CONNACK return codes
+ACCEPTED = 0
+BAD_CREDENTIALS = 4
+NOT_AUTHORIZED = 5
+
+TELEMETRY_TOPIC = "v1/devices/me/telemetry"
+# Binary frames from telemetry_codec.py (generated sketch with --batch-size > 1)
+PACKED_TELEMETRY_TOPIC = "v1/devices/me/telemetry/packed"
+# Raw MPU6050 FIFO frames from mpu6050_fifo.py (generated sketch with --raw-imu)
+RAW_TELEMETRY_TOPIC = "v1/devices/me/telemetry/raw"
+
+# Downlink, ThingsBoard style: shared attribute updates are pushed to
+# ATTRIBUTES_TOPIC, a device asks for the current ones by publishing to
+# .../request/<id> and gets {"shared": {...}} back on .../response/<id>;
+# RPCs go out on rpc/request/<id> and are answered on rpc/response/<id>
+ATTRIBUTES_TOPIC = "v1/devices/me/attributes"
+ATTRIBUTES_REQUEST_PREFIX = "v1/devices/me/attributes/request/"
+ATTRIBUTES_RESPONSE_PREFIX = "v1/devices/me/attributes/response/"
+RPC_REQUEST_PREFIX = "v1/devices/me/rpc/request/"
+RPC_RESPONSE_PREFIX = "v1/devices/me/rpc/response/"
+
+MAX_PACKET_SIZE = 1 << 20
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_remaining_length(length):
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        out.append(byte)
+        if not length:
+            return bytes(out)
+
+
+def _string(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack("!H", len(value)) + value
+
+
+def _read_string(body, offset):
+    (length,) = struct.unpack_from("!H", body, offset)
+    offset += 2
+    return body[offset:offset + length], offset + length
+
+
+def packet(packet_type, body=b"", flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_remaining_length(len(body)) + body
+
+
+# Read one packet from an asyncio StreamReader -> (type, flags, body)
+async def read_packet(reader):
+    header = await reader.readexactly(1)
+    multiplier = 1
+    length = 0
+    for _ in range(4):
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    else:
+        raise ProtocolError("malformed remaining length")
+    if length > MAX_PACKET_SIZE:
+        raise ProtocolError(f"packet of {length} bytes exceeds limit")
+    body = await reader.readexactly(length) if length else b""
+    return header[0] >> 4, header[0] & 0x0F, body
+
+
+def encode_connect(client_id, username=None, password=None, keepalive=15):
+    flags = 0x02  # clean session
+    payload = _string(client_id)
+    if username is not None:
+        flags |= 0x80
+        payload += _string(username)
+    if password is not None:
+        flags |= 0x40
+        payload += _string(password)
+    body = _string("MQTT") + bytes([4, flags]) + struct.pack("!H", keepalive) + payload
+    return packet(CONNECT, body)
+
+
+# CONNECT body -> dict with client_id, username, password, keepalive
+def decode_connect(body):
+    name, offset = _read_string(body, 0)
+    if name not in (b"MQTT", b"MQIsdp"):
+        raise ProtocolError(f"unknown protocol name {name!r}")
+    level, flags = body[offset], body[offset + 1]
+    (keepalive,) = struct.unpack_from("!H", body, offset + 2)
+    offset += 4
+    client_id, offset = _read_string(body, offset)
+    if flags & 0x04:  # will topic and message
+        _, offset = _read_string(body, offset)
+        _, offset = _read_string(body, offset)
+    username = password = None
+    if flags & 0x80:
+        username, offset = _read_string(body, offset)
+        username = username.decode()
+    if flags & 0x40:
+        password, offset = _read_string(body, offset)
+    return {
+        "level": level,
+        "client_id": client_id.decode(),
+        "username": username,
+        "password": password,
+        "keepalive": keepalive,
+    }
+
+
+def encode_connack(return_code, session_present=False):
+    return packet(CONNACK, bytes([1 if session_present else 0, return_code]))
+
+
+def encode_publish(topic, payload, qos=0, packet_id=None, retain=False):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    body = _string(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    return packet(PUBLISH, body + payload, flags=(qos << 1) | (1 if retain else 0))
+
+
+# PUBLISH body -> (topic, payload, qos, packet_id)
+def decode_publish(flags, body):
+    qos = (flags >> 1) & 0x03
+    topic, offset = _read_string(body, 0)
+    packet_id = None
+    if qos:
+        (packet_id,) = struct.unpack_from("!H", body, offset)
+        offset += 2
+    return topic.decode(), body[offset:], qos, packet_id
+
+
+def encode_puback(packet_id):
+    return packet(PUBACK, struct.pack("!H", packet_id))
+
+
+def encode_subscribe(packet_id, topics, qos=0):
+    body = struct.pack("!H", packet_id)
+    for topic in topics:
+        body += _string(topic) + bytes([qos])
+    return packet(SUBSCRIBE, body, flags=0x02)
+
+
+# SUBSCRIBE body -> (packet_id, [(topic, qos), ...])
+def decode_subscribe(body):
+    (packet_id,) = struct.unpack_from("!H", body, 0)
+    offset = 2
+    topics = []
+    while offset < len(body):
+        topic, offset = _read_string(body, offset)
+        topics.append((topic.decode(), body[offset]))
+        offset += 1
+    return packet_id, topics
+
+
+def encode_suback(packet_id, granted):
+    return packet(SUBACK, struct.pack("!H", packet_id) + bytes(granted))
+
+
+PINGREQ_PACKET = packet(PINGREQ)
+PINGRESP_PACKET = packet(PINGRESP)
+DISCONNECT_PACKET = packet(DISCONNECT)
+
+
+# MQTT topic filter matching with + and # wildcards
+def topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[i]:
+            return False
+    return len(filter_parts) == len(topic_parts)
@@ -0,0 +1,482 @@
+# Server-side quaternion fusion for a whole fleet in lockstep
+#
+# The sketches fuse with an Euler complementary filter whose yaw is the raw
+# running sum of GyroZ and which falls apart near +-90 deg pitch. FleetFusion
+# re-fuses the raw acc_*/gyro_* columns with Madgwick's gradient descent or
+# Mahony's PI filter (6-axis IMU forms of both). The state of every device is
+# one row of an (N, 4) quaternion array [w, x, y, z] and each tick advances all
+# N rows with a fixed number of whole-column numpy operations, so the cost per
+# tick grows linearly with N and the per-sample Python overhead is paid once
+# per tick instead of once per device.
+#
+# Axes and units match mpu.getEvent(): accel in m/s^2 (any scale, it is
+# normalised), gyro in rad/s, +Z up when the board lies flat. Euler angles
+# come out in degrees with the sketch's sign conventions (roll about X, pitch
+# about Y, so a flat board reads 0, 0).
+#
+#   python quaternion_fusion.py --devices 10000 --ticks 200
+#   python quaternion_fusion.py --store data --algorithm mahony
+
+import argparse
+import math
+import time
+
+import numpy as np
+
+ALGORITHMS = ("madgwick", "mahony")
+MADGWICK_BETA = 0.1
+MAHONY_KP = 1.0
+MAHONY_KI = 0.0
+
+# Devices advanced per pass over the kernel: the ~20 scratch rows of a block
+# stay in L2, where one numpy call on a 100k row would stream from memory
+BLOCK = 16384
+
+
+# Per-device gain column: a scalar fills all N rows, an array must have N
+def _gain(value, n, dtype):
+    gain = np.empty(n, dtype=dtype)
+    gain[:] = value
+    return gain
+
+
+# The kernels below write into preallocated (N,) rows; a fresh temporary per
+# operation costs more than the arithmetic at fleet sizes
+def _add_product(out, a, b, tmp):
+    np.multiply(a, b, out=tmp)
+    out += tmp
+
+
+def _sub_product(out, a, b, tmp):
+    np.multiply(a, b, out=tmp)
+    out -= tmp
+
+
+# out = 1 / |column| for a (k, N) array, and 0 where the column is all zeros
+# (free fall, no reading) so those devices skip the correction
+def _inverse_norm(rows, out):
+    np.einsum("ij,ij->j", rows, rows, out=out)
+    np.sqrt(out, out=out)
+    np.divide(1, out, out=out, where=out > 0)
+    return out
+
+
+class FleetFusion:
+    # beta (Madgwick) and kp/ki (Mahony) are scalars or one value per device;
+    # they stay public arrays so single devices can be retuned in place,
+    # e.g. fusion.beta[42] = 0.05.
+    #
+    # The quaternions live in a (4, N) array so every component is one
+    # contiguous row for the column-wise math; q is its (N, 4) transpose view.
+    def __init__(self, n_devices, algorithm="madgwick", beta=MADGWICK_BETA,
+                 kp=MAHONY_KP, ki=MAHONY_KI, dtype=np.float32):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"algorithm must be one of {ALGORITHMS}, got {algorithm!r}")
+        self.algorithm = algorithm
+        self.dtype = np.dtype(dtype)
+        self._q = np.zeros((4, n_devices), dtype=self.dtype)
+        self._q[0] = 1
+        self.beta = _gain(beta, n_devices, self.dtype)
+        self.kp = _gain(kp, n_devices, self.dtype)
+        self.ki = _gain(ki, n_devices, self.dtype)
+        self._integral = np.zeros((3, n_devices), dtype=self.dtype)
+        block = min(BLOCK, n_devices)
+        self._work = np.empty((16, block), dtype=self.dtype)
+        self._correction = np.empty((4, block), dtype=self.dtype)
+        self._valid = np.empty(block, dtype=bool)
+
+    @property
+    def q(self):
+        return self._q.T
+
+    def __len__(self):
+        return self._q.shape[1]
+
+    # Start devices at the tilt their (3, n) accelerometer rows report (yaw 0)
+    # instead of letting the filter converge from level; devices=None is all
+    def reset(self, acc, devices=None):
+        rows = slice(None) if devices is None else devices
+        ax, ay, az = np.asarray(acc, dtype=np.float64)
+        roll = np.arctan2(ay, az)
+        pitch = np.arctan2(-ax, np.sqrt(ay * ay + az * az))
+        self._q[:, rows] = euler_to_quaternion(roll, pitch, 0).T
+        self._integral[:, rows] = 0
+
+    # Advance every device by one sample. gyro and acc are (3, N), one row
+    # per axis like the store's acc_*/gyro_* columns; dt is in seconds, a
+    # scalar or (N,). A device with nothing new this tick gets dt = 0 and
+    # keeps its state. Returns the (N, 4) quaternions.
+    def update(self, gyro, acc, dt):
+        gyro = np.asarray(gyro, dtype=self.dtype)
+        acc = np.asarray(acc, dtype=self.dtype)
+        dt = np.asarray(dt, dtype=self.dtype)
+        n = len(self)
+        for start in range(0, n, BLOCK):
+            rows = slice(start, min(start + BLOCK, n))
+            self._step(rows, gyro[:, rows], acc[:, rows], dt if dt.ndim == 0 else dt[rows])
+        return self.q
+
+    def _step(self, rows, gyro, acc, dt):
+        size = gyro.shape[1]
+        q = self._q[:, rows]
+        work = self._work[:, :size]
+        valid = self._valid[:size]
+        unit, tmp = work[:3], work[3]
+        _inverse_norm(acc, tmp)
+        np.greater(tmp, 0, out=valid)
+        np.multiply(acc, tmp, out=unit)
+        ax, ay, az = unit
+        if self.algorithm == "madgwick":
+            correction = self._madgwick(q, work, rows, ax, ay, az, valid, dt)
+            rates = gyro
+        else:
+            correction = None
+            rates = self._mahony(q, work, rows, gyro, ax, ay, az, dt)
+
+        # q += q * (0, rates) * dt / 2, then back to unit length
+        w, x, y, z = q
+        half, delta = work[4:7], work[7:11]
+        gx, gy, gz = half
+        dw, dx, dy, dz = delta
+        np.multiply(rates, 0.5 * dt, out=half)
+        np.multiply(x, gx, out=dw)
+        np.negative(dw, out=dw)
+        _sub_product(dw, y, gy, tmp)
+        _sub_product(dw, z, gz, tmp)
+        np.multiply(w, gx, out=dx)
+        _add_product(dx, y, gz, tmp)
+        _sub_product(dx, z, gy, tmp)
+        np.multiply(w, gy, out=dy)
+        _sub_product(dy, x, gz, tmp)
+        _add_product(dy, z, gx, tmp)
+        np.multiply(w, gz, out=dz)
+        _add_product(dz, x, gy, tmp)
+        _sub_product(dz, y, gx, tmp)
+        q += delta
+        if correction is not None:
+            q -= correction
+        q *= _inverse_norm(q, tmp)
+
+    # Madgwick leaves the gyro alone and steps the quaternion down the
+    # normalised gradient of the gravity error, beta * dt at a time
+    def _madgwick(self, q, work, rows, ax, ay, az, valid, dt):
+        w, x, y, z = q
+        fx, fy, fz, scale, tmp = work[11:16]
+        # Gravity direction the estimate predicts minus the measured one
+        np.multiply(x, z, out=fx)
+        _sub_product(fx, w, y, tmp)
+        fx *= 2
+        fx -= ax
+        np.multiply(w, x, out=fy)
+        _add_product(fy, y, z, tmp)
+        fy *= 2
+        fy -= ay
+        np.multiply(x, x, out=fz)
+        _add_product(fz, y, y, tmp)
+        fz *= -2
+        fz += 1
+        fz -= az
+        # J^T f, halved since only its direction is used
+        correction = self._correction[:, :q.shape[1]]
+        sw, sx, sy, sz = correction
+        np.multiply(x, fy, out=sw)
+        _sub_product(sw, y, fx, tmp)
+        np.multiply(z, fx, out=sx)
+        _add_product(sx, w, fy, tmp)
+        np.multiply(x, fz, out=tmp)
+        tmp *= 2
+        sx -= tmp
+        np.multiply(z, fy, out=sy)
+        _sub_product(sy, w, fx, tmp)
+        np.multiply(y, fz, out=tmp)
+        tmp *= 2
+        sy -= tmp
+        np.multiply(x, fx, out=sz)
+        _add_product(sz, y, fy, tmp)
+        _inverse_norm(correction, scale)
+        scale *= self.beta[rows]
+        scale *= dt
+        scale *= valid
+        correction *= scale
+        return correction
+
+    # Mahony feeds the gravity error back into the gyro rates through a PI
+    # controller; the I term is per device state
+    def _mahony(self, q, work, rows, gyro, ax, ay, az, dt):
+        w, x, y, z = q
+        vx, vy, vz, gain, tmp = work[11:16]
+        # Half the predicted gravity direction, crossed with the measured one
+        np.multiply(x, z, out=vx)
+        _sub_product(vx, w, y, tmp)
+        np.multiply(w, x, out=vy)
+        _add_product(vy, y, z, tmp)
+        np.multiply(w, w, out=vz)
+        _add_product(vz, z, z, tmp)
+        vz -= 0.5
+        error = self._correction[:3, :q.shape[1]]
+        ex, ey, ez = error
+        np.multiply(ay, vz, out=ex)
+        _sub_product(ex, az, vy, tmp)
+        np.multiply(az, vx, out=ey)
+        _sub_product(ey, ax, vz, tmp)
+        np.multiply(ax, vy, out=ez)
+        _sub_product(ez, ay, vx, tmp)
+        integral = self._integral[:, rows]
+        np.multiply(self.ki[rows], dt, out=gain)
+        gain *= 2
+        for axis in range(3):
+            _add_product(integral[axis], error[axis], gain, tmp)
+        np.multiply(self.kp[rows], 2, out=gain)
+        error *= gain
+        error += integral
+        error += gyro
+        return error
+
+    # Whole recordings at once: gyro and acc are (T, 3, N), dt is (T, N),
+    # (T,) or a scalar. Returns the (T, N, 4) quaternion after every tick.
+    def run(self, gyro, acc, dt):
+        ticks = len(gyro)
+        gyro = np.asarray(gyro, dtype=self.dtype)
+        acc = np.asarray(acc, dtype=self.dtype)
+        dt = np.asarray(dt, dtype=self.dtype)
+        if dt.ndim < 2:
+            dt = np.broadcast_to(dt, (ticks,))
+        out = np.empty((ticks, 4, len(self)), dtype=self.dtype)
+        for t in range(ticks):
+            self.update(gyro[t], acc[t], dt[t])
+            out[t] = self._q
+        return np.moveaxis(out, 1, 2)
+
+    def euler(self):
+        return quaternion_to_euler(self.q)
+
+
+# Roll, pitch, yaw in radians (ZYX, as quaternion_to_euler) -> (..., 4)
+def euler_to_quaternion(roll, pitch, yaw):
+    cr, sr = np.cos(np.divide(roll, 2)), np.sin(np.divide(roll, 2))
+    cp, sp = np.cos(np.divide(pitch, 2)), np.sin(np.divide(pitch, 2))
+    cy, sy = np.cos(np.divide(yaw, 2)), np.sin(np.divide(yaw, 2))
+    return np.stack([cr * cp * cy + sr * sp * sy,
+                     sr * cp * cy - cr * sp * sy,
+                     cr * sp * cy + sr * cp * sy,
+                     cr * cp * sy - sr * sp * cy], axis=-1)
+
+
+# Rotation angle in degrees between two sets of (..., 4) attitudes
+def attitude_error(q, reference):
+    dot = np.abs(np.sum(np.asarray(q, dtype=np.float64) * reference, axis=-1))
+    return np.degrees(2 * np.arccos(np.clip(dot, 0, 1)))
+
+
+# Angle in degrees between the gravity directions two attitudes predict: the
+# tilt part of the error, which the accelerometer keeps bounded (yaw is not
+# observable without a magnetometer and only ever drifts)
+def tilt_error(q, reference):
+    def down(q):
+        w, x, y, z = np.moveaxis(np.asarray(q, dtype=np.float64), -1, 0)
+        return np.stack([2 * (x * z - w * y), 2 * (w * x + y * z), 1 - 2 * (x * x + y * y)], axis=-1)
+    cosine = np.sum(down(q) * down(reference), axis=-1)
+    return np.degrees(np.arccos(np.clip(cosine, -1, 1)))
+
+
+# (..., 4) quaternions -> (..., 3) roll, pitch, yaw in degrees
+def quaternion_to_euler(q):
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    roll = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2 * (w * y - x * z), -1, 1))
+    yaw = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return np.degrees(np.stack([roll, pitch, yaw], axis=-1))
+
+
+# One device, one sample, plain Python floats: the loop FleetFusion replaces,
+# kept as the reference for agreement and speed checks
+def madgwick_update(q, gyro, acc, dt, beta=MADGWICK_BETA):
+    w, x, y, z = q
+    gx, gy, gz = gyro
+    ax, ay, az = acc
+    rw = 0.5 * (-x * gx - y * gy - z * gz)
+    rx = 0.5 * (w * gx + y * gz - z * gy)
+    ry = 0.5 * (w * gy - x * gz + z * gx)
+    rz = 0.5 * (w * gz + x * gy - y * gx)
+    norm = math.sqrt(ax * ax + ay * ay + az * az)
+    if norm > 0:
+        ax, ay, az = ax / norm, ay / norm, az / norm
+        fx = 2 * (x * z - w * y) - ax
+        fy = 2 * (w * x + y * z) - ay
+        fz = 1 - 2 * (x * x + y * y) - az
+        sw = -2 * y * fx + 2 * x * fy
+        sx = 2 * z * fx + 2 * w * fy - 4 * x * fz
+        sy = -2 * w * fx + 2 * z * fy - 4 * y * fz
+        sz = 2 * x * fx + 2 * y * fy
+        norm = math.sqrt(sw * sw + sx * sx + sy * sy + sz * sz)
+        if norm > 0:
+            rw -= beta * sw / norm
+            rx -= beta * sx / norm
+            ry -= beta * sy / norm
+            rz -= beta * sz / norm
+    w, x, y, z = w + rw * dt, x + rx * dt, y + ry * dt, z + rz * dt
+    norm = math.sqrt(w * w + x * x + y * y + z * z)
+    return w / norm, x / norm, y / norm, z / norm
+
+
+# Same for Mahony; integral is the (3,) list of the I term, updated in place
+def mahony_update(q, gyro, acc, dt, integral, kp=MAHONY_KP, ki=MAHONY_KI):
+    w, x, y, z = q
+    gx, gy, gz = gyro
+    ax, ay, az = acc
+    norm = math.sqrt(ax * ax + ay * ay + az * az)
+    if norm > 0:
+        ax, ay, az = ax / norm, ay / norm, az / norm
+        vx = x * z - w * y
+        vy = w * x + y * z
+        vz = w * w - 0.5 + z * z
+        ex, ey, ez = ay * vz - az * vy, az * vx - ax * vz, ax * vy - ay * vx
+        integral[0] += 2 * ki * ex * dt
+        integral[1] += 2 * ki * ey * dt
+        integral[2] += 2 * ki * ez * dt
+        gx += integral[0] + 2 * kp * ex
+        gy += integral[1] + 2 * kp * ey
+        gz += integral[2] + 2 * kp * ez
+    half = 0.5 * dt
+    w, x, y, z = (w + (-x * gx - y * gy - z * gz) * half,
+                  x + (w * gx + y * gz - z * gy) * half,
+                  y + (w * gy - x * gz + z * gx) * half,
+                  z + (w * gz + x * gy - y * gx) * half)
+    norm = math.sqrt(w * w + x * x + y * y + z * z)
+    return w / norm, x / norm, y / norm, z / norm
+
+
+# Synthetic fleet: every device tilts on its own slow sine with a pass
+# through +-85 deg pitch, where the Euler filter breaks down, while the whole
+# fleet turns slowly in yaw. Returns gyro and acc (T, 3, N) float32, dt (T,)
+# and the true (T, N, 4) attitude.
+def synthetic_fleet(n_devices, ticks, rate_hz=100, seed=0):
+    rng = np.random.default_rng(seed)
+    t = (np.arange(ticks) / rate_hz)[:, None]
+    phase = rng.uniform(0, 2 * np.pi, (1, n_devices))
+    roll = np.radians(30) * np.sin(0.3 * t + phase)
+    pitch = np.radians(85) * np.sin(0.2 * t + phase) ** 3
+    yaw = np.broadcast_to(0.4 * np.sin(0.1 * t), roll.shape)
+
+    # Body rates from the Euler angle derivatives (ZYX)
+    d_roll, d_pitch, d_yaw = (np.gradient(a, 1 / rate_hz, axis=0) for a in (roll, pitch, yaw))
+    sr, cr = np.sin(roll), np.cos(roll)
+    sp, cp = np.sin(pitch), np.cos(pitch)
+    gyro = np.stack([d_roll - sp * d_yaw,
+                     cr * d_pitch + sr * cp * d_yaw,
+                     -sr * d_pitch + cr * cp * d_yaw], axis=1)
+    acc = 9.81 * np.stack([-sp, sr * cp, cr * cp], axis=1)
+    gyro += rng.normal(0, 0.002, gyro.shape)
+    acc += rng.normal(0, 0.05, acc.shape)
+    truth = euler_to_quaternion(roll, pitch, yaw)
+    return gyro.astype(np.float32), acc.astype(np.float32), np.full(ticks, 1 / rate_hz), truth
+
+
+# Re-fuse every device in a TelemetryStore. Devices are advanced row by row
+# in lockstep with their own millis() deltas; shorter logs get dt = 0 once
+# they run out. Returns {device: (timestamps, (rows, 4) quaternions)}.
+def fuse_store(store, devices=None, start=None, end=None, **kwargs):
+    devices = devices or store.devices()
+    names = ["acc_x", "acc_y", "acc_z", "gyro_x", "gyro_y", "gyro_z", "timestamp"]
+    logs = [store.read(device, start, end, columns=names) for device in devices]
+    lengths = np.array([len(log["timestamp"]) for log in logs])
+    ticks = int(lengths.max(initial=0))
+
+    acc = np.zeros((ticks, 3, len(devices)), dtype=np.float32)
+    gyro = np.zeros((ticks, 3, len(devices)), dtype=np.float32)
+    dt = np.zeros((ticks, len(devices)), dtype=np.float32)
+    for i, log in enumerate(logs):
+        rows = lengths[i]
+        for axis, name in enumerate("xyz"):
+            acc[:rows, axis, i] = log["acc_" + name]
+            gyro[:rows, axis, i] = log["gyro_" + name]
+        dt[1:rows, i] = np.diff(log["timestamp"]) / 1000.0
+
+    fusion = FleetFusion(len(devices), **kwargs)
+    if ticks:
+        fusion.reset(acc[0])
+    q = fusion.run(gyro, acc, dt)
+    return {device: (log["timestamp"], q[:lengths[i], i])
+            for i, (device, log) in enumerate(zip(devices, logs))}
+
+
+def _per_device_loop(algorithm, gyro, acc, dt):
+    ticks, _, n = gyro.shape
+    gyro = np.moveaxis(gyro, 2, 0).tolist()
+    acc = np.moveaxis(acc, 2, 0).tolist()
+    dt = dt.tolist()
+    out = np.empty((ticks, n, 4))
+    for d in range(n):
+        q = (1.0, 0.0, 0.0, 0.0)
+        integral = [0.0, 0.0, 0.0]
+        for t in range(ticks):
+            if algorithm == "madgwick":
+                q = madgwick_update(q, gyro[d][t], acc[d][t], dt[t])
+            else:
+                q = mahony_update(q, gyro[d][t], acc[d][t], dt[t], integral)
+            out[t, d] = q
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched Madgwick/Mahony fusion across a fleet")
+    parser.add_argument("--algorithm", choices=ALGORITHMS, default="madgwick")
+    parser.add_argument("--devices", type=int, default=10_000)
+    parser.add_argument("--ticks", type=int, default=200)
+    parser.add_argument("--loop-devices", type=int, default=100,
+                        help="devices timed with the per-device Python loop")
+    parser.add_argument("--store", help="re-fuse every device in this TelemetryStore instead")
+    args = parser.parse_args()
+
+    if args.store:
+        from telemetry_store import TelemetryStore
+
+        for device, (timestamps, q) in fuse_store(TelemetryStore(args.store),
+                                                  algorithm=args.algorithm).items():
+            if len(q):
+                roll, pitch, yaw = quaternion_to_euler(q[-1])
+                print(f"{device}: {len(q)} samples, last roll {roll:.1f} pitch {pitch:.1f} "
+                      f"yaw {yaw:.1f} deg")
+        raise SystemExit
+
+    # Agreement with the per-device loop
+    gyro, acc, dt, truth = synthetic_fleet(args.loop_devices, 6000)
+    batch = FleetFusion(args.loop_devices, args.algorithm).run(gyro, acc, dt)
+    reference = _per_device_loop(args.algorithm, gyro, acc, dt)
+    print(f"max |batch - per-device loop| = {np.abs(batch - reference).max():.2e}")
+
+    # Accuracy through +-85 deg pitch, started from the accelerometer tilt
+    fusion = FleetFusion(args.loop_devices, args.algorithm)
+    fusion.reset(acc[0])
+    q = fusion.run(gyro, acc, dt)
+    print(f"over 60 s: max tilt error {tilt_error(q, truth).max():.2f} deg, "
+          f"max attitude error (incl. yaw drift) {attitude_error(q, truth).max():.2f} deg")
+
+    # Per-device Python loops vs one vectorized step per tick: plain floats
+    # (the fastest a loop gets) and one single-device engine per device
+    ticks = args.ticks
+    gyro, acc, dt, _ = synthetic_fleet(args.loop_devices, ticks)
+    start = time.perf_counter()
+    _per_device_loop(args.algorithm, gyro, acc, dt)
+    loop_rate = args.loop_devices * ticks / (time.perf_counter() - start)
+    engines = [FleetFusion(1, args.algorithm) for _ in range(10)]
+    start = time.perf_counter()
+    for t in range(ticks):
+        for d, engine in enumerate(engines):
+            engine.update(gyro[t, :, d:d + 1], acc[t, :, d:d + 1], dt[t])
+    engine_rate = len(engines) * ticks / (time.perf_counter() - start)
+    print(f"per-device loop, floats:          {loop_rate / 1e3:7.1f} k device-samples/s")
+    print(f"per-device loop, FleetFusion(1):  {engine_rate / 1e3:7.1f} k device-samples/s")
+
+    sizes = sorted({max(args.devices // 100, 1), max(args.devices // 10, 1), args.devices})
+    for n in sizes:
+        gyro, acc, dt, _ = synthetic_fleet(n, ticks)
+        fusion = FleetFusion(n, args.algorithm)
+        start = time.perf_counter()
+        for t in range(ticks):
+            fusion.update(gyro[t], acc[t], dt[t])
+        elapsed = time.perf_counter() - start
+        rate = n * ticks / elapsed
+        print(f"fleet of {n:>7,}: {elapsed / ticks * 1e3:7.3f} ms/tick, "
+              f"{rate / 1e6:6.2f} M device-samples/s, {rate / loop_rate:4.0f}x / "
+              f"{rate / engine_rate:5.0f}x the loops")
@@ -0,0 +1,363 @@
+# Server-driven publish rates for the fleet, on top of IngestServer's downlink
+#
+# RateController runs next to the ingest server. Every period it looks at the
+# p99 commit latency of the records written since its last step, the age of
+# whatever is still waiting to be written and the queue depth, and adjusts an
+# allowed fleet throughput (records/s) AIMD style: cut it by `decrease` when
+# latency passes `headroom` of the target or the queue limit is exceeded,
+# grow it back by `increase` of the budget once latency is comfortably low,
+# never above the budget. A step only sees the p99 of its own period, so
+# cutting below the target leaves room for the spikes between steps.
+# Latency lags the load by about itself, so after a cut the controller waits
+# that long before cutting again instead of reacting to its own backlog. The
+# allowance is split over the connected devices by weighted max-min fairness
+# (no device gets more than it would send anyway) and each device's share is
+# turned into a cloudInterval pushed as a shared attribute, which the sketch
+# applies at runtime (applyRates() in script_4.py).
+#
+# The __main__ block is the demo: a fleet of simulated boards, speaking the
+# sketch's MQTT contract including the downlink, publishes to an in-process
+# IngestServer whose storage can commit `capacity` records/s. Partway through
+# a second batch of boards comes online; the run is done without and with the
+# controller.
+#
+#   python rate_controller.py --devices 300 --burst-devices 900 --capacity 800
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import deque, namedtuple
+
+import mqtt_protocol as mqtt
+from ingest_loadgen import percentile
+from ingest_server import DeviceRegistry, IngestServer, MemorySink
+
+# ms between publishes and readings per publish, as in the sketch
+DeviceRates = namedtuple("DeviceRates", ["cloud_interval", "batch_size"])
+NOMINAL_RATES = DeviceRates(1000, 1)
+
+# The sketch's clamps in applyRates()
+MIN_CLOUD_INTERVAL = 200
+MAX_CLOUD_INTERVAL = 60000
+MAX_BATCH_SIZE = 10
+
+
+def records_per_second(rates):
+    return rates.batch_size * 1000.0 / rates.cloud_interval
+
+
+# Seconds between readings
+def period(rates):
+    return rates.cloud_interval / rates.batch_size / 1000.0
+
+
+# Weighted max-min fair split of total over devices wanting demand[i]:
+# device i gets min(demand[i], weight[i] * level) with the level chosen so
+# the shares add up to total (or everyone gets their demand)
+def allocate(demand, weights, total):
+    shares = list(demand)
+    if sum(demand) <= total:
+        return shares
+    order = sorted(range(len(demand)), key=lambda i: demand[i] / weights[i])
+    remaining = float(total)
+    weight_left = float(sum(weights))
+    for position, i in enumerate(order):
+        level = remaining / weight_left
+        if demand[i] <= weights[i] * level:
+            remaining -= demand[i]
+            weight_left -= weights[i]
+            continue
+        for j in order[position:]:
+            shares[j] = weights[j] * level
+        break
+    return shares
+
+
+# Sink wrapper recording the commit latency of the last `keep` records
+# (commit time minus IngestServer's receive time), plus the receive time of
+# the oldest record in a commit that is still running
+class LatencyProbe:
+    def __init__(self, sink=None, keep=1_000_000):
+        self.sink = sink if sink is not None else MemorySink()
+        self.samples = deque(maxlen=keep)  # (commit time, latency)
+        self.in_flight = None
+
+    def __call__(self, batch):
+        self.in_flight = batch[0].received if batch else None
+        try:
+            self.sink(batch)
+        finally:
+            self.in_flight = None
+        now = time.time()
+        self.samples.extend((now, now - record.received) for record in batch)
+
+    # Latencies committed after since (time.time()), newest first
+    def latencies(self, since):
+        recent = []
+        for at, latency in reversed(self.samples):
+            if at <= since:
+                break
+            recent.append(latency)
+        return recent
+
+
+class RateController:
+    # budget: records/s the storage tier is provisioned for; latency_target:
+    # p99 commit latency in seconds. weights and nominal map device -> weight
+    # (default 1) and device -> DeviceRates (default NOMINAL_RATES).
+    def __init__(self, server, probe, budget, latency_target=0.5, queue_limit=None,
+                 weights=None, nominal=None, period=0.5, decrease=0.7, increase=0.05,
+                 hysteresis=0.1, headroom=0.8):
+        self.server = server
+        self.probe = probe
+        self.budget = float(budget)
+        self.latency_target = latency_target
+        self.queue_limit = queue_limit if queue_limit is not None else budget * latency_target
+        self.weights = weights or {}
+        self.nominal = nominal or {}
+        self.period = period
+        self.decrease = decrease
+        self.increase = increase
+        self.hysteresis = hysteresis
+        self.headroom = headroom
+        self.allowed = self.budget
+        self.intervals = {}  # device -> cloudInterval last pushed
+        self.history = []    # (time, p99, queue depth, allowed)
+        self._last_step = time.time()
+        self._hold_until = 0.0
+
+    def step(self, now=None):
+        now = time.time() if now is None else now
+        latencies = self.probe.latencies(self._last_step)
+        self._last_step = now
+        # A stuck commit produces no samples, so also count how long the
+        # oldest record not yet written has been waiting
+        waiting = (self.probe.in_flight, self.server.oldest_pending)
+        age = max((now - t for t in waiting if t is not None), default=0.0)
+        p99 = max(percentile(latencies, 99) if latencies else 0.0, age)
+        depth = self.server.queue_depth
+
+        if p99 > self.headroom * self.latency_target or depth > self.queue_limit:
+            if now >= self._hold_until:
+                self.allowed *= self.decrease
+                self._hold_until = now + p99
+        elif p99 < self.latency_target / 2:
+            self.allowed = min(self.allowed + self.increase * self.budget, self.budget)
+        self.history.append((now, p99, depth, self.allowed))
+        self.apply()
+
+    # Split the allowance and push every cloudInterval that moved by more
+    # than the hysteresis, so the downlink stays quiet in steady state
+    def apply(self):
+        devices = list(self.server.clients)
+        nominal = [self.nominal.get(d, NOMINAL_RATES) for d in devices]
+        demand = [records_per_second(rates) for rates in nominal]
+        weights = [self.weights.get(d, 1.0) for d in devices]
+        floor = sum(rates.batch_size * 1000.0 / MAX_CLOUD_INTERVAL for rates in nominal)
+        self.allowed = max(self.allowed, floor)
+        for device, rates, share in zip(devices, nominal,
+                                        allocate(demand, weights, self.allowed)):
+            interval = rates.batch_size * 1000.0 / share if share > 0 else MAX_CLOUD_INTERVAL
+            interval = int(round(min(max(interval, rates.cloud_interval), MAX_CLOUD_INTERVAL), -1))
+            current = self.intervals.get(device, rates.cloud_interval)
+            if abs(interval - current) > self.hysteresis * current:
+                self.server.set_attributes(device, {"cloudInterval": interval})
+                self.intervals[device] = interval
+
+    # Steps every period; in between, devices that just connected get their
+    # share right away instead of publishing at their nominal rate until then
+    async def run(self, poll=0.05):
+        connected = set()
+        next_step = time.time() + self.period
+        while True:
+            await asyncio.sleep(poll)
+            if time.time() >= next_step:
+                next_step += self.period
+                self.step()
+            elif not connected.issuperset(self.server.clients):
+                self.apply()
+            connected = set(self.server.clients)
+
+
+# Storage stand-in that commits `capacity` records/s plus a fixed cost per batch
+class ThrottledSink:
+    def __init__(self, capacity, per_batch=0.002):
+        self.capacity = capacity
+        self.per_batch = per_batch
+        self.count = 0
+
+    def __call__(self, batch):
+        time.sleep(self.per_batch + len(batch) / self.capacity)
+        self.count += len(batch)
+
+
+# One board running the generated sketch: readings every cloudInterval /
+# batchSize, a publish per full batch, and applyRates() on downlink messages,
+# which restarts the reading timer at a random point of a changed period
+async def simulated_board(host, port, token, start_at, stop_at, rates=NOMINAL_RATES):
+    await asyncio.sleep(max(0.0, start_at - time.perf_counter()))
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(mqtt.encode_connect("ESP32Client", token, ""))
+    packet_type, _, body = await mqtt.read_packet(reader)
+    if packet_type != mqtt.CONNACK or body[1] != mqtt.ACCEPTED:
+        writer.close()
+        return 0
+    writer.write(mqtt.encode_subscribe(1, [mqtt.ATTRIBUTES_TOPIC,
+                                           mqtt.ATTRIBUTES_RESPONSE_PREFIX + "+",
+                                           mqtt.RPC_REQUEST_PREFIX + "+"]))
+    writer.write(mqtt.encode_publish(mqtt.ATTRIBUTES_REQUEST_PREFIX + "1", json.dumps(
+        {"sharedKeys": "cloudInterval,batchSize,displayInterval"})))
+    state = {"cloud_interval": rates.cloud_interval, "batch_size": rates.batch_size,
+             "last_reading": time.perf_counter() - random.uniform(0, period(rates))}
+    changed = asyncio.Event()
+
+    def apply_rates(values):
+        old_period = state["cloud_interval"] / state["batch_size"]
+        if "cloudInterval" in values:
+            state["cloud_interval"] = min(max(int(values["cloudInterval"]), MIN_CLOUD_INTERVAL),
+                                          MAX_CLOUD_INTERVAL)
+        if "batchSize" in values:
+            state["batch_size"] = min(max(int(values["batchSize"]), 1), MAX_BATCH_SIZE)
+        new_period = state["cloud_interval"] / state["batch_size"]
+        if new_period != old_period:
+            state["last_reading"] = time.perf_counter() - random.uniform(0, new_period / 1000.0)
+            changed.set()
+
+    async def downlink():
+        while True:
+            packet_type, flags, body = await mqtt.read_packet(reader)
+            if packet_type != mqtt.PUBLISH:
+                continue
+            topic, payload, _, _ = mqtt.decode_publish(flags, body)
+            message = json.loads(payload)
+            if topic == mqtt.ATTRIBUTES_TOPIC:
+                apply_rates(message)
+            elif topic.startswith(mqtt.ATTRIBUTES_RESPONSE_PREFIX):
+                apply_rates(message.get("shared", {}))
+            elif topic.startswith(mqtt.RPC_REQUEST_PREFIX) and message.get("method") == "setRates":
+                apply_rates(message.get("params", {}))
+                reply = {"cloudInterval": state["cloud_interval"], "batchSize": state["batch_size"]}
+                writer.write(mqtt.encode_publish(
+                    mqtt.RPC_RESPONSE_PREFIX + topic[len(mqtt.RPC_REQUEST_PREFIX):],
+                    json.dumps(reply)))
+
+    listener = asyncio.create_task(downlink())
+    boot = time.perf_counter() - random.uniform(0, 3600)
+    queued = []
+    published = 0
+    try:
+        while time.perf_counter() < stop_at:
+            due = state["last_reading"] + state["cloud_interval"] / state["batch_size"] / 1000.0
+            try:
+                await asyncio.wait_for(changed.wait(), max(0.0, due - time.perf_counter()))
+                changed.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+            state["last_reading"] = time.perf_counter()
+            queued.append({
+                "roll": round(random.uniform(-90, 90), 2),
+                "pitch": round(random.uniform(-90, 90), 2),
+                "yaw": round(random.uniform(-180, 180), 2),
+                "temperature": 25.0,
+                "timestamp": int((time.perf_counter() - boot) * 1000),
+            })
+            if len(queued) >= state["batch_size"]:
+                payload = queued[0] if len(queued) == 1 else queued
+                writer.write(mqtt.encode_publish(mqtt.TELEMETRY_TOPIC, json.dumps(payload)))
+                await writer.drain()
+                published += len(queued)
+                queued = []
+    finally:
+        listener.cancel()
+        writer.write(mqtt.DISCONNECT_PACKET)
+        writer.close()
+    return published
+
+
+# Run the fleet once; returns the wall clock start, the probe, records
+# committed, the deepest queue seen and the server
+async def run_fleet(args, control):
+    total = args.devices + args.burst_devices
+    registry = DeviceRegistry({f"token-{i}": f"device-{i}" for i in range(total)})
+    sink = ThrottledSink(args.capacity)
+    probe = LatencyProbe(sink)
+    server = await IngestServer(registry, probe, host="127.0.0.1", port=0).start()
+    tasks = []
+    if control:
+        controller = RateController(server, probe, args.budget, args.latency_target)
+        tasks.append(asyncio.create_task(controller.run()))
+    depths = []
+
+    async def watch_queue():
+        while True:
+            await asyncio.sleep(0.1)
+            depths.append(server.queue_depth)
+    tasks.append(asyncio.create_task(watch_queue()))
+
+    start = time.perf_counter()
+    stop_at = start + args.duration
+    burst_start, burst_end = (start + t for t in args.burst)
+    boards = [simulated_board("127.0.0.1", server.port, f"token-{i}", start, stop_at)
+              for i in range(args.devices)]
+    boards += [simulated_board("127.0.0.1", server.port, f"token-{i}", burst_start, burst_end)
+               for i in range(args.devices, total)]
+    wall_start = time.time()
+    await asyncio.gather(*boards)
+    for task in tasks:
+        task.cancel()
+    await server.close()
+    return wall_start, probe, sink.count, max(depths, default=0), server
+
+
+def _burst(text):
+    start, end = (float(part) for part in text.split(":"))
+    if end <= start:
+        raise argparse.ArgumentTypeError("burst must be START:END seconds with END > START")
+    return start, end
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest rate control demo with a simulated fleet")
+    parser.add_argument("--devices", type=int, default=300, help="boards online throughout")
+    parser.add_argument("--burst-devices", type=int, default=900,
+                        help="boards that come online for the burst")
+    parser.add_argument("--burst", type=_burst, default=(8.0, 20.0), help="START:END seconds")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--capacity", type=float, default=800,
+                        help="records/s the simulated storage commits")
+    # Below capacity: the server waits flush_interval between commits, so a
+    # commit cycle takes flush_interval / (1 - rate / capacity) and the worst
+    # latency is about two of them, 280 ms at 500 records/s against 420 ms at
+    # 600, well before the storage itself is saturated
+    parser.add_argument("--budget", type=float, default=500,
+                        help="records/s the controller keeps the fleet within")
+    parser.add_argument("--latency-target", type=float, default=0.5, help="p99 seconds")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="boot times and reading phases of the boards")
+    args = parser.parse_args()
+
+    print(f"{args.devices} boards, {args.burst_devices} more from {args.burst[0]:.0f} s to "
+          f"{args.burst[1]:.0f} s, storage {args.capacity:.0f} records/s, "
+          f"p99 target {args.latency_target * 1000:.0f} ms")
+    print(f"{'':14s} {'p99 before':>11s} {'p99 burst':>10s} {'p99 after':>10s} "
+          f"{'max queue':>10s} {'committed':>10s} {'downlink':>9s}")
+    results = {}
+    for name, control in (("no control", False), ("controller", True)):
+        random.seed(args.seed)
+        wall_start, probe, committed, depth, server = asyncio.run(
+            run_fleet(args, control))
+        phases = [[], [], []]
+        for at, latency in probe.samples:
+            t = at - wall_start
+            phases[0 if t < args.burst[0] else 1 if t < args.burst[1] else 2].append(latency)
+        p99 = [percentile(phase, 99) * 1000 for phase in phases]
+        results[name] = p99
+        print(f"{name:14s} {p99[0]:9.0f}ms {p99[1]:8.0f}ms {p99[2]:8.0f}ms "
+              f"{depth:10d} {committed:10d} {server.stats['downlink']:9d}")
+
+    held = max(results["controller"]) <= args.latency_target * 1000
+    print(f"controller {'held' if held else 'did not hold'} p99 under "
+          f"{args.latency_target * 1000:.0f} ms in every phase")
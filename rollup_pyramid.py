@@ -0,0 +1,291 @@
+# Multi-resolution rollups of device telemetry for dashboard time-range queries
+#
+# Every device keeps min/max/sum/count of roll, pitch, yaw and temperature per
+# 1 s, 10 s, 1 min and 1 h bucket. Each level is a TelemetryStore of its own
+# (<root>/<level>/<device>/...) with one row per bucket, timestamped with the
+# bucket start. update() folds a batch of raw readings into the 1 s level
+# with numpy reduceat and cascades the result up, merging into each level's
+# open bucket, so ingest costs a few vectorized passes per batch and nothing
+# ever rescans raw data. Closed buckets are written in blocks of write_rows;
+# until then, and for the open bucket, queries read them from memory. A
+# bucket written twice (flush() on shutdown, then more data in the same
+# bucket after a restart) is merged again at query time.
+#
+# query() plans from the point budget: the finest level that covers the
+# range in at most max_points buckets, or the 1 h level with adjacent buckets
+# merged when even that is too many. A 30-day chart reads 720 rows.
+#
+#   python rollup_pyramid.py                           synthetic 30 days, query timings
+#   python rollup_pyramid.py --store data --backfill   build rollups for a stored fleet
+#   python rollup_pyramid.py --store data --device esp32-01 --days 7 --points 500
+
+import argparse
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from telemetry_store import TelemetryStore, group_records
+
+FIELDS = ("roll", "pitch", "yaw", "temperature")
+
+# Bucket widths in ms, finest first, and the directory each level lives in
+LEVELS = (1000, 10_000, 60_000, 3_600_000)
+LEVEL_NAMES = ("1s", "10s", "1m", "1h")
+
+# count is per field: a reading with NaN in one field (a JSON payload without
+# temperature) still counts for the others
+ROLLUP_SCHEMA = (("timestamp", "<i8"),) + tuple(
+    (f"{field}_{stat}", dtype) for field in FIELDS
+    for stat, dtype in (("count", "<u4"), ("min", "<f4"), ("max", "<f4"), ("sum", "<f8")))
+
+# Query result: bucket start times, the bucket width actually used and per
+# field arrays of the aggregates. Empty buckets are left out.
+Rollup = namedtuple("Rollup", ["bucket_ms", "timestamp", "count", "min", "max", "mean"])
+
+
+# Merge rows sharing a timestamp. columns must be sorted by timestamp.
+def _combine(columns):
+    timestamps = columns["timestamp"]
+    if len(timestamps) < 2 or np.all(timestamps[1:] > timestamps[:-1]):
+        return columns
+    starts = np.flatnonzero(np.r_[True, timestamps[1:] != timestamps[:-1]])
+    merged = {"timestamp": timestamps[starts]}
+    for field in FIELDS:
+        merged[f"{field}_count"] = np.add.reduceat(columns[f"{field}_count"], starts)
+        merged[f"{field}_min"] = np.fmin.reduceat(columns[f"{field}_min"], starts)
+        merged[f"{field}_max"] = np.fmax.reduceat(columns[f"{field}_max"], starts)
+        merged[f"{field}_sum"] = np.add.reduceat(columns[f"{field}_sum"], starts)
+    return merged
+
+
+# Re-bucket rollup rows (or raw rows, below) to width ms
+def _rebucket(columns, width):
+    columns = dict(columns, timestamp=columns["timestamp"] // width * width)
+    return _combine(columns)
+
+
+def _concat(parts):
+    parts = [part for part in parts if part is not None and len(part["timestamp"])]
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    columns = {name: np.concatenate([part[name] for part in parts]) for name, _ in ROLLUP_SCHEMA}
+    order = np.argsort(columns["timestamp"], kind="stable")
+    if np.any(order != np.arange(len(order))):
+        columns = {name: values[order] for name, values in columns.items()}
+    return columns
+
+
+def _slice(columns, lo, hi):
+    return {name: values[lo:hi] for name, values in columns.items()}
+
+
+# Raw readings -> one rollup row each, in ROLLUP_SCHEMA dtypes
+def _raw_rows(columns):
+    timestamps = np.asarray(columns["timestamp"], dtype=np.int64)
+    rows = {"timestamp": timestamps}
+    for field in FIELDS:
+        values = columns.get(field)
+        values = np.full(len(timestamps), np.nan, np.float32) if values is None \
+            else np.asarray(values, dtype=np.float32)
+        present = ~np.isnan(values)
+        rows[f"{field}_count"] = present.astype(np.uint32)
+        rows[f"{field}_min"] = values
+        rows[f"{field}_max"] = values
+        rows[f"{field}_sum"] = np.where(present, values, 0).astype(np.float64)
+    if len(timestamps) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+        order = np.argsort(timestamps, kind="stable")
+        rows = {name: values[order] for name, values in rows.items()}
+    return rows
+
+
+class RollupPyramid:
+    def __init__(self, root, levels=LEVELS, names=LEVEL_NAMES, write_rows=256):
+        self.levels = tuple(levels)
+        self.stores = [TelemetryStore(os.path.join(root, name), ROLLUP_SCHEMA,
+                                      segment_rows=1 << 18, index_stride=256)
+                       for name in names]
+        self.write_rows = write_rows
+        # device -> per level: buffered rows, the last one the open bucket
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def devices(self):
+        with self._lock:
+            pending = set(self._pending)
+        return sorted(pending.union(*(store.devices() for store in self.stores)))
+
+    # Fold raw readings ({"timestamp": ms, "roll": ..., ...}) of one device
+    # into every level
+    def update(self, device, columns):
+        rows = _raw_rows(columns)
+        if not len(rows["timestamp"]):
+            return
+        with self._lock:
+            pending = self._pending.setdefault(device, [None] * len(self.levels))
+            for level, width in enumerate(self.levels):
+                rows = _rebucket(rows, width)
+                merged = _combine(_concat([pending[level], rows]))
+                closed = len(merged["timestamp"]) - 1
+                if closed >= self.write_rows:
+                    self.stores[level].append(device, _slice(merged, 0, closed))
+                    merged = _slice(merged, closed, closed + 1)
+                pending[level] = merged
+
+    # Write every buffered bucket, open ones included
+    def flush(self):
+        with self._lock:
+            for device, pending in self._pending.items():
+                for store, rows in zip(self.stores, pending):
+                    if rows is not None:
+                        store.append(device, rows)
+            self._pending.clear()
+
+    # Level index for a range of span ms under a point budget; the coarsest
+    # level if none fits. An unaligned range can touch one bucket more than
+    # span / width.
+    def plan(self, span, max_points):
+        for level, width in enumerate(self.levels):
+            if -(-span // width) + 1 <= max_points:
+                return level
+        return len(self.levels) - 1
+
+    def _read(self, device, level, start, end):
+        width = self.levels[level]
+        start = start // width * width
+        # Under the lock, so update() cannot move rows from memory to disk
+        # between the two reads
+        with self._lock:
+            stored = self.stores[level].read(device, start, end)
+            pending = self._pending.get(device)
+            buffered = pending[level] if pending else None
+        if buffered is not None:
+            lo, hi = np.searchsorted(buffered["timestamp"], (start, end))
+            buffered = _slice(buffered, lo, hi)
+        return _combine(_concat([stored, buffered]) or
+                        {name: np.empty(0, dtype) for name, dtype in ROLLUP_SCHEMA})
+
+    # Aggregates of [start, end) ms in at most max_points buckets
+    def query(self, device, start, end, max_points=1000):
+        level = self.plan(end - start, max_points)
+        width = self.levels[level]
+        columns = self._read(device, level, start, end)
+        buckets = -(-(end - start) // width)
+        if buckets + 1 > max_points:
+            width *= -(-buckets // max(max_points - 1, 1))
+            columns = _rebucket(columns, width)
+        count = {field: columns[f"{field}_count"] for field in FIELDS}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = {field: columns[f"{field}_sum"] / count[field] for field in FIELDS}
+        return Rollup(
+            bucket_ms=width,
+            timestamp=columns["timestamp"],
+            count=count,
+            min={field: columns[f"{field}_min"] for field in FIELDS},
+            max={field: columns[f"{field}_max"] for field in FIELDS},
+            mean=mean,
+        )
+
+    # Build rollups for data already in a TelemetryStore
+    def backfill(self, store, device, start=None, end=None):
+        for part in store.scan(device, start, end, ("timestamp",) + FIELDS):
+            self.update(device, part)
+
+
+# Sink for ingest_server.IngestServer: passes the batch on to inner (a
+# StoreSink, normally) and then folds it into the pyramid
+class RollupSink:
+    def __init__(self, pyramid, inner=None):
+        self.pyramid = pyramid
+        self.inner = inner
+        self._last = {}
+
+    def __call__(self, batch):
+        if self.inner is not None:
+            self.inner(batch)
+        for device, columns in group_records(batch, self._last).items():
+            self.pyramid.update(device, columns)
+
+
+# Brute-force aggregates of raw readings, for checking query()
+def _reference(timestamps, values, start, end, width):
+    keep = (timestamps >= start) & (timestamps < end)
+    buckets = timestamps[keep] // width * width
+    values = values[keep]
+    starts, first = np.unique(buckets, return_index=True)
+    return (starts, np.minimum.reduceat(values, first), np.maximum.reduceat(values, first),
+            np.add.reduceat(values.astype(np.float64), first) / np.diff(np.r_[first, len(values)]))
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description="Telemetry rollup pyramid")
+    parser.add_argument("--store", help="TelemetryStore root; rollups go to <store>/rollups")
+    parser.add_argument("--backfill", action="store_true", help="build rollups for every device")
+    parser.add_argument("--device")
+    parser.add_argument("--days", type=float, default=30.0, help="query range, ending now")
+    parser.add_argument("--points", type=int, default=1000, help="point budget")
+    parser.add_argument("--rate", type=int, default=10, help="synthetic readings per second")
+    args = parser.parse_args()
+
+    if args.store:
+        store = TelemetryStore(args.store)
+        pyramid = RollupPyramid(os.path.join(args.store, "rollups"))
+        if args.backfill:
+            for device in store.devices():
+                pyramid.backfill(store, device)
+            pyramid.flush()
+            print(f"rolled up {len(store.devices())} devices")
+        if args.device:
+            end = store.time_range(args.device)[1] + 1
+            start = end - int(args.days * 86_400_000)
+            began = time.perf_counter()
+            rollup = pyramid.query(args.device, start, end, args.points)
+            print(f"{len(rollup.timestamp)} buckets of {rollup.bucket_ms / 1000:g} s in "
+                  f"{(time.perf_counter() - began) * 1000:.1f} ms")
+        raise SystemExit
+
+    # 30 days of one device at --rate, fed in 1 s ingest batches' worth of
+    # 10 minutes at a time
+    root = tempfile.mkdtemp(prefix="rollups-")
+    pyramid = RollupPyramid(root)
+    t0 = 1_750_000_000_000
+    step = 1000 // args.rate
+    n = 30 * 86_400 * args.rate
+    chunk = 600 * args.rate
+    rng = np.random.default_rng(0)
+    timestamps = t0 + np.arange(n, dtype=np.int64) * step + rng.integers(0, step, n)
+    roll = (20 * np.sin(np.arange(n) / (3600.0 * args.rate)) + rng.normal(0, 0.5, n)).astype(np.float32)
+    began = time.perf_counter()
+    for offset in range(0, n, chunk):
+        part = slice(offset, offset + chunk)
+        pyramid.update("device-0", {"timestamp": timestamps[part], "roll": roll[part],
+                                    "pitch": roll[part], "yaw": roll[part],
+                                    "temperature": np.full(len(roll[part]), 25.0)})
+    print(f"rolled up {n:,} readings in {time.perf_counter() - began:.2f} s")
+
+    end = int(timestamps[-1]) // 3_600_000 * 3_600_000
+    for days, points in ((30, 1000), (30, 200), (7, 1000), (1, 1500), (1 / 24, 1000), (1 / 24, 100)):
+        start = end - int(days * 86_400_000)
+        began = time.perf_counter()
+        rollup = pyramid.query("device-0", start, end, points)
+        elapsed = time.perf_counter() - began
+        print(f"  {days * 24:6.1f} h, budget {points:5d}: {len(rollup.timestamp):5d} buckets "
+              f"of {rollup.bucket_ms / 1000:6g} s in {elapsed * 1000:6.2f} ms")
+        assert len(rollup.timestamp) <= points
+        starts, low, high, mean = _reference(timestamps, roll, start, end, rollup.bucket_ms)
+        assert np.array_equal(rollup.timestamp, starts)
+        assert np.array_equal(rollup.min["roll"], low) and np.array_equal(rollup.max["roll"], high)
+        assert np.allclose(rollup.mean["roll"], mean, atol=1e-4)
+
+    # Buffered rows survive a flush and merge with later data in the same bucket
+    pyramid.flush()
+    pyramid.update("device-0", {"timestamp": [end + 10], "roll": [90.0]})
+    rollup = pyramid.query("device-0", end - 60_000, end + 1000, 60)
+    assert rollup.max["roll"][-1] == 90.0
+    print("  checked against brute-force aggregates of the raw readings")
@@ -1,5 +1,58 @@
 # Create comprehensive Arduino code for ESP32 MPU6050 OLED system
-arduino_code = '''/*
+import argparse
+
+from sketch_features import (ANGLE_MATH_MODES, CALIBRATION_MODES, DISPLAY_FUNCTIONS, DISPLAY_GLOBALS,
+                             FIFO_RATES, MAX_BATCH_SIZE, RTOS_SAMPLE_RATES, SAMPLE_RATES, angle_math,
+                             calibration, deadband, fifo_acquisition, fill_template,
+                             high_rate_sampling, packed_telemetry, rtos_tasks)
+
+parser = argparse.ArgumentParser(description='Generate the ESP32 position monitoring sketch')
+parser.add_argument('--batch-size', type=int, default=1,
+                    help='samples per MQTT publish; above 1 the sketch sends packed binary '
+                         'frames (see telemetry_codec.py) instead of one JSON document')
+parser.add_argument('--sample-rate', type=int, choices=RTOS_SAMPLE_RATES,
+                    help='fuse samples at this rate (Hz) into a ring buffer and flush them '
+                         'as batched packed frames; batch size defaults to rate / 10')
+parser.add_argument('--angle-math', choices=ANGLE_MATH_MODES, default='exact',
+                    help="accelerometer tilt math: 'exact' (atan, pow, double PI), 'fast' "
+                         "(float atan2f) or 'poly' (polynomial atan2, see angle_math.py)")
+parser.add_argument('--calibration', choices=CALIBRATION_MODES, default='streaming',
+                    help="'streaming' (single-pass Welford estimate that stops once converged, "
+                         "plus runtime gyro bias tracking) or 'fixed' (200 + 200 readings)")
+parser.add_argument('--rtos', action='store_true',
+                    help='FreeRTOS profile: a hardware timer drives sampling and fusion in a '
+                         'task on core 1, loop() (display, network, telemetry) runs in a '
+                         'low-priority task on core 0; --sample-rate also accepts 100 here')
+parser.add_argument('--fifo', type=int, choices=FIFO_RATES, metavar='RATE',
+                    help='let the MPU6050 sample at RATE Hz into its FIFO and drain it in '
+                         'burst reads triggered from the INT pin, timestamps from the sensor '
+                         f'clock; one of {FIFO_RATES}, see mpu6050_fifo.py')
+parser.add_argument('--raw-imu', action='store_true',
+                    help='with --fifo and packed frames, also publish the raw accelerometer and '
+                         'gyro frames for server-side vibration analysis (vibration_analytics.py)')
+parser.add_argument('--deadband', type=float, metavar='DEGREES',
+                    help='report by exception: queue a JSON reading only when roll, pitch or yaw '
+                         'moved more than this since the last one queued (see deadband.py)')
+parser.add_argument('--heartbeat', type=float, default=60.0, metavar='SECONDS',
+                    help='with --deadband, queue a reading at least this often anyway')
+parser.add_argument('--output', default='iot_position_monitor.ino')
+options = parser.parse_args()
+if not 1 <= options.batch_size <= MAX_BATCH_SIZE:
+    parser.error(f'--batch-size must be between 1 and {MAX_BATCH_SIZE}')
+if options.deadband is not None and options.deadband <= 0:
+    parser.error('--deadband must be positive')
+if options.heartbeat <= 0:
+    parser.error('--heartbeat must be positive')
+if options.sample_rate and options.sample_rate not in SAMPLE_RATES and not options.rtos:
+    parser.error(f'--sample-rate {options.sample_rate} needs --rtos')
+if options.fifo and (options.rtos or options.sample_rate):
+    parser.error('--fifo replaces --sample-rate and --rtos acquisition')
+if options.raw_imu and not (options.fifo and options.batch_size > 1):
+    parser.error('--raw-imu needs --fifo and a --batch-size above 1')
+if options.deadband is not None and (options.sample_rate or options.batch_size > 1):
+    parser.error('--deadband applies to JSON telemetry, not packed frames')
+
+sketch_template = '''/*
   IoT Position and Orientation Monitoring System
   
   Author: [Your Name]
@@ -62,8 +115,10 @@ PubSubClient mqttClient(wifiClient);
 float AccX, AccY, AccZ;
 float GyroX, GyroY, GyroZ;
 float roll, pitch, yaw = 0;
+float temperature = 0;
 float AccErrorX = 0, AccErrorY = 0;
 float GyroErrorX = 0, GyroErrorY = 0, GyroErrorZ = 0;
+$calibration_globals
 
 // Timing variables
 unsigned long previousTime = 0;
@@ -75,11 +130,40 @@ float alpha = 0.96;
 
 // Display update timing
 unsigned long lastDisplayUpdate = 0;
-const unsigned long displayInterval = 100; // Update every 100ms
+unsigned long displayInterval = 100; // Update every 100ms, the server can change it
+$display_globals
+DisplayField rollField = {42, 15, 86, 8};
+DisplayField pitchField = {42, 25, 86, 8};
+DisplayField yawField = {42, 35, 86, 8};
+DisplayField wifiField = {0, 50, 128, 7}; // 7 rows, row 57 is the cloud line's top
+DisplayField cloudField = {0, 57, 128, 7};
 
 // Cloud update timing
 unsigned long lastCloudUpdate = 0;
-const unsigned long cloudInterval = 1000; // Send to cloud every 1 second
+unsigned long cloudInterval = 1000; // Send to cloud every 1 second, the server can change it
+const int replayBudget = 5; // Queued messages sent per loop pass after an outage
+$telemetry_globals
+$deadband_globals
+$acquisition_globals
+
+// Connection state machine, polled from loop() so an outage never blocks sensing
+enum LinkState { LINK_WIFI_WAIT, LINK_MQTT_IDLE, LINK_MQTT_CONNECTING, LINK_ONLINE };
+LinkState linkState = LINK_WIFI_WAIT;
+const unsigned long minBackoff = 500;    // First retry after 0.5 s
+const unsigned long maxBackoff = 30000;  // Retries back off to at most 30 s
+unsigned long linkBackoff = minBackoff;
+unsigned long linkRetryAt = 0;
+volatile bool mqttAttemptDone = false;
+volatile bool mqttAttemptOk = false;
+
+// Downlink: shared attribute updates and setRates RPCs from the server change
+// cloudInterval, batchSize and displayInterval at runtime (see rate_controller.py)
+const char* attributesTopic = "v1/devices/me/attributes";
+const char* rpcRequestPrefix = "v1/devices/me/rpc/request/";
+const unsigned long minCloudInterval = 200;
+const unsigned long maxCloudInterval = 60000;
+const unsigned long minDisplayInterval = 50;
+const unsigned long maxDisplayInterval = 5000;
 
 void setup() {
   Serial.begin(115200);
@@ -87,6 +171,7 @@ void setup() {
   
   // Initialize I2C
   Wire.begin(21, 22); // SDA, SCL pins for ESP32
+  $i2c_setup
   
   // Initialize MPU6050
   if (!mpu.begin()) {
@@ -100,7 +185,7 @@ void setup() {
   // Configure MPU6050
   mpu.setAccelerometerRange(MPU6050_RANGE_8_G);
   mpu.setGyroRange(MPU6050_RANGE_500_DEG);
-  mpu.setFilterBandwidth(MPU6050_BAND_21_HZ);
+  $imu_bandwidth
   
   // Initialize OLED display
   if(!display.begin(SSD1306_SWITCHCAPVCC, OLED_ADDRESS)) {
@@ -127,62 +212,71 @@ void setup() {
   
   calculateIMUError();
   
-  // Initialize WiFi
+  // Initialize WiFi (updateConnection() in loop() completes the connection)
+  WiFi.mode(WIFI_STA);
   WiFi.begin(ssid, password);
-  display.clearDisplay();
-  display.setCursor(0, 0);
-  display.println("Connecting to WiFi...");
-  display.display();
-  
-  while (WiFi.status() != WL_CONNECTED) {
-    delay(500);
-    Serial.print(".");
-  }
-  
-  Serial.println("");
-  Serial.println("WiFi connected!");
-  Serial.print("IP address: ");
-  Serial.println(WiFi.localIP());
   
   // Initialize MQTT
   mqttClient.setServer(tb_server, tb_port);
+  mqttClient.setCallback(onMqttMessage);
+  $mqtt_setup
   
   display.clearDisplay();
   display.setCursor(0, 0);
   display.println("System Ready!");
-  display.println("WiFi: Connected");
-  display.print("IP: ");
-  display.println(WiFi.localIP());
+  display.println("WiFi: Connecting...");
   display.display();
   delay(2000);
+  drawDisplayChrome();
   
   Serial.println("System initialization complete!");
   currentTime = millis();
+  $sampling_start
 }
 
 void loop() {
+  $orientation_schedule
+  
+  // Update display
+  if (millis() - lastDisplayUpdate >= displayInterval) {
+    updateDisplay();
+    lastDisplayUpdate = millis();
+  }
+  
+  // Keep WiFi and MQTT up without blocking
+  updateConnection();
+  
+  $cloud_schedule
+  
+  $serial_log
+  $loop_delay
+}
+
+$angle_functions
+void updateOrientation() {
   // Read sensor data
   sensors_event_t a, g, temp;
   mpu.getEvent(&a, &g, &temp);
-  
-  // Get current time
-  previousTime = currentTime;
-  currentTime = millis();
-  elapsedTime = (currentTime - previousTime) / 1000.0;
-  
+  temperature = temp.temperature;
+  fuseEvents(a, g);
+}
+
+// Complementary filter step over elapsedTime for one accelerometer and gyro reading
+void fuseEvents(const sensors_event_t& a, const sensors_event_t& g) {
   // Read accelerometer data (in m/s²)
   AccX = a.acceleration.x;
   AccY = a.acceleration.y;
   AccZ = a.acceleration.z;
   
   // Calculate roll and pitch from accelerometer
-  float accAngleX = (atan(AccY / sqrt(pow(AccX, 2) + pow(AccZ, 2))) * 180 / PI) - AccErrorX;
-  float accAngleY = (atan(-1 * AccX / sqrt(pow(AccY, 2) + pow(AccZ, 2))) * 180 / PI) - AccErrorY;
+  float accAngleX = accelRoll(AccX, AccY, AccZ) - AccErrorX;
+  float accAngleY = accelPitch(AccX, AccY, AccZ) - AccErrorY;
   
   // Read gyroscope data (in rad/s, convert to deg/s)
-  GyroX = g.gyro.x * 180 / PI - GyroErrorX;
-  GyroY = g.gyro.y * 180 / PI - GyroErrorY;
-  GyroZ = g.gyro.z * 180 / PI - GyroErrorZ;
+  GyroX = toDegrees(g.gyro.x) - GyroErrorX;
+  GyroY = toDegrees(g.gyro.y) - GyroErrorY;
+  GyroZ = toDegrees(g.gyro.z) - GyroErrorZ;
+  $bias_refinement
   
   // Integrate gyroscope data
   float gyroAngleX = roll + GyroX * elapsedTime;
@@ -192,29 +286,12 @@ void loop() {
   // Apply complementary filter
   roll = alpha * gyroAngleX + (1 - alpha) * accAngleX;
   pitch = alpha * gyroAngleY + (1 - alpha) * accAngleY;
-  
-  // Update display
-  if (millis() - lastDisplayUpdate >= displayInterval) {
-    updateDisplay();
-    lastDisplayUpdate = millis();
-  }
-  
-  // Send data to cloud
-  if (millis() - lastCloudUpdate >= cloudInterval) {
-    sendToCloud();
-    lastCloudUpdate = millis();
-  }
-  
-  // Print to serial monitor
-  Serial.print("Roll: "); Serial.print(roll, 2);
-  Serial.print("° | Pitch: "); Serial.print(pitch, 2);
-  Serial.print("° | Yaw: "); Serial.print(yaw, 2);
-  Serial.println("°");
-  
-  delay(10); // Small delay for stability
 }
 
-void updateDisplay() {
+$acquisition_functions
+$display_functions
+// Static labels, drawn once; updateDisplay() only redraws the values
+void drawDisplayChrome() {
   display.clearDisplay();
   
   // Title
@@ -225,135 +302,326 @@ void updateDisplay() {
   // Draw separator line
   display.drawLine(0, 10, SCREEN_WIDTH, 10, WHITE);
   
-  // Roll value
+  // Value labels
   display.setCursor(0, 15);
   display.print("Roll:  ");
-  display.print(roll, 1);
-  display.println("°");
-  
-  // Pitch value
   display.setCursor(0, 25);
   display.print("Pitch: ");
-  display.print(pitch, 1);
-  display.println("°");
-  
-  // Yaw value
   display.setCursor(0, 35);
   display.print("Yaw:   ");
-  display.print(yaw, 1);
-  display.println("°");
   
-  // Connection status
-  display.setCursor(0, 50);
-  if (WiFi.status() == WL_CONNECTED) {
-    display.print("WiFi: OK");
-  } else {
-    display.print("WiFi: DISCONNECTED");
-  }
+  pushFullFrame();
+}
+
+void updateDisplay() {
+  char text[24];
   
-  display.setCursor(0, 57);
-  if (mqttClient.connected()) {
-    display.print("Cloud: CONNECTED");
-  } else {
-    display.print("Cloud: OFFLINE");
-  }
+  // Roll value
+  snprintf(text, sizeof(text), "%.1f°", roll);
+  drawField(rollField, text);
   
-  display.display();
+  // Pitch value
+  snprintf(text, sizeof(text), "%.1f°", pitch);
+  drawField(pitchField, text);
+  
+  // Yaw value
+  snprintf(text, sizeof(text), "%.1f°", yaw);
+  drawField(yawField, text);
+  
+  // Connection status
+  drawField(wifiField, WiFi.status() == WL_CONNECTED ? "WiFi: OK" : "WiFi: DISCONNECTED");
+  drawField(cloudField, linkState == LINK_ONLINE ? "Cloud: CONNECTED" : "Cloud: OFFLINE");
+  
+  pushDirtyPages();
 }
 
 void sendToCloud() {
-  if (!mqttClient.connected()) {
-    reconnectMQTT();
+  if (linkState != LINK_ONLINE) {
+    return; // Telemetry stays queued until updateConnection() restores the link
   }
   
-  if (mqttClient.connected()) {
-    // Create JSON payload
-    StaticJsonDocument<200> doc;
-    doc["roll"] = round(roll * 100) / 100.0;
-    doc["pitch"] = round(pitch * 100) / 100.0;
-    doc["yaw"] = round(yaw * 100) / 100.0;
-    doc["temperature"] = 25.0; // You can add actual temp from MPU6050
-    doc["timestamp"] = millis();
-    
-    char buffer[256];
-    serializeJson(doc, buffer);
-    
-    // Publish to ThingsBoard
-    String topic = "v1/devices/me/telemetry";
-    mqttClient.publish(topic.c_str(), buffer);
-    
-    Serial.println("Data sent to cloud: " + String(buffer));
+  $cloud_payload
+}
+
+$telemetry_functions
+// Schedule the next connection attempt with exponential backoff and jitter,
+// so a fleet does not reconnect in lockstep after a broker restart
+void scheduleRetry() {
+  linkRetryAt = millis() + linkBackoff / 2 + random(linkBackoff / 2 + 1);
+  linkBackoff = min(linkBackoff * 2, maxBackoff);
+}
+
+// PubSubClient::connect() blocks on DNS, TCP and CONNACK, so each attempt runs
+// in a short-lived task on the other core while loop() keeps sampling
+void mqttConnectTask(void* parameter) {
+  mqttAttemptOk = mqttClient.connect("ESP32Client", tb_token, "");
+  mqttAttemptDone = true;
+  vTaskDelete(NULL);
+}
+
+void updateConnection() {
+  bool wifiUp = WiFi.status() == WL_CONNECTED;
+  
+  switch (linkState) {
+    case LINK_WIFI_WAIT:
+      if (wifiUp) {
+        Serial.print("WiFi connected, IP address: ");
+        Serial.println(WiFi.localIP());
+        linkState = LINK_MQTT_IDLE;
+        linkBackoff = minBackoff;
+        linkRetryAt = millis();
+      } else if ((long)(millis() - linkRetryAt) >= 0) {
+        WiFi.reconnect();
+        scheduleRetry();
+      }
+      break;
+      
+    case LINK_MQTT_IDLE:
+      if (!wifiUp) {
+        linkState = LINK_WIFI_WAIT;
+      } else if ((long)(millis() - linkRetryAt) >= 0) {
+        Serial.println("Attempting MQTT connection...");
+        mqttAttemptDone = false;
+        linkState = LINK_MQTT_CONNECTING;
+        xTaskCreatePinnedToCore(mqttConnectTask, "mqttConnect", 6144, NULL, 1, NULL, 0);
+      }
+      break;
+      
+    case LINK_MQTT_CONNECTING:
+      if (!mqttAttemptDone) {
+        break;
+      }
+      if (mqttAttemptOk) {
+        Serial.println("MQTT connected");
+        linkState = LINK_ONLINE;
+        linkBackoff = minBackoff;
+        subscribeDownlink();
+      } else {
+        Serial.print("MQTT connection failed, rc=");
+        Serial.println(mqttClient.state());
+        linkState = wifiUp ? LINK_MQTT_IDLE : LINK_WIFI_WAIT;
+        scheduleRetry();
+      }
+      break;
+      
+    case LINK_ONLINE:
+      if (!mqttClient.connected()) {
+        Serial.println("MQTT connection lost");
+        linkState = wifiUp ? LINK_MQTT_IDLE : LINK_WIFI_WAIT;
+        scheduleRetry();
+      } else {
+        mqttClient.loop();
+      }
+      break;
   }
-  
-  mqttClient.loop();
 }
 
-void reconnectMQTT() {
-  while (!mqttClient.connected()) {
-    Serial.print("Attempting MQTT connection...");
-    if (mqttClient.connect("ESP32Client", tb_token, "")) {
-      Serial.println("connected");
-    } else {
-      Serial.print("failed, rc=");
-      Serial.print(mqttClient.state());
-      Serial.println(" try again in 5 seconds");
-      delay(5000);
-    }
+// Subscribe to rate changes and ask for the current values, which the server
+// may have changed while this board was offline
+void subscribeDownlink() {
+  mqttClient.subscribe(attributesTopic);
+  mqttClient.subscribe("v1/devices/me/attributes/response/+");
+  mqttClient.subscribe("v1/devices/me/rpc/request/+");
+  mqttClient.publish("v1/devices/me/attributes/request/1",
+                     "{\\"sharedKeys\\":\\"cloudInterval,batchSize,displayInterval\\"}");
+}
+
+// Apply whichever of cloudInterval (ms), batchSize and displayInterval (ms)
+// are present, clamped to what this build supports
+void applyRates(JsonObjectConst rates) {
+  unsigned long oldPeriod = cloudInterval / batchSize;
+  if (rates.containsKey("cloudInterval")) {
+    cloudInterval = constrain(rates["cloudInterval"].as<unsigned long>(), minCloudInterval, maxCloudInterval);
+  }
+  if (rates.containsKey("batchSize")) {
+    batchSize = constrain(rates["batchSize"].as<int>(), 1, (int)maxBatchSize);
   }
+  if (rates.containsKey("displayInterval")) {
+    displayInterval = constrain(rates["displayInterval"].as<unsigned long>(), minDisplayInterval, maxDisplayInterval);
+  }
+  if (cloudInterval / batchSize != oldPeriod) {
+    // Restart the sample timer at a random point of the new period: boards
+    // slowed down together would keep phases packed into the old, shorter
+    // period and publish in bunches
+    $sample_phase
+  }
+  Serial.printf("Rates: cloud %lu ms, batch %u, display %lu ms\\n",
+                cloudInterval, batchSize, displayInterval);
 }
 
-void calculateIMUError() {
-  // Calculate accelerometer error (200 readings)
-  int c = 0;
-  while (c < 200) {
-    sensors_event_t a, g, temp;
-    mpu.getEvent(&a, &g, &temp);
-    
-    AccErrorX += (atan((a.acceleration.y) / sqrt(pow((a.acceleration.x), 2) + pow((a.acceleration.z), 2))) * 180 / PI);
-    AccErrorY += (atan(-1 * (a.acceleration.x) / sqrt(pow((a.acceleration.y), 2) + pow((a.acceleration.z), 2))) * 180 / PI);
-    c++;
-    delay(5);
+// Runs inside mqttClient.loop(), so it never races loop() over the rates
+void onMqttMessage(char* topic, byte* payload, unsigned int length) {
+  StaticJsonDocument<256> doc;
+  // Parse from a const pointer so ArduinoJson copies the strings: publishing
+  // the RPC reply reuses the client buffer payload points into
+  if (deserializeJson(doc, (const byte*)payload, length)) {
+    return;
   }
-  AccErrorX = AccErrorX / 200;
-  AccErrorY = AccErrorY / 200;
-  
-  c = 0;
-  // Calculate gyroscope error (200 readings)
-  while (c < 200) {
-    sensors_event_t a, g, temp;
-    mpu.getEvent(&a, &g, &temp);
+  
+  if (strcmp(topic, attributesTopic) == 0) {
+    applyRates(doc.as<JsonObjectConst>());
+  } else if (strncmp(topic, rpcRequestPrefix, strlen(rpcRequestPrefix)) == 0) {
+    if (doc["method"] != "setRates") {
+      return;
+    }
+    applyRates(doc["params"].as<JsonObjectConst>());
     
-    GyroErrorX += (g.gyro.x * 180 / PI);
-    GyroErrorY += (g.gyro.y * 180 / PI);
-    GyroErrorZ += (g.gyro.z * 180 / PI);
-    c++;
-    delay(5);
+    // Reply with the rates now in force
+    char responseTopic[64];
+    snprintf(responseTopic, sizeof(responseTopic), "v1/devices/me/rpc/response/%s",
+             topic + strlen(rpcRequestPrefix));
+    StaticJsonDocument<128> reply;
+    reply["cloudInterval"] = cloudInterval;
+    reply["batchSize"] = batchSize;
+    reply["displayInterval"] = displayInterval;
+    char buffer[128];
+    serializeJson(reply, buffer);
+    mqttClient.publish(responseTopic, buffer);
+  } else {
+    // Attribute request response: {"shared": {...}}
+    applyRates(doc["shared"].as<JsonObjectConst>());
   }
-  GyroErrorX = GyroErrorX / 200;
-  GyroErrorY = GyroErrorY / 200;
-  GyroErrorZ = GyroErrorZ / 200;
-  
-  Serial.println("IMU Calibration Complete");
-  Serial.print("AccErrorX: "); Serial.println(AccErrorX);
-  Serial.print("AccErrorY: "); Serial.println(AccErrorY);
-  Serial.print("GyroErrorX: "); Serial.println(GyroErrorX);
-  Serial.print("GyroErrorY: "); Serial.println(GyroErrorY);
-  Serial.print("GyroErrorZ: "); Serial.println(GyroErrorZ);
-}'''
+}
+
+$calibration_functions'''
+
+# Default fragments: fusion once per loop pass, one JSON document per second
+fragments = {
+    'display_globals': DISPLAY_GLOBALS,
+    'display_functions': DISPLAY_FUNCTIONS,
+    'telemetry_globals': '''
+// Readings waiting to be sent; holds the last OFFLINE_QUEUE_SIZE while offline
+#define OFFLINE_QUEUE_SIZE 300
+struct Reading {
+  float roll, pitch, yaw;
+  unsigned long timestamp;
+};
+Reading offlineQueue[OFFLINE_QUEUE_SIZE];
+uint32_t queueHead = 0; // Readings queued so far
+uint32_t queueTail = 0; // Readings sent so far
+
+// Readings per publish, the server can raise it up to maxBatchSize; a batch
+// goes out as a JSON array of the single-reading objects
+uint16_t batchSize = 1;
+const uint16_t maxBatchSize = 10;
+char jsonBuffer[1024];''',
+    'deadband_globals': '',
+    'acquisition_globals': '',
+    'acquisition_functions': '',
+    'i2c_setup': '',
+    'imu_bandwidth': 'mpu.setFilterBandwidth(MPU6050_BAND_21_HZ);',
+    'mqtt_setup': 'mqttClient.setBufferSize(sizeof(jsonBuffer) + 64); // A full batch exceeds the default 256 bytes',
+    'sample_phase': 'lastCloudUpdate = millis() - random(cloudInterval / batchSize);',
+    'sampling_start': '',
+    'orientation_schedule': '''// Get current time
+previousTime = currentTime;
+currentTime = millis();
+elapsedTime = (currentTime - previousTime) / 1000.0;
+
+// Read sensors and apply the complementary filter
+updateOrientation();''',
+    'cloud_schedule': '''// Queue batchSize readings for the cloud every cloudInterval
+if (millis() - lastCloudUpdate >= cloudInterval / batchSize) {
+  queueReading();
+  lastCloudUpdate = millis();
+}
+
+// Send full batches, including any backlog from an outage
+if (queueHead - queueTail >= batchSize) {
+  sendToCloud();
+}''',
+    'cloud_payload': '''// Oldest first, at most replayBudget per call so a backlog never stalls the loop;
+// the last publish may carry fewer than batchSize readings
+for (int i = 0; i < replayBudget && queueHead != queueTail; i++) {
+  uint16_t count = min(queueHead - queueTail, (uint32_t)batchSize);
+  
+  // Create JSON payload: one object per reading, an array of them for a batch
+  StaticJsonDocument<1024> doc;
+  for (uint16_t j = 0; j < count; j++) {
+    Reading& reading = offlineQueue[(queueTail + j) % OFFLINE_QUEUE_SIZE];
+    JsonObject item = count == 1 ? doc.to<JsonObject>() : doc.createNestedObject();
+    item["roll"] = round(reading.roll * 100) / 100.0;
+    item["pitch"] = round(reading.pitch * 100) / 100.0;
+    item["yaw"] = round(reading.yaw * 100) / 100.0;
+    item["temperature"] = 25.0; // You can add actual temp from MPU6050
+    item["timestamp"] = reading.timestamp;
+  }
+  serializeJson(doc, jsonBuffer, sizeof(jsonBuffer));
+  
+  // Publish to ThingsBoard
+  String topic = "v1/devices/me/telemetry";
+  if (!mqttClient.publish(topic.c_str(), jsonBuffer)) {
+    break;
+  }
+  queueTail += count;
+  
+  Serial.println("Data sent to cloud: " + String(jsonBuffer));
+}''',
+    'serial_log': '''// Print to serial monitor
+Serial.print("Roll: "); Serial.print(roll, 2);
+Serial.print("° | Pitch: "); Serial.print(pitch, 2);
+Serial.print("° | Yaw: "); Serial.print(yaw, 2);
+Serial.println("°");''',
+    'loop_delay': '''
+delay(10); // Small delay for stability''',
+    'telemetry_functions': '''void queueReading() {
+  if (queueHead - queueTail >= OFFLINE_QUEUE_SIZE) {
+    queueTail++; // Queue full: drop the oldest reading
+  }
+  offlineQueue[queueHead % OFFLINE_QUEUE_SIZE] = {roll, pitch, yaw, millis()};
+  queueHead++;
+}
+''',
+}
+fragments.update(angle_math(options.angle_math))
+fragments.update(calibration(options.calibration))
+if options.fifo:
+    fragments.update(fifo_acquisition(options.fifo, options.batch_size, options.raw_imu))
+elif options.rtos:
+    fragments.update(rtos_tasks(options.sample_rate, options.batch_size))
+elif options.sample_rate:
+    fragments.update(high_rate_sampling(options.sample_rate, options.batch_size))
+elif options.batch_size > 1:
+    fragments.update(packed_telemetry(options.batch_size))
+if options.deadband is not None:
+    fragments.update(deadband(options.deadband, options.heartbeat * 1000))
+
+arduino_code = fill_template(sketch_template, fragments)
 
 # Save the Arduino code
-with open('iot_position_monitor.ino', 'w') as f:
+with open(options.output, 'w') as f:
     f.write(arduino_code)
 
 print("Arduino Code Generated Successfully!")
-print("File saved as: iot_position_monitor.ino")
+print(f"File saved as: {options.output}")
 print("\nCode Features:")
-print("✓ MPU6050 sensor integration with calibration")
+if options.calibration == 'streaming':
+    print("✓ MPU6050 sensor integration with streaming calibration and gyro bias tracking")
+else:
+    print("✓ MPU6050 sensor integration with calibration")
 print("✓ Real-time OLED display updates")
 print("✓ WiFi connectivity and ThingsBoard integration")
 print("✓ Complementary filter for sensor fusion")
-print("✓ JSON telemetry data transmission")
-print("✓ Error handling and connection monitoring")
+if options.angle_math != 'exact':
+    print(f"✓ Single-precision tilt math ({options.angle_math}, see angle_math.py)")
+if options.fifo:
+    print(f"✓ MPU6050 FIFO sampling at {options.fifo} Hz, drained in INT-triggered burst reads")
+if options.raw_imu:
+    print("✓ Raw accelerometer/gyro frames published for server-side vibration analysis")
+if options.rtos:
+    print(f"✓ Timer-driven {options.sample_rate or 100} Hz sensing task on core 1, network and "
+          f"display on core 0 behind a lock-free queue")
+if options.sample_rate:
+    print(f"✓ {options.sample_rate} Hz fused sampling into a ring buffer, flushed as packed frames")
+elif options.batch_size > 1:
+    print(f"✓ Packed binary telemetry, {options.batch_size} samples per publish")
+elif options.deadband is not None:
+    print(f"✓ JSON telemetry by exception: {options.deadband:g}° deadband, "
+          f"{options.heartbeat:g} s heartbeat")
+else:
+    print("✓ JSON telemetry data transmission")
+print("✓ Non-blocking WiFi/MQTT reconnect with backoff and offline queue")
+print("✓ Runtime publish rates from the server (shared attributes / setRates RPC)")
 print("✓ Comprehensive serial output for debugging")
 
 # Create a simple circuit connection guide
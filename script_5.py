@@ -1,4 +1,22 @@
 # Create Wokwi simulation configuration
+import argparse
+
+from sketch_features import (ANGLE_MATH_MODES, DISPLAY_FUNCTIONS, DISPLAY_GLOBALS, MAX_BATCH_SIZE,
+                             SAMPLE_RATES, angle_math, fill_template, high_rate_sampling)
+
+parser = argparse.ArgumentParser(description='Generate the Wokwi simulation and project documentation')
+parser.add_argument('--sample-rate', type=int, choices=SAMPLE_RATES,
+                    help='fuse samples at this rate (Hz) into a ring buffer and print them '
+                         'as batched packed frames on Serial')
+parser.add_argument('--batch-size', type=int, default=1,
+                    help='samples per printed frame with --sample-rate (default rate / 10)')
+parser.add_argument('--angle-math', choices=ANGLE_MATH_MODES, default='exact',
+                    help="accelerometer tilt math: 'exact' (atan, pow, double PI), 'fast' "
+                         "(float atan2f) or 'poly' (polynomial atan2, see angle_math.py)")
+options = parser.parse_args()
+if not 1 <= options.batch_size <= MAX_BATCH_SIZE:
+    parser.error(f'--batch-size must be between 1 and {MAX_BATCH_SIZE}')
+
 wokwi_config = {
     "diagram.json": {
         "version": 1,
@@ -41,7 +59,7 @@ wokwi_config = {
 }
 
 # Create simplified Arduino code for Wokwi (without WiFi for simulation)
-wokwi_code = '''/*
+wokwi_template = '''/*
   IoT Position Monitor - Wokwi Simulation Version
   
   Simplified version for Wokwi simulation without WiFi components
@@ -56,19 +74,30 @@ wokwi_code = '''/*
 #define SCREEN_WIDTH 128
 #define SCREEN_HEIGHT 64
 #define OLED_RESET -1
+#define OLED_ADDRESS 0x3C
 
 Adafruit_MPU6050 mpu;
 Adafruit_SSD1306 display(SCREEN_WIDTH, SCREEN_HEIGHT, &Wire, OLED_RESET);
 
+sensors_event_t a, g, temp;
 float roll = 0, pitch = 0, yaw = 0;
+float temperature = 0;
 float AccErrorX = 0, AccErrorY = 0;
 float GyroErrorX = 0, GyroErrorY = 0, GyroErrorZ = 0;
 unsigned long previousTime = 0;
+float elapsedTime = 0;
 float alpha = 0.96;
+$display_globals
+DisplayField rollField = {42, 15, 86, 8};
+DisplayField pitchField = {42, 25, 86, 8};
+DisplayField yawField = {42, 35, 86, 8};
+DisplayField accelField = {42, 50, 86, 8};
+$telemetry_globals
 
 void setup() {
   Serial.begin(115200);
   Wire.begin();
+  $i2c_setup
   
   if (!mpu.begin()) {
     Serial.println("Failed to find MPU6050 chip");
@@ -77,9 +106,9 @@ void setup() {
   
   mpu.setAccelerometerRange(MPU6050_RANGE_8_G);
   mpu.setGyroRange(MPU6050_RANGE_500_DEG);
-  mpu.setFilterBandwidth(MPU6050_BAND_21_HZ);
+  $imu_bandwidth
   
-  if(!display.begin(SSD1306_SWITCHCAPVCC, 0x3C)) {
+  if(!display.begin(SSD1306_SWITCHCAPVCC, OLED_ADDRESS)) {
     Serial.println(F("SSD1306 allocation failed"));
     for(;;);
   }
@@ -94,27 +123,36 @@ void setup() {
   display.println("to change values!");
   display.display();
   delay(3000);
+  drawDisplayChrome();
   
   Serial.println("System Ready - Click MPU6050 to interact!");
   previousTime = millis();
+  $sampling_start
 }
 
 void loop() {
-  sensors_event_t a, g, temp;
-  mpu.getEvent(&a, &g, &temp);
+  $orientation_schedule
+  
+  $display_schedule
+  $cloud_schedule
   
-  unsigned long currentTime = millis();
-  float elapsedTime = (currentTime - previousTime) / 1000.0;
-  previousTime = currentTime;
+  $serial_log
+  $loop_delay
+}
+
+$angle_functions
+void updateOrientation() {
+  mpu.getEvent(&a, &g, &temp);
+  temperature = temp.temperature;
   
   // Calculate angles from accelerometer
-  float accAngleX = (atan(a.acceleration.y / sqrt(pow(a.acceleration.x, 2) + pow(a.acceleration.z, 2))) * 180 / PI);
-  float accAngleY = (atan(-1 * a.acceleration.x / sqrt(pow(a.acceleration.y, 2) + pow(a.acceleration.z, 2))) * 180 / PI);
+  float accAngleX = accelRoll(a.acceleration.x, a.acceleration.y, a.acceleration.z);
+  float accAngleY = accelPitch(a.acceleration.x, a.acceleration.y, a.acceleration.z);
   
   // Get gyroscope data in degrees/sec
-  float GyroX = g.gyro.x * 180 / PI;
-  float GyroY = g.gyro.y * 180 / PI;
-  float GyroZ = g.gyro.z * 180 / PI;
+  float GyroX = toDegrees(g.gyro.x);
+  float GyroY = toDegrees(g.gyro.y);
+  float GyroZ = toDegrees(g.gyro.z);
   
   // Integrate gyroscope
   float gyroAngleX = roll + GyroX * elapsedTime;
@@ -124,8 +162,11 @@ void loop() {
   // Apply complementary filter
   roll = alpha * gyroAngleX + (1 - alpha) * accAngleX;
   pitch = alpha * gyroAngleY + (1 - alpha) * accAngleY;
-  
-  // Update display
+}
+
+$display_functions
+// Static labels, drawn once; updateDisplay() only redraws the values
+void drawDisplayChrome() {
   display.clearDisplay();
   display.setTextSize(1);
   display.setCursor(0, 0);
@@ -134,35 +175,78 @@ void loop() {
   
   display.setCursor(0, 15);
   display.print("Roll:  ");
-  display.print(roll, 1);
-  display.println("°");
-  
   display.setCursor(0, 25);
   display.print("Pitch: ");
-  display.print(pitch, 1);
-  display.println("°");
-  
   display.setCursor(0, 35);
   display.print("Yaw:   ");
-  display.print(yaw, 1);
-  display.println("°");
-  
   display.setCursor(0, 50);
   display.print("Accel: ");
-  display.print(sqrt(pow(a.acceleration.x,2) + pow(a.acceleration.y,2) + pow(a.acceleration.z,2)), 1);
-  display.println(" m/s²");
   
-  display.display();
+  pushFullFrame();
+}
+
+void updateDisplay() {
+  char text[24];
+  
+  snprintf(text, sizeof(text), "%.1f°", roll);
+  drawField(rollField, text);
   
-  // Serial output
-  Serial.print("Roll: "); Serial.print(roll, 2);
-  Serial.print("° | Pitch: "); Serial.print(pitch, 2);
-  Serial.print("° | Yaw: "); Serial.print(yaw, 2);
-  Serial.println("°");
+  snprintf(text, sizeof(text), "%.1f°", pitch);
+  drawField(pitchField, text);
   
-  delay(50);
+  snprintf(text, sizeof(text), "%.1f°", yaw);
+  drawField(yawField, text);
+  
+  snprintf(text, sizeof(text), "%.1f m/s²",
+           sqrt(pow(a.acceleration.x,2) + pow(a.acceleration.y,2) + pow(a.acceleration.z,2)));
+  drawField(accelField, text);
+  
+  pushDirtyPages();
+}
+$telemetry_functions'''
+
+# Default fragments: fusion, display and serial output once per loop pass
+fragments = {
+    'display_globals': DISPLAY_GLOBALS,
+    'display_functions': DISPLAY_FUNCTIONS,
+    'telemetry_globals': '',
+    'i2c_setup': '',
+    'imu_bandwidth': 'mpu.setFilterBandwidth(MPU6050_BAND_21_HZ);',
+    'sampling_start': '',
+    'orientation_schedule': '''unsigned long currentTime = millis();
+elapsedTime = (currentTime - previousTime) / 1000.0;
+previousTime = currentTime;
+
+updateOrientation();''',
+    'display_schedule': '''// Update display
+updateDisplay();''',
+    'cloud_schedule': '',
+    'serial_log': '''// Serial output
+Serial.print("Roll: "); Serial.print(roll, 2);
+Serial.print("° | Pitch: "); Serial.print(pitch, 2);
+Serial.print("° | Yaw: "); Serial.print(yaw, 2);
+Serial.println("°");''',
+    'loop_delay': '''
+delay(50);''',
+    'telemetry_functions': '',
+}
+fragments.update(angle_math(options.angle_math))
+if options.sample_rate:
+    fragments.update(high_rate_sampling(options.sample_rate, options.batch_size, transport='serial'))
+    fragments['telemetry_globals'] += '''
+unsigned long lastDisplayUpdate = 0;
+const unsigned long displayInterval = 100;
+unsigned long lastCloudUpdate = 0;
+const unsigned long cloudInterval = 1000; // Print partial frames every second'''
+    fragments['cloud_schedule'] = '\n' + fragments['cloud_schedule']
+    fragments['display_schedule'] = '''// Update display
+if (millis() - lastDisplayUpdate >= displayInterval) {
+  updateDisplay();
+  lastDisplayUpdate = millis();
 }'''
 
+wokwi_code = fill_template(wokwi_template, fragments)
+
 # Save Wokwi files
 import json
 
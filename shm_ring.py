@@ -0,0 +1,378 @@
+# Single-producer, multi-consumer ring of fixed-width records in shared memory
+#
+# Decoded telemetry is written once into a multiprocessing.shared_memory
+# block, and every consumer process on the host (fusion, rules, rollups, the
+# live dashboard) reads it from there as NumPy views of the same pages.
+# Nothing is pickled or copied per consumer. The block is self-describing:
+#
+#   line 0         magic, capacity, record size, consumer slots, closed flag
+#   line 1         write cursor: records published since creation
+#   1 KB           the record dtype as JSON, for attach()
+#   slots x 64 B   one line per consumer: read cursor, active flag, laps
+#   records        capacity records, capacity a power of two
+#
+# Every field has exactly one writer, so no locks are needed. The producer
+# owns the write cursor and the laps counters. Each consumer owns its slot's
+# cursor and active flag. Cursors only grow, and a record's index in the ring
+# is its sequence number modulo capacity. The producer stores the records
+# before it advances the write cursor (aligned 8-byte stores, in order on
+# x86-64).
+#
+# The producer never waits. Before it overwrites records that an active
+# consumer has not released yet, it bumps that consumer's laps counter.
+# That consumer's release() then returns False, because the views it held
+# may be torn. Its next poll() skips ahead to the newest capacity // 2
+# records and adds what it skipped to dropped. A slow or stuck consumer
+# therefore only loses its own data. lagging() reports the consumers that
+# are falling behind before that happens.
+#
+#   python shm_ring.py                         4 consumer processes, 20M records
+#   python shm_ring.py --consumers 2 --records 50000000 --batch 8192
+#   python shm_ring.py --slow 1                one consumer that stalls and gets lapped
+
+import argparse
+import json
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+MAGIC = b"SHMRING1"
+LINE = 64
+DTYPE_BYTES = 1024
+
+# One ingest_server.TelemetryRecord in 64 bytes. The device name is stored
+# as up to DEVICE_BYTES of UTF-8; longer names are rejected, not cut short
+# (which could split a character or merge two devices).
+RECORD_DTYPE = np.dtype([("device", "S32"), ("timestamp", "<i8"), ("roll", "<f4"),
+                         ("pitch", "<f4"), ("yaw", "<f4"), ("temperature", "<f4"),
+                         ("received", "<f8")])
+DEVICE_BYTES = RECORD_DTYPE["device"].itemsize
+
+_HEADER = np.dtype([("magic", "S8"), ("capacity", "<u8"), ("itemsize", "<u8"),
+                    ("slots", "<u8"), ("closed", "<u8")])
+_SLOT = np.dtype({"names": ["cursor", "active", "laps"], "formats": ["<u8", "<u8", "<u8"],
+                  "itemsize": LINE})
+_DATA = 2 * LINE + DTYPE_BYTES
+
+
+def _layout(buf, slots):
+    header = np.ndarray((), _HEADER, buf, 0)
+    write = np.ndarray((), np.uint64, buf, LINE)
+    table = np.ndarray((slots,), _SLOT, buf, _DATA)
+    return header, write, table
+
+
+def _data_offset(slots):
+    return _DATA + slots * LINE
+
+
+# Attach without leaving the block registered with a resource tracker of
+# our own. That tracker would unlink the block when this process exits,
+# even though the producer still owns it. Before Python 3.13 there is no
+# track=False. Processes started by multiprocessing share the creator's
+# tracker, so registering there again is harmless. Any other process
+# unregisters again straight away.
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        inherited = resource_tracker._resource_tracker._fd is not None
+        shm = shared_memory.SharedMemory(name)
+        if not inherited:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+# The producer side. Create it first; consumers attach by name.
+class RingBuffer:
+    def __init__(self, capacity=1 << 20, dtype=RECORD_DTYPE, slots=16, name=None):
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+        self.dtype = np.dtype(dtype)
+        descr = json.dumps(self.dtype.descr).encode()
+        if len(descr) > DTYPE_BYTES:
+            raise ValueError("record dtype description is too long")
+        self.capacity = capacity
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(name, create=True,
+                                              size=_data_offset(slots) + capacity * self.dtype.itemsize)
+        self.name = self.shm.name
+        buf = self.shm.buf
+        buf[:_data_offset(slots)] = bytes(_data_offset(slots))
+        self._header, self._write, self._table = _layout(buf, slots)
+        self.records = np.ndarray((capacity,), self.dtype, buf, _data_offset(slots))
+        buf[2 * LINE:2 * LINE + len(descr)] = descr
+        self._header["capacity"] = capacity
+        self._header["itemsize"] = self.dtype.itemsize
+        self._header["slots"] = slots
+        self._header["magic"] = MAGIC
+        self.written = 0
+
+    # Records published so far minus each active consumer's cursor
+    def lag(self):
+        active = self._table["active"] != 0
+        return {int(slot): self.written - int(cursor) for slot, cursor in
+                zip(np.flatnonzero(active), self._table["cursor"][active])}
+
+    # Active consumers more than fraction of the ring behind
+    def lagging(self, fraction=0.5):
+        return sorted(slot for slot, lag in self.lag().items() if lag > fraction * self.capacity)
+
+    # Space for n records at the head, as one or two views (two when it wraps).
+    # Fill them and then publish(n). Only the first capacity records of one
+    # claim are usable.
+    def claim(self, n):
+        if n > self.capacity:
+            raise ValueError("claim larger than the ring")
+        # Consumers whose unreleased records the next n would overwrite
+        active = self._table["active"] != 0
+        behind = active & (self.written + n - self._table["cursor"].astype(np.int64) > self.capacity)
+        if behind.any():
+            self._table["laps"][behind] += 1
+        start = self.written & (self.capacity - 1)
+        first = min(n, self.capacity - start)
+        views = [self.records[start:start + first]]
+        if first < n:
+            views.append(self.records[:n - first])
+        return views
+
+    def publish(self, n):
+        self.written += n
+        self._write[()] = self.written
+
+    # Copy a structured array (or {field: column}) into the ring and publish it
+    def write(self, records):
+        if isinstance(records, dict):
+            n = len(next(iter(records.values())))
+            views = self.claim(n)
+            done = 0
+            for view in views:
+                for name, column in records.items():
+                    view[name] = column[done:done + len(view)]
+                done += len(view)
+        else:
+            n = len(records)
+            done = 0
+            for view in self.claim(n):
+                view[...] = records[done:done + len(view)]
+                done += len(view)
+        self.publish(n)
+
+    # Consumers drain what is left and then stop
+    def close(self):
+        self._header["closed"] = 1
+
+    def unlink(self):
+        self._header = self._write = self._table = self.records = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+# One reader on slot slot of an existing ring, starting at the newest record
+class Consumer:
+    def __init__(self, name, slot):
+        self.shm = _attach(name)
+        buf = self.shm.buf
+        header = np.ndarray((), _HEADER, buf, 0)
+        if bytes(header["magic"]) != MAGIC:
+            raise ValueError(f"{name!r} is not a shm_ring buffer")
+        slots = int(header["slots"])
+        if not 0 <= slot < slots:
+            raise ValueError(f"slot must be in [0, {slots})")
+        descr = bytes(buf[2 * LINE:2 * LINE + DTYPE_BYTES]).rstrip(b"\0")
+        self.dtype = np.dtype([tuple(field) for field in json.loads(descr)])
+        self.capacity = int(header["capacity"])
+        self._header, self._write, table = _layout(buf, slots)
+        self._slot = table[slot]
+        if self._slot["active"]:
+            raise ValueError(f"slot {slot} is already in use")
+        self.records = np.ndarray((self.capacity,), self.dtype, buf, _data_offset(slots))
+        self.cursor = int(self._write[()])
+        self._laps = int(self._slot["laps"])
+        self._pending = 0
+        self.received = 0
+        self.dropped = 0
+        self._slot["cursor"] = self.cursor
+        self._slot["active"] = 1
+
+    # Up to limit unread records as one view into the ring: an empty view when
+    # there are none, None once the producer has closed and everything was read.
+    # The view is valid until release().
+    def poll(self, limit=65536):
+        written = int(self._write[()])
+        laps = int(self._slot["laps"])
+        if laps != self._laps or written - self.cursor > self.capacity:
+            skip_to = written - self.capacity // 2
+            if skip_to > self.cursor:
+                self.dropped += skip_to - self.cursor
+                self.cursor = skip_to
+                self._slot["cursor"] = self.cursor
+            self._laps = laps
+        if written == self.cursor and self._header["closed"]:
+            return None
+        start = self.cursor & (self.capacity - 1)
+        n = min(written - self.cursor, limit, self.capacity - start)
+        self._pending = n
+        return self.records[start:start + n]
+
+    # poll(), sleeping between empty polls for up to timeout seconds
+    def wait(self, limit=65536, timeout=1.0, interval=0.0002):
+        deadline = time.monotonic() + timeout
+        while True:
+            view = self.poll(limit)
+            if view is None or len(view) or time.monotonic() >= deadline:
+                return view
+            time.sleep(interval)
+
+    # Give the last view's records back to the producer. False when the
+    # producer lapped this consumer meanwhile: the view may have been
+    # overwritten while it was read, and those records count as dropped.
+    def release(self):
+        n, self._pending = self._pending, 0
+        self.cursor += n
+        self._slot["cursor"] = self.cursor
+        if int(self._slot["laps"]) != self._laps:
+            self.dropped += n
+            return False
+        self.received += n
+        return True
+
+    def close(self):
+        self._slot["active"] = 0
+        self._header = self._write = self._slot = self.records = None
+        self.shm.close()
+
+
+# A batch of ingest_server TelemetryRecords -> RECORD_DTYPE array. Raises
+# ValueError for a device name over DEVICE_BYTES of UTF-8.
+def pack_records(batch):
+    names = [r.device.encode() for r in batch]
+    for name in names:
+        if len(name) > DEVICE_BYTES:
+            raise ValueError(f"device name {name.decode()!r} is over {DEVICE_BYTES} bytes")
+    records = np.empty(len(batch), RECORD_DTYPE)
+    records["device"] = names
+    for i, name in enumerate(("timestamp", "roll", "pitch", "yaw", "temperature", "received")):
+        column = [r[i + 1] for r in batch]
+        if name == "timestamp":
+            column = [-1 if t is None else t for t in column]
+        records[name] = column
+    return records
+
+
+# Sink for ingest_server.IngestServer: publishes each batch to the ring,
+# then passes it on to inner. Records of devices whose names do not fit
+# RECORD_DTYPE stay out of the ring (counted in rejected) but still go on
+# to inner.
+class RingSink:
+    def __init__(self, ring, inner=None):
+        self.ring = ring
+        self.inner = inner
+        self.rejected = 0
+
+    def __call__(self, batch):
+        fits = [r for r in batch if len(r.device.encode()) <= DEVICE_BYTES]
+        self.rejected += len(batch) - len(fits)
+        self.ring.write(pack_records(fits))
+        if self.inner is not None:
+            self.inner(batch)
+
+
+# Benchmark consumer: checks every released record's timestamp against its
+# sequence number and sums a column, as a stand-in for real work
+def _consume(name, slot, stall):
+    consumer = Consumer(name, slot)
+    checksum = 0.0
+    torn = 0
+    stalled = False
+    began = time.perf_counter()
+    while True:
+        view = consumer.wait(timeout=5.0)
+        if view is None:
+            break
+        if len(view) == 0:
+            continue
+        first = consumer.cursor
+        ok = view["timestamp"][0] == first and view["timestamp"][-1] == first + len(view) - 1
+        roll = float(view["roll"].sum(dtype=np.float64))
+        if stall and not stalled and consumer.received > 1_000_000:
+            time.sleep(stall)
+            stalled = True
+        if consumer.release():
+            torn += not ok
+            checksum += roll
+    elapsed = time.perf_counter() - began
+    result = (consumer.received, consumer.dropped, torn, checksum, elapsed)
+    consumer.close()
+    return result
+
+
+if __name__ == "__main__":
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser(description="Shared-memory ring handoff benchmark")
+    parser.add_argument("--consumers", type=int, default=4)
+    parser.add_argument("--records", type=int, default=20_000_000)
+    parser.add_argument("--batch", type=int, default=4096, help="records per write")
+    parser.add_argument("--capacity", type=int, default=1 << 21)
+    parser.add_argument("--slow", type=int, default=0, help="consumers that stall for a second")
+    args = parser.parse_args()
+
+    # Names over DEVICE_BYTES are rejected, never cut into another device's
+    from ingest_server import TelemetryRecord
+
+    long_names = ["x" * 31 + "é", "device-" + "0" * 30 + "1", "device-" + "0" * 30 + "2"]
+    ring = RingBuffer(64)
+    sink = RingSink(ring)
+    sink([TelemetryRecord(name, 1, 0.0, 0.0, 0.0, 25.0, 1.0)
+          for name in ["esp32-01", "é" * 16, *long_names]])
+    assert sink.rejected == 3 and int(ring._write) == 2
+    ring.unlink()
+
+    ring = RingBuffer(args.capacity, slots=max(16, args.consumers))
+    block = np.zeros(args.batch, RECORD_DTYPE)
+    block["device"] = b"esp32-01"
+    block["roll"] = np.arange(args.batch) % 7
+
+    pool = ProcessPoolExecutor(args.consumers, multiprocessing.get_context("spawn"))
+    jobs = [pool.submit(_consume, ring.name, slot, 1.0 if slot < args.slow else 0.0)
+            for slot in range(args.consumers)]
+    while int(np.count_nonzero(ring._table["active"])) < args.consumers:
+        time.sleep(0.01)
+
+    # Pace the producer only as far as the fast consumers need to keep up, so
+    # the run measures handoff rather than how often the stalled one is lapped
+    fast = list(range(args.slow, args.consumers))
+    peak_lagging = 0
+    began = time.perf_counter()
+    written = 0
+    while written < args.records:
+        n = min(args.batch, args.records - written)
+        block["timestamp"][:n] = np.arange(written, written + n)
+        while fast and max(ring.lag().get(s, 0) for s in fast) + n > args.capacity // 2:
+            time.sleep(0.0001)
+        ring.write(block[:n])
+        written += n
+        peak_lagging = max(peak_lagging, len(ring.lagging()))
+    produced = time.perf_counter() - began
+    ring.close()
+    results = [job.result() for job in jobs]
+    elapsed = time.perf_counter() - began
+    pool.shutdown()
+    ring.unlink()
+
+    expected = float((np.arange(args.records) % args.batch % 7).sum())
+    print(f"{args.records:,} records of {RECORD_DTYPE.itemsize} B, {args.consumers} consumers: "
+          f"produced at {args.records / produced / 1e6:.1f}M records/s, "
+          f"{args.consumers * args.records / elapsed / 1e6:.1f}M records/s delivered in total")
+    for slot, (received, dropped, torn, checksum, seconds) in enumerate(results):
+        print(f"  consumer {slot}: {received:,} received, {dropped:,} dropped, "
+              f"{received / seconds / 1e6:.1f}M records/s")
+        assert torn == 0
+        assert received + dropped == args.records
+        if slot >= args.slow:
+            assert dropped == 0 and checksum == expected
+        else:
+            assert dropped > 0
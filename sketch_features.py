@@ -0,0 +1,1124 @@
+# Firmware fragments shared by the sketch generators (script_4.py, script_5.py)
+#
+# The generators keep their sketch as one template string. A line holding
+# nothing but a $placeholder is replaced by the fragment for the enabled
+# options, re-indented to the placeholder's column; an empty fragment drops the
+# line. Fragments that take parameters use string.Template ${name}
+# substitution, which never collides with C syntax.
+#
+# Both sketches share the names the fragments rely on: roll/pitch/yaw,
+# temperature, elapsedTime, updateOrientation(), lastCloudUpdate and
+# cloudInterval.
+
+from string import Template
+
+
+def fill_template(template, fragments):
+    lines = []
+    for line in template.split('\n'):
+        stripped = line.strip()
+        if stripped.startswith('$') and stripped[1:].isidentifier():
+            fragment = fragments[stripped[1:]]
+            if fragment:
+                indent = line[:len(line) - len(line.lstrip())]
+                lines.extend(indent + l if l else l for l in fragment.split('\n'))
+        else:
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def _ring_size(samples):
+    size = 1
+    while size < samples:
+        size *= 2
+    return size
+
+
+# Dirty-region OLED rendering, shared by both sketches. Each sketch draws its
+# static chrome once and keeps its changing text in DisplayFields; a field is
+# redrawn only when its text changes, and only the SSD1306 columns whose bytes
+# differ from what the panel already shows go out over the I2C bus the MPU6050
+# shares. ssd1306_emulator.py counts the bytes this saves.
+
+DISPLAY_GLOBALS = '''
+// Dirty-region display: the panel's last known contents, one byte per
+// 8-pixel column of a page, and the fields redrawn when their text changes
+#define OLED_CHUNK 127 // Data bytes per I2C write; ESP32's Wire buffer is 128
+uint8_t oledShown[SCREEN_WIDTH * SCREEN_HEIGHT / 8];
+bool displayDirty = false;
+
+struct DisplayField {
+  int16_t x, y, w, h;
+  char text[24];
+};'''
+
+DISPLAY_FUNCTIONS = '''// Redraw a field only if its text changed
+void drawField(DisplayField& field, const char* text) {
+  if (strcmp(field.text, text) == 0) {
+    return;
+  }
+  strncpy(field.text, text, sizeof(field.text) - 1);
+  display.fillRect(field.x, field.y, field.w, field.h, BLACK);
+  display.setCursor(field.x, field.y);
+  display.print(text);
+  displayDirty = true;
+}
+
+// Push the whole framebuffer and remember it as the panel contents
+void pushFullFrame() {
+  display.display();
+  memcpy(oledShown, display.getBuffer(), sizeof(oledShown));
+}
+
+// Send only the changed span of each changed page
+void pushDirtyPages() {
+  if (!displayDirty) {
+    return; // Nothing visible changed, skip the frame
+  }
+  displayDirty = false;
+  uint8_t* buffer = display.getBuffer();
+  for (uint8_t page = 0; page < SCREEN_HEIGHT / 8; page++) {
+    uint8_t* row = buffer + page * SCREEN_WIDTH;
+    uint8_t* shown = oledShown + page * SCREEN_WIDTH;
+    int first = 0;
+    while (first < SCREEN_WIDTH && row[first] == shown[first]) {
+      first++;
+    }
+    if (first == SCREEN_WIDTH) {
+      continue;
+    }
+    int last = SCREEN_WIDTH - 1;
+    while (row[last] == shown[last]) {
+      last--;
+    }
+    
+    // Horizontal addressing window covering just this span
+    Wire.beginTransmission(OLED_ADDRESS);
+    Wire.write((uint8_t)0x00); // Command stream
+    Wire.write((uint8_t)SSD1306_COLUMNADDR);
+    Wire.write((uint8_t)first);
+    Wire.write((uint8_t)last);
+    Wire.write((uint8_t)SSD1306_PAGEADDR);
+    Wire.write(page);
+    Wire.write(page);
+    Wire.endTransmission();
+    
+    for (int column = first; column <= last; column += OLED_CHUNK) {
+      Wire.beginTransmission(OLED_ADDRESS);
+      Wire.write((uint8_t)0x40); // Data stream
+      Wire.write(row + column, min(OLED_CHUNK, last + 1 - column));
+      Wire.endTransmission();
+    }
+    memcpy(shown + first, row + first, last + 1 - first);
+  }
+}
+'''
+
+
+# Accelerometer tilt and gyro unit conversion used by updateOrientation() and
+# calculateIMUError(), selected with --angle-math. angle_math.py sweeps the
+# accuracy of each variant against the exact formula.
+
+ANGLE_MATH_MODES = ('exact', 'fast', 'poly')
+
+# Odd polynomial for atan(a) on [0, 1], a * (c0 + c1 a^2 + ... + c4 a^8)
+# (Abramowitz & Stegun 4.4.49, |error| <= 1e-5 rad)
+ATAN_COEFFS = (0.9998660, -0.3302995, 0.1801410, -0.0851330, 0.0208351)
+
+EXACT_ANGLE_MATH = '''// Accelerometer tilt angles and gyro rates in degrees
+float accelRoll(float x, float y, float z) {
+  return atan(y / sqrt(pow(x, 2) + pow(z, 2))) * 180 / PI;
+}
+
+float accelPitch(float x, float y, float z) {
+  return atan(-1 * x / sqrt(pow(y, 2) + pow(z, 2))) * 180 / PI;
+}
+
+float toDegrees(float radians) {
+  return radians * 180 / PI;
+}
+'''
+
+FAST_ANGLE_MATH = '''// Accelerometer tilt angles and gyro rates in degrees, all in single
+// precision: squared terms are multiplied directly and the degree conversion
+// is one float multiply instead of a double-precision divide by PI
+const float radToDeg = 57.2957795f;
+
+float accelRoll(float x, float y, float z) {
+  return ${atan2}(y, sqrtf(x * x + z * z)) * radToDeg;
+}
+
+float accelPitch(float x, float y, float z) {
+  return ${atan2}(-x, sqrtf(y * y + z * z)) * radToDeg;
+}
+
+float toDegrees(float radians) {
+  return radians * radToDeg;
+}
+'''
+
+POLY_ATAN2 = '''// atan2 without libm: fold into the first octant, evaluate a degree 9
+// odd polynomial, unfold. Max error ${error} degrees (see angle_math.py)
+float polyAtan2(float y, float x) {
+  float ax = fabsf(x), ay = fabsf(y);
+  float hi = fmaxf(ax, ay);
+  if (hi == 0.0f) {
+    return 0.0f;
+  }
+  float a = fminf(ax, ay) / hi;
+  float s = a * a;
+  float r = ${polynomial} * a;
+  if (ay > ax) {
+    r = 1.57079633f - r;
+  }
+  if (x < 0.0f) {
+    r = 3.14159265f - r;
+  }
+  return y < 0.0f ? -r : r;
+}
+
+'''
+
+# Max |polyAtan2 - atan2| in degrees, as reported by angle_math.py
+POLY_ATAN2_ERROR = 0.0007
+
+
+def angle_math(mode):
+    if mode not in ANGLE_MATH_MODES:
+        raise ValueError(f'angle math must be one of {ANGLE_MATH_MODES}')
+    if mode == 'exact':
+        return {'angle_functions': EXACT_ANGLE_MATH}
+    if mode == 'fast':
+        return {'angle_functions': Template(FAST_ANGLE_MATH).substitute(atan2='atan2f')}
+    # Horner form in s = a^2, highest coefficient innermost
+    polynomial = f'{ATAN_COEFFS[-1]}f'
+    for c in reversed(ATAN_COEFFS[:-1]):
+        polynomial = f'({polynomial} * s {"-" if c < 0 else "+"} {abs(c)}f)'
+    return {'angle_functions': Template(POLY_ATAN2).substitute(error=POLY_ATAN2_ERROR,
+                                                              polynomial=polynomial)
+            + Template(FAST_ANGLE_MATH).substitute(atan2='polyAtan2')}
+
+
+# IMU calibration, selected with --calibration. 'fixed' is the original
+# 200 + 200 reading calculateIMUError(). 'streaming' runs one Welford pass
+# over accelerometer angles and gyro rates together, restarts while the
+# device is moving and stops as soon as the standard error of every mean is
+# small enough; loop() then keeps refining the gyro bias whenever the device
+# is still. imu_calibration.py is the Python twin, sharing these constants.
+
+CALIBRATION_MODES = ('streaming', 'fixed')
+
+CALIBRATION = {
+    'period_ms': 5,            # Between calibration reads, as the fixed loop
+    'min_samples': 50,
+    'max_samples': 400,        # Never longer than the fixed procedure
+    'timeout_ms': 10000,       # Give up waiting for stillness
+    'accel_sem': 0.05,         # Target standard error of the accel angle means (deg)
+    'gyro_sem': 0.01,          # and of the gyro bias means (deg/s)
+    'moving_gyro_std': 1.0,    # Rate noise above this (deg/s) means the device moves
+    'still_accel': 0.5,        # Runtime stillness: | |a| - g | below this (m/s^2)
+    'still_gyro': 2.0,         # and every bias-corrected rate below this (deg/s)
+    'bias_window': 200,        # Still samples averaged per bias update
+    'bias_gain': 0.25,         # Fraction of the way the bias moves per update
+}
+
+FIXED_CALIBRATION = '''void calculateIMUError() {
+  // Calculate accelerometer error (200 readings)
+  int c = 0;
+  while (c < 200) {
+    sensors_event_t a, g, temp;
+    mpu.getEvent(&a, &g, &temp);
+    
+    AccErrorX += accelRoll(a.acceleration.x, a.acceleration.y, a.acceleration.z);
+    AccErrorY += accelPitch(a.acceleration.x, a.acceleration.y, a.acceleration.z);
+    c++;
+    delay(5);
+  }
+  AccErrorX = AccErrorX / 200;
+  AccErrorY = AccErrorY / 200;
+  
+  c = 0;
+  // Calculate gyroscope error (200 readings)
+  while (c < 200) {
+    sensors_event_t a, g, temp;
+    mpu.getEvent(&a, &g, &temp);
+    
+    GyroErrorX += toDegrees(g.gyro.x);
+    GyroErrorY += toDegrees(g.gyro.y);
+    GyroErrorZ += toDegrees(g.gyro.z);
+    c++;
+    delay(5);
+  }
+  GyroErrorX = GyroErrorX / 200;
+  GyroErrorY = GyroErrorY / 200;
+  GyroErrorZ = GyroErrorZ / 200;
+  
+  Serial.println("IMU Calibration Complete");
+  Serial.print("AccErrorX: "); Serial.println(AccErrorX);
+  Serial.print("AccErrorY: "); Serial.println(AccErrorY);
+  Serial.print("GyroErrorX: "); Serial.println(GyroErrorX);
+  Serial.print("GyroErrorY: "); Serial.println(GyroErrorY);
+  Serial.print("GyroErrorZ: "); Serial.println(GyroErrorZ);
+}'''
+
+STREAMING_CALIBRATION_GLOBALS = '''
+// Streaming calibration (see imu_calibration.py): Welford running mean and
+// variance of accel roll/pitch (deg) and gyro x/y/z (deg/s)
+#define CAL_AXES 5
+struct RunningStats {
+  uint32_t n;
+  float mean[CAL_AXES];
+  float m2[CAL_AXES];
+};
+const unsigned long calibrationPeriod = ${period_ms};
+const uint32_t minCalibrationSamples = ${min_samples};
+const uint32_t maxCalibrationSamples = ${max_samples};
+const unsigned long calibrationTimeout = ${timeout_ms};
+const float accelTargetSem = ${accel_sem};
+const float gyroTargetSem = ${gyro_sem};
+const float movingGyroStd = ${moving_gyro_std};
+
+// Runtime gyro bias refinement while the device is still
+const float stillAccelTolerance = ${still_accel};
+const float stillGyroTolerance = ${still_gyro};
+const uint32_t biasWindow = ${bias_window};
+const float biasGain = ${bias_gain};
+RunningStats stillStats = {};'''
+
+STREAMING_CALIBRATION = '''void addSample(RunningStats& stats, const float* sample) {
+  stats.n++;
+  for (int i = 0; i < CAL_AXES; i++) {
+    float delta = sample[i] - stats.mean[i];
+    stats.mean[i] += delta / stats.n;
+    stats.m2[i] += delta * (sample[i] - stats.mean[i]);
+  }
+}
+
+float sampleVariance(const RunningStats& stats, int axis) {
+  return stats.n > 1 ? stats.m2[axis] / (stats.n - 1) : 0;
+}
+
+void calculateIMUError() {
+  RunningStats stats = {};
+  uint32_t restarts = 0;
+  unsigned long start = millis();
+  
+  while (millis() - start < calibrationTimeout) {
+    sensors_event_t a, g, temp;
+    mpu.getEvent(&a, &g, &temp);
+    float sample[CAL_AXES] = {
+      accelRoll(a.acceleration.x, a.acceleration.y, a.acceleration.z),
+      accelPitch(a.acceleration.x, a.acceleration.y, a.acceleration.z),
+      toDegrees(g.gyro.x), toDegrees(g.gyro.y), toDegrees(g.gyro.z)
+    };
+    addSample(stats, sample);
+    
+    if (stats.n >= minCalibrationSamples) {
+      bool moving = false;
+      bool converged = true;
+      for (int i = 0; i < CAL_AXES; i++) {
+        float variance = sampleVariance(stats, i);
+        float target = i < 2 ? accelTargetSem : gyroTargetSem;
+        if (i >= 2 && variance > movingGyroStd * movingGyroStd) {
+          moving = true;
+        }
+        if (variance / stats.n > target * target) {
+          converged = false;
+        }
+      }
+      if (moving) {
+        stats = {}; // Device is being handled, start over
+        restarts++;
+      } else if (converged || stats.n >= maxCalibrationSamples) {
+        break;
+      }
+    }
+    delay(calibrationPeriod);
+  }
+  
+  AccErrorX = stats.mean[0];
+  AccErrorY = stats.mean[1];
+  GyroErrorX = stats.mean[2];
+  GyroErrorY = stats.mean[3];
+  GyroErrorZ = stats.mean[4];
+  
+  Serial.print("IMU Calibration Complete in ");
+  Serial.print(millis() - start);
+  Serial.print(" ms (");
+  Serial.print(stats.n);
+  Serial.print(" samples, ");
+  Serial.print(restarts);
+  Serial.println(" restarts)");
+  Serial.print("AccErrorX: "); Serial.println(AccErrorX);
+  Serial.print("AccErrorY: "); Serial.println(AccErrorY);
+  Serial.print("GyroErrorX: "); Serial.println(GyroErrorX);
+  Serial.print("GyroErrorY: "); Serial.println(GyroErrorY);
+  Serial.print("GyroErrorZ: "); Serial.println(GyroErrorZ);
+}
+
+// While the device is still, average the raw gyro rates over biasWindow
+// samples and move the bias biasGain of the way to that average
+void refineGyroBias() {
+  float accelNorm = sqrtf(AccX * AccX + AccY * AccY + AccZ * AccZ);
+  bool still = fabsf(accelNorm - 9.80665f) < stillAccelTolerance &&
+               fabsf(GyroX) < stillGyroTolerance &&
+               fabsf(GyroY) < stillGyroTolerance &&
+               fabsf(GyroZ) < stillGyroTolerance;
+  if (!still) {
+    stillStats = {};
+    return;
+  }
+  float sample[CAL_AXES] = {0, 0, GyroX + GyroErrorX, GyroY + GyroErrorY, GyroZ + GyroErrorZ};
+  addSample(stillStats, sample);
+  if (stillStats.n >= biasWindow) {
+    GyroErrorX += biasGain * (stillStats.mean[2] - GyroErrorX);
+    GyroErrorY += biasGain * (stillStats.mean[3] - GyroErrorY);
+    GyroErrorZ += biasGain * (stillStats.mean[4] - GyroErrorZ);
+    stillStats = {};
+  }
+}'''
+
+STREAMING_BIAS_REFINEMENT = '''
+// Track gyro drift while the device is still
+refineGyroBias();'''
+
+
+def calibration(mode):
+    if mode not in CALIBRATION_MODES:
+        raise ValueError(f'calibration must be one of {CALIBRATION_MODES}')
+    if mode == 'fixed':
+        return {'calibration_globals': '', 'calibration_functions': FIXED_CALIBRATION,
+                'bias_refinement': ''}
+    return {
+        'calibration_globals': Template(STREAMING_CALIBRATION_GLOBALS).substitute(CALIBRATION),
+        'calibration_functions': STREAMING_CALIBRATION,
+        'bias_refinement': STREAMING_BIAS_REFINEMENT,
+    }
+
+
+# Report by exception, selected with --deadband. A reading is still taken
+# every cloudInterval / batchSize, but it is only queued when an angle has
+# moved more than DEADBAND_DEG from the last one queued, or HEARTBEAT_MS has
+# passed since, so the server can tell an idle device from a dead one. Between
+# reports every angle stays within DEADBAND_DEG of the last one sent, the bound
+# deadband.py's step-hold reconstruction relies on.
+
+DEADBAND_GLOBALS = '''
+// Report by exception (see deadband.py)
+#define DEADBAND_DEG ${deadband}f
+#define HEARTBEAT_MS ${heartbeat}UL
+float reportedRoll = 0, reportedPitch = 0, reportedYaw = 0;
+unsigned long lastReportTime = 0;
+bool reportedOnce = false;'''
+
+DEADBAND_SCHEDULE = '''// Take a reading every cloudInterval / batchSize, queue it only if an angle
+// left the deadband around the last one queued or the heartbeat is due
+if (millis() - lastCloudUpdate >= cloudInterval / batchSize) {
+  lastCloudUpdate = millis();
+  if (!reportedOnce || millis() - lastReportTime >= HEARTBEAT_MS ||
+      fabsf(roll - reportedRoll) > DEADBAND_DEG ||
+      fabsf(pitch - reportedPitch) > DEADBAND_DEG ||
+      fabsf(yaw - reportedYaw) > DEADBAND_DEG) {
+    queueReading();
+    reportedRoll = roll;
+    reportedPitch = pitch;
+    reportedYaw = yaw;
+    lastReportTime = millis();
+    reportedOnce = true;
+  }
+}
+
+// Send full batches at once and a partial one once its oldest reading has
+// waited cloudInterval, so a change is never held back for long
+if (queueHead - queueTail >= batchSize ||
+    (queueHead != queueTail &&
+     millis() - offlineQueue[queueTail % OFFLINE_QUEUE_SIZE].timestamp >= cloudInterval)) {
+  sendToCloud();
+}'''
+
+
+# Fragments for --deadband (degrees) with a heartbeat in ms; JSON telemetry only
+def deadband(threshold, heartbeat):
+    if threshold <= 0:
+        raise ValueError('deadband must be positive')
+    return {
+        'deadband_globals': Template(DEADBAND_GLOBALS).substitute(deadband=threshold,
+                                                                   heartbeat=int(heartbeat)),
+        'cloud_schedule': DEADBAND_SCHEDULE,
+    }
+
+
+# Packed binary telemetry frames (layout documented in telemetry_codec.py).
+# Samples wait in a ring buffer and leave it only once a frame carrying them
+# has been sent, so a failed publish keeps them for the next attempt.
+
+# Largest samples per frame: a 10 KB frameBuffer (plus the MQTT client's copy)
+# and a ring no bigger than --sample-rate 1000's 2048 samples
+MAX_BATCH_SIZE = 1000
+
+PACKED_GLOBALS = '''
+// Packed telemetry (see telemetry_codec.py): up to BATCH_SIZE samples per
+// frame, buffered in a RING_SIZE sample ring until they are sent
+#define BATCH_SIZE ${batch_size}
+#define RING_SIZE ${ring_size} // Power of two
+uint16_t batchSize = BATCH_SIZE; // Samples per frame now, at most BATCH_SIZE
+const uint32_t deviceId = 0; // Informational, the server identifies devices by token
+
+struct __attribute__((packed)) FrameHeader {
+  char magic[2];
+  uint8_t version;
+  uint8_t flags;
+  uint16_t count;
+  uint32_t deviceId;
+  uint32_t baseTimestamp;
+};
+
+struct __attribute__((packed)) PackedSample {
+  uint16_t dt;          // ms since the previous sample
+  int16_t roll;         // hundredths of a degree
+  int16_t pitch;
+  int16_t yaw;          // wrapped to [-180, 180)
+  int16_t temperature;  // hundredths of a degree C
+};
+
+struct RingSample {
+  uint32_t timestamp;
+  int16_t roll, pitch, yaw, temperature;
+};
+
+RingSample ring[RING_SIZE];
+uint32_t ringHead = 0; // Samples written so far
+uint32_t ringTail = 0; // Samples sent so far
+uint32_t droppedSamples = 0;
+uint8_t frameBuffer[sizeof(FrameHeader) + BATCH_SIZE * sizeof(PackedSample)];'''
+
+MQTT_FRAME_GLOBALS = '''const char* packedTopic = "v1/devices/me/telemetry/packed";
+const uint16_t maxBatchSize = BATCH_SIZE; // The server can lower batchSize, frameBuffer caps it'''
+
+PACKED_FUNCTIONS = '''int16_t toFixedPoint(float value) {
+  long scaled = lroundf(value * 100.0f);
+  return (int16_t)constrain(scaled, -32768L, 32767L);
+}
+
+float wrapAngle(float angle) {
+  angle = fmodf(angle + 180.0f, 360.0f);
+  return angle < 0 ? angle + 180.0f : angle - 180.0f;
+}
+
+uint32_t ringCount() {
+  return ringHead - ringTail;
+}
+
+void recordSample(unsigned long timestamp, float roll, float pitch, float yaw, float temperature) {
+  if (ringCount() >= RING_SIZE) {
+    ringTail++; // Overwrite the oldest sample
+    droppedSamples++;
+  }
+  RingSample& sample = ring[ringHead % RING_SIZE];
+  sample.timestamp = timestamp;
+  sample.roll = toFixedPoint(roll);
+  sample.pitch = toFixedPoint(pitch);
+  sample.yaw = toFixedPoint(wrapAngle(yaw));
+  sample.temperature = toFixedPoint(temperature);
+  ringHead++;
+}
+
+// Pack the oldest count samples into frameBuffer, returns the frame length
+size_t buildFrame(uint16_t count) {
+  uint32_t previous = ring[ringTail % RING_SIZE].timestamp;
+  FrameHeader header = {{'P', 'M'}, 1, 0, count, deviceId, previous};
+  memcpy(frameBuffer, &header, sizeof(header));
+  for (uint16_t i = 0; i < count; i++) {
+    const RingSample& sample = ring[(ringTail + i) % RING_SIZE];
+    PackedSample packed = {
+      (uint16_t)min(sample.timestamp - previous, (uint32_t)65535),
+      sample.roll, sample.pitch, sample.yaw, sample.temperature
+    };
+    memcpy(frameBuffer + sizeof(header) + i * sizeof(packed), &packed, sizeof(packed));
+    previous = sample.timestamp;
+  }
+  return sizeof(header) + count * sizeof(PackedSample);
+}
+'''
+
+MQTT_FLUSH = '''// Publish the oldest frame; its samples leave the ring only if the publish succeeds
+bool flushSamples() {
+  uint16_t count = min(ringCount(), (uint32_t)batchSize);
+  if (count == 0) {
+    return true;
+  }
+  size_t length = buildFrame(count);
+  if (!mqttClient.publish(packedTopic, frameBuffer, length)) {
+    return false;
+  }
+  ringTail += count;
+  return true;
+}
+'''
+
+SERIAL_FLUSH = '''// Print the oldest frame as one "PM <hex>" line, which
+// telemetry_codec.frames_from_serial() decodes
+bool flushSamples() {
+  static char hexLine[2 * sizeof(frameBuffer) + 1];
+  uint16_t count = min(ringCount(), (uint32_t)batchSize);
+  if (count == 0) {
+    return true;
+  }
+  size_t length = buildFrame(count);
+  for (size_t i = 0; i < length; i++) {
+    hexLine[2 * i] = "0123456789ABCDEF"[frameBuffer[i] >> 4];
+    hexLine[2 * i + 1] = "0123456789ABCDEF"[frameBuffer[i] & 0x0F];
+  }
+  hexLine[2 * length] = '\\0';
+  Serial.print("PM ");
+  Serial.println(hexLine);
+  ringTail += count;
+  return true;
+}
+'''
+
+PACKED_MQTT_SETUP = '''// Default 256 bytes can be too small for a frame; never go below it, downlink
+// messages arrive through the same buffer
+mqttClient.setBufferSize(max(sizeof(frameBuffer) + 64, (size_t)256));'''
+
+PACKED_PAYLOAD = '''// Publish the oldest packed frames to the self-hosted ingest server,
+// at most replayBudget per call so a backlog never stalls the loop
+for (int i = 0; i < replayBudget && ringCount() > 0; i++) {
+  if (!flushSamples()) {
+    break;
+  }
+}'''
+
+# --batch-size without --sample-rate: one sample every cloudInterval / batchSize
+
+BATCH_GLOBALS = '''unsigned long lastSampleTime = 0;'''
+
+BATCH_SAMPLE_PHASE = 'lastSampleTime = millis() - random(cloudInterval / batchSize);'
+
+BATCH_SCHEDULE = '''// Record a sample for the next packed frame
+if (millis() - lastSampleTime >= cloudInterval / batchSize) {
+  lastSampleTime = millis();
+  recordSample(lastSampleTime, roll, pitch, yaw, temperature);
+}
+
+// Send data to cloud once a frame is full
+if (ringCount() >= batchSize) {
+  sendToCloud();
+  lastCloudUpdate = millis();
+}'''
+
+# --sample-rate: fusion paced by micros() at SAMPLE_RATE_HZ, every fused sample
+# goes into the ring and frames are flushed as soon as they fill up
+
+HIGH_RATE_GLOBALS = '''
+// High-rate sampling: fuse and record one sample every 1 / SAMPLE_RATE_HZ
+#define SAMPLE_RATE_HZ ${sample_rate}
+const unsigned long samplePeriodMicros = 1000000UL / SAMPLE_RATE_HZ;
+const unsigned long samplePeriodMillis = 1000UL / SAMPLE_RATE_HZ;
+unsigned long nextSampleMicros = 0;
+unsigned long sampleTime = 0; // Sample clock in ms, advances in whole periods
+
+// Serial logging is rate-limited so it cannot stall sampling
+unsigned long lastSerialPrint = 0;
+const unsigned long serialInterval = 200;'''
+
+HIGH_RATE_START = '''nextSampleMicros = micros();
+sampleTime = millis();'''
+
+HIGH_RATE_SCHEDULE = '''// Sample the IMU on a fixed SAMPLE_RATE_HZ schedule. When the loop falls
+// behind, the missed periods are skipped so the gap shows in the timestamps.
+unsigned long lateMicros = micros() - nextSampleMicros;
+if ((long)lateMicros >= 0) {
+  unsigned long periods = 1 + lateMicros / samplePeriodMicros;
+  nextSampleMicros += periods * samplePeriodMicros;
+  sampleTime += periods * samplePeriodMillis;
+  elapsedTime = periods * samplePeriodMillis / 1000.0;
+  updateOrientation();
+  recordSample(sampleTime, roll, pitch, yaw, temperature);
+}'''
+
+HIGH_RATE_FLUSH = '''// Flush batched samples: full frames right away, partial ones every cloudInterval
+if (ringCount() >= batchSize || (ringCount() > 0 && millis() - lastCloudUpdate >= cloudInterval)) {
+  ${flush_call}
+  lastCloudUpdate = millis();
+}'''
+
+RATE_LIMITED_SERIAL_LOG = '''// Print to serial monitor (rate-limited)
+if (millis() - lastSerialPrint >= serialInterval) {
+  lastSerialPrint = millis();
+  Serial.print("Roll: "); Serial.print(roll, 2);
+  Serial.print("° | Pitch: "); Serial.print(pitch, 2);
+  Serial.print("° | Yaw: "); Serial.print(yaw, 2);
+  Serial.println("°");
+}'''
+
+# Sample rates whose period is a whole number of milliseconds, so frame
+# timestamps (1 ms resolution) stay exact
+SAMPLE_RATES = (200, 250, 500, 1000)
+
+# MPU6050 digital low-pass settings, widest band below Nyquist for each rate
+_BANDWIDTHS = {100: 'MPU6050_BAND_44_HZ', 200: 'MPU6050_BAND_94_HZ', 250: 'MPU6050_BAND_94_HZ',
+               500: 'MPU6050_BAND_184_HZ', 1000: 'MPU6050_BAND_260_HZ'}
+
+
+def packed_telemetry(batch_size, transport='mqtt', ring_samples=None):
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(f'batch size must be between 1 and {MAX_BATCH_SIZE}')
+    ring_size = _ring_size(max(ring_samples or 0, 2 * batch_size))
+    globals_ = Template(PACKED_GLOBALS).substitute(batch_size=batch_size, ring_size=ring_size)
+    if transport == 'mqtt':
+        return {
+            'telemetry_globals': globals_ + '\n' + MQTT_FRAME_GLOBALS + '\n' + BATCH_GLOBALS,
+            'mqtt_setup': PACKED_MQTT_SETUP,
+            'cloud_schedule': BATCH_SCHEDULE,
+            'cloud_payload': PACKED_PAYLOAD,
+            'sample_phase': BATCH_SAMPLE_PHASE,
+            'telemetry_functions': PACKED_FUNCTIONS + '\n' + MQTT_FLUSH,
+        }
+    return {
+        'telemetry_globals': globals_,
+        'telemetry_functions': PACKED_FUNCTIONS + '\n' + SERIAL_FLUSH,
+    }
+
+
+# Fragments for --sample-rate. transport is 'mqtt' for the full sketch and
+# 'serial' for the Wokwi sketch, which has no network.
+def high_rate_sampling(sample_rate, batch_size=None, transport='mqtt'):
+    if sample_rate not in SAMPLE_RATES:
+        raise ValueError(f'sample rate must be one of {SAMPLE_RATES} Hz')
+    # Default to ten frames per second; keep two seconds of samples in the ring
+    batch_size = batch_size if batch_size and batch_size > 1 else sample_rate // 10
+    fragments = packed_telemetry(batch_size, transport, ring_samples=2 * sample_rate)
+    if transport == 'mqtt':
+        fragments['telemetry_globals'] = fragments['telemetry_globals'].replace(
+            '\n' + BATCH_GLOBALS, '')
+        # Samples follow the micros() schedule; only partial flushes use the timer
+        del fragments['sample_phase']
+    fragments['telemetry_globals'] += '\n' + Template(HIGH_RATE_GLOBALS).substitute(
+        sample_rate=sample_rate)
+    flush_call = 'sendToCloud();' if transport == 'mqtt' else 'flushSamples();'
+    fragments.update({
+        'i2c_setup': 'Wire.setClock(400000); // Fast-mode I2C keeps each read short',
+        'imu_bandwidth': f'mpu.setFilterBandwidth({_BANDWIDTHS[sample_rate]});',
+        'sampling_start': HIGH_RATE_START,
+        'orientation_schedule': HIGH_RATE_SCHEDULE,
+        'cloud_schedule': Template(HIGH_RATE_FLUSH).substitute(flush_call=flush_call),
+        'serial_log': RATE_LIMITED_SERIAL_LOG,
+        'loop_delay': '',
+    })
+    return fragments
+
+
+# Dual-core FreeRTOS profile, selected with --rtos. A hardware timer ticks at
+# the sample rate and wakes sensorTask (core 1, top priority), which reads the
+# MPU6050, fuses with the fixed sample period as dt and pushes the sample into
+# a lock-free single-producer, single-consumer queue. Everything else (display,
+# WiFi/MQTT, telemetry, Serial) is loop(), run by networkTask at low priority
+# on core 0, so a publish that blocks for seconds only lets the queue fill.
+# The MPU6050 and the OLED share the I2C bus; Wire serialises the two cores'
+# transactions. networkTask prints each sample's wake-up latency on "TM" lines
+# for jitter_analyzer.py.
+
+RTOS_SAMPLE_RATES = (100,) + SAMPLE_RATES
+
+RTOS_GLOBALS = '''
+// Dual-core tasks: sensorTask samples at SAMPLE_RATE_HZ on core 1, loop() runs
+// in networkTask on core 0
+#include <atomic>
+#define SAMPLE_RATE_HZ ${sample_rate}
+#define SAMPLE_QUEUE_SIZE ${queue_size} // Power of two, about a second of samples
+const uint32_t samplePeriodMicros = 1000000UL / SAMPLE_RATE_HZ;
+hw_timer_t* sampleTimer = NULL;
+TaskHandle_t sensorTaskHandle = NULL;
+uint32_t timerStartMicros = 0;
+uint32_t timerStartMillis = 0;
+
+struct TimedSample {
+  uint32_t tick;          // Timer periods since the timer started
+  uint32_t latencyMicros; // From the tick to sensorTask waking up
+  float roll, pitch, yaw, temperature;
+};
+
+// Lock-free queue from sensorTask (the only writer of the head) to
+// networkTask (the only writer of the tail)
+TimedSample sampleQueue[SAMPLE_QUEUE_SIZE];
+std::atomic<uint32_t> sampleQueueHead(0);
+std::atomic<uint32_t> sampleQueueTail(0);
+volatile uint32_t queueOverflows = 0; // Samples dropped while networkTask was stalled
+volatile uint32_t missedTicks = 0;    // Timer periods sensorTask slept through
+
+// Timing log: "TM <period us> <first tick> <latency us>..." for runs of
+// consecutive ticks, TIMING_LOG_SAMPLES per line at most
+#define TIMING_LOG_SAMPLES 32
+char timingLine[32 + TIMING_LOG_SAMPLES * 11];
+size_t timingLength = 0;
+uint16_t timingCount = 0;
+uint32_t timingNextTick = 0;
+
+// Serial logging is rate-limited so it leaves room for the timing log
+unsigned long lastSerialPrint = 0;
+const unsigned long serialInterval = 200;'''
+
+RTOS_FUNCTIONS = '''// Timer interrupt: wake sensorTask, switching to it as soon as the ISR returns
+void IRAM_ATTR onSampleTimer() {
+  BaseType_t woken = pdFALSE;
+  vTaskNotifyGiveFromISR(sensorTaskHandle, &woken);
+  if (woken) {
+    portYIELD_FROM_ISR();
+  }
+}
+
+// Core 1, top priority: one fused sample per timer tick. The sample instant
+// is the tick, so dt is a whole number of periods however late the read runs.
+void sensorTask(void* parameter) {
+  uint32_t tick = 0;
+  for (;;) {
+    uint32_t ticks = ulTaskNotifyTake(pdTRUE, portMAX_DELAY);
+    tick += ticks;
+    missedTicks += ticks - 1;
+    uint32_t latency = micros() - (timerStartMicros + tick * samplePeriodMicros);
+    elapsedTime = ticks * samplePeriodMicros / 1000000.0f;
+    updateOrientation();
+    
+    uint32_t head = sampleQueueHead.load(std::memory_order_relaxed);
+    if (head - sampleQueueTail.load(std::memory_order_acquire) >= SAMPLE_QUEUE_SIZE) {
+      queueOverflows++;
+      continue;
+    }
+    sampleQueue[head % SAMPLE_QUEUE_SIZE] = {tick, latency, roll, pitch, yaw, temperature};
+    sampleQueueHead.store(head + 1, std::memory_order_release);
+  }
+}
+
+bool popSample(TimedSample& sample) {
+  uint32_t tail = sampleQueueTail.load(std::memory_order_relaxed);
+  if (tail == sampleQueueHead.load(std::memory_order_acquire)) {
+    return false;
+  }
+  sample = sampleQueue[tail % SAMPLE_QUEUE_SIZE];
+  sampleQueueTail.store(tail + 1, std::memory_order_release);
+  return true;
+}
+
+// Core 0, below the WiFi stack: display, network, telemetry and Serial
+void networkTask(void* parameter) {
+  for (;;) {
+    loop();
+  }
+}
+
+void logTiming(const TimedSample& sample) {
+  if (timingCount == TIMING_LOG_SAMPLES || (timingCount > 0 && sample.tick != timingNextTick)) {
+    Serial.println(timingLine);
+    timingCount = 0;
+  }
+  if (timingCount == 0) {
+    timingLength = snprintf(timingLine, sizeof(timingLine), "TM %lu %lu",
+                            (unsigned long)samplePeriodMicros, (unsigned long)sample.tick);
+  }
+  timingLength += snprintf(timingLine + timingLength, sizeof(timingLine) - timingLength,
+                           " %lu", (unsigned long)sample.latencyMicros);
+  timingCount++;
+  timingNextTick = sample.tick + 1;
+}
+'''
+
+RTOS_START = '''// Core 1: sensorTask, woken by the sample timer
+xTaskCreatePinnedToCore(sensorTask, "sensor", 4096, NULL, configMAX_PRIORITIES - 1,
+                        &sensorTaskHandle, 1);
+// Core 0: loop(), below the WiFi stack that runs there too
+xTaskCreatePinnedToCore(networkTask, "network", 8192, NULL, 1, NULL, 0);
+
+// 1 MHz hardware timer (80 MHz APB / 80), alarm every sample period
+sampleTimer = timerBegin(0, 80, true);
+timerAttachInterrupt(sampleTimer, &onSampleTimer, true);
+timerAlarmWrite(sampleTimer, samplePeriodMicros, true);
+timerStartMicros = micros();
+timerStartMillis = millis();
+timerAlarmEnable(sampleTimer);
+
+// loop() now runs in networkTask, the Arduino loop task can go
+vTaskDelete(NULL);'''
+
+RTOS_DRAIN = '''// Take the samples sensorTask fused since the last pass
+TimedSample sample;
+while (popSample(sample)) {
+  logTiming(sample);
+  ${record}
+}'''
+
+RTOS_RECORD = '''recordSample(timerStartMillis + sample.tick * (samplePeriodMicros / 1000),
+             sample.roll, sample.pitch, sample.yaw, sample.temperature);'''
+
+
+def _rtos_drain(record):
+    drain = Template(RTOS_DRAIN).substitute(record=record.replace('\n', '\n  '))
+    return '\n'.join(line for line in drain.split('\n') if line.strip())
+
+
+# Fragments for --rtos. Without sample_rate or batch_size the sensor task runs
+# at 100 Hz and telemetry stays JSON; with either, every sample goes into
+# packed frames as with --sample-rate.
+def rtos_tasks(sample_rate=None, batch_size=None):
+    rate = sample_rate or 100
+    if rate not in RTOS_SAMPLE_RATES:
+        raise ValueError(f'RTOS sample rate must be one of {RTOS_SAMPLE_RATES} Hz')
+    fragments = {
+        'acquisition_globals': Template(RTOS_GLOBALS).substitute(sample_rate=rate,
+                                                          queue_size=_ring_size(rate)),
+        'acquisition_functions': RTOS_FUNCTIONS,
+        'i2c_setup': 'Wire.setClock(400000); // Fast-mode I2C keeps each read short',
+        'imu_bandwidth': f'mpu.setFilterBandwidth({_BANDWIDTHS[rate]});',
+        'sampling_start': RTOS_START,
+        'orientation_schedule': _rtos_drain(''),
+        'serial_log': RATE_LIMITED_SERIAL_LOG,
+    }
+    if sample_rate or (batch_size or 1) > 1:
+        batch_size = batch_size if batch_size and batch_size > 1 else rate // 10
+        fragments.update(packed_telemetry(batch_size, ring_samples=2 * rate))
+        fragments['telemetry_globals'] = fragments['telemetry_globals'].replace(
+            '\n' + BATCH_GLOBALS, '')
+        del fragments['sample_phase']
+        fragments['orientation_schedule'] = _rtos_drain(RTOS_RECORD)
+        fragments['cloud_schedule'] = Template(HIGH_RATE_FLUSH).substitute(
+            flush_call='sendToCloud();')
+    return fragments
+
+
+# MPU6050 FIFO acquisition, selected with --fifo RATE. The sensor samples on
+# its own clock at RATE (SMPLRT_DIV), appends each sample's accelerometer,
+# temperature and gyro registers to its 1 KB FIFO as one 14 byte frame and
+# pulses INT. The ISR only counts pulses; once FIFO_BURST samples are waiting
+# loop() drains every whole frame, FIFO_BURST per 400 kHz I2C read, and fuses
+# each with the sample period as dt. Samples are timestamped from their index
+# on the sensor clock, not from millis(). mpu6050_fifo.py decodes the same
+# frames and runs this drain against a register-level model of the chip.
+
+FIFO_RATES = (100, 200, 250, 500, 1000)
+FIFO_FRAME_BYTES = 14
+FIFO_SIZE = 1024
+# arduino-esp32's Wire buffer holds 128 bytes, so 9 frames per read at most
+WIRE_BUFFER = 128
+
+# The digital low-pass filter must stay on (1 kHz internal rate) for the
+# divider to mean what it says
+_FIFO_BANDWIDTHS = {**_BANDWIDTHS, 1000: 'MPU6050_BAND_184_HZ'}
+
+FIFO_GLOBALS = '''
+// MPU6050 FIFO acquisition (see mpu6050_fifo.py); wire the MPU6050 INT pin to MPU_INT_PIN
+#define MPU_ADDRESS 0x68
+#define MPU_INT_PIN 19
+#define FIFO_RATE_HZ ${rate}
+#define FIFO_FRAME_BYTES ${frame_bytes} // Accel xyz, temperature, gyro xyz, big-endian int16
+#define FIFO_BURST ${burst} // Frames per I2C read
+#define MPU_FIFO_SIZE ${fifo_size}
+const uint32_t fifoPeriodMicros = 1000000UL / FIFO_RATE_HZ;
+volatile uint32_t dataReadyCount = 0; // Samples the MPU6050 has taken, counted from INT
+uint32_t sampleIndex = 0;             // Sensor-clock index of the next frame read
+uint32_t fifoStartMillis = 0;         // millis() at sample index 0
+unsigned long fifoSampleTime = 0;     // Timestamp of the frame just fused
+uint32_t fifoRestarts = 0;
+
+// Raw to SI units for the ranges set in setup(): +-8 g, +-500 deg/s
+const float accelScale = 9.80665f / 4096.0f;
+const float gyroScale = 3.14159265f / 180.0f / 65.5f;
+
+// Serial logging is rate-limited so it cannot stall the drain
+unsigned long lastSerialPrint = 0;
+const unsigned long serialInterval = 200;'''
+
+FIFO_FUNCTIONS = '''void IRAM_ATTR onDataReady() {
+  dataReadyCount++;
+}
+
+void writeMpuRegister(uint8_t reg, uint8_t value) {
+  Wire.beginTransmission(MPU_ADDRESS);
+  Wire.write(reg);
+  Wire.write(value);
+  Wire.endTransmission();
+}
+
+// Burst read from reg on: the register pointer auto-increments, except at
+// FIFO_R_W (0x74), where every byte read pops the next FIFO byte
+bool readMpuRegisters(uint8_t reg, uint8_t* buffer, uint8_t length) {
+  Wire.beginTransmission(MPU_ADDRESS);
+  Wire.write(reg);
+  if (Wire.endTransmission(false) != 0 || Wire.requestFrom((uint8_t)MPU_ADDRESS, length) != length) {
+    return false;
+  }
+  for (uint8_t i = 0; i < length; i++) {
+    buffer[i] = Wire.read();
+  }
+  return true;
+}
+
+int16_t bigEndian16(const uint8_t* bytes) {
+  return (int16_t)((bytes[0] << 8) | bytes[1]);
+}
+
+// Empty the FIFO and carry the index on from the samples taken so far, so
+// timestamps stay on the sensor clock across the gap (to within a sample)
+void restartFifo() {
+  writeMpuRegister(0x6A, 0x04); // USER_CTRL: FIFO_RESET
+  writeMpuRegister(0x6A, 0x40); // USER_CTRL: FIFO_EN
+  sampleIndex = dataReadyCount;
+  fifoRestarts++;
+}
+
+void startFifo() {
+  writeMpuRegister(0x19, 1000 / FIFO_RATE_HZ - 1); // SMPLRT_DIV: 1 kHz / (1 + divider)
+  writeMpuRegister(0x37, 0x10); // INT_PIN_CFG: active high 50 us pulse, cleared by any read
+  writeMpuRegister(0x38, 0x01); // INT_ENABLE: data ready
+  writeMpuRegister(0x23, 0xF8); // FIFO_EN: temperature, gyro x/y/z, accel
+  pinMode(MPU_INT_PIN, INPUT);
+  attachInterrupt(digitalPinToInterrupt(MPU_INT_PIN), onDataReady, RISING);
+  restartFifo();
+  fifoRestarts = 0;
+  fifoStartMillis = millis() - (uint32_t)((uint64_t)sampleIndex * fifoPeriodMicros / 1000);
+}
+
+void fuseFifoFrame(const uint8_t* frame) {
+  sensors_event_t a, g;
+  a.acceleration.x = bigEndian16(frame) * accelScale;
+  a.acceleration.y = bigEndian16(frame + 2) * accelScale;
+  a.acceleration.z = bigEndian16(frame + 4) * accelScale;
+  temperature = bigEndian16(frame + 6) / 340.0f + 36.53f;
+  g.gyro.x = bigEndian16(frame + 8) * gyroScale;
+  g.gyro.y = bigEndian16(frame + 10) * gyroScale;
+  g.gyro.z = bigEndian16(frame + 12) * gyroScale;
+  elapsedTime = fifoPeriodMicros / 1000000.0f;
+  fuseEvents(a, g);
+  fifoSampleTime = fifoStartMillis + (uint32_t)((uint64_t)sampleIndex * fifoPeriodMicros / 1000);
+  sampleIndex++;
+  ${record}
+  ${raw_record}
+}
+
+// Fuse every whole frame waiting in the FIFO
+void drainFifo() {
+  uint8_t countBytes[2];
+  if (!readMpuRegisters(0x72, countBytes, 2)) {
+    return;
+  }
+  uint16_t count = (countBytes[0] << 8) | countBytes[1];
+  if (count >= MPU_FIFO_SIZE) {
+    restartFifo(); // Overflowed: old bytes were overwritten, frames are misaligned
+    return;
+  }
+  uint8_t frames[FIFO_BURST * FIFO_FRAME_BYTES];
+  for (uint16_t left = count / FIFO_FRAME_BYTES; left > 0; ) {
+    uint16_t burst = min(left, (uint16_t)FIFO_BURST);
+    if (!readMpuRegisters(0x74, frames, burst * FIFO_FRAME_BYTES)) {
+      restartFifo(); // Bytes may have been popped, the next frame boundary is unknown
+      return;
+    }
+    for (uint16_t i = 0; i < burst; i++) {
+      fuseFifoFrame(frames + i * FIFO_FRAME_BYTES);
+    }
+    left -= burst;
+  }
+}
+'''
+
+FIFO_SCHEDULE = '''// Drain the MPU6050 FIFO once FIFO_BURST samples are waiting
+if (dataReadyCount - sampleIndex >= FIFO_BURST) {
+  drainFifo();
+}'''
+
+FIFO_RECORD = 'recordSample(fifoSampleTime, roll, pitch, yaw, temperature);'
+
+# --raw-imu (with --fifo and packed frames): every frame drainFifo() reads
+# is also published unchanged to the raw topic, RAW_BATCH consecutive frames
+# per message (layout in mpu6050_fifo.py), for vibration_analytics.py. Raw
+# data is best effort: a message that cannot be published, or whose run of
+# frames a FIFO restart breaks, is dropped and counted.
+
+RAW_IMU_GLOBALS = '''
+// Raw FIFO frames for the server's vibration analysis (see mpu6050_fifo.py)
+#define RAW_BATCH ${raw_batch} // Frames per raw message
+struct __attribute__((packed)) RawHeader {
+  char magic[2];
+  uint8_t version;
+  uint8_t flags;
+  uint16_t count;
+  uint16_t rateHz;
+  uint32_t firstTimestamp;
+};
+const char* rawTopic = "v1/devices/me/telemetry/raw";
+uint8_t rawBuffer[sizeof(RawHeader) + RAW_BATCH * FIFO_FRAME_BYTES];
+uint16_t rawCount = 0;
+uint32_t rawNextIndex = 0; // Sample index the next buffered frame must have
+uint32_t rawDropped = 0;'''
+
+RAW_IMU_FUNCTIONS = '''// Buffer one frame as the sensor wrote it; publish once RAW_BATCH
+// consecutive frames are in
+void recordRawFrame(const uint8_t* frame, uint32_t index, unsigned long timestamp) {
+  if (rawCount > 0 && index != rawNextIndex) {
+    rawDropped += rawCount; // A FIFO restart broke the run, the header's timing would be wrong
+    rawCount = 0;
+  }
+  if (rawCount == 0) {
+    RawHeader header = {{'R', 'I'}, 1, 0, RAW_BATCH, FIFO_RATE_HZ, (uint32_t)timestamp};
+    memcpy(rawBuffer, &header, sizeof(header));
+  }
+  memcpy(rawBuffer + sizeof(RawHeader) + rawCount * FIFO_FRAME_BYTES, frame, FIFO_FRAME_BYTES);
+  rawCount++;
+  rawNextIndex = index + 1;
+  if (rawCount == RAW_BATCH) {
+    if (linkState != LINK_ONLINE || !mqttClient.publish(rawTopic, rawBuffer, sizeof(rawBuffer))) {
+      rawDropped += RAW_BATCH;
+    }
+    rawCount = 0;
+  }
+}
+'''
+
+RAW_IMU_RECORD = 'recordRawFrame(frame, sampleIndex - 1, fifoSampleTime);'
+
+RAW_MQTT_SETUP = '''// Default 256 bytes is too small for a frame or a raw message; never go
+// below it, downlink messages arrive through the same buffer
+mqttClient.setBufferSize(max(max(sizeof(frameBuffer), sizeof(rawBuffer)) + 64, (size_t)256));'''
+
+
+# Frames per burst: about 20 ms of samples, at most what one Wire read holds
+def fifo_burst(rate):
+    return max(1, min(rate // 50, WIRE_BUFFER // FIFO_FRAME_BYTES))
+
+
+# Fragments for --fifo. With batch_size above 1 every sample goes into
+# packed frames, otherwise telemetry stays JSON. raw_imu also publishes the
+# raw frames, ten messages a second; it needs packed frames.
+def fifo_acquisition(rate, batch_size=None, raw_imu=False):
+    if rate not in FIFO_RATES:
+        raise ValueError(f'FIFO rate must be one of {FIFO_RATES} Hz')
+    packed = (batch_size or 1) > 1
+    if raw_imu and not packed:
+        raise ValueError('raw IMU frames need packed telemetry (batch size above 1)')
+    functions = Template(FIFO_FUNCTIONS).substitute(record=FIFO_RECORD if packed else '',
+                                                    raw_record=RAW_IMU_RECORD if raw_imu else '')
+    globals_ = Template(FIFO_GLOBALS).substitute(
+        rate=rate, frame_bytes=FIFO_FRAME_BYTES, burst=fifo_burst(rate), fifo_size=FIFO_SIZE)
+    if raw_imu:
+        functions = RAW_IMU_FUNCTIONS + '\n' + functions
+        globals_ += '\n' + Template(RAW_IMU_GLOBALS).substitute(raw_batch=rate // 10)
+    fragments = {
+        'acquisition_globals': globals_,
+        'acquisition_functions': '\n'.join(line for line in functions.split('\n')
+                                           if line != '  '),
+        'i2c_setup': 'Wire.setClock(400000); // Fast-mode I2C for the FIFO bursts',
+        'imu_bandwidth': f'mpu.setFilterBandwidth({_FIFO_BANDWIDTHS[rate]});',
+        'sampling_start': 'startFifo();',
+        'orientation_schedule': FIFO_SCHEDULE,
+        'serial_log': RATE_LIMITED_SERIAL_LOG,
+        'loop_delay': '',
+    }
+    if packed:
+        fragments.update(packed_telemetry(batch_size, ring_samples=2 * rate))
+        fragments['telemetry_globals'] = fragments['telemetry_globals'].replace(
+            '\n' + BATCH_GLOBALS, '')
+        del fragments['sample_phase']
+        fragments['cloud_schedule'] = Template(HIGH_RATE_FLUSH).substitute(
+            flush_call='sendToCloud();')
+    if raw_imu:
+        fragments['mqtt_setup'] = RAW_MQTT_SETUP
+    return fragments
@@ -0,0 +1,239 @@
+# Replay engine for the generated sketch's loop(), driven by IMU traces
+#
+# Mirrors the timing of loop() in the default script_4.py sketch: every pass
+# reads the MPU6050 and fuses, redraws the OLED once displayInterval has
+# passed, queues and publishes a reading once cloudInterval has passed
+# (or records packed samples with --batch-size), prints to serial and sleeps
+# delay(10). Only pass start times are stepped one by one; the trace is then
+# sampled at those times and fused in one vectorized ComplementaryFilter call,
+# so an hour of 100 Hz data replays in well under a second. Per-pass costs are
+# rough ESP32 figures and are parameters like everything else.
+#
+#   python sketch_sim.py --hours 1
+#   python sketch_sim.py --sweep alpha=0.9,0.96,0.98 cloud_interval=500,1000
+#   python sketch_sim.py --trace log.npz --sweep display_interval=50,100,200
+
+import argparse
+import itertools
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import mqtt_protocol as mqtt
+from imu_fusion import ComplementaryFilter, complementary_filter, synthetic_recording, synthetic_truth
+from telemetry_codec import HEADER, SAMPLE_DTYPE
+
+SketchConfig = namedtuple("SketchConfig", [
+    "alpha",             # complementary filter coefficient
+    "display_interval",  # ms
+    "cloud_interval",    # ms
+    "loop_delay",        # ms, the delay() at the end of loop()
+    "batch_size",        # 1: one JSON document per cloudInterval, >1: packed frames
+    "sense_ms",          # mpu.getEvent() over I2C plus the fusion math
+    "display_ms",        # one dirty-region updateDisplay()
+    "publish_ms",        # one mqttClient.publish()
+    "serial_ms",         # the per-pass Serial.print() lines
+    "jitter_ms",         # std dev of random extra time per pass
+], defaults=(0.96, 100, 1000, 10, 1, 1.8, 6.0, 1.5, 0.3, 0.2))
+
+SimResult = namedtuple("SimResult", [
+    "config",
+    "passes",
+    "loop_hz",           # effective loop() rate
+    "roll_rmse",         # fused vs reference, degrees
+    "pitch_rmse",
+    "max_error",         # worst roll/pitch error
+    "yaw_drift",         # final |yaw - reference yaw|
+    "messages",          # MQTT publishes
+    "bytes_sent",        # MQTT PUBLISH packet bytes (no TCP/IP headers)
+    "wall_seconds",
+])
+
+# Trace: raw columns as mpu.getEvent() reports them (m/s^2, rad/s), millis()
+# timestamps, and reference roll/pitch/yaw in degrees at those timestamps
+Trace = namedtuple("Trace", ["columns", "timestamps", "reference"])
+
+
+def synthetic_trace(seconds, rate_hz=100, seed=0):
+    n = int(seconds * rate_hz)
+    *columns, timestamps = synthetic_recording(n, rate_hz, seed)
+    roll, pitch = synthetic_truth(timestamps)
+    return Trace(tuple(columns), timestamps, (roll, pitch, np.zeros(n)))
+
+
+# .npz with acc_x..gyro_z and timestamp, optionally true_roll/true_pitch/
+# true_yaw. Without those the reference is the filter run at the trace's own
+# rate, so the error reported is what the loop's slower cadence costs.
+def load_trace(path, alpha=0.96):
+    data = np.load(path)
+    columns = tuple(data[name] for name in ("acc_x", "acc_y", "acc_z", "gyro_x", "gyro_y", "gyro_z"))
+    timestamps = data["timestamp"].astype(np.float64)
+    if "true_roll" in data:
+        reference = tuple(data["true_" + name] for name in ("roll", "pitch", "yaw"))
+    else:
+        reference = complementary_filter(*columns, timestamps, alpha=alpha)
+    return Trace(columns, timestamps, reference)
+
+
+# Step loop() through time. Returns pass start times (ms) and the indices of
+# the passes that queued a cloud reading (or recorded a packed sample).
+def pass_schedule(config, duration_ms, seed=0):
+    rng = np.random.default_rng(seed)
+    shortest = config.sense_ms + config.serial_ms + config.loop_delay
+    n_max = int(duration_ms / shortest) + 2
+    jitter = np.abs(rng.normal(0, config.jitter_ms, n_max)) if config.jitter_ms else np.zeros(n_max)
+    base = config.sense_ms + jitter
+
+    sample_interval = config.cloud_interval / config.batch_size
+    starts = []
+    samples = []
+    t = 0.0
+    last_display = last_sample = 0
+    i = 0
+    while t < duration_ms:
+        starts.append(t)
+        t += base[i]
+        if int(t) - last_display >= config.display_interval:
+            t += config.display_ms
+            last_display = int(t)
+        if int(t) - last_sample >= sample_interval:
+            samples.append(i)
+            last_sample = int(t)
+            if len(samples) % config.batch_size == 0:
+                t += config.publish_ms
+        t += config.serial_ms + config.loop_delay
+        i += 1
+    return np.array(starts), np.array(samples, dtype=np.int64)
+
+
+def _json_payload(roll, pitch, yaw, timestamp):
+    return json.dumps({
+        "roll": round(roll, 2),
+        "pitch": round(pitch, 2),
+        "yaw": round(yaw, 2),
+        "temperature": 25.0,
+        "timestamp": timestamp,
+    }, separators=(",", ":"))
+
+
+# Errors skip the first settle_ms, while the filter converges from the
+# zero orientation the sketch starts with
+def simulate(config, trace, seed=0, settle_ms=5000):
+    wall = time.perf_counter()
+    duration = float(trace.timestamps[-1] - trace.timestamps[0])
+    starts, sample_passes = pass_schedule(config, duration, seed)
+
+    # The MPU6050 returns its latest sample: hold the trace at each pass start
+    millis = np.floor(starts + trace.timestamps[0])
+    index = np.searchsorted(trace.timestamps, millis, side="right") - 1
+    columns = [c[index] for c in trace.columns]
+    roll, pitch, yaw = ComplementaryFilter(alpha=config.alpha).update(*columns, millis)
+
+    reference = [np.interp(millis, trace.timestamps, r) for r in trace.reference]
+    settled = millis - millis[0] >= settle_ms
+    roll_error = (roll - reference[0])[settled]
+    pitch_error = (pitch - reference[1])[settled]
+
+    if config.batch_size == 1:
+        messages = len(sample_passes)
+        bytes_sent = sum(
+            len(mqtt.encode_publish(mqtt.TELEMETRY_TOPIC, _json_payload(
+                float(roll[i]), float(pitch[i]), float(yaw[i]), int(millis[i]))))
+            for i in sample_passes)
+    else:
+        messages = len(sample_passes) // config.batch_size
+        frame = HEADER.size + config.batch_size * SAMPLE_DTYPE.itemsize
+        bytes_sent = messages * len(mqtt.encode_publish(mqtt.PACKED_TELEMETRY_TOPIC, bytes(frame)))
+
+    return SimResult(
+        config=config,
+        passes=len(starts),
+        loop_hz=len(starts) / (duration / 1000.0),
+        roll_rmse=float(np.sqrt(np.mean(roll_error ** 2))),
+        pitch_rmse=float(np.sqrt(np.mean(pitch_error ** 2))),
+        max_error=float(max(np.abs(roll_error).max(), np.abs(pitch_error).max())),
+        yaw_drift=float(abs(yaw[-1] - reference[2][-1])),
+        messages=messages,
+        bytes_sent=bytes_sent,
+        wall_seconds=time.perf_counter() - wall,
+    )
+
+
+# Sweep workers build the trace once each instead of pickling it per task
+_trace = None
+
+
+def _init_worker(trace_args):
+    global _trace
+    _trace = _build_trace(*trace_args)
+
+
+def _run(config):
+    return simulate(config, _trace)
+
+
+def _build_trace(path, hours, seed):
+    if path:
+        return load_trace(path)
+    return synthetic_trace(hours * 3600, seed=seed)
+
+
+def sweep(base, grid, trace_args, workers=None):
+    names = list(grid)
+    configs = [base._replace(**dict(zip(names, values)))
+               for values in itertools.product(*(grid[name] for name in names))]
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(trace_args,)) as pool:
+        return list(pool.map(_run, configs))
+
+
+def _parse_grid(items):
+    grid = {}
+    for item in items:
+        name, _, values = item.partition("=")
+        if name not in SketchConfig._fields:
+            raise SystemExit(f"unknown parameter {name!r}, expected one of {SketchConfig._fields}")
+        kind = type(SketchConfig._field_defaults[name])
+        grid[name] = [kind(v) for v in values.split(",")]
+    return grid
+
+
+def _print_results(results, fields):
+    header = "".join(f"{name:>17s}" for name in fields)
+    print(header + "  loop Hz  roll rmse  pitch rmse  max err  yaw drift   msgs     bytes")
+    for r in results:
+        values = "".join(f"{getattr(r.config, name):>17}" for name in fields)
+        print(f"{values} {r.loop_hz:8.1f} {r.roll_rmse:10.3f} {r.pitch_rmse:11.3f} "
+              f"{r.max_error:8.2f} {r.yaw_drift:10.2f} {r.messages:6d} {r.bytes_sent:9d}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay IMU traces through the sketch's loop()")
+    parser.add_argument("--trace", help=".npz trace (acc_x..gyro_z, timestamp); default synthetic")
+    parser.add_argument("--hours", type=float, default=1.0, help="length of the synthetic trace")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sweep", nargs="+", metavar="NAME=V1,V2",
+                        help="run every combination of these parameter values in parallel")
+    parser.add_argument("--workers", type=int)
+    for name, default in SketchConfig._field_defaults.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=type(default), default=default)
+    args = parser.parse_args()
+
+    base = SketchConfig(**{name: getattr(args, name) for name in SketchConfig._fields})
+    trace_args = (args.trace, args.hours, args.seed)
+    start = time.perf_counter()
+    if args.sweep:
+        grid = _parse_grid(args.sweep)
+        results = sweep(base, grid, trace_args, args.workers)
+        results.sort(key=lambda r: r.roll_rmse + r.pitch_rmse)
+        _print_results(results, list(grid))
+        print(f"{len(results)} runs in {time.perf_counter() - start:.2f} s")
+    else:
+        trace = _build_trace(*trace_args)
+        result = simulate(base, trace)
+        _print_results([result], [])
+        duration = (trace.timestamps[-1] - trace.timestamps[0]) / 1000.0
+        print(f"replayed {duration / 3600:.2f} h of trace in {result.wall_seconds:.2f} s "
+              f"({duration / result.wall_seconds:.0f}x real time)")
@@ -0,0 +1,289 @@
+# SSD1306 framebuffer and I2C bus emulator for the sketches' OLED code
+#
+# Framebuffer mirrors the Adafruit_GFX calls updateDisplay() makes (classic
+# 5x7 glcd font at text size 1, transparent text, lines and filled rects) on
+# the same page-major buffer Adafruit_SSD1306 keeps. Panel decodes the I2C
+# writes the driver sends, keeps the panel's GDDRAM and counts bytes on the
+# bus. The __main__ block replays a fused IMU recording through the old
+# clear-and-redraw updateDisplay() and the dirty-region renderer the
+# generators now emit, and compares the bus traffic.
+
+import numpy as np
+
+SCREEN_WIDTH = 128
+SCREEN_HEIGHT = 64
+
+COLUMNADDR = 0x21
+PAGEADDR = 0x22
+COMMAND_STREAM = 0x00
+DATA_STREAM = 0x40
+
+# Data bytes per I2C write, matching the Adafruit driver on an ESP32 (128 byte
+# Wire buffer, one byte of it taken by the control byte)
+WIRE_CHUNK = 127
+
+# Adafruit glcdfont, ASCII 0x20-0x7E, five column bytes per glyph (bit 0 at
+# the top). Other bytes, such as the UTF-8 degree sign, draw as blanks.
+GLCD_FONT = bytes.fromhex(
+    "0000000000" "00005f0000" "0007000700" "147f147f14" "242a7f2a12" "2313086462"
+    "3649562050" "0008070300" "001c224100" "0041221c00" "2a1c7f1c2a" "08083e0808"
+    "0080703000" "0808080808" "0000606000" "2010080402" "3e5149453e" "00427f4000"
+    "7249494946" "2141494d33" "1814127f10" "2745454539" "3c4a494931" "4121110907"
+    "3649494936" "464949291e" "0000140000" "0040340000" "0008142241" "1414141414"
+    "0041221408" "0201590906" "3e415d594e" "7c1211127c" "7f49494936" "3e41414122"
+    "7f4141413e" "7f49494941" "7f09090901" "3e41415173" "7f0808087f" "00417f4100"
+    "2040413f01" "7f08142241" "7f40404040" "7f021c027f" "7f0408107f" "3e4141413e"
+    "7f09090906" "3e4151215e" "7f09192946" "2649494932" "03017f0103" "3f4040403f"
+    "1f2040201f" "3f4038403f" "6314081463" "0304780403" "61594d4943" "007f414141"
+    "0204081020" "004141417f" "0402010204" "4040404040" "0003070800" "2054547840"
+    "7f28444438" "3844444428" "384444287f" "3854545418" "00087e0902" "18a4a49c78"
+    "7f08040478" "00447d4000" "2040403d00" "7f10284400" "00417f4000" "7c04780478"
+    "7c08040478" "3844444438" "fc18242418" "18242418fc" "7c08040408" "4854545424"
+    "04043f4424" "3c4040207c" "1c2040201c" "3c4030403c" "4428102844" "4c9090907c"
+    "4464544c44" "0008364100" "0000770000" "0041360800" "0201020402"
+)
+
+
+def _glyph(code):
+    if 0x20 <= code <= 0x7E:
+        offset = (code - 0x20) * 5
+        return GLCD_FONT[offset:offset + 5]
+    return bytes(5)
+
+
+# The 1 KB buffer Adafruit_SSD1306 draws into: byte [page, x] holds pixels
+# (x, 8 * page) to (x, 8 * page + 7), bit 0 at the top
+class Framebuffer:
+    def __init__(self, width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+        self.width = width
+        self.height = height
+        self.buffer = np.zeros((height // 8, width), dtype=np.uint8)
+
+    def clear(self):
+        self.buffer[:] = 0
+
+    def pixel(self, x, y, on=True):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            if on:
+                self.buffer[y // 8, x] |= 1 << (y & 7)
+            else:
+                self.buffer[y // 8, x] &= ~(1 << (y & 7)) & 0xFF
+
+    def fill_rect(self, x, y, w, h, on=True):
+        for row in range(max(y, 0), min(y + h, self.height)):
+            for column in range(max(x, 0), min(x + w, self.width)):
+                self.pixel(column, row, on)
+
+    def hline(self, x, y, w):
+        self.fill_rect(x, y, w, 1)
+
+    # print() at text size 1 with a transparent background, returns the cursor
+    def text(self, x, y, text):
+        for code in text.encode():
+            if code == ord("\n"):
+                x, y = 0, y + 8
+                continue
+            if x + 6 > self.width:  # Adafruit_GFX wraps by default
+                x, y = 0, y + 8
+            for i, column in enumerate(_glyph(code)):
+                for j in range(8):
+                    if column >> j & 1:
+                        self.pixel(x + i, y + j)
+            x += 6
+        return x, y
+
+
+# The panel end of the bus: decodes command and data writes into GDDRAM
+# (horizontal addressing, as Adafruit_SSD1306::begin() configures it)
+class Panel:
+    def __init__(self, width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+        self.gddram = np.zeros((height // 8, width), dtype=np.uint8)
+        self.columns = (0, width - 1)
+        self.pages = (0, height // 8 - 1)
+        self.column = 0
+        self.page = 0
+        self._pending = []
+        self.bytes = 0
+        self.transactions = 0
+
+    # One Wire transaction after the address byte: control byte + payload
+    def write(self, data):
+        self.transactions += 1
+        self.bytes += 1 + len(data)  # address byte
+        control, payload = data[0], data[1:]
+        if control == COMMAND_STREAM:
+            self._commands(payload)
+        elif control == DATA_STREAM:
+            for value in payload:
+                self._data(value)
+
+    # Arguments may arrive in a later transaction, as display() sends the
+    # last COLUMNADDR argument on its own
+    def _commands(self, payload):
+        for value in payload:
+            self._pending.append(value)
+            command = self._pending[0]
+            if command not in (COLUMNADDR, PAGEADDR):
+                self._pending.clear()
+            elif len(self._pending) == 3:
+                _, start, end = self._pending
+                self._pending.clear()
+                if command == COLUMNADDR:
+                    self.columns = (start, end)
+                    self.column = start
+                else:
+                    # Adafruit sends 0xFF as "last page"; the panel clamps it
+                    self.pages = (start, min(end, self.gddram.shape[0] - 1))
+                    self.page = start
+
+    def _data(self, value):
+        self.gddram[self.page, self.column] = value
+        if self.column < self.columns[1]:
+            self.column += 1
+        else:
+            self.column = self.columns[0]
+            self.page = self.page + 1 if self.page < self.pages[1] else self.pages[0]
+
+    # Seconds the bus was busy: 9 clocks a byte (8 bits + ACK), 2 for start/stop
+    def bus_seconds(self, clock_hz):
+        return (9 * self.bytes + 2 * self.transactions) / clock_hz
+
+
+# Adafruit_SSD1306::display(): full-screen window, then the whole buffer
+def push_full(framebuffer, panel, chunk=WIRE_CHUNK):
+    panel.write(bytes([COMMAND_STREAM, PAGEADDR, 0, 0xFF, COLUMNADDR, 0]))
+    panel.write(bytes([COMMAND_STREAM, framebuffer.width - 1]))
+    data = framebuffer.buffer.tobytes()
+    for start in range(0, len(data), chunk):
+        panel.write(bytes([DATA_STREAM]) + data[start:start + chunk])
+
+
+# pushDirtyPages(): per page, only the span of columns that differ from what
+# the panel shows. Returns the number of pages sent.
+def push_dirty(framebuffer, shown, panel, chunk=WIRE_CHUNK):
+    sent = 0
+    for page in range(framebuffer.buffer.shape[0]):
+        changed = np.flatnonzero(framebuffer.buffer[page] != shown[page])
+        if not len(changed):
+            continue
+        first, last = int(changed[0]), int(changed[-1])
+        panel.write(bytes([COMMAND_STREAM, COLUMNADDR, first, last, PAGEADDR, page, page]))
+        data = framebuffer.buffer[page, first:last + 1].tobytes()
+        for start in range(0, len(data), chunk):
+            panel.write(bytes([DATA_STREAM]) + data[start:start + chunk])
+        shown[page, first:last + 1] = framebuffer.buffer[page, first:last + 1]
+        sent += 1
+    return sent
+
+
+# Layout of the full sketch's screen (script_4.py): static labels and the
+# (x, y, w, h) fields updateDisplay() redraws
+TITLE = "Position Monitor"
+LABELS = ((0, 15, "Roll:  "), (0, 25, "Pitch: "), (0, 35, "Yaw:   "))
+FIELDS = {
+    "roll": (42, 15, 86, 8),
+    "pitch": (42, 25, 86, 8),
+    "yaw": (42, 35, 86, 8),
+    "wifi": (0, 50, 128, 7),
+    "cloud": (0, 57, 128, 7),
+}
+
+
+def draw_chrome(framebuffer):
+    framebuffer.clear()
+    framebuffer.text(0, 0, TITLE)
+    framebuffer.hline(0, 10, framebuffer.width)
+    for x, y, label in LABELS:
+        framebuffer.text(x, y, label)
+
+
+def screen_texts(roll, pitch, yaw, wifi=True, cloud=True):
+    return {
+        "roll": f"{roll:.1f}°",
+        "pitch": f"{pitch:.1f}°",
+        "yaw": f"{yaw:.1f}°",
+        "wifi": "WiFi: OK" if wifi else "WiFi: DISCONNECTED",
+        "cloud": "Cloud: CONNECTED" if cloud else "Cloud: OFFLINE",
+    }
+
+
+# The old updateDisplay(): clear, draw everything, push 1 KB
+class FullRedrawRenderer:
+    def __init__(self, panel):
+        self.panel = panel
+        self.framebuffer = Framebuffer()
+
+    def update(self, texts):
+        draw_chrome(self.framebuffer)
+        for name, text in texts.items():
+            x, y, _, _ = FIELDS[name]
+            self.framebuffer.text(x, y, text)
+        push_full(self.framebuffer, self.panel)
+
+
+# drawDisplayChrome() once, then drawField() + pushDirtyPages() per refresh
+class DirtyRenderer:
+    def __init__(self, panel):
+        self.panel = panel
+        self.framebuffer = Framebuffer()
+        draw_chrome(self.framebuffer)
+        push_full(self.framebuffer, panel)
+        self.shown = self.framebuffer.buffer.copy()
+        self.texts = dict.fromkeys(FIELDS, "")
+        self.skipped = 0
+
+    def update(self, texts):
+        dirty = False
+        for name, text in texts.items():
+            if self.texts[name] == text:
+                continue
+            self.texts[name] = text
+            x, y, w, h = FIELDS[name]
+            self.framebuffer.fill_rect(x, y, w, h, on=False)
+            self.framebuffer.text(x, y, text)
+            dirty = True
+        if not dirty:
+            self.skipped += 1
+            return
+        push_dirty(self.framebuffer, self.shown, self.panel)
+
+
+if __name__ == "__main__":
+    from imu_fusion import complementary_filter, synthetic_recording
+
+    seconds = 60
+    refresh_hz = 10  # displayInterval = 100 ms
+    n = seconds * 100
+    moving = complementary_filter(*synthetic_recording(n))
+
+    # Device at rest: gravity on Z plus sensor noise only
+    rng = np.random.default_rng(1)
+    still_sensors = [rng.normal(0, 0.05, n).astype(np.float32) for _ in range(2)]
+    still_sensors.append((9.81 + rng.normal(0, 0.05, n)).astype(np.float32))
+    still_sensors += [rng.normal(0, 0.002, n).astype(np.float32) for _ in range(3)]
+    still = complementary_filter(*still_sensors, np.arange(n) * 10.0)
+
+    for scenario, (roll, pitch, yaw) in (("moving", moving), ("still", still)):
+        step = 100 // refresh_hz
+        frames = [screen_texts(roll[i], pitch[i], yaw[i], cloud=not 200 <= i < 400)
+                  for i in range(0, n, step)]
+
+        full_panel, dirty_panel = Panel(), Panel()
+        full, dirty = FullRedrawRenderer(full_panel), DirtyRenderer(dirty_panel)
+        setup_bytes, setup_transactions = dirty_panel.bytes, dirty_panel.transactions
+        dirty_panel.bytes = dirty_panel.transactions = 0
+        for texts in frames:
+            full.update(texts)
+            dirty.update(texts)
+            # The dirty renderer must leave the panel showing the same image
+            assert np.array_equal(dirty_panel.gddram, full.framebuffer.buffer)
+
+        print(f"{scenario}: {len(frames)} refreshes over {seconds} s "
+              f"({dirty.skipped} skipped by the dirty renderer, "
+              f"{setup_bytes} bytes once for the chrome)")
+        for name, panel in (("clear + redraw", full_panel), ("dirty regions", dirty_panel)):
+            print(f"  {name:15s} {panel.bytes / seconds:8.0f} B/s in "
+                  f"{panel.transactions / seconds:5.1f} writes/s, bus busy "
+                  f"{panel.bus_seconds(100_000) / seconds * 100:5.1f}% at 100 kHz, "
+                  f"{panel.bus_seconds(400_000) / seconds * 100:5.1f}% at 400 kHz")
+        print(f"  reduction {full_panel.bytes / max(dirty_panel.bytes, 1):.1f}x")
@@ -0,0 +1,148 @@
+# Packed binary telemetry frame and its NumPy codec
+#
+# Replaces the per-sample JSON built by sendToCloud(). One frame carries a
+# batch of samples from one device, all little-endian (the ESP32's native
+# byte order, so the sketch can memcpy its structs straight into the buffer):
+#
+#   header   magic "PM" | version u8 | flags u8 | count u16 | device id u32 | base millis u32
+#   samples  count x (dt u16 | roll i16 | pitch i16 | yaw i16 | temperature i16)
+#
+# dt is milliseconds since the previous sample (0 for the first one), angles
+# and temperature are fixed point in hundredths, matching the 0.01 rounding
+# sendToCloud() already applies. Yaw is wrapped to [-180, 180) so it fits the
+# int16 range. A frame decodes into arrays with a single np.frombuffer call.
+
+import struct
+
+import numpy as np
+
+FRAME_MAGIC = b"PM"
+FRAME_VERSION = 1
+HEADER = struct.Struct("<2sBBHII")
+
+SAMPLE_DTYPE = np.dtype([
+    ("dt", "<u2"),
+    ("roll", "<i2"),
+    ("pitch", "<i2"),
+    ("yaw", "<i2"),
+    ("temperature", "<i2"),
+])
+
+SCALE = 100
+ANGLE_FIELDS = ("roll", "pitch", "yaw", "temperature")
+
+
+class FrameError(ValueError):
+    pass
+
+
+def wrap_angle(angle):
+    return (np.asarray(angle) + 180.0) % 360.0 - 180.0
+
+
+def _fixed_point(values):
+    scaled = np.rint(np.asarray(values, dtype=np.float64) * SCALE)
+    return np.clip(scaled, -32768, 32767).astype("<i2")
+
+
+# Columns -> one frame. timestamps are millis() values; gaps between
+# consecutive samples must fit in 16 bits (about 65 s).
+def encode_frame(device_id, timestamps, roll, pitch, yaw, temperature):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    n = len(timestamps)
+    if n > 0xFFFF:
+        raise FrameError(f"{n} samples do not fit in one frame")
+    deltas = np.diff(timestamps, prepend=timestamps[:1])
+    if n and (deltas.min() < 0 or deltas.max() > 0xFFFF):
+        raise FrameError("sample spacing must be between 0 and 65535 ms")
+
+    samples = np.empty(n, dtype=SAMPLE_DTYPE)
+    samples["dt"] = deltas
+    samples["roll"] = _fixed_point(roll)
+    samples["pitch"] = _fixed_point(pitch)
+    samples["yaw"] = _fixed_point(wrap_angle(yaw))
+    samples["temperature"] = _fixed_point(temperature)
+
+    base = int(timestamps[0]) & 0xFFFFFFFF if n else 0
+    return HEADER.pack(FRAME_MAGIC, FRAME_VERSION, 0, n, device_id, base) + samples.tobytes()
+
+
+# Frame -> (device_id, columns). Columns are a timestamp int64 array and
+# float32 arrays for roll, pitch, yaw and temperature.
+def decode_frame(frame):
+    if len(frame) < HEADER.size:
+        raise FrameError("frame shorter than its header")
+    magic, version, _, count, device_id, base = HEADER.unpack_from(frame)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise FrameError(f"not a version {FRAME_VERSION} telemetry frame")
+    if len(frame) != HEADER.size + count * SAMPLE_DTYPE.itemsize:
+        raise FrameError(f"frame length {len(frame)} does not match {count} samples")
+
+    # Every field is 16 bits wide, so the samples decode as one (count, 5) block
+    words = np.frombuffer(frame, dtype="<i2", count=count * 5, offset=HEADER.size).reshape(count, 5)
+    values = words[:, 1:] * np.float32(1.0 / SCALE)
+    timestamps = np.cumsum(words[:, 0].view("<u2"), dtype=np.int64)
+    timestamps += base
+    columns = {"timestamp": timestamps}
+    for i, name in enumerate(ANGLE_FIELDS):
+        columns[name] = values[:, i]
+    return device_id, columns
+
+
+# Decode the "PM <hex>" frame lines the Wokwi sketch prints in --sample-rate
+# mode; other serial output is skipped. Yields (device_id, columns).
+def frames_from_serial(lines):
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode(errors="replace")
+        if line.startswith("PM "):
+            yield decode_frame(bytes.fromhex(line[3:].strip()))
+
+
+if __name__ == "__main__":
+    import json
+    import time
+
+    from imu_fusion import complementary_filter, synthetic_recording
+
+    n = 100_000
+    batch = 100  # one second of samples at 100 Hz
+    *sensors, timestamps = synthetic_recording(n)
+    roll, pitch, yaw = complementary_filter(*sensors, timestamps)
+    temperature = np.full(n, 25.0)
+
+    # What sendToCloud() publishes today: one JSON document per sample
+    messages = [json.dumps({
+        "roll": round(float(roll[i]), 2),
+        "pitch": round(float(pitch[i]), 2),
+        "yaw": round(float(yaw[i]), 2),
+        "temperature": 25.0,
+        "timestamp": int(timestamps[i]),
+    }, separators=(",", ":")).encode() for i in range(n)]
+
+    frames = [encode_frame(1, timestamps[i:i + batch], roll[i:i + batch], pitch[i:i + batch],
+                           yaw[i:i + batch], temperature[i:i + batch])
+              for i in range(0, n, batch)]
+
+    start = time.perf_counter()
+    for message in messages:
+        json.loads(message)
+    json_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for frame in frames:
+        decode_frame(frame)
+    frame_seconds = time.perf_counter() - start
+
+    json_bytes = sum(map(len, messages))
+    frame_bytes = sum(map(len, frames))
+    print(f"JSON:   {json_bytes / n:6.1f} bytes/sample, "
+          f"decode {json_seconds / n * 1e9:7.1f} ns/sample")
+    print(f"Packed: {frame_bytes / n:6.1f} bytes/sample, "
+          f"decode {frame_seconds / n * 1e9:7.1f} ns/sample ({batch} samples/frame)")
+    print(f"Bandwidth reduction: {json_bytes / frame_bytes:.1f}x, "
+          f"decode speedup: {json_seconds / frame_seconds:.1f}x")
+
+    _, decoded = decode_frame(frames[0])
+    assert np.array_equal(decoded["timestamp"], timestamps[:batch].astype(np.int64))
+    assert np.max(np.abs(decoded["roll"] - roll[:batch])) <= 0.005 + 1e-6
@@ -0,0 +1,349 @@
+# Streaming export of stored telemetry: gzip CSV, Parquet or NPZ
+#
+# export() writes one device's [start, end) range from a TelemetryStore to a
+# binary file object, chunk_rows rows at a time, straight from the store's
+# memory-mapped columns, so memory stays flat whether the range is a minute or
+# a year. The row count is fixed when the export starts; rows appended while
+# it runs are left for the next one.
+#
+#   csv.gz   header line, then one line per reading (floats to float32
+#            precision, %.7g), through gzip at compresslevel 1
+#   parquet  one row group per chunk (needs pyarrow)
+#   npz      the numpy.savez layout, one uncompressed <column>.npy per column,
+#            each streamed in a pass over that column alone
+#
+# ExportService runs exports to files on a thread pool (the work is file I/O,
+# zlib and numpy, which release the GIL), so several devices export in
+# parallel; ExportJob.cancel() stops one at its next chunk and removes the
+# partial file. Files are written as <path>.part and renamed when complete.
+# chart_api.py serves the same streams over HTTP at /api/export.
+#
+#   python telemetry_export.py --store data --device esp32-01 --out esp32-01.csv.gz
+#   python telemetry_export.py --store data --device esp32-01 --device esp32-02 \
+#       --format npz --out exports/ --start 1750000000000 --end 1750086400000
+#   python telemetry_export.py --benchmark                2M rows, every format
+
+import argparse
+import gzip
+import os
+import threading
+import time
+import zipfile
+from collections import namedtuple
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+import numpy as np
+
+FORMATS = ("csv.gz", "parquet", "npz")
+CONTENT_TYPES = {"csv.gz": "application/gzip", "parquet": "application/vnd.apache.parquet",
+                 "npz": "application/zip"}
+CSV_BATCH = 4096
+
+ExportResult = namedtuple("ExportResult", ["device", "path", "format", "rows", "bytes", "seconds"])
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+# The formats whose dependencies are installed
+def available_formats():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return tuple(format for format in FORMATS if format != "parquet")
+    return FORMATS
+
+
+# Readings stored in [start, end), counted without reading them
+def count_rows(store, device, start=None, end=None):
+    return sum(len(part["timestamp"]) for part in store.scan(device, start, end, ["timestamp"]))
+
+
+# The first limit rows of [start, end) as dicts of at most chunk_rows rows,
+# each column a slice of the store's memmaps. Checks cancel before each chunk.
+def iter_chunks(store, device, start, end, names, chunk_rows, limit, cancel=None):
+    remaining = limit
+    for part in store.scan(device, start, end, names):
+        rows = min(len(part[names[0]]), remaining)
+        for offset in range(0, rows, chunk_rows):
+            if cancel is not None and cancel.is_set():
+                raise ExportCancelled(device)
+            stop = min(offset + chunk_rows, rows)
+            yield {name: part[name][offset:stop] for name in names}
+        remaining -= rows
+        if remaining == 0:
+            return
+
+
+# Formatting goes through Python objects, CSV_BATCH rows at a time
+def _write_csv(out, chunks, names, dtypes, progress):
+    line = ",".join("%d" if dtypes[name].kind in "iu" else "%.7g" for name in names)
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=1, mtime=0) as z:
+        z.write((",".join(names) + "\n").encode())
+        for chunk in chunks:
+            rows = len(chunk[names[0]])
+            for offset in range(0, rows, CSV_BATCH):
+                batch = zip(*(chunk[name][offset:offset + CSV_BATCH].tolist() for name in names))
+                z.write(("\n".join([line % row for row in batch]) + "\n").encode())
+            progress(rows)
+
+
+def _write_parquet(out, chunks, names, dtypes, progress):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(name, pa.from_numpy_dtype(dtypes[name])) for name in names])
+    with pq.ParquetWriter(out, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.table({name: np.asarray(chunk[name]) for name in names},
+                                        schema=schema))
+            progress(len(chunk[names[0]]))
+
+
+# np.savez needs every array in memory, so each .npy member gets its header
+# for the known row count and then its column streamed in
+def _write_npz(out, column_chunks, names, dtypes, rows, progress):
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name in names:
+            with archive.open(name + ".npy", "w", force_zip64=True) as member:
+                np.lib.format.write_array_header_1_0(member, {
+                    "descr": np.lib.format.dtype_to_descr(dtypes[name]),
+                    "fortran_order": False, "shape": (rows,)})
+                for chunk in column_chunks(name):
+                    member.write(memoryview(np.ascontiguousarray(chunk[name])))
+                    if name == names[-1]:
+                        progress(len(chunk[name]))
+
+
+# Stream device's [start, end) to the binary file object out. progress, if
+# given, is called with the number of rows each chunk finished. Returns the
+# number of rows exported; raises ExportCancelled once cancel is set.
+def export(store, device, out, format="csv.gz", start=None, end=None, columns=None,
+           chunk_rows=65536, cancel=None, progress=None):
+    if format not in FORMATS:
+        raise ValueError(f"format must be one of {FORMATS}")
+    dtypes = dict(store.schema)
+    names = list(columns) if columns is not None else [name for name, _ in store.schema]
+    unknown = set(names) - set(dtypes)
+    if unknown:
+        raise ValueError(f"unknown columns {sorted(unknown)}")
+    rows = count_rows(store, device, start, end)
+    progress = progress or (lambda done: None)
+
+    if format == "npz":
+        _write_npz(out, lambda name: iter_chunks(store, device, start, end, [name], chunk_rows,
+                                                 rows, cancel),
+                   names, dtypes, rows, progress)
+    else:
+        writer = _write_csv if format == "csv.gz" else _write_parquet
+        writer(out, iter_chunks(store, device, start, end, names, chunk_rows, rows, cancel),
+               names, dtypes, progress)
+    return rows
+
+
+class ExportJob:
+    def __init__(self, device, path, format):
+        self.device = device
+        self.path = path
+        self.format = format
+        self.rows_done = 0
+        self.cancelled = threading.Event()
+        self.future = None
+
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+    def done(self):
+        return self.future.done()
+
+    # ExportResult; raises ExportCancelled if the job was cancelled
+    def result(self, timeout=None):
+        try:
+            return self.future.result(timeout)
+        except CancelledError:
+            raise ExportCancelled(self.device) from None
+
+
+# Exports to files on a pool of worker threads
+class ExportService:
+    def __init__(self, store, workers=4, chunk_rows=65536):
+        self.store = store
+        self.chunk_rows = chunk_rows
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="export")
+
+    def submit(self, device, path, format="csv.gz", start=None, end=None, columns=None):
+        job = ExportJob(device, path, format)
+        job.future = self._pool.submit(self._run, job, start, end, columns)
+        return job
+
+    # One job per device into directory, named <device>.<format>
+    def submit_devices(self, devices, directory, format="csv.gz", start=None, end=None,
+                       columns=None):
+        os.makedirs(directory, exist_ok=True)
+        return {device: self.submit(device, os.path.join(directory, f"{device}.{format}"),
+                                    format, start, end, columns)
+                for device in devices}
+
+    def _run(self, job, start, end, columns):
+        began = time.perf_counter()
+        partial = job.path + ".part"
+
+        def progress(rows):
+            job.rows_done += rows
+
+        try:
+            with open(partial, "wb") as out:
+                rows = export(self.store, job.device, out, job.format, start, end, columns,
+                              self.chunk_rows, job.cancelled, progress)
+            os.replace(partial, job.path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return ExportResult(job.device, job.path, job.format, rows, os.path.getsize(job.path),
+                            time.perf_counter() - began)
+
+    def close(self, cancel=False):
+        self._pool.shutdown(wait=True, cancel_futures=cancel)
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    import tracemalloc
+
+    from telemetry_store import TelemetryStore
+
+    parser = argparse.ArgumentParser(description="Streaming telemetry export")
+    parser.add_argument("--store", help="TelemetryStore root")
+    parser.add_argument("--device", action="append", help="device to export (repeatable)")
+    parser.add_argument("--format", choices=FORMATS, default="csv.gz")
+    parser.add_argument("--start", type=int, help="first timestamp, ms")
+    parser.add_argument("--end", type=int, help="end timestamp (exclusive), ms")
+    parser.add_argument("--out", help="output file, or directory with several devices")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--benchmark", action="store_true",
+                        help="time every format on synthetic data instead")
+    parser.add_argument("--rows", type=int, default=2_000_000, help="benchmark rows")
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        if not (args.store and args.device and args.out):
+            parser.error("give --store, --device and --out, or --benchmark")
+        service = ExportService(TelemetryStore(args.store), args.workers)
+        if len(args.device) == 1 and not os.path.isdir(args.out):
+            jobs = {args.device[0]: service.submit(args.device[0], args.out, args.format,
+                                                   args.start, args.end)}
+        else:
+            jobs = service.submit_devices(args.device, args.out, args.format, args.start, args.end)
+        try:
+            for device, job in jobs.items():
+                result = job.result()
+                print(f"{device}: {result.rows:,} rows, {result.bytes / 1e6:.1f} MB -> "
+                      f"{result.path} in {result.seconds:.1f} s")
+        except KeyboardInterrupt:
+            for job in jobs.values():
+                job.cancel()
+        service.close(cancel=True)
+        raise SystemExit
+
+    # 1 kHz of every schema column, in segments of 256k rows
+    root = tempfile.mkdtemp(prefix="telemetry-export-")
+    store = TelemetryStore(os.path.join(root, "store"), segment_rows=1 << 18)
+    t0 = 1_750_000_000_000
+    rng = np.random.default_rng(0)
+    for offset in range(0, args.rows, 500_000):
+        n = min(500_000, args.rows - offset)
+        columns = {name: rng.normal(0, 30, n).astype(dtype)
+                   for name, dtype in store.schema if name != "timestamp"}
+        columns["timestamp"] = t0 + offset + np.arange(n)
+        store.append("device-0", columns)
+    stored = sum(os.path.getsize(os.path.join(dirpath, name))
+                 for dirpath, _, names in os.walk(os.path.join(root, "store")) for name in names)
+
+    # Reference: copying the column files
+    began = time.perf_counter()
+    shutil.copytree(os.path.join(root, "store"), os.path.join(root, "copy"))
+    copy_seconds = time.perf_counter() - began
+    print(f"{args.rows:,} rows, {stored / 1e6:.0f} MB stored; plain file copy "
+          f"{stored / 1e6 / copy_seconds:.0f} MB/s")
+
+    formats = available_formats()
+    if "parquet" not in formats:
+        print("pyarrow is not installed, skipping parquet")
+
+    service = ExportService(store)
+    for format in formats:
+        path = os.path.join(root, f"device-0.{format}")
+        result = service.submit("device-0", path, format).result()
+        print(f"{format:8s} {result.rows:,} rows in {result.seconds:.2f} s: "
+              f"{result.rows / result.seconds / 1e6:.2f} M rows/s, "
+              f"{stored / 1e6 / result.seconds:.0f} MB/s of stored data, "
+              f"{result.bytes / 1e6:.0f} MB written")
+        assert result.rows == args.rows
+
+    # Every format reads back as what was stored
+    expected = store.read("device-0", t0 + 1000, t0 + 3000)
+    exported = {}
+    for format in formats:
+        path = os.path.join(root, f"part.{format}")
+        with open(path, "wb") as out:
+            export(store, "device-0", out, format, t0 + 1000, t0 + 3000)
+        if format == "npz":
+            with np.load(path) as npz:
+                exported[format] = {name: npz[name] for name in npz.files}
+        elif format == "csv.gz":
+            with gzip.open(path, "rt") as f:
+                table = np.genfromtxt(f, delimiter=",", names=True, dtype=None)
+            exported[format] = {name: table[name] for name in table.dtype.names}
+        else:
+            import pyarrow.parquet as pq
+
+            table = pq.read_table(path)
+            exported[format] = {name: column.to_numpy()
+                                for name, column in zip(table.column_names, table.columns)}
+    for format, columns in exported.items():
+        assert list(columns) == list(expected), format
+        for name, values in expected.items():
+            assert np.allclose(columns[name], values, rtol=1e-6, atol=0), (format, name)
+    print("exports read back as stored")
+
+    # Memory stays flat: exporting 1/16 of the rows and a half peak alike
+    peaks = []
+    sizes = (args.rows // 16, args.rows // 2)
+    for rows in sizes:
+        tracemalloc.start()
+        with open(os.devnull, "wb") as out:
+            export(store, "device-0", out, "npz", t0, t0 + rows)
+            export(store, "device-0", out, "csv.gz", t0, t0 + rows)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    print(f"peak Python memory {peaks[0] / 1e6:.1f} MB for {sizes[0]:,} rows, "
+          f"{peaks[1] / 1e6:.1f} MB for {sizes[1]:,}")
+    assert peaks[1] < peaks[0] * 1.5
+
+    # Parallel exports of four devices; cancelling one removes its partial file
+    for i in range(1, 4):
+        for offset in range(0, args.rows, 500_000):
+            n = min(500_000, args.rows - offset)
+            store.append(f"device-{i}", {"timestamp": t0 + offset + np.arange(n),
+                                         "roll": rng.normal(0, 30, n)})
+    began = time.perf_counter()
+    jobs = service.submit_devices([f"device-{i}" for i in range(4)],
+                                  os.path.join(root, "parallel"), "npz")
+    jobs["device-3"].cancel()
+    cancelled = False
+    for device, job in jobs.items():
+        try:
+            job.result()
+        except ExportCancelled:
+            assert device == "device-3"
+            cancelled = True
+    print(f"4 devices in parallel, one cancelled: {time.perf_counter() - began:.2f} s")
+    assert cancelled
+    assert sorted(os.listdir(os.path.join(root, "parallel"))) == [
+        "device-0.npz", "device-1.npz", "device-2.npz"]
+    service.close()
+    shutil.rmtree(root)
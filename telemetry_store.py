@@ -0,0 +1,340 @@
+# Columnar, memory-mapped time-series store for device telemetry
+#
+# Layout on disk, one directory per device:
+#
+#   <root>/<device>/manifest.json          schema + per-segment row counts and time bounds
+#   <root>/<device>/seg-000000/<column>    append-only fixed-width column files
+#   <root>/<device>/seg-000000/time.idx    first timestamp of every index_stride rows
+#
+# Segments hold at most segment_rows rows. Columns are raw little-endian arrays
+# so readers map them with numpy.memmap and slice without copying. Appends must
+# be in timestamp order per device (sort upstream), which keeps every timestamp
+# column sorted and lets a range query binary search the sparse time index
+# first and then only the index_stride rows around each end of the range.
+
+import json
+import os
+import threading
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+# Timestamps are int64 milliseconds: float32 cannot represent epoch ms.
+TELEMETRY_SCHEMA = (
+    ("timestamp", "<i8"),
+    ("roll", "<f4"),
+    ("pitch", "<f4"),
+    ("yaw", "<f4"),
+    ("temperature", "<f4"),
+    ("acc_x", "<f4"),
+    ("acc_y", "<f4"),
+    ("acc_z", "<f4"),
+    ("gyro_x", "<f4"),
+    ("gyro_y", "<f4"),
+    ("gyro_z", "<f4"),
+)
+
+MANIFEST = "manifest.json"
+INDEX_FILE = "time.idx"
+
+
+# Write data at offset, dropping anything after offset first
+def _write_at(path, offset, data):
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        f.truncate(offset)
+        f.seek(offset)
+        f.write(data.tobytes())
+
+
+class TelemetryStore:
+    def __init__(self, root, schema=TELEMETRY_SCHEMA, segment_rows=1 << 20, index_stride=4096):
+        if schema[0][0] != "timestamp":
+            raise ValueError("the first schema column must be 'timestamp'")
+        self.root = root
+        self.schema = tuple((name, np.dtype(dtype)) for name, dtype in schema)
+        self.segment_rows = segment_rows
+        self.index_stride = index_stride
+        self._manifests = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def devices(self):
+        return sorted(unquote(name) for name in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, name, MANIFEST)))
+
+    # "." and ".." survive quote(), so their dots are escaped too
+    def _device_dir(self, device):
+        name = quote(str(device), safe="")
+        if not name:
+            raise ValueError("device name must not be empty")
+        if name in (".", ".."):
+            name = name.replace(".", "%2E")
+        return os.path.join(self.root, name)
+
+    def _segment_dir(self, device, segment_id):
+        return os.path.join(self._device_dir(device), f"seg-{segment_id:06d}")
+
+    def _manifest(self, device):
+        manifest = self._manifests.get(device)
+        if manifest is None:
+            path = os.path.join(self._device_dir(device), MANIFEST)
+            if os.path.exists(path):
+                with open(path) as f:
+                    manifest = json.load(f)
+                if [name for name, _ in self.schema] != [name for name, _ in manifest["schema"]]:
+                    raise ValueError(f"{device!r} was written with a different schema")
+            else:
+                manifest = {
+                    "schema": [(name, dtype.str) for name, dtype in self.schema],
+                    "segment_rows": self.segment_rows,
+                    "index_stride": self.index_stride,
+                    "segments": [],
+                }
+            self._manifests[device] = manifest
+        return manifest
+
+    def _write_manifest(self, device, manifest):
+        path = os.path.join(self._device_dir(device), MANIFEST)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, path)
+
+    # Append rows for one device. columns maps schema names to equal-length
+    # arrays; missing columns are filled with NaN. Returns the number of rows.
+    # The manifest is the only record of how many rows exist: columns are
+    # written at the offset it gives (cutting off whatever an interrupted
+    # append left behind) and the manifest is replaced only after them.
+    def append(self, device, columns):
+        timestamps = np.asarray(columns["timestamp"], dtype=np.int64)
+        n = len(timestamps)
+        if n == 0:
+            return 0
+        order = None
+        if n > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind="stable")
+            timestamps = timestamps[order]
+
+        with self._lock:
+            manifest = self._manifest(device)
+            segments = [dict(segment) for segment in manifest["segments"]]
+            if segments and timestamps[0] < segments[-1]["t_max"]:
+                raise ValueError(
+                    f"out-of-order append for {device!r}: "
+                    f"{timestamps[0]} < {segments[-1]['t_max']}")
+            segment_rows = manifest["segment_rows"]
+            stride = manifest["index_stride"]
+
+            data = {}
+            for name, dtype in self.schema:
+                if name == "timestamp":
+                    data[name] = timestamps
+                    continue
+                values = columns.get(name)
+                if values is None:
+                    data[name] = np.full(n, np.nan, dtype=dtype)
+                else:
+                    values = np.asarray(values, dtype=dtype)
+                    data[name] = values[order] if order is not None else values
+
+            offset = 0
+            while offset < n:
+                if not segments or segments[-1]["rows"] >= segment_rows:
+                    segments.append({"id": len(segments), "rows": 0,
+                                     "t_min": int(timestamps[offset]), "t_max": None})
+                    os.makedirs(self._segment_dir(device, segments[-1]["id"]), exist_ok=True)
+                segment = segments[-1]
+                take = min(segment_rows - segment["rows"], n - offset)
+                seg_dir = self._segment_dir(device, segment["id"])
+                for name, dtype in self.schema:
+                    _write_at(os.path.join(seg_dir, name), segment["rows"] * dtype.itemsize,
+                              data[name][offset:offset + take])
+
+                # Sparse index entry for every row that starts a stride block
+                first = (-segment["rows"]) % stride
+                positions = np.arange(offset + first, offset + take, stride)
+                _write_at(os.path.join(seg_dir, INDEX_FILE),
+                          (segment["rows"] + stride - 1) // stride * 8, timestamps[positions])
+
+                segment["rows"] += take
+                segment["t_max"] = int(timestamps[offset + take - 1])
+                offset += take
+
+            manifest = dict(manifest, segments=segments)
+            self._write_manifest(device, manifest)
+            self._manifests[device] = manifest
+        return n
+
+    def count(self, device):
+        with self._lock:
+            return sum(segment["rows"] for segment in self._manifest(device)["segments"])
+
+    def time_range(self, device):
+        with self._lock:
+            segments = self._manifest(device)["segments"]
+            if not segments:
+                return None
+            return segments[0]["t_min"], segments[-1]["t_max"]
+
+    def _column(self, device, segment, name, dtype):
+        path = os.path.join(self._segment_dir(device, segment["id"]), name)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(segment["rows"],))
+
+    # Row range [lo, hi) of a segment holding timestamps in [start, end)
+    def _row_range(self, device, segment, stride, start, end):
+        rows = segment["rows"]
+        timestamps = self._column(device, segment, "timestamp", np.int64)
+        index_path = os.path.join(self._segment_dir(device, segment["id"]), INDEX_FILE)
+        index = np.memmap(index_path, dtype=np.int64, mode="r",
+                          shape=((rows + stride - 1) // stride,))
+
+        lo = 0
+        if start is not None and start > segment["t_min"]:
+            block = max(int(np.searchsorted(index, start, "left")) - 1, 0)
+            base = block * stride
+            lo = base + int(np.searchsorted(timestamps[base:base + stride], start, "left"))
+        hi = rows
+        if end is not None and end <= segment["t_max"]:
+            block = max(int(np.searchsorted(index, end, "left")) - 1, 0)
+            base = block * stride
+            hi = base + int(np.searchsorted(timestamps[base:base + stride], end, "left"))
+        return lo, max(lo, hi)
+
+    # Zero-copy scan of [start, end) in milliseconds: yields one dict of
+    # memmap slices per segment that overlaps the range.
+    def scan(self, device, start=None, end=None, columns=None):
+        with self._lock:
+            manifest = self._manifest(device)
+            segments = [dict(segment) for segment in manifest["segments"]]
+        stride = manifest["index_stride"]
+        dtypes = dict(self.schema)
+        names = list(columns) if columns is not None else list(dtypes)
+        for segment in segments:
+            if segment["rows"] == 0:
+                continue
+            if start is not None and segment["t_max"] < start:
+                continue
+            if end is not None and segment["t_min"] >= end:
+                break
+            lo, hi = self._row_range(device, segment, stride, start, end)
+            if hi > lo:
+                yield {name: self._column(device, segment, name, dtypes[name])[lo:hi]
+                       for name in names}
+
+    # Materialized read of [start, end): one contiguous array per column
+    def read(self, device, start=None, end=None, columns=None):
+        dtypes = dict(self.schema)
+        names = list(columns) if columns is not None else list(dtypes)
+        parts = list(self.scan(device, start, end, names))
+        if len(parts) == 1:
+            return {name: np.array(parts[0][name]) for name in names}
+        return {name: np.concatenate([part[name] for part in parts])
+                if parts else np.empty(0, dtype=dtypes[name]) for name in names}
+
+
+# A batch of ingest_server TelemetryRecords -> {device: columns}. The
+# sketch's "timestamp" is millis() uptime, not wall-clock time, so each
+# message (the records sharing one arrival time, e.g. a packed frame) is
+# anchored once: its last sample lands on the arrival time and the others
+# keep their board-side spacing before it. Records without a board
+# timestamp get their arrival time. last, when given, maps device -> latest
+# timestamp already committed and is updated; times are clamped to it, so
+# network jitter between messages cannot make an out-of-order append.
+def group_records(batch, last=None):
+    by_device = {}
+    for record in batch:
+        by_device.setdefault(record.device, []).append(record)
+    grouped = {}
+    for device, records in by_device.items():
+        arrival = (np.array([r.received for r in records]) * 1000).astype(np.int64)
+        stamped = np.array([r.timestamp is not None for r in records])
+        board = np.array([r.timestamp if r.timestamp is not None else 0 for r in records],
+                         np.int64)
+        messages, message = np.unique(arrival, return_inverse=True)
+        newest = np.full(len(messages), np.iinfo(np.int64).min)
+        np.maximum.at(newest, message[stamped], board[stamped])
+        anchor = messages - newest
+        timestamps = np.where(stamped, board + anchor[message], arrival)
+        if last is not None:
+            if device in last:
+                timestamps = np.maximum(timestamps, last[device])
+            last[device] = int(timestamps.max())
+        grouped[device] = {
+            "timestamp": timestamps,
+            "roll": [r.roll for r in records],
+            "pitch": [r.pitch for r in records],
+            "yaw": [r.yaw for r in records],
+            "temperature": [r.temperature for r in records],
+        }
+    return grouped
+
+
+# Sink for ingest_server.IngestServer: commits each batch per device
+class StoreSink:
+    def __init__(self, store):
+        self.store = store
+        self._last = {}
+
+    def __call__(self, batch):
+        for device, columns in group_records(batch, self._last).items():
+            self.store.append(device, columns)
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description="Telemetry store write/scan benchmark")
+    parser.add_argument("--hours", type=float, default=24.0)
+    parser.add_argument("--rate", type=int, default=100)
+    parser.add_argument("--root", default=None)
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="telemetry-store-")
+    store = TelemetryStore(root)
+    n = int(args.hours * 3600 * args.rate)
+    t0 = 1_750_000_000_000
+    chunk = 360_000
+    start = time.perf_counter()
+    for offset in range(0, n, chunk):
+        m = min(chunk, n - offset)
+        t = t0 + (np.arange(offset, offset + m) * (1000 // args.rate))
+        values = np.sin(np.arange(offset, offset + m) / 1000.0).astype(np.float32)
+        store.append("device-0", {name: (t if name == "timestamp" else values)
+                                  for name, _ in TELEMETRY_SCHEMA})
+    elapsed = time.perf_counter() - start
+    row_bytes = sum(np.dtype(dtype).itemsize for _, dtype in TELEMETRY_SCHEMA)
+    print(f"Wrote {n:,} rows ({n * row_bytes / 1e6:.0f} MB) in {elapsed:.2f} s to {root}")
+
+    # One hour from the middle of the range
+    q_start = t0 + n // 2 * (1000 // args.rate)
+    q_end = q_start + 3_600_000
+    start = time.perf_counter()
+    rows = 0
+    checksum = 0.0
+    for part in store.scan("device-0", q_start, q_end, ["timestamp", "roll", "pitch", "yaw"]):
+        rows += len(part["timestamp"])
+        checksum += float(part["roll"].sum())
+    elapsed = time.perf_counter() - start
+    print(f"Scanned {rows:,} rows in {elapsed * 1000:.1f} ms "
+          f"({rows * 20 / elapsed / 1e9:.2f} GB/s)")
+
+    # Equal timestamps that straddle an index block are all found
+    check = TelemetryStore(tempfile.mkdtemp(prefix="telemetry-store-"), index_stride=4)
+    check.append("d", {"timestamp": [1, 2, 3, 5, 5, 5, 6, 8]})
+    assert check.read("d", 5, 7)["timestamp"].tolist() == [5, 5, 5, 6]
+    assert check.read("d", 4, 6)["timestamp"].tolist() == [5, 5, 5]
+
+    # Bytes past the manifest's row count (an append that died before its
+    # manifest write) are overwritten, not read
+    with open(os.path.join(check._segment_dir("d", 0), "timestamp"), "ab") as f:
+        f.write(np.arange(100, 103, dtype=np.int64).tobytes())
+    check.append("d", {"timestamp": [9, 10]})
+    reopened = TelemetryStore(check.root, index_stride=4)
+    assert reopened.read("d")["timestamp"].tolist() == [1, 2, 3, 5, 5, 5, 6, 8, 9, 10]
+
+    for name in (".", ".."):
+        check.append(name, {"timestamp": [1]})
+    assert sorted(os.listdir(check.root)) == ["%2E", "%2E%2E", "d"]
+    assert check.devices() == [".", "..", "d"]
@@ -0,0 +1,461 @@
+# Clock alignment and resampling of device telemetry onto a shared wall-clock grid
+#
+# Boards stamp readings with millis(), their uptime, on a crystal that runs a
+# few tens of ppm fast or slow, and loop() takes readings at whatever cadence
+# its passes happen to have. Before series from different boards can be
+# compared they need wall-clock times and a common grid:
+#
+#   ClockModel      fits wall = intercept + slope * millis for one device from
+#                   (millis, arrival time) pairs: an exponentially weighted
+#                   least-squares line (time constant tau_ms) merged a batch
+#                   at a time, plus the lowest residual of the recent window,
+#                   since network delay only ever adds. Points far above
+#                   that lower envelope (replayed or queued batches) are not
+#                   fitted. The remaining error is the minimum one-way delay.
+#   reorder buffer  holds each device's readings for reorder_ms of device
+#                   time, so batches that arrive out of order are released
+#                   in order; readings older than what was released are late
+#                   and dropped
+#   resampling      maps released readings to wall time and interpolates them
+#                   onto multiples of step_ms with np.interp, carrying the
+#                   last reading over to the next batch. Gaps longer than
+#                   max_gap_ms give NaN; yaw is unwrapped first.
+#
+# AlignedWindow keeps the last length grid points of every device in one
+# (fields, devices, length) array, so comparing boards is array work:
+# cross_correlate() correlates every device with a reference over a window in
+# one batched FFT.
+#
+#   python time_alignment.py                      8 boards, 3 h, 1M-point window
+#   python time_alignment.py --devices 4 --hours 1 --step 100
+
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+FIELDS = ("roll", "pitch", "yaw", "temperature")
+WRAPPED_FIELDS = ("yaw",)
+# millis() is an unsigned 32-bit counter: it wraps after 49.7 days
+MILLIS_WRAP = 1 << 32
+
+# time: int64 wall-clock ms on the grid; columns: field -> float64
+AlignedChunk = namedtuple("AlignedChunk", ["device", "time", "columns"])
+
+
+class ClockModel:
+    def __init__(self, tau_ms=3_600_000, floor_window_ms=600_000, gate_ms=250):
+        self.tau_ms = tau_ms
+        self.floor_window_ms = floor_window_ms
+        self.gate_ms = gate_ms
+        self.points = 0
+        self._last_x = None
+        # Weighted sums around the means (numerically stable merge)
+        self._w = 0.0
+        self._mean_x = self._mean_y = 0.0
+        self._cxx = self._cxy = 0.0
+        # Lowest point of each recent update, and how far the fitted line
+        # currently runs above the lowest of them
+        self._low_x = np.zeros(0)
+        self._low_y = np.zeros(0)
+        self._floor = 0.0
+
+    @property
+    def slope(self):
+        return self._cxy / self._cxx if self._cxx > 0 else 1.0
+
+    # Clock rate error of the device, ppm (positive: its millis() runs slow)
+    @property
+    def drift_ppm(self):
+        return (self.slope - 1) * 1e6
+
+    def _line(self, millis):
+        return self._mean_y + self.slope * (np.asarray(millis, dtype=np.float64) - self._mean_x)
+
+    # Wall-clock ms for device millis
+    def to_wall(self, millis):
+        return self._line(millis) + self._floor
+
+    # Fit (millis, arrival ms) pairs; arrivals are send times plus delay
+    def update(self, millis, arrival):
+        x = np.asarray(millis, dtype=np.float64)
+        y = np.asarray(arrival, dtype=np.float64)
+        if not len(x):
+            return
+        lowest = int(np.argmin(y - self._line(x)))
+        recent = self._low_x >= x.max() - self.floor_window_ms
+        self._low_x = np.append(self._low_x[recent], x[lowest])
+        self._low_y = np.append(self._low_y[recent], y[lowest])
+        if self.points >= 2:
+            # Held-back frames would drag the line up: fit only those near
+            # the lower envelope
+            keep = y - self.to_wall(x) <= self.gate_ms
+            x, y = x[keep], y[keep]
+
+        if len(x):
+            newest = float(x.max())
+            if self._last_x is not None and newest > self._last_x:
+                decay = np.exp(-(newest - self._last_x) / self.tau_ms)
+                self._w *= decay
+                self._cxx *= decay
+                self._cxy *= decay
+            self._last_x = max(newest, self._last_x if self._last_x is not None else newest)
+            weights = np.exp(np.minimum(x - self._last_x, 0) / self.tau_ms)
+            w = weights.sum()
+            mean_x = np.dot(weights, x) / w
+            mean_y = np.dot(weights, y) / w
+            total = self._w + w
+            dx = mean_x - self._mean_x
+            dy = mean_y - self._mean_y
+            self._cxx += np.dot(weights, (x - mean_x) ** 2) + dx * dx * self._w * w / total
+            self._cxy += np.dot(weights, (x - mean_x) * (y - mean_y)) + dx * dy * self._w * w / total
+            self._mean_x += dx * w / total
+            self._mean_y += dy * w / total
+            self._w = total
+            self.points += len(x)
+
+        self._floor = float(np.min(self._low_y - self._line(self._low_x)))
+
+
+class _Device:
+    def __init__(self, clock, fields):
+        self.clock = clock
+        self.millis = np.zeros(0, dtype=np.int64)        # awaiting release
+        self.values = np.zeros((0, fields))
+        self.newest = None           # highest millis seen
+        self.released = None         # highest millis released
+        self.wrap = 0                # multiples of MILLIS_WRAP under newest
+        self.tail = None             # (wall ms, values) of the last reading released
+        self.next_grid = None
+
+
+class AlignmentStage:
+    def __init__(self, step_ms=10, reorder_ms=5000, max_gap_ms=1000, reboot_ms=60_000,
+                 fields=FIELDS, clock=ClockModel):
+        self.step_ms = step_ms
+        self.reorder_ms = reorder_ms
+        self.max_gap_ms = max_gap_ms
+        self.reboot_ms = reboot_ms
+        self.fields = tuple(fields)
+        self.clock = clock
+        self.devices = {}
+        self.stats = {"readings": 0, "late": 0, "reboots": 0, "grid_points": 0}
+
+    # Readings of one device: millis, their arrival wall-clock ms (one per
+    # reading; readings of one packed frame share it) and field -> values.
+    # Returns the AlignedChunk this made ready, or None.
+    def push(self, name, millis, arrival, columns):
+        device = self.devices.get(name)
+        if device is None:
+            device = self.devices[name] = _Device(self.clock(), len(self.fields))
+        raw = np.asarray(millis, dtype=np.int64)
+        arrival = np.asarray(arrival, dtype=np.float64)
+        if not len(raw):
+            return None
+        millis = raw + device.wrap
+        if device.newest is not None:
+            if device.newest - device.wrap > MILLIS_WRAP - self.reboot_ms:
+                # 32-bit rollover: readings near zero are past it and keep
+                # counting; readings from before it stay where they are
+                millis[raw < self.reboot_ms] += MILLIS_WRAP
+            # Held back from before the last rollover, arriving after it
+            millis[millis - device.newest > MILLIS_WRAP // 2] -= MILLIS_WRAP
+            if millis.max() < device.newest - self.reboot_ms:
+                # Too far back to be a held-back frame: the board restarted.
+                # What it buffered is dropped with its clock, and its millis
+                # count from zero again.
+                self.stats["reboots"] += 1
+                device = self.devices[name] = _Device(self.clock(), len(self.fields))
+                millis = raw
+        self.stats["readings"] += len(millis)
+
+        # The freshest reading of each frame is the one sent right away
+        starts = np.flatnonzero(np.r_[True, arrival[1:] != arrival[:-1]])
+        device.clock.update(np.maximum.reduceat(millis, starts), arrival[starts])
+
+        values = np.column_stack([np.asarray(columns[f], dtype=np.float64) for f in self.fields])
+        device.millis = np.concatenate([device.millis, millis])
+        device.values = np.concatenate([device.values, values])
+        device.newest = max(device.newest if device.newest is not None else millis.max(),
+                            int(millis.max()))
+        device.wrap = device.newest - device.newest % MILLIS_WRAP
+        return self._release(name, device, device.newest - self.reorder_ms)
+
+    # Everything a device still buffers, e.g. at shutdown
+    def flush(self, name):
+        device = self.devices[name]
+        return self._release(name, device, device.newest)
+
+    def _release(self, name, device, up_to):
+        order = np.argsort(device.millis, kind="stable")
+        millis = device.millis[order]
+        values = device.values[order]
+        split = int(np.searchsorted(millis, up_to, "right"))
+        device.millis, device.values = millis[split:], values[split:]
+        millis, values = millis[:split], values[:split]
+        if device.released is not None:
+            fresh = millis > device.released
+            self.stats["late"] += int(len(millis) - fresh.sum())
+            millis, values = millis[fresh], values[fresh]
+        if not len(millis):
+            return None
+        device.released = int(millis[-1])
+        return self._resample(name, device, device.clock.to_wall(millis), values)
+
+    def _resample(self, name, device, wall, values):
+        if device.tail is not None:
+            wall = np.r_[device.tail[0], wall]
+            values = np.vstack([device.tail[1], values])
+        # A refit can move the mapping back a little; never let time reverse
+        wall = np.maximum.accumulate(wall)
+        device.tail = (wall[-1], values[-1])
+        step = self.step_ms
+        if device.next_grid is None:
+            device.next_grid = int(np.ceil(wall[0] / step)) * step
+        grid = np.arange(device.next_grid, wall[-1] + 1e-9, step, dtype=np.float64)
+        if not len(grid):
+            return None
+        device.next_grid = int(grid[-1]) + step
+
+        right = np.clip(np.searchsorted(wall, grid, "left"), 1, len(wall) - 1)
+        gap = (wall[right] - wall[right - 1]) > self.max_gap_ms
+        columns = {}
+        for k, field in enumerate(self.fields):
+            series = values[:, k]
+            if field in WRAPPED_FIELDS:
+                series = np.unwrap(series, period=360)
+            resampled = np.interp(grid, wall, series)
+            if field in WRAPPED_FIELDS:
+                resampled = (resampled + 180) % 360 - 180
+            resampled[gap] = np.nan
+            columns[field] = resampled
+        self.stats["grid_points"] += len(grid)
+        return AlignedChunk(name, grid.astype(np.int64), columns)
+
+
+# The last length grid points of every device, one array per field
+class AlignedWindow:
+    def __init__(self, devices, step_ms, length, fields=FIELDS):
+        self.devices = list(devices)
+        self.step_ms = step_ms
+        self.length = length
+        self.fields = tuple(fields)
+        self._row = {device: i for i, device in enumerate(self.devices)}
+        self.data = np.full((len(self.fields), len(self.devices), length), np.nan)
+        self.slot_time = np.full((len(self.devices), length), -1, dtype=np.int64)
+        self.end = None              # grid time after the newest point
+
+    def add(self, chunk):
+        if chunk is None or chunk.device not in self._row:
+            return
+        row = self._row[chunk.device]
+        time = chunk.time[-self.length:]
+        slots = (time // self.step_ms) % self.length
+        for k, field in enumerate(self.fields):
+            self.data[k, row, slots] = chunk.columns[field][-self.length:]
+        self.slot_time[row, slots] = time
+        self.end = max(self.end or 0, int(time[-1]) + self.step_ms)
+
+    # (grid times, devices x length array of field) ending at end (default:
+    # the newest point), oldest first; slots a device has not filled are NaN
+    def window(self, field, end=None):
+        end = self.end if end is None else end
+        if end is None:
+            return np.zeros(0, dtype=np.int64), np.zeros((len(self.devices), 0))
+        times = end - self.step_ms * np.arange(self.length, 0, -1, dtype=np.int64)
+        slots = (times // self.step_ms) % self.length
+        values = self.data[self.fields.index(field)][:, slots]
+        values[self.slot_time[:, slots] != times] = np.nan
+        return times, values
+
+
+# Normalized cross-correlation of every row of x (devices x samples) with
+# row reference, for lags -max_lag..max_lag samples, in one batched FFT.
+# A peak at lag L means the row lags the reference by L samples. NaN counts
+# as the row's mean.
+def cross_correlate(x, max_lag, reference=0):
+    x = np.asarray(x, dtype=np.float64)
+    n = x.shape[1]
+    mean = np.nanmean(x, axis=1, keepdims=True)
+    x = np.where(np.isnan(x), mean, x) - mean
+    x /= np.maximum(np.sqrt(np.sum(x * x, axis=1, keepdims=True)), 1e-12)
+    size = 1 << int(np.ceil(np.log2(n + max_lag)))
+    spectra = np.fft.rfft(x, size, axis=1)
+    full = np.fft.irfft(spectra * spectra[reference].conj(), size, axis=1)
+    lags = np.arange(-max_lag, max_lag + 1)
+    return lags, full[:, lags % size]
+
+
+# Sink for ingest_server.IngestServer: aligns each batch per device and adds
+# the chunks to window, then passes the batch on to inner. Records without a
+# board timestamp cannot be placed on the device clock and are not aligned.
+class AlignmentSink:
+    def __init__(self, stage, window=None, inner=None):
+        self.stage = stage
+        self.window = window
+        self.inner = inner
+
+    def __call__(self, batch):
+        by_device = {}
+        for record in batch:
+            if record.timestamp is not None:
+                by_device.setdefault(record.device, []).append(record)
+        for device, records in by_device.items():
+            chunk = self.stage.push(device, [r.timestamp for r in records],
+                                    [r.received * 1000 for r in records],
+                                    {f: [getattr(r, f) for r in records] for f in self.stage.fields})
+            if self.window is not None:
+                self.window.add(chunk)
+        if self.inner is not None:
+            self.inner(batch)
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description="Clock alignment and resampling check")
+    parser.add_argument("--devices", type=int, default=8)
+    parser.add_argument("--hours", type=float, default=3.0)
+    parser.add_argument("--step", type=int, default=10, help="grid step, ms")
+    parser.add_argument("--window", type=int, default=1_000_000, help="grid points compared")
+    parser.add_argument("--frame-ms", type=int, default=1000, help="packed frame interval")
+    args = parser.parse_args()
+
+    # Every board sits on the same shaking table: a sum of slow and fast
+    # sinusoids of wall time. Each has its own boot time and crystal error,
+    # loop() jitter and network delay, and now and then a frame is held back
+    # (a reconnect) and delivered after newer ones. Board 3's sensor sits
+    # 40 ms further down the table.
+    rng = np.random.default_rng(0)
+    freqs = rng.uniform(0.02, 3.0, 24)
+    phases = rng.uniform(0, 2 * np.pi, 24)
+    amps = 10 / (1 + freqs * 4)
+
+    def motion(wall_ms):
+        wall_ms = np.asarray(wall_ms, dtype=np.float64)
+        out = np.empty(len(wall_ms))
+        for i in range(0, len(wall_ms), 100_000):
+            t = wall_ms[i:i + 100_000, None] / 1000
+            out[i:i + 100_000] = np.sum(amps * np.sin(2 * np.pi * freqs * t + phases), axis=1)
+        return out
+
+    start_wall = 1_750_000_000_000.0
+    duration = args.hours * 3_600_000
+    names = [f"board-{i}" for i in range(args.devices)]
+    boot = start_wall - rng.uniform(60_000, 86_400_000, args.devices)
+    rate = 1 + rng.uniform(-60, 60, args.devices) * 1e-6     # device ms per wall ms
+    sensor_lag = np.where(np.arange(args.devices) == 3, 40.0, 0.0)
+
+    frames = []                      # (arrival, device, millis, values)
+    truth = []                       # (millis, wall) per device
+    for d in range(args.devices):
+        # Pass times ~13 ms apart in device time, with jitter
+        passes = (start_wall - boot[d]) * rate[d] + np.cumsum(
+            12 + np.abs(rng.normal(0, 1.5, int(duration / 12))))
+        wall = boot[d] + passes / rate[d]
+        keep = wall < start_wall + duration
+        millis = np.floor(passes[keep]).astype(np.int64)
+        wall = boot[d] + millis / rate[d]
+        truth.append((millis, wall))
+        values = motion(wall - sensor_lag[d])
+        edges = np.searchsorted(wall, np.arange(start_wall, start_wall + duration, args.frame_ms))
+        for a, b in zip(edges[:-1], edges[1:]):
+            if b > a:
+                delay = 4 + rng.exponential(30)
+                if rng.random() < 0.01:
+                    delay += rng.uniform(1000, 4000)
+                frames.append((wall[b - 1] + delay, d, millis[a:b], values[a:b]))
+    frames.sort(key=lambda frame: frame[0])
+
+    stage = AlignmentStage(step_ms=args.step, fields=("roll",))
+    window = AlignedWindow(names, args.step, min(args.window, int(duration / args.step) - 1000),
+                           fields=("roll",))
+    began = time.perf_counter()
+    for arrival, d, millis, values in frames:
+        window.add(stage.push(names[d], millis, np.full(len(millis), arrival), {"roll": values}))
+    for name in names:
+        window.add(stage.flush(name))
+    elapsed = time.perf_counter() - began
+    print(f"{stage.stats['readings']:,} readings from {args.devices} boards in {len(frames):,} "
+          f"frames aligned in {elapsed:.2f} s ({stage.stats['readings'] / elapsed / 1e6:.2f} M "
+          f"readings/s), {stage.stats['late']} late, {stage.stats['grid_points']:,} grid points")
+    assert stage.stats["late"] == 0
+
+    # Clock estimates against the truth, over the last hour of readings
+    for d, name in enumerate(names):
+        clock = stage.devices[name].clock
+        millis, wall = truth[d]
+        recent = wall > wall[-1] - 3_600_000
+        error = clock.to_wall(millis[recent]) - wall[recent]
+        print(f"{name}: drift {clock.drift_ppm:+6.1f} ppm (true {(1 / rate[d] - 1) * 1e6:+6.1f}), "
+              f"wall-clock error {error.mean():+5.1f} ms mean, {np.abs(error).max():4.1f} ms max")
+        assert np.abs(error).max() < 15
+
+    times, roll = window.window("roll")
+    expected = np.array([motion(times - lag) for lag in sensor_lag])
+    print(f"resampled vs true motion: max error {np.nanmax(np.abs(roll - expected)):.2f} over "
+          f"{roll.shape[1]:,} grid points per board, {np.isnan(roll).mean():.3%} NaN")
+
+    began = time.perf_counter()
+    lags, correlation = cross_correlate(roll, max_lag=200 // args.step)
+    elapsed = time.perf_counter() - began
+    best = lags[np.argmax(correlation, axis=1)] * args.step
+    print(f"cross-correlation of {args.devices} x {roll.shape[1]:,} points in "
+          f"{elapsed * 1000:.0f} ms: lag behind board-0 {best.tolist()} ms")
+    assert best[3] == 40 and all(abs(lag) <= args.step for i, lag in enumerate(best) if i != 3)
+
+    # Counting on across the 32-bit rollover, in a frame that straddles it
+    # and after it, also when the last frame before it is held back until
+    # after it; a restart after 30 days of uptime, well past 2^31 ms, or
+    # after a rollover is a reboot rather than a rollover
+    def steady(stage, first_millis, first_wall, seconds, held=None):
+        frames = []
+        for k in range(seconds):
+            millis = first_millis + k * 1000 + np.arange(0, 1000, 10)
+            frames.append((first_wall + k * 1000 + 999 + 5.0, millis % MILLIS_WRAP))
+        if held is not None:
+            frames[held] = (frames[held][0] + 2500, frames[held][1])
+            frames.sort(key=lambda frame: frame[0])
+        chunks = [stage.push("board-0", millis, np.full(len(millis), wall),
+                             {"roll": np.zeros(len(millis))}) for wall, millis in frames]
+        return [chunk for chunk in chunks if chunk is not None]
+
+    def grid_points(chunks):
+        return sum(len(chunk.time) for chunk in chunks)
+
+    stage = AlignmentStage(fields=("roll",))
+    chunks = steady(stage, MILLIS_WRAP - 600_500, start_wall, 1200)
+    assert stage.stats["reboots"] == 0 and stage.devices["board-0"].wrap == MILLIS_WRAP
+    assert abs(stage.devices["board-0"].clock.drift_ppm) < 1
+    assert chunks[-1].time[-1] > start_wall + 1_190_000
+    expected_points = grid_points(chunks)
+    stage = AlignmentStage(fields=("roll",))
+    chunks = steady(stage, MILLIS_WRAP - 600_000, start_wall, 1200, held=599)
+    assert stage.stats["reboots"] == 0 and stage.stats["late"] == 0
+    assert stage.devices["board-0"].wrap == MILLIS_WRAP
+    assert abs(grid_points(chunks) - expected_points) <= 100
+    stage = AlignmentStage(fields=("roll",))
+    steady(stage, 30 * 86_400_000, start_wall, 600)
+    chunks = steady(stage, 0, start_wall + 700_000, 600)
+    assert stage.stats["reboots"] == 1 and stage.devices["board-0"].wrap == 0
+    assert abs(stage.devices["board-0"].clock.drift_ppm) < 1
+    assert chunks[-1].time[-1] > start_wall + 1_290_000
+    for boot_millis in (70_000, 5_000):
+        stage = AlignmentStage(fields=("roll",))
+        steady(stage, MILLIS_WRAP - 600_500, start_wall, 1200)
+        chunks = steady(stage, boot_millis, start_wall + 1_300_000, 600)
+        assert stage.stats["reboots"] == 1 and stage.devices["board-0"].wrap == 0
+        assert abs(stage.devices["board-0"].clock.drift_ppm) < 1
+        assert chunks[-1].time[-1] > start_wall + 1_890_000
+        assert abs(grid_points(chunks) - 59_500) <= 100
+    print("millis rollover counted on, held-back frames placed before it, "
+          "reboots after long uptime and after a rollover detected")
+
+    # A record without a board timestamp is passed on but not aligned
+    from ingest_server import TelemetryRecord
+
+    passed = []
+    sink = AlignmentSink(AlignmentStage(fields=("roll",)), inner=passed.extend)
+    sink([TelemetryRecord("board-0", 1000, 1.0, 0.0, 0.0, 25.0, 1_750_000_000.0),
+          TelemetryRecord("board-0", None, 2.0, 0.0, 0.0, 25.0, 1_750_000_000.0)])
+    assert sink.stage.stats["readings"] == 1 and len(passed) == 2
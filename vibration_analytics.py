@@ -0,0 +1,613 @@
+# Streaming vibration analytics over raw IMU data: Welch PSDs, RMS, dominant frequency
+#
+# Input is the raw six axes at the sensor's sample rate: acc_x/y/z in m/s^2
+# and gyro_x/y/z in rad/s with millisecond timestamps, as mpu6050_fifo's
+# FifoDecoder and to_si() produce them from the --fifo drain.
+#
+# VibrationAnalyzer keeps every device's samples not yet covered by a window
+# in one (devices, 6, capacity) array. A Hann window of segment samples
+# starts every hop samples, so windows overlap by segment - hop. process()
+# cuts every complete window out of every device's buffer with one gather,
+# runs one rfft over the stacked (windows, 6, segment) array and adds each
+# window's periodogram to its device's running sum. Every report windows a
+# device emits one derived row:
+#
+#   <axis>_rms      RMS about the window mean (gravity and gyro bias removed),
+#                   averaged over the windows
+#   <axis>_peak_hz  frequency of the largest non-DC bin of the Welch PSD,
+#                   refined by a parabola through its neighbours
+#
+# The PSD of a row is the mean of its windows' periodograms: the estimate
+# scipy.signal.welch gives over the same samples. The latest one per device
+# is kept for spectrum(). A jump of more than gap_ms between batches (a
+# FIFO overflow, a reboot) drops the device's partial windows.
+#
+# Rows go to a TelemetryStore with VIBRATION_SCHEMA, by convention in
+# <store>/vibration next to <store>/rollups. VibrationPool spreads devices
+# over worker processes by crc32(device). Each shard has its own
+# single-process executor, so a device's buffers always live in the same
+# process. Boards send the raw axes with --fifo RATE --raw-imu; IngestServer
+# decodes those messages into RawImuBatch and VibrationSink, its raw_sink,
+# runs each batch through a pool per sample rate on the board clock. It
+# appends the rows, plus the raw samples to a TELEMETRY_SCHEMA store in
+# <store>/raw, in blocks per device.
+#
+#   python vibration_analytics.py                       1,000 devices at 500 Hz
+#   python vibration_analytics.py --devices 200 --workers 2 --seconds 20
+#   python vibration_analytics.py --store data          also write the derived series
+
+import argparse
+import multiprocessing
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mpu6050_fifo import COLUMNS
+
+VIBRATION_SCHEMA = (("timestamp", "<i8"),
+                    *((f"{axis}_rms", "<f4") for axis in COLUMNS),
+                    *((f"{axis}_peak_hz", "<f4") for axis in COLUMNS))
+
+
+class VibrationAnalyzer:
+    def __init__(self, rate_hz=500, segment=512, hop=256, report=8, gap_ms=None):
+        if not 0 < hop <= segment:
+            raise ValueError("hop must be in (0, segment]")
+        self.rate_hz = rate_hz
+        self.segment = segment
+        self.hop = hop
+        self.report = report
+        self.gap_ms = gap_ms if gap_ms is not None else 2.5 * 1000.0 / rate_hz
+        self.window = np.hanning(segment + 1)[:-1].astype(np.float32)
+        self.scale = 1.0 / (rate_hz * float(np.sum(self.window.astype(np.float64) ** 2)))
+        self.freqs = np.fft.rfftfreq(segment, 1.0 / rate_hz)
+        self.names = []
+        self.index = {}
+        self._grow(0, 16, 2 * segment)
+
+    # (Re)allocate the per-device arrays for devices rows and capacity samples
+    def _grow(self, devices, rows, capacity):
+        bins = len(self.freqs)
+        old = getattr(self, "_values", None)
+        values = np.zeros((rows, len(COLUMNS), capacity), np.float32)
+        times = np.zeros((rows, capacity), np.int64)
+        arrays = {"_fill": ((rows,), np.int64), "_last": ((rows,), np.int64),
+                  "_windows": ((rows,), np.int64), "_power": ((rows, len(COLUMNS), bins), np.float64),
+                  "_variance": ((rows, len(COLUMNS)), np.float64),
+                  "psd": ((rows, len(COLUMNS), bins), np.float32)}
+        if old is not None:
+            values[:devices, :, :old.shape[2]] = old[:devices]
+            times[:devices, :old.shape[2]] = self._times[:devices]
+        self._values, self._times = values, times
+        for name, (shape, dtype) in arrays.items():
+            array = np.zeros(shape, dtype)
+            if old is not None:
+                array[:devices] = getattr(self, name)[:devices]
+            setattr(self, name, array)
+        self.psd[devices:] = np.nan
+
+    def _device_rows(self, devices):
+        rows = []
+        for name in devices:
+            row = self.index.get(name)
+            if row is None:
+                row = self.index[name] = len(self.names)
+                self.names.append(name)
+                if row == len(self._fill):
+                    self._grow(row, 2 * row, self._values.shape[2])
+                self._last[row] = np.iinfo(np.int64).min // 2
+            rows.append(row)
+        return np.asarray(rows, np.int64)
+
+    # Append n samples to each of devices. timestamps is (n,) when they share
+    # a grid or (len(devices), n); values is (len(devices), 6, n) in COLUMNS
+    # order.
+    def push_block(self, devices, timestamps, values):
+        self.push_runs(devices, *_block_runs(devices, timestamps, values))
+
+    # Append counts[i] samples to devices[i], each device listed once.
+    # timestamps (sum(counts),) and values (6, sum(counts)) hold the runs
+    # back to back, in devices order.
+    def push_runs(self, devices, counts, timestamps, values):
+        rows = self._device_rows(devices)
+        counts = np.asarray(counts, np.int64)
+        values = np.asarray(values, np.float32)
+        timestamps = np.asarray(timestamps, np.int64)
+        rows, counts = rows[counts > 0], counts[counts > 0]
+        if len(rows) == 0:
+            return
+        ends = np.cumsum(counts)
+        gap = timestamps[ends - counts] - self._last[rows] > self.gap_ms
+        self._fill[rows[gap]] = 0
+        self._last[rows] = timestamps[ends - 1]
+        need = int((self._fill[rows] + counts).max())
+        if need > self._values.shape[2]:
+            self._grow(len(self.names), len(self._fill), max(need, 2 * self._values.shape[2]))
+        owner = np.repeat(rows, counts)
+        at = np.repeat(self._fill[rows] - (ends - counts), counts) + np.arange(len(owner))
+        self._values[owner[None, :], np.arange(len(COLUMNS))[:, None], at[None, :]] = values
+        self._times[owner, at] = timestamps
+        self._fill[rows] += counts
+
+    # One device's samples; columns maps COLUMNS to equal-length arrays
+    def push(self, device, timestamps, columns):
+        self.push_block([device], timestamps, np.stack([np.asarray(columns[name], np.float32)
+                                                         for name in COLUMNS])[None])
+
+    # Every complete window of every device through one rfft. Returns
+    # {device: columns} of the rows this completed, ready for
+    # TelemetryStore(..., schema=VIBRATION_SCHEMA).append().
+    def process(self):
+        count = len(self.names)
+        fill = self._fill[:count]
+        windows = np.where(fill >= self.segment, (fill - self.segment) // self.hop + 1, 0)
+        rows = np.flatnonzero(windows)
+        if len(rows) == 0:
+            return {}
+        windows = windows[rows]
+        owner = np.repeat(rows, windows)
+        first = np.repeat(np.cumsum(windows) - windows, windows)
+        within = np.arange(len(owner)) - first
+        start = within * self.hop
+        span = start[:, None] + np.arange(self.segment)
+        segments = self._values[owner[:, None, None], np.arange(len(COLUMNS))[None, :, None],
+                                span[:, None, :]]
+        ends = self._times[owner, start + self.segment - 1]
+
+        # Keep what the next window needs: everything from the first unused start
+        consumed = windows * self.hop
+        keep = self.segment - 1
+        tail = np.minimum(consumed[:, None] + np.arange(keep), self._values.shape[2] - 1)
+        self._values[rows[:, None, None], np.arange(len(COLUMNS))[None, :, None],
+                     np.arange(keep)[None, None, :]] = \
+            self._values[rows[:, None, None], np.arange(len(COLUMNS))[None, :, None], tail[:, None, :]]
+        self._times[rows[:, None], np.arange(keep)] = self._times[rows[:, None], tail]
+        self._fill[rows] -= consumed
+
+        segments -= segments.mean(axis=2, keepdims=True)
+        variance = np.mean(np.square(segments, dtype=np.float64), axis=2)
+        power = np.abs(np.fft.rfft(segments * self.window, axis=2)) ** 2 * self.scale
+        power[..., 1:(self.segment + 1) // 2] *= 2
+
+        # Windows of the same device and report are contiguous: sum each run
+        number = self._windows[owner] + within
+        report = number // self.report
+        run = np.ones(len(owner), bool)
+        run[1:] = (owner[1:] != owner[:-1]) | (report[1:] != report[:-1])
+        starts = np.flatnonzero(run)
+        last = np.append(starts[1:], len(owner)) - 1
+        power = np.add.reduceat(power, starts, axis=0)
+        variance = np.add.reduceat(variance, starts, axis=0)
+        device = owner[starts]
+        continuing = number[starts] % self.report != 0
+        power[continuing] += self._power[device[continuing]]
+        variance[continuing] += self._variance[device[continuing]]
+        self._power[rows] = 0.0
+        self._variance[rows] = 0.0
+        self._windows[rows] += windows
+        complete = number[last] % self.report == self.report - 1
+        partial = ~complete
+        self._power[device[partial]] = power[partial]
+        self._variance[device[partial]] = variance[partial]
+        if not complete.any():
+            return {}
+
+        device = device[complete]
+        psd = power[complete] / self.report
+        self.psd[device] = psd
+        rms = np.sqrt(variance[complete] / self.report)
+        peak = self._peak_hz(psd)
+        timestamp = ends[last[complete]]
+        out = {}
+        bounds = np.flatnonzero(np.diff(device)) + 1
+        for group in np.split(np.arange(len(device)), bounds):
+            columns = {"timestamp": timestamp[group]}
+            for a, axis in enumerate(COLUMNS):
+                columns[f"{axis}_rms"] = rms[group, a].astype(np.float32)
+                columns[f"{axis}_peak_hz"] = peak[group, a].astype(np.float32)
+            out[self.names[device[group[0]]]] = columns
+        return out
+
+    # Largest non-DC bin per (row, axis), refined by a parabola through the
+    # log powers of it and its neighbours
+    def _peak_hz(self, psd):
+        bins = psd.shape[-1]
+        peak = np.argmax(psd[..., 1:], axis=-1) + 1
+        left = np.take_along_axis(psd, np.maximum(peak - 1, 0)[..., None], -1)[..., 0]
+        middle = np.take_along_axis(psd, peak[..., None], -1)[..., 0]
+        right = np.take_along_axis(psd, np.minimum(peak + 1, bins - 1)[..., None], -1)[..., 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a, b, c = (np.log(np.maximum(x, 1e-30)) for x in (left, middle, right))
+            shift = 0.5 * (a - c) / (a - 2 * b + c)
+        shift = np.where(np.isfinite(shift) & (peak < bins - 1), np.clip(shift, -0.5, 0.5), 0.0)
+        return (peak + shift) * (self.rate_hz / self.segment)
+
+    # (frequencies in Hz, {axis: PSD}) of the device's last row, NaN before it has one
+    def spectrum(self, device):
+        psd = self.psd[self.index[device]]
+        return self.freqs, {axis: psd[a] for a, axis in enumerate(COLUMNS)}
+
+
+_analyzer = None
+
+
+def _init_worker(kwargs):
+    global _analyzer
+    _analyzer = VibrationAnalyzer(**kwargs)
+
+
+def _step(devices, counts, timestamps, values):
+    if devices:
+        _analyzer.push_runs(devices, counts, timestamps, values)
+    return _analyzer.process()
+
+
+def _spectrum(device):
+    return _analyzer.spectrum(device)
+
+
+# VibrationAnalyzer sharded over processes. step() pushes one block to every
+# shard and runs process() on all of them at once.
+class VibrationPool:
+    def __init__(self, workers=None, **kwargs):
+        workers = workers or multiprocessing.cpu_count()
+        context = multiprocessing.get_context("spawn")
+        self.shards = [ProcessPoolExecutor(1, context, initializer=_init_worker, initargs=(kwargs,))
+                       for _ in range(workers)]
+        self._shard = {}
+
+    def shard(self, device):
+        shard = self._shard.get(device)
+        if shard is None:
+            shard = self._shard[device] = zlib.crc32(str(device).encode()) % len(self.shards)
+        return shard
+
+    # Same arguments as VibrationAnalyzer.push_block(); returns the merged rows
+    def step(self, devices, timestamps, values):
+        return self.collect(self.submit(devices, *_block_runs(devices, timestamps, values)))
+
+    # Same arguments as VibrationAnalyzer.push_runs(). Returns the shards'
+    # jobs at once, so the caller can work while they run; collect() waits
+    # for them and merges their rows.
+    def submit(self, devices, counts, timestamps, values):
+        counts = np.asarray(counts, np.int64)
+        timestamps = np.asarray(timestamps, np.int64)
+        values = np.asarray(values, np.float32)
+        shards = np.fromiter((self.shard(d) for d in devices), np.int64, len(devices))
+        samples = np.repeat(shards, counts)
+        jobs = []
+        for s, executor in enumerate(self.shards):
+            mine = np.flatnonzero(shards == s)
+            taken = samples == s
+            jobs.append(executor.submit(_step, [devices[i] for i in mine], counts[mine],
+                                        timestamps[taken], values[:, taken]))
+        return jobs
+
+    @staticmethod
+    def collect(jobs):
+        out = {}
+        for job in jobs:
+            out.update(job.result())
+        return out
+
+    def spectrum(self, device):
+        return self.shards[self.shard(device)].submit(_spectrum, device).result()
+
+    def close(self):
+        for executor in self.shards:
+            executor.shutdown()
+
+
+# push_block() arguments -> push_runs() counts, timestamps and values
+def _block_runs(devices, timestamps, values):
+    values = np.asarray(values, np.float32)
+    n = values.shape[2]
+    timestamps = np.broadcast_to(np.asarray(timestamps, np.int64), (len(devices), n))
+    return (np.full(len(devices), n, np.int64), timestamps.reshape(-1),
+            values.transpose(1, 0, 2).reshape(len(COLUMNS), -1))
+
+
+# timestamps raised to at least the device's last one, which is updated
+def _monotonic(last, device, timestamps):
+    if device in last:
+        timestamps = np.maximum(timestamps, last[device])
+    last[device] = int(timestamps[-1])
+    return timestamps
+
+
+# Per-device buffer in front of a TelemetryStore: every append writes each
+# column file and the manifest, so a device's columns are appended rows at a
+# time instead of as they come
+class _BlockWriter:
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = rows
+        self._pending = {}
+        self._count = {}
+
+    def add(self, device, columns):
+        self._pending.setdefault(device, []).append(columns)
+        self._count[device] = self._count.get(device, 0) + len(columns["timestamp"])
+        if self._count[device] >= self.rows:
+            self._write(device)
+
+    def _write(self, device):
+        parts = self._pending.pop(device)
+        del self._count[device]
+        self.store.append(device, {name: np.concatenate([part[name] for part in parts])
+                                   for name in parts[0]})
+
+    def flush(self):
+        for device in list(self._pending):
+            self._write(device)
+
+
+# raw_sink for ingest_server.IngestServer. Analysis runs on the board's
+# sensor clock, in one VibrationPool per sample rate, while the sink stores
+# the batch. Rows and raw samples are stored on wall time, anchored per
+# message the way telemetry_store.group_records() does (board millis plus
+# arrival minus the message's newest board millis) and kept non-decreasing
+# per device. Both are appended per device in blocks, write_rows rows and
+# raw_write_rows samples at a time; until then, and until flush() for the
+# rest, they are only in memory. close() flushes and stops the pools.
+class VibrationSink:
+    def __init__(self, store, raw_store=None, workers=None, write_rows=16,
+                 raw_write_rows=4096, **analyzer):
+        self.rows = _BlockWriter(store, write_rows)
+        self.raw = _BlockWriter(raw_store, raw_write_rows) if raw_store is not None else None
+        self.workers = workers
+        self.analyzer = analyzer
+        self.pools = {}
+        self._anchor = {}
+        self._last = {}
+        self._last_raw = {}
+
+    @property
+    def store(self):
+        return self.rows.store
+
+    @property
+    def raw_store(self):
+        return self.raw.store if self.raw is not None else None
+
+    def __call__(self, batch):
+        by_rate = {}
+        for raw in batch:
+            by_rate.setdefault(raw.rate_hz, {}).setdefault(raw.device, []).append(raw)
+        jobs = []
+        for rate_hz, messages in by_rate.items():
+            pool = self.pools.get(rate_hz)
+            if pool is None:
+                pool = self.pools[rate_hz] = VibrationPool(self.workers, rate_hz=rate_hz,
+                                                           **self.analyzer)
+            devices = list(messages)
+            raws = [raw for device in devices for raw in messages[device]]
+            lengths = np.fromiter((len(raw.timestamp) for raw in raws), np.int64, len(raws))
+            counts = np.fromiter((sum(len(raw.timestamp) for raw in messages[device])
+                                  for device in devices), np.int64, len(devices))
+            timestamps = np.concatenate([raw.timestamp for raw in raws]).astype(np.int64)
+            values = np.stack([np.concatenate([raw.columns[name] for raw in raws])
+                               for name in COLUMNS]).astype(np.float32)
+            jobs.append(pool.submit(devices, counts, timestamps, values))
+            anchors = np.fromiter((int(raw.received * 1000) - int(raw.timestamp[-1])
+                                   for raw in raws), np.int64, len(raws))
+            for device in devices:
+                last = messages[device][-1]
+                self._anchor[device] = int(last.received * 1000) - int(last.timestamp[-1])
+            if self.raw is not None:
+                temperature = np.concatenate([raw.temperature for raw in raws]).astype(np.float32)
+                self._add_raw(devices, counts, timestamps + np.repeat(anchors, lengths),
+                              values, temperature)
+        for job in jobs:
+            for device, columns in VibrationPool.collect(job).items():
+                columns["timestamp"] = _monotonic(self._last, device,
+                                                  columns["timestamp"] + self._anchor[device])
+                self.rows.add(device, columns)
+
+    def _add_raw(self, devices, counts, timestamps, values, temperature):
+        for device, end, count in zip(devices, np.cumsum(counts).tolist(), counts.tolist()):
+            run = slice(end - count, end)
+            # Board times rise within a message, so clamping to the running
+            # maximum is clamping each message to the end of the one before
+            stamped = np.maximum.accumulate(timestamps[run])
+            stamped = _monotonic(self._last_raw, device, stamped)
+            block = values[:, run].copy()
+            columns = {name: block[a] for a, name in enumerate(COLUMNS)}
+            self.raw.add(device, dict(columns, timestamp=stamped, temperature=temperature[run]))
+
+    # Write every buffered row and raw sample
+    def flush(self):
+        self.rows.flush()
+        if self.raw is not None:
+            self.raw.flush()
+
+    def close(self):
+        self.flush()
+        for pool in self.pools.values():
+            pool.close()
+        self.pools.clear()
+
+
+# n samples per device of boards shaking at their own frequency on one axis,
+# plus sensor noise
+def shaking_block(freqs, axes, t_ms, noise):
+    t = np.asarray(t_ms, np.float64) / 1000.0
+    values = noise[:, :, :len(t)].copy()
+    values[:, 2] += 9.80665
+    tone = 0.5 * np.sin(2 * np.pi * freqs[:, None] * t).astype(np.float32)
+    values[np.arange(len(freqs)), axes] += tone
+    return values
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import time
+
+    from scipy.signal import welch
+
+    from ingest_server import decode_raw_telemetry, raw_sinks
+    from mpu6050_fifo import encode_raw, quantize, to_si
+    from telemetry_store import TelemetryStore
+
+    parser = argparse.ArgumentParser(description="Streaming vibration analytics benchmark")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--rate", type=int, default=500)
+    parser.add_argument("--seconds", type=float, default=30.0)
+    parser.add_argument("--batch-ms", type=int, default=50, help="ingest flush interval")
+    parser.add_argument("--message-ms", type=int, default=100,
+                        help="interval of each board's raw messages, for the sink run")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--store", help="also append the rows to <store>/vibration")
+    args = parser.parse_args()
+
+    # The Welch estimate of a row is scipy's over the same samples
+    analyzer = VibrationAnalyzer(rate_hz=500, segment=256, hop=64, report=6)
+    rng = np.random.default_rng(1)
+    n = 256 + 5 * 64
+    signal = rng.normal(0, 1, (len(COLUMNS), n)) + np.sin(2 * np.pi * 37.3 * np.arange(n) / 500)
+    rows = {}
+    for offset in range(0, n, 50):
+        analyzer.push("ref", 1000 + np.arange(offset, min(offset + 50, n)) * 2,
+                      dict(zip(COLUMNS, signal[:, offset:offset + 50])))
+        rows.update(analyzer.process())
+    freqs, expected = welch(signal.astype(np.float32), 500, nperseg=256, noverlap=192)
+    assert np.allclose(analyzer.psd[0], expected, rtol=1e-4, atol=1e-9)
+    assert rows["ref"]["timestamp"][0] == 1000 + (n - 1) * 2
+    centered = signal.astype(np.float32) - signal.astype(np.float32).mean(axis=1, keepdims=True)
+    assert np.allclose(rows["ref"]["gyro_z_rms"][0], np.sqrt(np.mean(centered[5] ** 2)), rtol=0.05)
+    assert np.all(np.abs(np.array([rows["ref"][f"{a}_peak_hz"][0] for a in COLUMNS]) - 37.3) < 1.0)
+
+    # Runs of different lengths in one push_runs() land where a push per
+    # device puts them
+    each, runs = (VibrationAnalyzer(rate_hz=500, segment=256, hop=64, report=2) for _ in range(2))
+    at = {"a": 0, "b": 0}
+    for i in range(n // 40):
+        counts = {"a": min(40, n - at["a"]), "b": min(13 + 11 * (i % 3), n - at["b"])}
+        parts = {device: slice(at[device], at[device] + count) for device, count in counts.items()}
+        for device, part in parts.items():
+            each.push(device, 1000 + np.arange(n)[part] * 2, dict(zip(COLUMNS, signal[:, part])))
+        runs.push_runs(list(parts), list(counts.values()),
+                       np.concatenate([1000 + np.arange(n)[part] * 2 for part in parts.values()]),
+                       np.concatenate([signal[:, part] for part in parts.values()], axis=1))
+        expected, got = each.process(), runs.process()
+        assert expected.keys() == got.keys()
+        for device in got:
+            assert all(np.array_equal(got[device][k], expected[device][k]) for k in got[device])
+        for device, count in counts.items():
+            at[device] += count
+
+    # Raw messages through the ingest decoder and VibrationSink into both stores
+    with tempfile.TemporaryDirectory() as root:
+        sink = raw_sinks(root, args.workers)
+        t = np.arange(512 + 7 * 256)
+        tone = dict(zip(COLUMNS, rng.normal(0, 0.05, (len(COLUMNS), len(t)))))
+        tone["acc_z"] = tone["acc_z"] + 9.80665 + 2.0 * np.sin(2 * np.pi * 61.0 * t / 500)
+        frames = quantize(tone)
+        # Two messages of 37 samples per commit
+        batch = []
+        for offset in range(0, len(t), 37):
+            payload = encode_raw(500, 81234 + 2 * offset, frames[offset:offset + 37])
+            batch += decode_raw_telemetry("bench", payload, 1_750_000_000 + offset / 500)
+            if len(batch) == 2:
+                sink(batch)
+                batch = []
+        sink(batch)
+        sink.close()
+        raw = sink.raw_store.read("bench")
+        assert len(raw["timestamp"]) == len(t) and np.all(np.diff(raw["timestamp"]) >= 0)
+        assert np.allclose(raw["acc_z"], to_si(frames)[0]["acc_z"])
+        rows = sink.store.read("bench")
+        assert len(rows["timestamp"]) == 1 and abs(rows["acc_z_peak_hz"][0] - 61.0) < 1.0
+
+    devices = [f"device-{i:04d}" for i in range(args.devices)]
+    freqs = rng.uniform(3, args.rate / 2 - 20, args.devices)
+    axes = rng.integers(0, len(COLUMNS), args.devices)
+    step = args.rate * args.batch_ms // 1000
+    noise = rng.normal(0, 0.05, (args.devices, len(COLUMNS), step)).astype(np.float32)
+    t0 = 1_750_000_000_000
+    batches = int(args.seconds * 1000 / args.batch_ms)
+
+    # The pool gives the same rows as one analyzer on a short run
+    sample = VibrationAnalyzer(args.rate)
+    pool = VibrationPool(args.workers, rate_hz=args.rate)
+    pool.step([], np.zeros(0, np.int64), np.zeros((0, len(COLUMNS), 0), np.float32))
+    check = {}
+    for b in range(3 * 512 // step):
+        t = t0 + (b * step + np.arange(step)) * 1000 // args.rate
+        block = shaking_block(freqs[:50], axes[:50], t, noise[:50])
+        sample.push_block(devices[:50], t, block)
+        expected = sample.process()
+        got = pool.step(devices[:50], t, block)
+        assert expected.keys() == got.keys()
+        for device in got:
+            assert all(np.array_equal(got[device][k], expected[device][k]) for k in got[device])
+        check.update(got)
+    pool.close()
+
+    pool = VibrationPool(args.workers, rate_hz=args.rate)
+    store = TelemetryStore(os.path.join(args.store, "vibration"), VIBRATION_SCHEMA) \
+        if args.store else None
+    written = 0
+    busy = 0.0
+    latest = {}
+    for b in range(batches):
+        t = t0 + (b * step + np.arange(step)) * 1000 // args.rate
+        block = shaking_block(freqs, axes, t, noise)
+        began = time.perf_counter()
+        rows = pool.step(devices, t, block)
+        busy += time.perf_counter() - began
+        latest.update(rows)
+        for device, columns in rows.items():
+            written += len(columns["timestamp"])
+            if store is not None:
+                store.append(device, columns)
+    samples = args.devices * batches * step
+    print(f"{args.devices} devices x {args.rate} Hz, {len(pool.shards)} workers: "
+          f"{samples / busy / 1e6:.2f}M samples/s per axis, {args.seconds / busy:.1f}x real time, "
+          f"{written:,} rows")
+    f, psd = pool.spectrum(devices[0])
+    pool.close()
+
+    error = np.array([latest[d][f"{COLUMNS[a]}_peak_hz"][-1] - freqs[i]
+                      for i, (d, a) in enumerate(zip(devices, axes)) if d in latest])
+    print(f"dominant frequency error: median {np.median(np.abs(error)):.3f} Hz, "
+          f"max {np.max(np.abs(error)):.3f} Hz (bins of {args.rate / 512:.2f} Hz)")
+    assert len(latest) == args.devices
+    assert np.max(np.abs(error)) < args.rate / 512
+    assert abs(f[np.argmax(psd[COLUMNS[axes[0]]][1:]) + 1] - freqs[0]) <= args.rate / 512
+
+    # The ingest path: every board's raw messages, message_ms apart and
+    # spread over the commits, through VibrationSink into the vibration and
+    # raw stores. Closing it, which writes what is still buffered, counts.
+    from ingest_server import RawImuBatch
+
+    per_message = args.rate * args.message_ms // 1000
+    stagger = max(args.message_ms // args.batch_ms, 1)
+    noise = rng.normal(0, 0.05, (args.devices, len(COLUMNS), per_message))
+    temperature = np.full(per_message, 25.0)
+    with tempfile.TemporaryDirectory() as root:
+        sink = raw_sinks(root, args.workers)
+        busy = 0.0
+        for b in range(batches):
+            batch = []
+            for i in range(b % stagger, args.devices, stagger):
+                first = (b // stagger) * per_message
+                millis = 81234 + (first + np.arange(per_message)) * 1000 // args.rate
+                values = shaking_block(freqs[i:i + 1], axes[i:i + 1], millis, noise[i:i + 1])[0]
+                batch.append(RawImuBatch(devices[i], args.rate, millis, dict(zip(COLUMNS, values)),
+                                         temperature, (t0 + b * args.batch_ms) / 1000))
+            began = time.perf_counter()
+            sink(batch)
+            busy += time.perf_counter() - began
+        began = time.perf_counter()
+        sink.close()
+        closing = time.perf_counter() - began
+        busy += closing
+        stored = sum(sink.raw_store.count(device) for device in devices)
+        print(f"VibrationSink, {args.devices} devices x {args.rate} Hz in "
+              f"{args.message_ms} ms messages with the raw store: "
+              f"{args.seconds / busy:.2f}x real time ({closing:.2f} s of it closing), "
+              f"{stored:,} raw samples stored")
+        assert stored == args.devices * (batches // stagger) * per_message
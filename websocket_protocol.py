@@ -0,0 +1,137 @@
+# Minimal RFC 6455 WebSocket codec
+#
+# Covers what the dashboard's live stream needs: the HTTP upgrade handshake,
+# unfragmented text frames, ping/pong and close, in both directions (browser
+# frames are masked, server frames are not). Shared by live_stream.py and
+# its load generator.
+
+import base64
+import hashlib
+import os
+import struct
+
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+# Close codes
+NORMAL_CLOSURE = 1000
+GOING_AWAY = 1001
+PROTOCOL_ERROR = 1002
+MESSAGE_TOO_BIG = 1009
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC11D65"
+
+MAX_HEADER_BYTES = 8192
+# Browsers only send subscription requests, so this stays small
+MAX_MESSAGE_SIZE = 1 << 16
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + GUID).encode()).digest()).decode()
+
+
+# Read an HTTP request head -> (method, path, {lowercase header: value})
+async def read_request(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    if len(head) > MAX_HEADER_BYTES:
+        raise ProtocolError("request head too large")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, path, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise ProtocolError(f"malformed request line {lines[0]!r}") from None
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return method, path, headers
+
+
+# Handshake response for an upgrade request, or None if it is not one
+def handshake_response(headers):
+    key = headers.get("sec-websocket-key")
+    if (key is None or headers.get("upgrade", "").lower() != "websocket"
+            or "upgrade" not in headers.get("connection", "").lower()):
+        return None
+    return ("HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept_key(key)}\r\n\r\n").encode()
+
+
+def http_error(status, reason, body=""):
+    body = body.encode()
+    return (f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n").encode() + body
+
+
+# Client side: request head for path, and the key the reply must answer
+def handshake_request(host, path):
+    key = base64.b64encode(os.urandom(16)).decode()
+    return (f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n").encode(), key
+
+
+def _mask(payload, key):
+    if not payload:
+        return payload
+    # XOR as one big integer instead of byte by byte
+    repeated = (key * (len(payload) // 4 + 1))[:len(payload)]
+    masked = int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")
+    return masked.to_bytes(len(payload), "big")
+
+
+def encode_frame(opcode, payload=b"", mask=False):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    length = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, mask_bit | length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, mask_bit | 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, mask_bit | 127, length)
+    if mask:
+        key = os.urandom(4)
+        return header + key + _mask(payload, key)
+    return header + payload
+
+
+def encode_close(code=NORMAL_CLOSURE, reason="", mask=False):
+    return encode_frame(CLOSE, struct.pack("!H", code) + reason.encode(), mask)
+
+
+# Read one frame from an asyncio StreamReader -> (opcode, payload).
+# Fragmented messages are refused; nothing in this protocol needs them.
+async def read_frame(reader, max_size=MAX_MESSAGE_SIZE):
+    first, second = await reader.readexactly(2)
+    opcode = first & 0x0F
+    if not first & 0x80 or opcode == CONTINUATION:
+        raise ProtocolError("fragmented messages are not supported")
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", await reader.readexactly(8))
+    if length > max_size:
+        raise ProtocolError(f"frame of {length} bytes exceeds limit")
+    key = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length) if length else b""
+    if key is not None:
+        payload = _mask(payload, key)
+    return opcode, payload
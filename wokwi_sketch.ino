@@ -13,16 +13,35 @@
 #define SCREEN_WIDTH 128
 #define SCREEN_HEIGHT 64
 #define OLED_RESET -1
+#define OLED_ADDRESS 0x3C
 
 Adafruit_MPU6050 mpu;
 Adafruit_SSD1306 display(SCREEN_WIDTH, SCREEN_HEIGHT, &Wire, OLED_RESET);
 
+sensors_event_t a, g, temp;
 float roll = 0, pitch = 0, yaw = 0;
+float temperature = 0;
 float AccErrorX = 0, AccErrorY = 0;
 float GyroErrorX = 0, GyroErrorY = 0, GyroErrorZ = 0;
 unsigned long previousTime = 0;
+float elapsedTime = 0;
 float alpha = 0.96;
 
+// Dirty-region display: the panel's last known contents, one byte per
+// 8-pixel column of a page, and the fields redrawn when their text changes
+#define OLED_CHUNK 127 // Data bytes per I2C write; ESP32's Wire buffer is 128
+uint8_t oledShown[SCREEN_WIDTH * SCREEN_HEIGHT / 8];
+bool displayDirty = false;
+
+struct DisplayField {
+  int16_t x, y, w, h;
+  char text[24];
+};
+DisplayField rollField = {42, 15, 86, 8};
+DisplayField pitchField = {42, 25, 86, 8};
+DisplayField yawField = {42, 35, 86, 8};
+DisplayField accelField = {42, 50, 86, 8};
+
 void setup() {
   Serial.begin(115200);
   Wire.begin();
@@ -36,7 +55,7 @@ void setup() {
   mpu.setGyroRange(MPU6050_RANGE_500_DEG);
   mpu.setFilterBandwidth(MPU6050_BAND_21_HZ);
 
-  if(!display.begin(SSD1306_SWITCHCAPVCC, 0x3C)) {
+  if(!display.begin(SSD1306_SWITCHCAPVCC, OLED_ADDRESS)) {
     Serial.println(F("SSD1306 allocation failed"));
     for(;;);
   }
@@ -51,27 +70,56 @@ void setup() {
   display.println("to change values!");
   display.display();
   delay(3000);
+  drawDisplayChrome();
 
   Serial.println("System Ready - Click MPU6050 to interact!");
   previousTime = millis();
 }
 
 void loop() {
-  sensors_event_t a, g, temp;
-  mpu.getEvent(&a, &g, &temp);
-
   unsigned long currentTime = millis();
-  float elapsedTime = (currentTime - previousTime) / 1000.0;
+  elapsedTime = (currentTime - previousTime) / 1000.0;
   previousTime = currentTime;
 
+  updateOrientation();
+
+  // Update display
+  updateDisplay();
+
+  // Serial output
+  Serial.print("Roll: "); Serial.print(roll, 2);
+  Serial.print("° | Pitch: "); Serial.print(pitch, 2);
+  Serial.print("° | Yaw: "); Serial.print(yaw, 2);
+  Serial.println("°");
+
+  delay(50);
+}
+
+// Accelerometer tilt angles and gyro rates in degrees
+float accelRoll(float x, float y, float z) {
+  return atan(y / sqrt(pow(x, 2) + pow(z, 2))) * 180 / PI;
+}
+
+float accelPitch(float x, float y, float z) {
+  return atan(-1 * x / sqrt(pow(y, 2) + pow(z, 2))) * 180 / PI;
+}
+
+float toDegrees(float radians) {
+  return radians * 180 / PI;
+}
+
+void updateOrientation() {
+  mpu.getEvent(&a, &g, &temp);
+  temperature = temp.temperature;
+
   // Calculate angles from accelerometer
-  float accAngleX = (atan(a.acceleration.y / sqrt(pow(a.acceleration.x, 2) + pow(a.acceleration.z, 2))) * 180 / PI);
-  float accAngleY = (atan(-1 * a.acceleration.x / sqrt(pow(a.acceleration.y, 2) + pow(a.acceleration.z, 2))) * 180 / PI);
+  float accAngleX = accelRoll(a.acceleration.x, a.acceleration.y, a.acceleration.z);
+  float accAngleY = accelPitch(a.acceleration.x, a.acceleration.y, a.acceleration.z);
 
   // Get gyroscope data in degrees/sec
-  float GyroX = g.gyro.x * 180 / PI;
-  float GyroY = g.gyro.y * 180 / PI;
-  float GyroZ = g.gyro.z * 180 / PI;
+  float GyroX = toDegrees(g.gyro.x);
+  float GyroY = toDegrees(g.gyro.y);
+  float GyroZ = toDegrees(g.gyro.z);
 
   // Integrate gyroscope
   float gyroAngleX = roll + GyroX * elapsedTime;
@@ -81,8 +129,71 @@ void loop() {
   // Apply complementary filter
   roll = alpha * gyroAngleX + (1 - alpha) * accAngleX;
   pitch = alpha * gyroAngleY + (1 - alpha) * accAngleY;
+}
 
-  // Update display
+// Redraw a field only if its text changed
+void drawField(DisplayField& field, const char* text) {
+  if (strcmp(field.text, text) == 0) {
+    return;
+  }
+  strncpy(field.text, text, sizeof(field.text) - 1);
+  display.fillRect(field.x, field.y, field.w, field.h, BLACK);
+  display.setCursor(field.x, field.y);
+  display.print(text);
+  displayDirty = true;
+}
+
+// Push the whole framebuffer and remember it as the panel contents
+void pushFullFrame() {
+  display.display();
+  memcpy(oledShown, display.getBuffer(), sizeof(oledShown));
+}
+
+// Send only the changed span of each changed page
+void pushDirtyPages() {
+  if (!displayDirty) {
+    return; // Nothing visible changed, skip the frame
+  }
+  displayDirty = false;
+  uint8_t* buffer = display.getBuffer();
+  for (uint8_t page = 0; page < SCREEN_HEIGHT / 8; page++) {
+    uint8_t* row = buffer + page * SCREEN_WIDTH;
+    uint8_t* shown = oledShown + page * SCREEN_WIDTH;
+    int first = 0;
+    while (first < SCREEN_WIDTH && row[first] == shown[first]) {
+      first++;
+    }
+    if (first == SCREEN_WIDTH) {
+      continue;
+    }
+    int last = SCREEN_WIDTH - 1;
+    while (row[last] == shown[last]) {
+      last--;
+    }
+
+    // Horizontal addressing window covering just this span
+    Wire.beginTransmission(OLED_ADDRESS);
+    Wire.write((uint8_t)0x00); // Command stream
+    Wire.write((uint8_t)SSD1306_COLUMNADDR);
+    Wire.write((uint8_t)first);
+    Wire.write((uint8_t)last);
+    Wire.write((uint8_t)SSD1306_PAGEADDR);
+    Wire.write(page);
+    Wire.write(page);
+    Wire.endTransmission();
+
+    for (int column = first; column <= last; column += OLED_CHUNK) {
+      Wire.beginTransmission(OLED_ADDRESS);
+      Wire.write((uint8_t)0x40); // Data stream
+      Wire.write(row + column, min(OLED_CHUNK, last + 1 - column));
+      Wire.endTransmission();
+    }
+    memcpy(shown + first, row + first, last + 1 - first);
+  }
+}
+
+// Static labels, drawn once; updateDisplay() only redraws the values
+void drawDisplayChrome() {
   display.clearDisplay();
   display.setTextSize(1);
   display.setCursor(0, 0);
@@ -91,31 +202,31 @@ void loop() {
 
   display.setCursor(0, 15);
   display.print("Roll:  ");
-  display.print(roll, 1);
-  display.println("°");
-
   display.setCursor(0, 25);
   display.print("Pitch: ");
-  display.print(pitch, 1);
-  display.println("°");
-
   display.setCursor(0, 35);
   display.print("Yaw:   ");
-  display.print(yaw, 1);
-  display.println("°");
-
   display.setCursor(0, 50);
   display.print("Accel: ");
-  display.print(sqrt(pow(a.acceleration.x,2) + pow(a.acceleration.y,2) + pow(a.acceleration.z,2)), 1);
-  display.println(" m/s²");
 
-  display.display();
+  pushFullFrame();
+}
 
-  // Serial output
-  Serial.print("Roll: "); Serial.print(roll, 2);
-  Serial.print("° | Pitch: "); Serial.print(pitch, 2);
-  Serial.print("° | Yaw: "); Serial.print(yaw, 2);
-  Serial.println("°");
+void updateDisplay() {
+  char text[24];
 
-  delay(50);
+  snprintf(text, sizeof(text), "%.1f°", roll);
+  drawField(rollField, text);
+
+  snprintf(text, sizeof(text), "%.1f°", pitch);
+  drawField(pitchField, text);
+
+  snprintf(text, sizeof(text), "%.1f°", yaw);
+  drawField(yawField, text);
+
+  snprintf(text, sizeof(text), "%.1f m/s²",
+           sqrt(pow(a.acceleration.x,2) + pow(a.acceleration.y,2) + pow(a.acceleration.z,2)));
+  drawField(accelField, text);
+
+  pushDirtyPages();
 }
\ No newline at end of file